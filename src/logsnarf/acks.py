@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_acks -*-
+# pylint: disable=invalid-name
+"""Committing offsets once their rows are uploaded.
+
+Offsets into log files used to be saved as soon as lines were handed to the
+uploader, so rows still buffered, being post-processed, or being uploaded
+were lost if logsnarf stopped. That meant keeping ``max_buffer`` small.
+
+With an :py:class:`AckTracker` shared between
+:py:class:`logsnarf.snarf.LogSnarf` and
+:py:class:`logsnarf.uploader.BigQueryUploader`, each write to the uploader
+is given a mark, a sequence number, which is held until every row loaded
+from it has been accepted by BigQuery, synced to disk in a closed bulk load
+spool file, or written to the failed loglines file. Lines that are filtered out, or don't load,
+are done with straight away. The watermark is the highest mark which,
+with every mark before it, is done. LogSnarf saves a file's offset only
+once the watermark has passed the mark of the last line read up to it.
+
+After a crash, lines from the last saved offset on are read again. Their
+rows have the same insertId as before, if the schema derives one from the
+line, so BigQuery drops those it already has.
+"""
+
+import collections
+
+
+class AckTracker(object):
+    """Marks writes, and tracks which are done with."""
+
+    def __init__(self):
+        self._next = 0
+        # mark: rows, and writes or batches in progress, holding it
+        self._holds = {}
+        # marks in the order they were made, done ones left to be popped
+        self._order = collections.deque()
+        self.watermark = -1
+        self._callbacks = []
+
+    def __len__(self):
+        return len(self._holds)
+
+    @property
+    def last(self):
+        """The most recent mark, or -1 if there are none yet."""
+        return self._next - 1
+
+    def addCallback(self, callback):
+        """Call callback with the watermark whenever it advances.
+
+        :param callback: a callable taking the new watermark
+        :type callback: callable
+        """
+        self._callbacks.append(callback)
+
+    def mark(self):
+        """Make a new mark, held once.
+
+        :return: the mark
+        :rtype: int
+        """
+        m = self._next
+        self._next += 1
+        self._holds[m] = 1
+        self._order.append(m)
+        return m
+
+    def hold(self, m, n=1):
+        """Hold a mark n more times.
+
+        :param m: mark
+        :type m: int
+        :param n: number of holds
+        :type n: int
+        """
+        if n:
+            self._holds[m] += n
+
+    def release(self, m, n=1):
+        """Release n holds on a mark.
+
+        :param m: mark
+        :type m: int
+        :param n: number of holds
+        :type n: int
+        """
+        held = self._holds[m] - n
+        if held > 0:
+            self._holds[m] = held
+            return
+        del self._holds[m]
+        if m != self._order[0]:
+            return
+        order, holds = self._order, self._holds
+        while order and order[0] not in holds:
+            order.popleft()
+        self.watermark = order[0] - 1 if order else self.last
+        for callback in self._callbacks:
+            callback(self.watermark)
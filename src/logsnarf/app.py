@@ -5,6 +5,7 @@
 
 Application code to connect the various modules to do something useful..
 """
+import glob
 import os
 import sys
 import logging
@@ -13,14 +14,26 @@ import re
 from twisted.python import usage
 from twisted.internet import reactor
 from oauth2client.service_account import ServiceAccountCredentials
+import pytz
 import simplejson as json
 
+from . import acks
+from . import bulk
 from . import config
+from . import filters
+from . import listener
+from . import metrics
+from . import notifier
+from . import parsers
+from . import profiling
+from . import ratelimit
 from . import schema
 from . import service
 from . import snarf
 from . import uploader
 from . import state
+from . import supervisor
+from . import tracing
 from . import errors
 
 
@@ -28,8 +41,21 @@ class Options(usage.Options):
     optParameters = [
         ['resource_name', 'n', 'logsnarf', 'Resource name'],
         ['config_file', 'f', None, 'Config file'],
+        ['worker', None, None, 'Run only this app section, as a worker of '
+         'a supervisor'],
+        ['shard', None, '0/1', 'index/count of the shard of the app '
+         'section\'s directories to watch, as a worker'],
     ]
 
+    def postOptions(self):
+        try:
+            index, count = [int(n) for n in self['shard'].split('/')]
+        except ValueError:
+            raise usage.UsageError('shard must be index/count')
+        if not 0 <= index < count:
+            raise usage.UsageError('shard index must be below the count')
+        self['shard'] = (index, count)
+
 
 def install_custom_verifiers(sch, default_domain):
     # noinspection PyUnusedLocal
@@ -86,6 +112,220 @@ def install_schema_load_hook(sch):
     sch.setObjectLoadHook(loadHook)
 
 
+def install_parser(section, sch):
+    """Set the schema's line parser, if a format other than json is set.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :param sch: the schema
+    :type sch: logsnarf.schema.Schema
+    """
+    fmt = section['format']
+    regex = section.get('format_regex', None) or None
+    fields = section.get('format_fields', None) or None
+    try:
+        parser = parsers.build(fmt, regex,
+                               pytz.timezone(section['default_tz']))
+    except (ValueError, re.error) as e:
+        raise errors.ConfigError(str(e))
+    if parser is None:
+        return
+    if fields:
+        try:
+            fields = json.loads(fields)
+        except json.JSONDecodeError:
+            raise errors.ConfigError('format_fields must be a JSON object')
+    sch.setParser(parser, fields)
+    logging.info('Parsing lines as %s', fmt)
+
+
+def install_filters(section, name, upl):
+    """Filter lines before they're parsed, if rules are set in section.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :param name: app section name
+    :type name: str
+    :param upl: BigQuery uploader
+    :type upl: logsnarf.uploader.BigQueryUploader
+    """
+    rules = section.get('filters', None)
+    if not rules:
+        return
+    try:
+        rules = json.loads(rules)
+    except json.JSONDecodeError:
+        raise errors.ConfigError('filters must be a JSON list')
+    if not isinstance(rules, list) or not all(
+            isinstance(r, dict) for r in rules):
+        raise errors.ConfigError('filters must be a JSON list of objects')
+    try:
+        line_filter = filters.LineFilter(rules, name)
+    except ValueError as e:
+        raise errors.ConfigError(str(e))
+    upl.setLineFilter(line_filter)
+    logging.info('Filtering lines with %d rules', len(rules))
+
+
+def rate_limit_shares(cfg, section_name):
+    """How many ways a supervised worker's rate limits are split.
+
+    Rate limiters aren't shared between processes, so each worker takes a
+    share of the limits: the project limits are split between every worker
+    uploading to the project, and the table limits between the workers of
+    the section, which upload to the same tables.
+
+    :param cfg: config object
+    :type cfg: logsnarf.config.Config
+    :param section_name: the worker's app section
+    :type section_name: str
+    :return: (project share, table share)
+    :rtype: tuple(int, int)
+    """
+    apps = json.loads(cfg['logsnarf']['apps'])
+    project = cfg[section_name]['project_id']
+    project_workers = sum(supervisor.shardCount(cfg[s]) for s in apps
+                          if cfg[s]['project_id'] == project)
+    return (max(1, project_workers),
+            supervisor.shardCount(cfg[section_name]))
+
+
+def install_rate_limiter(section, svc, shares=(1, 1)):
+    """Rate limit the service's inserts, with the limits set in section.
+
+    The limiter, and so the budget, is shared by all sections uploading to
+    the same project, including those that don't set limits. Those that do
+    must all set the same ones.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :param svc: BigQuery service
+    :type svc: logsnarf.service.BigQueryService
+    :param shares: (project share, table share) to divide the limits by,
+      see :py:func:`rate_limit_shares`
+    :type shares: tuple(int, int)
+    :raises logsnarf.errors.ConfigError: if other limits are set for the
+      project
+    """
+    limits = [section.get(k, None) or None for k in (
+        'rate_limit_rows', 'rate_limit_bytes',
+        'table_rate_limit_rows', 'table_rate_limit_bytes')]
+    limiter = ratelimit.projectLimiter(svc.project)
+    svc.setRateLimiter(limiter)
+    if not any(limits):
+        return
+    limits = [float(limit) / shares[i // 2] if limit else None
+              for i, limit in enumerate(limits)]
+    try:
+        limiter.setLimits(*limits)
+    except ValueError as e:
+        raise errors.ConfigError('Sections uploading to project %s must set '
+                                 'the same rate limits: %s' % (svc.project, e))
+    logging.info('Rate limiting inserts to project %s, project rows/s: %s '
+                 'bytes/s: %s, table rows/s: %s bytes/s: %s', svc.project,
+                 *limits)
+
+
+def install_partitioning(section, svc, upl):
+    """Configure single partitioned-table mode, if enabled in section.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :param svc: BigQuery service
+    :type svc: logsnarf.service.BigQueryService
+    :param upl: BigQuery uploader
+    :type upl: logsnarf.uploader.BigQueryUploader
+    """
+    partition_table = section.get('partition_table', None)
+    if not partition_table:
+        return
+    partition_type = section.get('partition_type', 'DAY').upper()
+    partition_field = section.get('partition_field', None) or None
+    expiration = section.get('partition_expiration', None) or None
+    clustering_fields = section.get('clustering_fields', None) or None
+    if clustering_fields:
+        try:
+            clustering_fields = json.loads(clustering_fields)
+        except json.JSONDecodeError:
+            raise errors.ConfigError('clustering_fields must be a JSON list')
+    if expiration is not None:
+        # configured in days, BigQuery wants milliseconds.
+        expiration = int(expiration * 86400 * 1000)
+    svc.setPartitioning(partition_type, partition_field, expiration,
+                        clustering_fields)
+    upl.setPartitionedTable(partition_table, partition_field, partition_type)
+    logging.info('Uploading to partitioned table %s type: %s field: %s',
+                 partition_table, partition_type, partition_field)
+
+
+def install_listener(section, name, upl):
+    """Set up a syslog network listener, if enabled in section.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :param name: app section name
+    :type name: str
+    :param upl: BigQuery uploader
+    :type upl: logsnarf.uploader.BigQueryUploader
+    :return: the listener, or None
+    :rtype: logsnarf.listener.SyslogListener
+    """
+    tcp_port = section.get('syslog_tcp_port', None)
+    udp_port = section.get('syslog_udp_port', None)
+    if not tcp_port and not udp_port:
+        return None
+    syslog = listener.SyslogListener(upl, name)
+    syslog.setMaxMessage(section['syslog_max_message'])
+    interface = section['syslog_interface']
+    if tcp_port:
+        syslog.listenTCP(tcp_port, interface)
+    if udp_port:
+        syslog.listenUDP(udp_port, interface)
+    return syslog
+
+
+def seed_state(state_object, state_path, dirs):
+    """Start a new state file with the offsets in the section's others.
+
+    When the number of workers a section is sharded over changes, the
+    shards' state files change too. Offsets for files in dirs are taken
+    from the section's other state files, the most recently saved winning.
+
+    :param state_object: the new, empty, state
+    :type state_object: logsnarf.state.State
+    :param state_path: the section's unsharded state file path
+    :type state_path: str
+    :param dirs: directories watched with this state
+    :type dirs: list(str)
+    """
+    base, ext = os.path.splitext(state_path)
+    paths = [p for p in glob.glob(glob.escape(base) + '.*of*' + ext)
+             if re.match(r'\.\d+of\d+$', p[len(base):len(p) - len(ext)])]
+    paths.append(state_path)
+    found = []
+    for path in paths:
+        try:
+            found.append((os.stat(path).st_mtime, path))
+        except OSError:
+            pass
+    prefixes = tuple(os.path.join(d, '') for d in dirs)
+    seeded = {}
+    for _, path in sorted(found):
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            logging.warning('Unable to read state file %s', path)
+            continue
+        seeded.update((name, entry) for name, entry in entries.items()
+                      if name.startswith(prefixes))
+    if seeded:
+        logging.info('Starting state file %s with %d offsets from %d other '
+                     'state files', state_object.state_path, len(seeded),
+                     len(found))
+        state_object.update(seeded)
+
+
 class App(object):
     """Logsnarf application class.
 
@@ -96,7 +336,9 @@ class App(object):
     Currently a logsnarf.App contains three main components.
 
     logsnarf.snarf.Logsnarf - Monitors directories for log updates, feeds them
-            linewise to the next in the chain.
+            linewise to the next in the chain. Alongside or instead of it,
+            logsnarf.listener.SyslogListener receives syslog messages over
+            the network.
 
     logsnarf.uploader.BigQueryUploader - Receieves lines from Logsnarf,
         pushes them through the logsnarf.schema.Schema object for
@@ -109,9 +351,13 @@ class App(object):
     logsnarf.service.BigQueryService - Encapsulates a standard googleapi
             BigQueryService along with our project/dataset information and
             credentials.
+
+    Apps in one process share an inotify file descriptor, see
+    logsnarf.notifier, and the connections of apps uploading to the same
+    project with the same credentials, see logsnarf.service.
     """
 
-    def __init__(self, cfg, section_name):
+    def __init__(self, cfg, section_name, shard=None):
         """
 
         :param cfg: config object
@@ -119,6 +365,10 @@ class App(object):
         :param section_name: section name from the config that tells us what
           to do
         :type section_name: str
+        :param shard: (index, count), to watch only every count'th of the
+          section's directories, starting at index, with files of our own.
+          See :py:mod:`logsnarf.supervisor`.
+        :type shard: tuple(int, int)
         """
         self.cfg = cfg
         self.section = section = cfg[section_name]
@@ -130,38 +380,112 @@ class App(object):
             section['project_id'],
             section['dataset'],
             creds, debug=True)
+        svc.setConnectionPool(service.connectionPool(
+            section['project_id'], creds,
+            (section['service_email'], section['keyfile']), debug=True))
+        compression_level = int(section.get('compression_level', 0))
+        if compression_level:
+            svc.setCompression(compression_level,
+                               section.get('compression_threshold', 1024))
+        shares = (1, 1)
+        if shard is not None:
+            shares = rate_limit_shares(cfg, section_name)
+        install_rate_limiter(section, svc, shares)
         default_tz = section.get('default_tz', 'UTC')
         default_domain = section.get('default_domain', None)
         schema_file = cfg.openConfigFile(section['schema_file'], 'rb')
         schema_obj = schema.Schema(schema_file, default_tz)
         install_schema_load_hook(schema_obj)
         install_custom_verifiers(schema_obj, default_domain)
+        install_parser(section, schema_obj)
 
         table_name_fmt = section.get('table_name_fmt', None)
         upl = uploader.BigQueryUploader(schema_obj, svc, table_name_fmt)
+        upl.setName(section_name)
         if 'batchsize' in section:
             upl.setBatchSize(section['batchsize'])
         if 'max_buffer' in section:
             upl.setMaxBuffer(section['max_buffer'])
         if 'flush_interval' in section:
             upl.setFlushInterval(section['flush_interval'])
+        if 'bisect_max_requests' in section:
+            upl.setBisectLimit(section['bisect_max_requests'])
         upl.setDefaultTZ(default_tz)
+        install_partitioning(section, svc, upl)
+        install_filters(section, section_name, upl)
+        trace_sample_rate = float(section['trace_sample_rate'])
+        if trace_sample_rate:
+            tracer = tracing.Tracer(
+                cfg.saveDataPath(supervisor.shardPath(section['trace_file'],
+                                                      shard)),
+                trace_sample_rate)
+            upl.setTracer(tracer)
+            svc.setTracer(tracer)
+        bulk_threshold = section.get('bulk_threshold', None)
+        if bulk_threshold:
+            loader = bulk.BulkLoader(
+                svc, schema_obj.schema,
+                cfg.saveDataPath(supervisor.shardPath(section['bulk_dir'],
+                                                      shard)))
+            loader.setMaxRows(section['bulk_max_rows'])
+            loader.setMaxAge(section['bulk_max_age'])
+            if compression_level:
+                loader.setCompressionLevel(compression_level)
+            upl.setBulkLoader(loader, bulk_threshold)
+            logging.info('Bulk loading files more than %d bytes behind',
+                         bulk_threshold)
 
-        state_path = cfg.saveConfigPath(section['state_file'])
-        state_object = state.State(state_path)
+        self.listener = None
+        if shard is None or shard[0] == 0:
+            self.listener = install_listener(section, section_name, upl)
+        self.snarfer = None
+        self.schema = schema_obj
+        self.service = svc
+        self.uploader = upl
 
         dirs = section.get('directories', None)
         if dirs is None:
-            logging.fatal('No directories configured in section %s',
-                          section_name)
+            if self.listener is not None:
+                return
+            logging.fatal('No directories or syslog ports configured in '
+                          'section %s', section_name)
             sys.exit(1)
         else:
             dirs = json.loads(dirs)
+        if shard is not None:
+            dirs = dirs[shard[0]::shard[1]]
+        state_path = cfg.saveConfigPath(section['state_file'])
+        shard_state_path = supervisor.shardPath(state_path, shard)
+        new_state = not os.path.exists(shard_state_path)
+        state_object = state.State(shard_state_path)
+        if new_state:
+            seed_state(state_object, state_path, dirs)
         pattern = section.get('pattern', None)
         if pattern is not None:
             pattern = re.compile(pattern)
         recursive = section.get('recursive', True)
-        snarfer = snarf.LogSnarf(state_object, upl)
+        snarfer = snarf.LogSnarf(state_object, upl,
+                                 notifier_obj=notifier.sharedNotifier())
+        if section['commit_after_upload']:
+            tracker = acks.AckTracker()
+            upl.setAckTracker(tracker)
+            snarfer.setAckTracker(tracker)
+        snarfer.lag_interval = section['lag_interval']
+        snarfer.setMaxOpenFiles(section['max_open_files'])
+        snarfer.setCoalescing(float(section['coalesce_window']),
+                              float(section['coalesce_max_delay']))
+        watcher = section['watcher']
+        if watcher not in snarf.WATCHERS:
+            raise errors.ConfigError('watcher must be one of %s, not %s' % (
+                snarf.WATCHERS, watcher))
+        snarfer.setPolling(float(section['poll_min_interval']),
+                           float(section['poll_max_interval']))
+        snarfer.setWatchBudget(section['max_watches'],
+                               float(section['watch_cold_after']))
+        snarfer.lag.setSnapshotPath(cfg.saveDataPath(
+            supervisor.shardPath(section['lag_file'], shard)))
+        if bulk_threshold:
+            snarfer.setLagCallback(upl.setLag)
         if pattern:
             logging.info(
                 'Setting up Snarfer to watch directories %s '
@@ -171,14 +495,49 @@ class App(object):
                 'Setting up Snarfer to watch directories %s recursive: %s',
                 dirs, recursive)
         for d in dirs:
-            snarfer.watch(d, pattern, recursive)
+            snarfer.watch(d, pattern, recursive, watcher)
         self.snarfer = snarfer
-        self.schema = schema_obj
-        self.service = svc
-        self.uploader = upl
 
     def start(self):
-        self.snarfer.start()
+        if self.snarfer is not None:
+            self.snarfer.start()
+        if self.listener is not None:
+            self.listener.start()
+
+
+def run_supervisor(cfg, sections, config_apps, opts):
+    """Run each app section, or shard of one, in a worker process.
+
+    :param cfg: config object
+    :type cfg: logsnarf.config.Config
+    :param sections: the logsnarf section
+    :type sections: logsnarf.config.ConfigSection
+    :param config_apps: app section names
+    :type config_apps: list(str)
+    :param opts: our command line options, passed on to the workers
+    :type opts: Options
+    """
+    workers = []
+    for s in config_apps:
+        count = supervisor.shardCount(cfg[s])
+        for index in range(count):
+            shard = (index, count)
+            workers.append((supervisor.workerName(s, shard),
+                            supervisor.workerArgs(s, shard,
+                                                  opts['resource_name'],
+                                                  opts['config_file'])))
+    sup = supervisor.Supervisor(workers)
+    metrics_port = sections.get('metrics_port', None)
+    if metrics_port:
+        metrics.listen(metrics_port, sections['metrics_interface'],
+                       registry=sup)
+    sup.installSignalHandlers()
+    # noinspection PyUnresolvedReferences
+    reactor.callWhenRunning(sup.start)
+    # noinspection PyUnresolvedReferences
+    reactor.addSystemEventTrigger('before', 'shutdown', sup.stop)
+    # noinspection PyUnresolvedReferences
+    reactor.run()
 
 
 def main():
@@ -200,13 +559,27 @@ def main():
             config_apps = json.loads(sections['apps'])
         except json.JSONDecodeError:
             raise errors.ConfigError('No valid apps section in configuration')
-    apps = []
     for s in config_apps:
         if s not in cfg.keys():
             raise errors.ConfigError('Application section %s referenced but '
                                      'does not exist. %s', s, sections)
-        else:
-            apps.append(App(cfg, s))
+    metrics_port = sections.get('metrics_port', None)
+    if opts['worker'] is None and sections['supervise']:
+        run_supervisor(cfg, sections, config_apps, opts)
+        return
+    if opts['worker'] is not None:
+        if opts['worker'] not in config_apps:
+            raise errors.ConfigError('Worker for section %s, which is not '
+                                     'in apps' % opts['worker'])
+        supervisor.connectSupervisor()
+    elif metrics_port:
+        metrics.listen(metrics_port, sections['metrics_interface'])
+    profiler = profiling.Profiler(cfg.saveDataPath(), sections['profile_mode'])
+    profiling.installSignalHandlers(profiler, sections['profile_seconds'])
+    if opts['worker'] is not None:
+        apps = [App(cfg, opts['worker'], opts['shard'])]
+    else:
+        apps = [App(cfg, s) for s in config_apps]
     for app in apps:
         app.start()
 
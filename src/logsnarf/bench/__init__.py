@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Logsnarf benchmarks.
+
+ * :py:mod:`logsnarf.bench.generator` writes rsyslog style JSON logs at a
+   controlled rate.
+ * :py:mod:`logsnarf.bench.fakeservice` stands in for BigQuery, either in
+   process in place of :py:class:`logsnarf.service.BigQueryService`, or over
+   HTTP behind the real service.
+ * :py:mod:`logsnarf.bench.harness` runs the real LogSnarf, Schema and
+   BigQueryUploader pipeline between the two, and reports throughput,
+   latency and resource usage. It's installed as ``logsnarf-bench``.
+ * :py:mod:`logsnarf.bench.micro` times the schema layer's per-line hot
+   paths. It's installed as ``logsnarf-microbench``.
+ * :py:mod:`logsnarf.bench.watch` measures the CPU cost of polling a large
+   tree of log files. It's installed as ``logsnarf-watchbench``.
+"""
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bench -*-
+# pylint: disable=invalid-name
+"""BigQuery stand-ins.
+
+:py:class:`FakeBigQueryService` replaces
+:py:class:`logsnarf.service.BigQueryService` in process, so only the
+pipeline in front of the service is measured. :py:class:`FakeBigQueryResource`
+is a :twisted:`twisted.web.resource.Resource` serving just enough of the
+BigQuery REST API, including its discovery document, for the real service to
+talk to it over HTTP, so request building, serialization, compression and
+the worker threads are measured too. The service makes some blocking calls
+from the reactor thread, so the HTTP stand-in has to run in another process::
+
+    python -m logsnarf.bench.fakeservice --latency 0.2 --error-rate 0.01
+
+Both take a configurable latency and can inject whole-request failures and
+per-row ``backendError`` insert errors. Accepted rows are handed to a
+:py:class:`Sink`, which records end to end latency from each row's ``time``
+field.
+"""
+
+import gzip
+import random
+import sys
+import time
+
+import httplib2
+import simplejson as json
+from googleapiclient import errors as gerrors
+from twisted.internet import task
+from twisted.python import usage
+from twisted.web import resource
+from twisted.web import server
+
+DISCOVERY_PATH = 'discovery/{api}/{apiVersion}'
+
+_PATH_PARAM = {'type': 'string', 'required': True, 'location': 'path'}
+
+DISCOVERY = {
+    'kind': 'discovery#restDescription',
+    'discoveryVersion': 'v1',
+    'id': 'bigquery:v2',
+    'name': 'bigquery',
+    'version': 'v2',
+    'protocol': 'rest',
+    'servicePath': 'bigquery/v2/',
+    'parameters': {},
+    'schemas': {
+        'Table': {'id': 'Table', 'type': 'object'},
+        'TableList': {
+            'id': 'TableList',
+            'type': 'object',
+            'properties': {
+                'nextPageToken': {'type': 'string'},
+                'tables': {'type': 'array', 'items': {'type': 'object'}},
+            },
+        },
+        'TableDataInsertAllRequest': {
+            'id': 'TableDataInsertAllRequest', 'type': 'object'},
+        'TableDataInsertAllResponse': {
+            'id': 'TableDataInsertAllResponse', 'type': 'object'},
+    },
+    'resources': {
+        'tables': {'methods': {
+            'list': {
+                'id': 'bigquery.tables.list',
+                'path': 'projects/{projectId}/datasets/{datasetId}/tables',
+                'httpMethod': 'GET',
+                'parameters': {
+                    'projectId': _PATH_PARAM,
+                    'datasetId': _PATH_PARAM,
+                    'pageToken': {'type': 'string', 'location': 'query'},
+                },
+                'parameterOrder': ['projectId', 'datasetId'],
+                'response': {'$ref': 'TableList'},
+            },
+            'insert': {
+                'id': 'bigquery.tables.insert',
+                'path': 'projects/{projectId}/datasets/{datasetId}/tables',
+                'httpMethod': 'POST',
+                'parameters': {
+                    'projectId': _PATH_PARAM,
+                    'datasetId': _PATH_PARAM,
+                },
+                'parameterOrder': ['projectId', 'datasetId'],
+                'request': {'$ref': 'Table'},
+                'response': {'$ref': 'Table'},
+            },
+        }},
+        'tabledata': {'methods': {
+            'insertAll': {
+                'id': 'bigquery.tabledata.insertAll',
+                'path': 'projects/{projectId}/datasets/{datasetId}/tables/'
+                        '{tableId}/insertAll',
+                'httpMethod': 'POST',
+                'parameters': {
+                    'projectId': _PATH_PARAM,
+                    'datasetId': _PATH_PARAM,
+                    'tableId': _PATH_PARAM,
+                },
+                'parameterOrder': ['projectId', 'datasetId', 'tableId'],
+                'request': {'$ref': 'TableDataInsertAllRequest'},
+                'response': {'$ref': 'TableDataInsertAllResponse'},
+            },
+        }},
+    },
+}
+
+
+def percentile(values, p):
+    """Nearest rank percentile of a sorted list.
+
+    :param values: sorted values
+    :type values: list(float)
+    :param p: percentile, 0-100
+    :type p: float
+    :rtype: float
+    """
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+
+class Sink(object):
+    """Counts accepted rows, and their end to end latency."""
+
+    def __init__(self):
+        self.rows = 0
+        self.requests = 0
+        self.failed_requests = 0
+        self.failed_rows = 0
+        self.latencies = []
+
+    def record(self, rows, now=None):
+        """Record rows accepted by the stand-in.
+
+        :param rows: insertAll rows, with the log entry under 'json'
+        :type rows: list(dict)
+        :param now: time the rows were accepted, defaults to time.time()
+        :type now: float
+        """
+        now = now or time.time()
+        self.rows += len(rows)
+        for row in rows:
+            t = row['json'].get('time')
+            if t is not None:
+                self.latencies.append(now - float(t))
+
+    def latency(self, p):
+        """End to end latency percentile in seconds.
+
+        :param p: percentile, 0-100
+        :type p: float
+        """
+        self.latencies.sort()
+        return percentile(self.latencies, p)
+
+    def summary(self):
+        """Counts and latency percentiles.
+
+        :rtype: dict
+        """
+        return {
+            'rows': self.rows,
+            'requests': self.requests,
+            'failed_requests': self.failed_requests,
+            'failed_rows': self.failed_rows,
+            'latency_p50': self.latency(50),
+            'latency_p99': self.latency(99),
+            'latency_max': self.latency(100),
+        }
+
+
+class _Faults(object):
+    """Latency and error injection shared by the stand-ins."""
+
+    def __init__(self, sink, latency=0.0, jitter=0.0, error_rate=0.0,
+                 row_error_rate=0.0, seed=None, reactor=None):
+        """
+
+        :param sink: where accepted rows are recorded
+        :type sink: Sink
+        :param latency: seconds to wait before responding to an insert
+        :type latency: float
+        :param jitter: up to this many seconds are added to latency at random
+        :type jitter: float
+        :param error_rate: fraction of inserts that fail with a 503
+        :type error_rate: float
+        :param row_error_rate:
+          fraction of rows in successful inserts rejected with backendError
+        :type row_error_rate: float
+        :param seed: random seed, for repeatable faults
+        :type seed: int
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.sink = sink
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.row_error_rate = row_error_rate
+        self.random = random.Random(seed)
+
+    def delay(self):
+        return self.latency + self.random.random() * self.jitter
+
+    def respond(self, rows):
+        """Decide the outcome of an insert, recording accepted rows.
+
+        :return: the insertAll response, or None if the request should fail
+        :rtype: dict
+        """
+        self.sink.requests += 1
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.sink.failed_requests += 1
+            return None
+        accepted = []
+        insert_errors = []
+        for index, row in enumerate(rows):
+            if self.row_error_rate and \
+                    self.random.random() < self.row_error_rate:
+                insert_errors.append({
+                    'index': index,
+                    'errors': [{'reason': 'backendError', 'message': ''}],
+                })
+            else:
+                accepted.append(row)
+        self.sink.failed_rows += len(insert_errors)
+        self.sink.record(accepted)
+        result = {'kind': 'bigquery#tableDataInsertAllResponse'}
+        if insert_errors:
+            result['insertErrors'] = insert_errors
+        return result
+
+
+class FakeBigQueryService(_Faults):
+    """An in process stand-in for :py:class:`logsnarf.service.BigQueryService`.
+    """
+
+    project = 'bench'
+    dataset = 'bench'
+
+    def __init__(self, sink, **kwargs):
+        super(FakeBigQueryService, self).__init__(sink, **kwargs)
+        self.tables = {}
+        self.max_retries = 8
+
+    def updateTableList(self):
+        pass
+
+    def insertAll(self, table, table_schema, data, upload_id=None):
+        """Respond to an insert after the configured latency.
+
+        Injected failures are retried, as the real service would, up to
+        :py:attr:`max_retries` times, each after another latency.
+
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        return self._insertAll(table, data, 0)
+
+    def _insertAll(self, table, data, attempt):
+        d = task.deferLater(self.reactor, self.delay(), self._insert,
+                            table, data)
+        if attempt < self.max_retries:
+            d.addErrback(self._retry, table, data, attempt + 1)
+        return d
+
+    def _retry(self, fail, table, data, attempt):
+        fail.trap(gerrors.HttpError)
+        return self._insertAll(table, data, attempt)
+
+    def insertAll_s(self, table, table_schema, data, upload_id=None):
+        """Respond to an insert immediately, failures aren't injected."""
+        self.tables[table] = True
+        self.sink.requests += 1
+        self.sink.record(data)
+        return {'kind': 'bigquery#tableDataInsertAllResponse'}
+
+    def _insert(self, table, data):
+        self.tables[table] = True
+        result = self.respond(data)
+        if result is None:
+            raise gerrors.HttpError(
+                httplib2.Response({'status': 503}), b'{}')
+        return result
+
+
+class FakeBigQueryResource(_Faults, resource.Resource):
+    """A BigQuery REST API stand-in for the real service to talk to.
+
+    Point :py:class:`logsnarf.service.BigQueryService` at it by passing
+    :py:meth:`discoveryURL` as its discovery_url, and credentials whose
+    authorize() does nothing, such as :py:class:`NoCredentials`. A summary
+    of what the sink has received is served as JSON at ``/stats``.
+    """
+
+    isLeaf = True
+
+    def __init__(self, sink, **kwargs):
+        _Faults.__init__(self, sink, **kwargs)
+        resource.Resource.__init__(self)
+        self.tables = {}
+        self.port = None
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        """Start serving.
+
+        :param port: TCP port to listen on, 0 for any free port
+        :type port: int
+        :return: the listening port
+        :rtype: :twisted:`twisted.internet.interfaces.IListeningPort`
+        """
+        self.port = self.reactor.listenTCP(port, server.Site(self),
+                                           interface=interface)
+        return self.port
+
+    def discoveryURL(self):
+        """Discovery URL template for the port we're listening on."""
+        host = self.port.getHost()
+        return 'http://%s:%d/%s' % (host.host, host.port, DISCOVERY_PATH)
+
+    # noinspection PyPep8Naming
+    def render_GET(self, request):
+        path = request.postpath
+        if path == [b'stats']:
+            return self._json(request, self.sink.summary())
+        if path[:1] == [b'discovery']:
+            host = request.getHost()
+            doc = dict(DISCOVERY)
+            doc['rootUrl'] = 'http://%s:%d/' % (host.host, host.port)
+            return self._json(request, doc)
+        if path[-1:] == [b'tables']:
+            return self._json(request, {'tables': [
+                {'tableReference': {'tableId': t}} for t in self.tables]})
+        request.setResponseCode(404)
+        return b''
+
+    # noinspection PyPep8Naming
+    def render_POST(self, request):
+        path = request.postpath
+        body = request.content.read()
+        if request.getHeader(b'content-encoding') == b'gzip':
+            body = gzip.decompress(body)
+        body = json.loads(body)
+        if path[-1:] == [b'tables']:
+            self.tables[body['tableReference']['tableId']] = True
+            return self._json(request, body)
+        if path[-1:] == [b'insertAll']:
+            self.tables[path[-2].decode('utf-8')] = True
+            d = task.deferLater(self.reactor, self.delay(), self.respond,
+                                body['rows'])
+            d.addCallback(self._insertDone, request)
+            return server.NOT_DONE_YET
+        request.setResponseCode(404)
+        return b''
+
+    def _insertDone(self, result, request):
+        if result is None:
+            request.setResponseCode(503)
+            result = {'error': {'code': 503, 'message': 'Injected failure'}}
+        request.write(self._json(request, result))
+        request.finish()
+
+    @staticmethod
+    def _json(request, obj):
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(obj).encode('utf-8')
+
+
+class NoCredentials(object):
+    """Credentials for the HTTP stand-in, requests aren't signed."""
+
+    def authorize(self, http):
+        return http
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['port', 'p', 0, 'Port to listen on, 0 for any free port', int],
+        ['interface', 'i', '127.0.0.1', 'Address to listen on'],
+        ['latency', None, 0.0, 'Seconds to wait before responding', float],
+        ['jitter', None, 0.0, 'Random extra seconds of latency', float],
+        ['error-rate', None, 0.0, 'Fraction of inserts failing with a 503',
+         float],
+        ['row-error-rate', None, 0.0,
+         'Fraction of rows failing with backendError', float],
+        ['seed', None, None, 'Random seed', int],
+    ]
+
+
+def main():
+    """Run the HTTP stand-in, printing the port it's listening on."""
+    opts = Options()
+    try:
+        opts.parseOptions()
+    except usage.UsageError as e:
+        print("%s: %s" % (sys.argv[0], e))
+        print("%s: Try --help for usage details." % (sys.argv[0]))
+        sys.exit(1)
+    from twisted.internet import reactor
+    standin = FakeBigQueryResource(
+        Sink(), latency=opts['latency'], jitter=opts['jitter'],
+        error_rate=opts['error-rate'], row_error_rate=opts['row-error-rate'],
+        seed=opts['seed'], reactor=reactor)
+    port = standin.listen(opts['port'], opts['interface'])
+    print(port.getHost().port)
+    sys.stdout.flush()
+    # noinspection PyUnresolvedReferences
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bench -*-
+# pylint: disable=invalid-name
+"""Synthetic log generator.
+
+Writes JSON log lines shaped like those produced by the rsyslog
+configuration in :doc:`logsnarf_rsyslog`, and valid against the syslog
+schema used in the tests. Every line's ``time`` field is the time it was
+written, so whatever receives the rows can work out end to end latency.
+"""
+
+import os
+import random
+import time
+
+import simplejson as json
+from twisted.internet import task
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test',
+                           'data', 'schema', 'syslog', 'schema.json')
+
+HOSTS = ['gw', 'nas.example.com', 'ap1', 'ap2', 'printer.example.com']
+FACILITIES = ['auth', 'authpriv', 'daemon', 'kern', 'local0', 'user']
+SEVERITIES = ['debug', 'info', 'notice', 'warning', 'err']
+PROGRAMS = {
+    'sshd': [
+        'Accepted publickey for {user} from {ip} port {port} ssh2',
+        'Failed password for invalid user {user} from {ip} port {port} ssh2',
+        'Connection closed by {ip} port {port} [preauth]',
+    ],
+    'dhcpd': [
+        'DHCPREQUEST for {ip} from {mac} via eth0',
+        'DHCPACK on {ip} to {mac} via eth0',
+    ],
+    'kernel': [
+        'IN=eth0 OUT= MAC={mac} SRC={ip} DST=10.0.0.1 LEN=60 PROTO=TCP '
+        'SPT={port} DPT=22',
+    ],
+    'CRON': [
+        '({user}) CMD (run-parts /etc/cron.hourly)',
+    ],
+}
+USERS = ['root', 'admin', 'backup', 'www-data', 'git']
+
+# Seconds between writes when rate limited.
+TICK = 0.01
+# Lines per reactor iteration when not rate limited.
+CHUNK = 1000
+
+
+class LogGenerator(object):
+    """Write synthetic rsyslog JSON to files in a directory."""
+
+    def __init__(self, directory, files=1, seed=None, reactor=None):
+        """
+
+        :param directory: directory to write log files in
+        :type directory: str
+        :param files: number of files to spread lines across
+        :type files: int
+        :param seed: random seed, for repeatable output
+        :type seed: int
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.directory = directory
+        self.paths = [os.path.join(directory, 'bench%d.log' % i)
+                      for i in range(files)]
+        self.random = random.Random(seed)
+        self.written = 0
+        self.bytes_written = 0
+        self.cpu_seconds = 0.0
+        self._next_file = 0
+
+    def line(self, now=None):
+        """Return one log line, including the trailing newline.
+
+        :param now: time the line was logged, defaults to time.time()
+        :type now: float
+        :rtype: str
+        """
+        r = self.random
+        now = now or time.time()
+        program = r.choice(list(PROGRAMS))
+        msg = r.choice(PROGRAMS[program]).format(
+            user=r.choice(USERS),
+            ip='10.0.%d.%d' % (r.randint(0, 255), r.randint(1, 254)),
+            port=r.randint(1024, 65535),
+            mac=':'.join('%02x' % r.randint(0, 255) for _ in range(6)))
+        entry = {
+            'msg': msg,
+            'host': r.choice(HOSTS),
+            'time': '%.6f' % now,
+            'timereported': '%.6f' % (now - r.random()),
+            'sev': r.choice(SEVERITIES),
+            'syslog': {'fac': r.choice(FACILITIES),
+                       'pri': str(r.randint(0, 191))},
+            'table': time.strftime('bench_%Y%m%d', time.gmtime(now)),
+        }
+        entry['pname'] = program
+        # rsyslog gives us '-' when there's no procid.
+        if r.random() < 0.1:
+            entry['pid'] = '-'
+        else:
+            entry['pid'] = str(r.randint(1, 65535))
+        return json.dumps(entry) + '\n'
+
+    def write(self, n):
+        """Append n lines, spread evenly over the log files.
+
+        :param n: number of lines to write
+        :type n: int
+        """
+        start = time.thread_time()
+        now = time.time()
+        per_file = [[] for _ in self.paths]
+        for _ in range(n):
+            per_file[self._next_file].append(self.line(now))
+            self._next_file = (self._next_file + 1) % len(self.paths)
+        for path, lines in zip(self.paths, per_file):
+            if lines:
+                data = ''.join(lines)
+                with open(path, 'a') as f:
+                    f.write(data)
+                self.bytes_written += len(data)
+        self.written += n
+        self.cpu_seconds += time.thread_time() - start
+
+    def run(self, total, rate=0):
+        """Write total lines at rate lines per second.
+
+        Writes are spread out over reactor iterations, so the pipeline
+        being benchmarked gets to run while lines are being written.
+
+        :param total: number of lines to write
+        :type total: int
+        :param rate: lines per second, 0 for as fast as possible
+        :type rate: float
+        :return: a deferred that fires when all lines are written
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        start_written = self.written
+        start = self.reactor.seconds()
+
+        def tick():
+            remaining = total - (self.written - start_written)
+            if rate:
+                due = int((self.reactor.seconds() - start) * rate)
+                n = min(remaining, due - (self.written - start_written))
+            else:
+                n = min(remaining, CHUNK)
+            if n > 0:
+                self.write(n)
+            if self.written - start_written >= total:
+                loop.stop()
+
+        loop = task.LoopingCall(tick)
+        loop.clock = self.reactor
+        d = loop.start(TICK if rate else 0, now=True)
+        d.addCallback(lambda _: self.written - start_written)
+        return d
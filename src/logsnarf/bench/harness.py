@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bench -*-
+# pylint: disable=invalid-name
+"""End to end throughput benchmark.
+
+Runs the real :py:class:`logsnarf.snarf.LogSnarf`,
+:py:class:`logsnarf.schema.Schema` and
+:py:class:`logsnarf.uploader.BigQueryUploader` pipeline against logs from
+:py:class:`logsnarf.bench.generator.LogGenerator`, uploading to one of the
+stand-ins in :py:mod:`logsnarf.bench.fakeservice`. Reports lines per second,
+end to end latency percentiles, CPU time and peak RSS, and saves them as JSON
+so runs can be compared across commits::
+
+    logsnarf-bench --lines 200000 --output before.json
+    git checkout my-branch
+    logsnarf-bench --lines 200000 --output after.json --compare before.json
+
+CPU time is for the whole process, less the time spent generating lines.
+With ``--sink http`` the stand-in runs in a child process, and its CPU time
+isn't included.
+"""
+
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import simplejson as json
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.python import usage
+from twisted.web import client
+
+from .. import app
+from .. import schema
+from .. import service
+from .. import snarf
+from .. import state
+from .. import uploader
+from . import fakeservice
+from . import generator
+
+# Seconds between checks for all rows having arrived.
+POLL_INTERVAL = 0.05
+
+# Results compared by --compare, and whether bigger is better.
+COMPARED = [
+    ('lines_per_second', True),
+    ('latency_p50', False),
+    ('latency_p99', False),
+    ('cpu_seconds_per_1k_lines', False),
+    ('peak_rss_bytes', False),
+]
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['lines', 'l', 100000, 'Lines to write', int],
+        ['rate', 'r', 0, 'Lines per second to write, 0 for unlimited',
+         float],
+        ['files', None, 1, 'Number of log files to spread lines over', int],
+        ['sink', 's', 'inprocess', 'BigQuery stand-in, inprocess or http'],
+        ['latency', None, 0.0, 'Seconds for the stand-in to respond', float],
+        ['jitter', None, 0.0, 'Random extra seconds of latency', float],
+        ['error-rate', None, 0.0, 'Fraction of inserts failing with a 503',
+         float],
+        ['row-error-rate', None, 0.0,
+         'Fraction of rows failing with backendError', float],
+        ['batch-size', None, 250, 'Uploader batch size', int],
+        ['max-buffer', None, 1000, 'Uploader max buffer', int],
+        ['flush-interval', None, 1, 'Uploader flush interval', float],
+        ['compression-level', None, 0, 'Gzip level for the http sink', int],
+        ['seed', None, 1, 'Random seed', int],
+        ['timeout', 't', 600, 'Give up after this many seconds', float],
+        ['output', 'o', None, 'Write results to this JSON file'],
+        ['compare', 'c', None, 'Compare with results in this JSON file'],
+        ['log-level', None, 'WARNING', 'Logging level'],
+    ]
+
+    def postOptions(self):
+        if self['sink'] not in ('inprocess', 'http'):
+            raise usage.UsageError('--sink must be inprocess or http')
+
+
+def gitCommit():
+    """The commit logsnarf is running from, if it's a git checkout."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpuSeconds():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    return usage_self.ru_utime + usage_self.ru_stime
+
+
+def peakRSS():
+    """Peak resident set size of this process in bytes."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def buildSchema():
+    """The syslog schema, set up as the app would."""
+    with open(generator.SCHEMA_FILE, 'rb') as f:
+        sch = schema.Schema(f)
+    app.install_schema_load_hook(sch)
+    app.install_custom_verifiers(sch, 'example.com')
+    return sch
+
+
+class LocalSink(object):
+    """Stats from an in process stand-in."""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    def stats(self):
+        return defer.succeed(self.sink.summary())
+
+    def stop(self):
+        pass
+
+
+class RemoteSink(object):
+    """Runs the HTTP stand-in in a child process, and fetches its stats."""
+
+    def __init__(self, args, reactor):
+        """
+
+        :param args: command line arguments for the stand-in
+        :type args: list(str)
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'logsnarf.bench.fakeservice'] + args,
+            stdout=subprocess.PIPE)
+        self.port = int(self.process.stdout.readline())
+        self.agent = client.Agent(reactor)
+
+    def discoveryURL(self):
+        return 'http://127.0.0.1:%d/%s' % (self.port,
+                                           fakeservice.DISCOVERY_PATH)
+
+    def stats(self):
+        d = self.agent.request(
+            b'GET', ('http://127.0.0.1:%d/stats' % self.port).encode('ascii'))
+        d.addCallback(client.readBody)
+        d.addCallback(json.loads)
+        return d
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def buildService(opts, reactor):
+    """Create the stand-in named by --sink.
+
+    :return: service for the uploader, and where to get sink stats from
+    """
+    faults = dict(latency=opts['latency'], jitter=opts['jitter'],
+                  error_rate=opts['error-rate'],
+                  row_error_rate=opts['row-error-rate'], seed=opts['seed'])
+    if opts['sink'] == 'inprocess':
+        sink = fakeservice.Sink()
+        svc = fakeservice.FakeBigQueryService(sink, reactor=reactor, **faults)
+        return svc, LocalSink(sink)
+    args = []
+    for k, v in faults.items():
+        args.extend(['--%s' % k.replace('_', '-'), str(v)])
+    sink = RemoteSink(args, reactor)
+    svc = service.BigQueryService(
+        'bench', 'bench', fakeservice.NoCredentials(), reactor=reactor,
+        discovery_url=sink.discoveryURL())
+    if opts['compression-level']:
+        svc.setCompression(opts['compression-level'])
+    return svc, sink
+
+
+@defer.inlineCallbacks
+def run(opts, reactor):
+    """Run the benchmark.
+
+    :param opts: parsed options
+    :type opts: Options
+    :param reactor: a running twisted reactor
+    :type reactor: :twisted:`twisted.internet.reactor`
+    :return: a deferred that fires with the results
+    :rtype: :twisted:`twisted.internet.defer.Deferred`
+    """
+    workdir = tempfile.mkdtemp(prefix='logsnarf-bench')
+    logdir = os.path.join(workdir, 'logs')
+    os.mkdir(logdir)
+    svc, sink = buildService(opts, reactor)
+    try:
+        sch = buildSchema()
+        upl = uploader.BigQueryUploader(sch, svc, 'bench_{YEAR}{MONTH}{DAY}',
+                                        reactor=reactor)
+        upl.setName('bench')
+        upl.setBatchSize(opts['batch-size'])
+        upl.setMaxBuffer(opts['max-buffer'])
+        upl.setFlushInterval(opts['flush-interval'])
+        snarfer = snarf.LogSnarf(
+            state.State(os.path.join(workdir, 'state.json')), upl,
+            reactor=reactor)
+        snarfer.watch(logdir, recursive=False)
+        snarfer.start()
+        gen = generator.LogGenerator(logdir, files=opts['files'],
+                                     seed=opts['seed'], reactor=reactor)
+
+        cpu_start = cpuSeconds()
+        start = time.time()
+        yield gen.run(opts['lines'], opts['rate'])
+        write_time = time.time() - start
+        stats = yield sink.stats()
+        while stats['rows'] < opts['lines'] and \
+                time.time() - start < opts['timeout']:
+            yield task.deferLater(reactor, POLL_INTERVAL, lambda: None)
+            stats = yield sink.stats()
+        elapsed = time.time() - start
+        cpu = cpuSeconds() - cpu_start - gen.cpu_seconds
+        snarfer.pauseProducing()
+        snarfer.lag.stop()
+    finally:
+        sink.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'lines': stats['rows'],
+        'complete': stats['rows'] >= opts['lines'],
+        'bytes': gen.bytes_written,
+        'seconds': elapsed,
+        'write_seconds': write_time,
+        'lines_per_second': stats['rows'] / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_seconds_per_1k_lines': cpu * 1000 / max(stats['rows'], 1),
+        'generator_cpu_seconds': gen.cpu_seconds,
+        'peak_rss_bytes': peakRSS(),
+    }
+    for k in ('latency_p50', 'latency_p99', 'latency_max', 'requests',
+              'failed_requests', 'failed_rows'):
+        results[k] = stats[k]
+    return {
+        'benchmark': 'throughput',
+        'commit': gitCommit(),
+        'time': start,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': dict((k, v) for k, v in opts.items()
+                        if k not in ('output', 'compare', 'log-level')),
+        'results': results,
+    }
+
+
+def formatResults(result, baseline=None):
+    """Format results as text, with changes from a baseline if given.
+
+    :param result: results returned by :py:func:`run`
+    :type result: dict
+    :param baseline: earlier results to compare with
+    :type baseline: dict
+    :rtype: str
+    """
+    r = result['results']
+    lines = ['%d lines in %.2fs%s' % (
+        r['lines'], r['seconds'], '' if r['complete'] else ' (TIMED OUT)')]
+    for key, higher_is_better in COMPARED:
+        value = r[key]
+        line = '  %-26s %14.6g' % (key, value if value is not None else 0)
+        if baseline is not None:
+            old = baseline['results'].get(key)
+            if old and value is not None:
+                change = (value - old) * 100.0 / old
+                better = change > 0 if higher_is_better else change < 0
+                line += '  %+7.1f%% %s (was %.6g)' % (
+                    change, 'better' if better else 'worse', old)
+        lines.append(line)
+    if baseline is not None and baseline.get('options') != result['options']:
+        lines.append('Warning: baseline was run with different options')
+    return '\n'.join(lines)
+
+
+def main():
+    opts = Options()
+    try:
+        opts.parseOptions()
+    except usage.UsageError as e:
+        print("%s: %s" % (sys.argv[0], e))
+        print("%s: Try --help for usage details." % (sys.argv[0]))
+        sys.exit(1)
+    logging.basicConfig(level=getattr(logging, opts['log-level'].upper()))
+    baseline = None
+    if opts['compare']:
+        with open(opts['compare']) as f:
+            baseline = json.load(f)
+
+    def report(result):
+        print(formatResults(result, baseline))
+        if opts['output']:
+            with open(opts['output'], 'w') as f:
+                json.dump(result, f, indent=2, sort_keys=True)
+
+    task.react(lambda reactor: run(opts, reactor).addCallback(report))
+
+
+if __name__ == '__main__':
+    main()
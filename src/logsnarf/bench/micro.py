@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bench -*-
+# pylint: disable=invalid-name
+"""Schema microbenchmarks.
+
+Times the per-line hot paths of the schema layer in isolation:
+:py:meth:`logsnarf.schema.Schema.loads` and
+:py:meth:`~logsnarf.schema.Schema.validateJSON` on the ``simple`` and
+``syslog`` test schemas and on generated wide and deep schemas,
+:py:meth:`~logsnarf.schema.Schema.toUnixTimestamp` with each type of input
+it accepts, and the app's load hook and ``host``/``pid`` validators.
+
+The ``metrics/`` cases time the :py:mod:`logsnarf.metrics` instrumentation
+on the per-line path, to compare with ``loads/syslog``: ``metrics/timer``
+the parse time histogram, ``metrics/counter`` incrementing a labelled
+counter and ``metrics/labels`` looking one up.
+
+The :py:mod:`logsnarf.parsers` are compared with JSON on the same syslog
+lines rendered in each format: ``parse/<format>`` times the parser alone,
+``parse/json`` the JSON decoder with the app's load hook, and
+``loads/syslog-<format>`` the whole of
+:py:meth:`~logsnarf.schema.Schema.loads`, to compare with ``loads/syslog``.
+
+Each case is run over a fresh list of inputs, as several of these modify
+their input, and the best of several repeats is reported as nanoseconds per
+call. Results are saved and compared like those of
+:py:mod:`logsnarf.bench.harness`::
+
+    logsnarf-microbench --output before.json
+    logsnarf-microbench --compare before.json --filter loads
+"""
+
+import collections
+import datetime
+import io
+import os
+import platform
+import re
+import sys
+import time
+
+import pytz
+import simplejson as json
+from twisted.python import usage
+
+from .. import metrics
+from .. import parsers
+from .. import schema
+from . import generator
+from . import harness
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test',
+                          'data', 'schema')
+
+WIDE_TYPES = ['STRING', 'INTEGER', 'FLOAT', 'TIMESTAMP']
+
+# Named groups for lines rendered by formatLines. pid is optional, as it is
+# left out when rsyslog gives us '-'.
+BENCH_REGEX = (r'(?P<time>\S+) (?P<timereported>\S+) (?P<host>\S+) '
+               r'(?P<pname>[^\[\s]+)'
+               r'(?:\[(?P<pid>\d+)\])? (?P<sev>\w+): (?P<msg>.*)')
+
+Case = collections.namedtuple('Case', ['name', 'fn', 'inputs'])
+"""A benchmark case. fn is called with each tuple of arguments returned by
+inputs(n)."""
+
+
+def wideSchema(width=200):
+    """A flat schema of width fields, of each type in turn."""
+    return [{'name': 'f%d' % i, 'type': WIDE_TYPES[i % len(WIDE_TYPES)]}
+            for i in range(width)]
+
+
+def wideDocument(width=200):
+    """A JSON document for :py:func:`wideSchema`, with values needing
+    coercion."""
+    values = {
+        'STRING': lambda i: 'value %d' % i,
+        'INTEGER': lambda i: str(i),
+        'FLOAT': lambda i: i + 0.5,
+        'TIMESTAMP': lambda i: '1420070400.%d' % i,
+    }
+    return json.dumps(dict(
+        ('f%d' % i, values[WIDE_TYPES[i % len(WIDE_TYPES)]](i))
+        for i in range(width)))
+
+
+def deepSchema(depth=8):
+    """A schema of records nested depth deep, with a few fields per level."""
+    fields = [{'name': 'leaf', 'type': 'STRING', 'mode': 'REQUIRED'}]
+    for _ in range(depth):
+        fields = [
+            {'name': 'name', 'type': 'STRING'},
+            {'name': 'count', 'type': 'INTEGER'},
+            {'name': 'time', 'type': 'TIMESTAMP'},
+            {'name': 'child', 'type': 'RECORD', 'fields': fields},
+        ]
+    return fields
+
+
+def deepDocument(depth=8):
+    """A JSON document for :py:func:`deepSchema`."""
+    doc = {'leaf': 'leaf'}
+    for i in range(depth):
+        doc = {'name': 'level %d' % i, 'count': str(i),
+               'time': '1420070400.5', 'child': doc}
+    return json.dumps(doc)
+
+
+def _schema(fields):
+    return schema.Schema(io.StringIO(json.dumps(fields)))
+
+
+def schemas():
+    """The schemas benchmarked, and sample lines for each.
+
+    :return: schema name to (schema, lines)
+    :rtype: dict
+    """
+    result = {}
+    with open(os.path.join(SCHEMA_DIR, 'simple', 'schema.json')) as f:
+        simple = schema.Schema(f)
+    pass_dir = os.path.join(SCHEMA_DIR, 'simple', 'pass')
+    lines = []
+    for name in sorted(os.listdir(pass_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(pass_dir, name)) as f:
+                lines.append(json.dumps(json.load(f)))
+    result['simple'] = simple, lines
+    gen = generator.LogGenerator(os.curdir, seed=1)
+    result['syslog'] = harness.buildSchema(), [
+        gen.line(1420070400.5).rstrip('\n') for _ in range(100)]
+    result['wide'] = _schema(wideSchema()), [wideDocument()]
+    result['deep'] = _schema(deepSchema()), [deepDocument()]
+    return result
+
+
+def renderLine(fmt, entry):
+    """Render a generated JSON entry as a line in another format.
+
+    :param fmt: rfc5424, rfc3164, logfmt or regex
+    :type fmt: str
+    :param entry: decoded line from :py:class:`~.generator.LogGenerator`
+    :type entry: dict
+    :rtype: str
+    """
+    now = float(entry['time'])
+    t = time.gmtime(now)
+    pri = entry['syslog']['pri']
+    pid = entry['pid'] if entry['pid'] != '-' else None
+    tag = entry['pname'] + ('[%s]' % pid if pid else '')
+    if fmt == 'rfc5424':
+        return '<%s>1 %s.%06dZ %s %s %s - - %s' % (
+            pri, time.strftime('%Y-%m-%dT%H:%M:%S', t),
+            int(round(now % 1 * 1e6)), entry['host'], entry['pname'],
+            pid or '-', entry['msg'])
+    if fmt == 'rfc3164':
+        return '<%s>%s %2d %s %s %s: %s' % (
+            pri, time.strftime('%b', t), t.tm_mday,
+            time.strftime('%H:%M:%S', t), entry['host'], tag, entry['msg'])
+    if fmt == 'logfmt':
+        pairs = ['%s=%s' % (k, entry[k])
+                 for k in ('time', 'timereported', 'host', 'pname', 'sev')]
+        if pid:
+            pairs.append('pid=%s' % pid)
+        pairs.append('msg="%s"' % entry['msg'].replace('"', '\\"'))
+        return ' '.join(pairs)
+    if fmt == 'regex':
+        return '%s %s %s %s %s: %s' % (
+            entry['time'], entry['timereported'], entry['host'], tag,
+            entry['sev'], entry['msg'])
+    raise ValueError('Unknown format %s' % fmt)
+
+
+def formatLines(n=100):
+    """Generated syslog lines, in each format a parser reads.
+
+    :return: format to (parser, lines)
+    :rtype: dict
+    """
+    gen = generator.LogGenerator(os.curdir, seed=1)
+    entries = [json.loads(gen.line(1420070400.5)) for _ in range(n)]
+    result = {}
+    for fmt in parsers.FORMATS:
+        if fmt == 'json':
+            continue
+        result[fmt] = (parsers.build(fmt, BENCH_REGEX),
+                       [renderLine(fmt, e) for e in entries])
+    return result
+
+
+def _cycle(items, n):
+    return [items[i % len(items)] for i in range(n)]
+
+
+def cases():
+    """Build every benchmark case.
+
+    :rtype: list(Case)
+    """
+    result = []
+    for name, (sch, lines) in sorted(schemas().items()):
+        result.append(Case(
+            'loads/%s' % name, sch.loads,
+            lambda n, lines=lines: [(ln,) for ln in _cycle(lines, n)]))
+
+        def decoded(n, sch=sch, lines=lines):
+            return [(json.loads(ln, object_hook=sch._load_hook),)
+                    for ln in _cycle(lines, n)]
+
+        result.append(Case('validateJSON/%s' % name, sch.validateJSON,
+                           decoded))
+
+    syslog_schema, syslog_lines = schemas()['syslog']
+    result.append(Case(
+        'parse/json',
+        lambda ln, hook=syslog_schema._load_hook: json.loads(
+            ln, object_hook=hook),
+        lambda n: [(ln,) for ln in _cycle(syslog_lines, n)]))
+    for fmt, (parser, lines) in sorted(formatLines().items()):
+        sch = harness.buildSchema()
+        sch.setParser(parser)
+        inputs = lambda n, lines=lines: [(ln,) for ln in _cycle(lines, n)]
+        result.append(Case('parse/%s' % fmt, parser, inputs))
+        result.append(Case('loads/syslog-%s' % fmt, sch.loads, inputs))
+
+    sch = harness.buildSchema()
+    utc = pytz.utc
+    timestamps = [
+        ('float_string', '1420070400.892028'),
+        ('iso_tz', '2015-01-01T00:00:00.892028+00:00'),
+        ('iso_naive', '2015-01-01 00:00:00.892028'),
+        ('int', 1420070400),
+        ('float', 1420070400.892028),
+        ('datetime_naive', datetime.datetime(2015, 1, 1)),
+        ('datetime_aware', datetime.datetime(2015, 1, 1, tzinfo=utc)),
+    ]
+    for name, value in timestamps:
+        result.append(Case(
+            'toUnixTimestamp/%s' % name, sch.toUnixTimestamp,
+            lambda n, value=value: [(None, value)] * n))
+
+    hook = sch._load_hook
+    flat = json.loads(generator.LogGenerator(os.curdir, seed=1).line(0))
+    flat.pop('syslog')
+    dotted = dict(flat, pid='-', **{
+        'syslog!fac': 'auth', 'syslog!pri': '38', 'src.host': 'gw',
+        'src.port': '22', 'user.name': 'root'})
+    for name, obj in ('flat', flat), ('dotted', dotted):
+        result.append(Case('loadHook/%s' % name, hook,
+                           lambda n, obj=obj: [(dict(obj),)
+                                               for _ in range(n)]))
+
+    host = sch.field_dict['host']['validator']
+    pid = sch.field_dict['pid']['validator']
+    validators = [
+        ('host/short', host, 'gw'),
+        ('host/fqdn', host, 'gw.example.com'),
+        ('pid/string', pid, '1234'),
+        ('pid/int', pid, 1234),
+        ('pid/none', pid, None),
+    ]
+    for name, fn, value in validators:
+        result.append(Case('validator/%s' % name, fn,
+                           lambda n, value=value: [({}, value)
+                                                   for _ in range(n)]))
+
+    registry = metrics.Registry()
+    seconds = metrics.histogram('bench_seconds', 'Seconds.',
+                                registry=registry)
+    lines = metrics.counter('bench_lines', 'Lines.', ['file'],
+                            registry=registry)
+    child = lines.labels('/var/log/syslog')
+    result.append(Case('metrics/timer', timed, lambda n: [(seconds,)] * n))
+    result.append(Case('metrics/counter', child.inc, lambda n: [()] * n))
+    result.append(Case('metrics/labels', lines.labels,
+                       lambda n: [('/var/log/syslog',)] * n))
+    return result
+
+
+def timed(histogram):
+    """What :py:meth:`logsnarf.schema.Schema.loads` adds to time a line."""
+    start = time.perf_counter()
+    histogram.observe(time.perf_counter() - start)
+
+
+def timeCase(case, number=2000, repeat=5):
+    """Time a case.
+
+    :param case: the case to time
+    :type case: Case
+    :param number: calls per repeat
+    :type number: int
+    :param repeat: number of repeats
+    :type repeat: int
+    :return: best and median nanoseconds per call, and calls per second
+    :rtype: dict
+    """
+    fn = case.fn
+    times = []
+    for _ in range(repeat):
+        inputs = case.inputs(number)
+        start = time.perf_counter()
+        for args in inputs:
+            fn(*args)
+        times.append((time.perf_counter() - start) / number)
+    times.sort()
+    return {
+        'ns_per_call': times[0] * 1e9,
+        'median_ns_per_call': times[len(times) // 2] * 1e9,
+        'calls_per_second': 1.0 / times[0],
+    }
+
+
+def run(number=2000, repeat=5, pattern=None):
+    """Run every case whose name matches pattern.
+
+    :param pattern: regular expression to search case names for
+    :type pattern: str
+    :return: case name to timings
+    :rtype: dict
+    """
+    results = {}
+    for case in cases():
+        if pattern and not re.search(pattern, case.name):
+            continue
+        results[case.name] = timeCase(case, number, repeat)
+    return results
+
+
+def formatResults(results, baseline=None):
+    """Format results as text, with changes from a baseline if given.
+
+    :param results: case name to timings
+    :type results: dict
+    :param baseline: earlier case name to timings
+    :type baseline: dict
+    :rtype: str
+    """
+    lines = []
+    width = max([len(name) for name in results] or [0])
+    for name in sorted(results):
+        ns = results[name]['ns_per_call']
+        line = '%-*s %12.0f ns' % (width, name, ns)
+        old = (baseline or {}).get(name)
+        if old:
+            change = (ns - old['ns_per_call']) * 100.0 / old['ns_per_call']
+            line += '  %+7.1f%% %s (was %.0f)' % (
+                change, 'faster' if change < 0 else 'slower',
+                old['ns_per_call'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['number', 'n', 2000, 'Calls per repeat', int],
+        ['repeat', 'r', 5, 'Repeats, the best is reported', int],
+        ['filter', 'k', None, 'Only run cases matching this regex'],
+        ['output', 'o', None, 'Write results to this JSON file'],
+        ['compare', 'c', None, 'Compare with results in this JSON file'],
+    ]
+
+
+def main():
+    opts = Options()
+    try:
+        opts.parseOptions()
+    except usage.UsageError as e:
+        print("%s: %s" % (sys.argv[0], e))
+        print("%s: Try --help for usage details." % (sys.argv[0]))
+        sys.exit(1)
+    baseline = None
+    if opts['compare']:
+        with open(opts['compare']) as f:
+            baseline = json.load(f)['results']
+    results = run(opts['number'], opts['repeat'], opts['filter'])
+    print(formatResults(results, baseline))
+    if opts['output']:
+        with open(opts['output'], 'w') as f:
+            json.dump({
+                'benchmark': 'micro',
+                'commit': harness.gitCommit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': {'number': opts['number'],
+                            'repeat': opts['repeat']},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bench -*-
+# pylint: disable=invalid-name
+"""Watcher benchmarks.
+
+Measures the CPU cost of watching a large tree of log files by polling,
+with :py:class:`logsnarf.poller.Poller`, and of the rescan
+:py:class:`logsnarf.dirindex.DirectoryIndex` makes possible. A tree of
+``--files`` files, ``--per-dir`` to a directory, is made in a temporary
+directory, and timed:
+
+ * ``snapshot``: the first listing and stat of every file, as done when a
+   directory is watched
+ * ``poll/idle``: polling every directory once, with nothing changed
+ * ``poll/active``: polling every directory once, after appending to
+   ``--active`` percent of the files
+ * ``index/refresh``: refreshing the directory index with nothing changed,
+   as a rescan does before stat'ing the files
+
+Each is reported as CPU nanoseconds per file, best of ``--repeat``, along
+with the CPU a second that polling an idle tree costs at the poller's
+shortest and longest intervals. Results are saved and compared like those
+of :py:mod:`logsnarf.bench.micro`::
+
+    logsnarf-watchbench --files 100000 --output before.json
+    logsnarf-watchbench --files 100000 --compare before.json
+"""
+
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import simplejson as json
+from twisted.python import usage
+
+from .. import dirindex
+from .. import poller
+from . import harness
+from . import micro
+
+
+def makeTree(root, files, per_dir):
+    """Make a tree of log files.
+
+    :param root: directory to make it in
+    :type root: str
+    :param files: number of files
+    :type files: int
+    :param per_dir: files per directory
+    :type per_dir: int
+    :return: the file paths
+    :rtype: list(str)
+    """
+    paths = []
+    for i in range(files):
+        d = os.path.join(root, 'd%04d' % (i // per_dir))
+        if i % per_dir == 0:
+            os.makedirs(d)
+        path = os.path.join(d, 'f%d.log' % i)
+        with open(path, 'wb') as f:
+            f.write(b'line\n')
+        paths.append(path)
+    return paths
+
+
+def timed(fn, repeat, before=None):
+    """Best CPU seconds of repeat calls of fn, calling before first."""
+    best = None
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = harness.cpuSeconds()
+        fn()
+        elapsed = harness.cpuSeconds() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(files=100000, per_dir=100, active=1.0, repeat=3, root=None):
+    """Run the benchmark.
+
+    :return: case name to timings
+    :rtype: dict
+    """
+    cleanup = root is None
+    if root is None:
+        root = tempfile.mkdtemp(prefix='logsnarf-watchbench-')
+    try:
+        paths = makeTree(root, files, per_dir)
+        index = dirindex.DirectoryIndex(root)
+        p = poller.Poller(index, lambda path, mask: None)
+        results = {}
+
+        def case(name, seconds):
+            results[name] = {'ns_per_call': seconds * 1e9 / files,
+                             'cpu_seconds': seconds}
+
+        def snapshot():
+            index._dirs.clear()
+            p._schedule.clear()
+            p._files.clear()
+            p._stats.clear()
+            p.snapshot()
+
+        case('snapshot', timed(snapshot, repeat))
+        dirs = index.directories()
+
+        def sweep():
+            for d in dirs:
+                p.poll(d)
+
+        case('poll/idle', timed(sweep, repeat))
+        step = max(1, int(round(100 / active))) if active else None
+
+        def touch():
+            for path in paths[::step]:
+                with open(path, 'ab') as f:
+                    f.write(b'line\n')
+
+        if step:
+            case('poll/active', timed(sweep, repeat, touch))
+        case('index/refresh', timed(index.refresh, repeat))
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def formatResults(results, baseline=None, intervals=(1.0, 30.0)):
+    """Format results as text, with changes from a baseline if given.
+
+    :param intervals: poll intervals to give the idle CPU cost at
+    :type intervals: tuple(float)
+    :rtype: str
+    """
+    text = micro.formatResults(results, baseline)
+    idle = results.get('poll/idle')
+    if idle:
+        text += '\n' + '\n'.join(
+            'idle polling every %gs: %.2f%% of a CPU' % (
+                interval, idle['cpu_seconds'] * 100.0 / interval)
+            for interval in intervals)
+    return text
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['files', 'n', 100000, 'Number of files', int],
+        ['per-dir', 'd', 100, 'Files per directory', int],
+        ['active', 'a', 1.0, 'Percent of files changed for poll/active',
+         float],
+        ['repeat', 'r', 3, 'Repeats, the best is reported', int],
+        ['dir', None, None, 'Make the files here, rather than in a '
+         'temporary directory'],
+        ['output', 'o', None, 'Write results to this JSON file'],
+        ['compare', 'c', None, 'Compare with results in this JSON file'],
+    ]
+
+
+def main():
+    opts = Options()
+    try:
+        opts.parseOptions()
+    except usage.UsageError as e:
+        print("%s: %s" % (sys.argv[0], e))
+        print("%s: Try --help for usage details." % (sys.argv[0]))
+        sys.exit(1)
+    baseline = None
+    if opts['compare']:
+        with open(opts['compare']) as f:
+            baseline = json.load(f)['results']
+    results = run(opts['files'], opts['per-dir'], opts['active'],
+                  opts['repeat'], opts['dir'])
+    print(formatResults(results, baseline))
+    if opts['output']:
+        with open(opts['output'], 'w') as f:
+            json.dump({
+                'benchmark': 'watch',
+                'commit': harness.gitCommit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': {'files': opts['files'],
+                            'per_dir': opts['per-dir'],
+                            'active': opts['active'],
+                            'repeat': opts['repeat']},
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_bulk -*-
+# pylint: disable=invalid-name
+"""Bulk loading through BigQuery load jobs.
+
+Streaming inserts are the slowest and most expensive way to push a large
+backlog into BigQuery. The :py:class:`BulkLoader` spools rows to gzip
+compressed, newline delimited JSON files, one per table, in a spool
+directory. Once a file is large or old enough it is closed and submitted as
+a load job through :py:meth:`logsnarf.service.BigQueryService.load`.
+
+Spool files are only removed once their load job has completed. A load that
+fails with a transient error is submitted again after a delay, which doubles
+with each failure up to :py:attr:`BulkLoader.max_retry_delay`, and files
+left over from a previous run are submitted again by :py:meth:`~.recover`.
+Load job ids are derived from the spool file name, so a file that was
+submitted before a restart is not loaded twice.
+"""
+
+import gzip
+import logging
+import os
+import os.path
+import uuid
+
+import simplejson as json
+from twisted.internet import task
+
+from . import errors as lserrors
+
+SPOOL_SUFFIX = '.json.gz'
+PART_SUFFIX = '.part'
+FAILED_SUFFIX = '.failed'
+
+
+class BulkLoader(object):
+    """Spool rows to disk and load them with BigQuery load jobs."""
+
+    def __init__(self, svc, table_schema, spool_dir, reactor=None):
+        """
+
+        :param svc: a BigQuery service
+        :type svc: logsnarf.service.BigQueryService
+        :param table_schema: list of fields, used when creating tables
+        :type table_schema: list
+        :param spool_dir: directory to keep spool files in, created if needed
+        :type spool_dir: str
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.service = svc
+        self.table_schema = table_schema
+        self.spool_dir = spool_dir
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.max_rows = 100000
+        self.max_age = 300
+        self.compression_level = 6
+        self.retry_delay = 5.0
+        self.max_retry_delay = 300.0
+        # table -> [file object, path, row count, time opened, callbacks]
+        self._files = {}
+        # path -> upload id, for load jobs in flight.
+        self.pending = {}
+        # path -> deferred, for loads waiting to be submitted again.
+        self._retries = {}
+
+    def setMaxRows(self, n):
+        """Set the number of rows after which a spool file is submitted.
+
+        :param n: maximum number of rows in a spool file
+        :type n: int
+        """
+        self.max_rows = n
+
+    def setMaxAge(self, n):
+        """Set the age in seconds after which a spool file is submitted.
+
+        :param n: maximum age of a spool file
+        :type n: int
+        """
+        self.max_age = n
+
+    def setCompressionLevel(self, n):
+        """Set the gzip compression level for spool files.
+
+        :param n: compression level, 0-9
+        :type n: int
+        """
+        self.compression_level = n
+
+    def write(self, table, rows, spooled=None):
+        """Spool rows destined for table.
+
+        :param table: BigQuery table name
+        :type table: str
+        :param rows: rows as passed to insertAll, i.e. dicts with insertId
+            and json keys.
+        :type rows: list(dict)
+        :param spooled: called once the rows are safely on disk, when their
+          spool file has been closed and synced
+        :type spooled: callable
+        :return: (upload_id, deferred) for each load job started
+        :rtype: list(tuple)
+        """
+        if table not in self._files:
+            self._files[table] = self._open(table)
+        entry = self._files[table]
+        fp = entry[0]
+        for row in rows:
+            fp.write(json.dumps(row['json']).encode('utf-8'))
+            fp.write(b'\n')
+        entry[2] += len(rows)
+        if spooled is not None:
+            entry[4].append(spooled)
+        if entry[2] >= self.max_rows:
+            return [self.rotate(table)]
+        return []
+
+    def rotate(self, table):
+        """Close the current spool file for table and submit it.
+
+        :param table: BigQuery table name
+        :type table: str
+        :return: upload_id and deferred for the load job
+        :rtype: tuple
+        """
+        return self.submit(self._close(table))
+
+    def rotateExpired(self):
+        """Submit spool files older than the maximum age.
+
+        :return: (upload_id, deferred) for each load job started
+        :rtype: list(tuple)
+        """
+        now = self.reactor.seconds()
+        return [self.rotate(table) for table in list(self._files)
+                if now - self._files[table][3] >= self.max_age]
+
+    def close(self):
+        """Close all open spool files, without submitting them.
+
+        Loads waiting to be retried are cancelled. They will all be
+        submitted by :py:meth:`~.recover`.
+        """
+        for table in list(self._files):
+            self._close(table)
+        for path, d in list(self._retries.items()):
+            self.pending.pop(path, None)
+            d.cancel()
+        self._retries.clear()
+
+    def recover(self):
+        """Submit spool files that are complete, but not yet loaded.
+
+        This picks up files left by a previous run, and files whose load
+        failed with a transient error. Partial files left by a crash are
+        salvaged up to their last complete line first.
+
+        :return: (upload_id, deferred) for each load job started
+        :rtype: list(tuple)
+        """
+        open_paths = set(entry[1] for entry in self._files.values())
+        loads = []
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name.endswith(PART_SUFFIX) and path not in open_paths:
+                path = self._salvage(path)
+                if path is None:
+                    continue
+            elif not name.endswith(SPOOL_SUFFIX):
+                continue
+            if path not in self.pending:
+                loads.append(self.submit(path))
+        return loads
+
+    def submit(self, path):
+        """Submit a spool file as a load job.
+
+        :param path: path of a complete spool file
+        :type path: str
+        :return: upload_id and deferred for the load job
+        :rtype: tuple
+        """
+        upload_id = os.path.basename(path).split('.')[1]
+        self.pending[path] = upload_id
+        return upload_id, self._load(path)
+
+    def _load(self, path, attempt=0):
+        """Start the load job for a spool file.
+
+        :param attempt: how many times the load has failed already
+        :type attempt: int
+        :return: a deferred that fires once the load succeeds, or fails for
+          good
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        self._retries.pop(path, None)
+        table, upload_id = os.path.basename(path).split('.')[:2]
+        self.log.info('Submitting %s as load job for table %s', path, table)
+        d = self.service.load(table, self.table_schema, path, upload_id,
+                              job_id='logsnarf_%s' % upload_id)
+        d.addCallbacks(self._loaded, self._loadFailed,
+                       callbackArgs=(path,), errbackArgs=(path, attempt))
+        return d
+
+    def _loaded(self, job, path):
+        self.pending.pop(path, None)
+        self.log.info('Load of %s complete', path)
+        os.remove(path)
+        return job
+
+    def _loadFailed(self, fail, path, attempt=0):
+        if fail.check(lserrors.ServiceError):
+            # The job ran and was rejected, submitting it again won't help.
+            self.pending.pop(path, None)
+            self.log.error('Load of %s failed, moving it aside: %s', path,
+                           fail.getErrorMessage())
+            os.rename(path, path + FAILED_SUFFIX)
+            return fail
+        # The job id is reused, so a job that did start is polled, not run
+        # again.
+        delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+        self.log.error('Load of %s failed, retrying in %ss: %s', path, delay,
+                       fail.getErrorMessage())
+        d = task.deferLater(self.reactor, delay, self._load, path,
+                            attempt + 1)
+        self._retries[path] = d
+        return d
+
+    def _open(self, table):
+        name = '%s.%s%s%s' % (table, uuid.uuid4().hex, SPOOL_SUFFIX,
+                              PART_SUFFIX)
+        path = os.path.join(self.spool_dir, name)
+        self.log.debug('Opening spool file %s', path)
+        return [gzip.GzipFile(path, 'wb', self.compression_level,
+                              open(path, 'wb')),
+                path, 0, self.reactor.seconds(), []]
+
+    def _close(self, table):
+        """Close, sync and rename a table's spool file.
+
+        :return: the spool file's final path
+        :rtype: str
+        """
+        fp, path, _, _, callbacks = self._files.pop(table)
+        raw = fp.fileobj
+        # GzipFile leaves a file object it was given open.
+        fp.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+        raw.close()
+        final_path = path[:-len(PART_SUFFIX)]
+        os.rename(path, final_path)
+        self._syncDir()
+        for callback in callbacks:
+            callback()
+        return final_path
+
+    def _syncDir(self):
+        """Sync the spool directory, so renames in it survive a crash."""
+        fd = os.open(self.spool_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _salvage(self, path):
+        """Rewrite a partial spool file up to its last complete line."""
+        final_path = path[:-len(PART_SUFFIX)]
+        lines = []
+        try:
+            with gzip.open(path, 'rb') as fp:
+                for line in fp:
+                    if line.endswith(b'\n'):
+                        lines.append(line)
+        except (EOFError, IOError, OSError):
+            pass
+        self.log.warning('Salvaged %d lines from partial spool file %s',
+                         len(lines), path)
+        if not lines:
+            os.remove(path)
+            return None
+        with gzip.open(final_path, 'wb') as fp:
+            fp.writelines(lines)
+        os.remove(path)
+        return final_path
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_compressed -*-
+# pylint: disable=invalid-name
+"""Reading compressed log files.
+
+logrotate usually compresses rotated files, and if logsnarf is behind when
+that happens, the rest of the file is only available compressed. Files
+ending in ``.gz``, ``.bz2`` or ``.zst`` that match the pattern are
+decompressed as they're read by :py:class:`CompressedReader`. ``.zst``
+files need the zstandard package.
+
+Offsets into compressed files are offsets into the uncompressed data, so
+restarting from one means decompressing up to it. That can only begin at
+the start of a gzip member, bzip2 stream or zstd frame, so the state also
+records a checkpoint: the compressed offset of the start of the member
+being read, and the uncompressed offset it corresponds to. A state entry
+for a compressed file is::
+
+    [offset, inode, [compressed offset, uncompressed offset]]
+
+On restart, decompression resumes from the checkpoint, and the output up
+to the offset is skipped rather than sent again. Files compressed as many
+members, such as by pigz or pbzip2, or zstd with ``--rsyncable``, resume
+almost immediately. A file of a single member, as logrotate's default of
+gzip produces, is decompressed from its start again, but only once.
+
+When logrotate compresses a rotated file, ``app.log.1`` say, it writes
+``app.log.1.gz``, a new file, then deletes ``app.log.1``. The compressed
+file isn't read while the file it's made from is still there, and once that
+has been deleted, its state is carried over to the compressed file, which is
+read on from the same uncompressed offset. Lines aren't sent twice.
+
+Decompression is done in a worker thread, a chunk at a time, so working
+through a large compressed backlog doesn't block the reactor.
+"""
+
+import bz2
+import collections
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 256 * 1024
+SUFFIXES = ('.gz', '.bz2', '.zst')
+
+
+def isCompressed(path):
+    """True if path is a compressed file, going by its name.
+
+    :param path: file path
+    :type path: str
+    :rtype: bool
+    """
+    return path.endswith(SUFFIXES)
+
+
+def uncompressedPath(path):
+    """The path of the file a compressed file was made from.
+
+    :param path: compressed file path
+    :type path: str
+    :rtype: str
+    """
+    for suffix in SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def decompressor(path):
+    """Make a decompressor for one member of a compressed file.
+
+    The decompressor has the interface of :py:class:`bz2.BZ2Decompressor`,
+    with ``decompress``, ``eof`` and ``unused_data``.
+
+    :param path: file path, whose suffix gives the compression
+    :type path: str
+    :raises ValueError: if the compression isn't supported
+    """
+    if path.endswith('.gz'):
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if path.endswith('.bz2'):
+        return bz2.BZ2Decompressor()
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('zstandard is needed to read %s' % path)
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError('%s is not a compressed file' % path)
+
+
+class CompressedReader(object):
+    """Reads lines from a compressed file.
+
+    :py:meth:`~.read` decompresses the next chunk of the file, and is
+    meant to be called in a worker thread. Its lines are queued in
+    :py:attr:`lines` for the reactor thread to take, as
+    ``(line, offset, checkpoint)``, where offset is the uncompressed offset
+    of the end of the line, and checkpoint the ``(compressed offset,
+    uncompressed offset)`` to resume from to read past it.
+    """
+
+    def __init__(self, path, inode, offset=0, checkpoint=None):
+        """
+
+        :param path: file path
+        :type path: str
+        :param inode: the file's inode
+        :type inode: int
+        :param offset: uncompressed offset to start reading from
+        :type offset: int
+        :param checkpoint: compressed and uncompressed offset of the start of
+          the member containing offset
+        :type checkpoint: tuple(int, int)
+        """
+        self.path = path
+        self.inode = inode
+        self.checkpoint = tuple(checkpoint or (0, 0))
+        self.compressed_offset, self.offset = self.checkpoint
+        self.lines = collections.deque()
+        self.busy = False
+        self.exhausted = False
+        self.complete = False
+        self.fp = None
+        self._decompressor = decompressor(path)
+        self._skip = max(0, offset - self.offset)
+        self._partial = b''
+
+    def read(self, chunk_size=CHUNK_SIZE):
+        """Decompress the next chunk of the file.
+
+        Sets :py:attr:`exhausted` once there is no more data, and
+        :py:attr:`complete` too if the file ended at the end of a member.
+
+        :param chunk_size: compressed bytes to read
+        :type chunk_size: int
+        :return: the number of lines read
+        :rtype: int
+        :raises IOError: if the file can't be read, or isn't valid
+        """
+        if self.fp is None:
+            self.fp = open(self.path, 'rb')
+            self.fp.seek(self.compressed_offset)
+        data = self.fp.read(chunk_size)
+        if not data:
+            self.exhausted = True
+            if (self.compressed_offset, self.offset) == self.checkpoint:
+                self.complete = True
+                self.close()
+            return 0
+        n = len(self.lines)
+        while data:
+            try:
+                self._split(self._decompressor.decompress(data))
+            except (zlib.error, EOFError, ValueError) as e:
+                raise IOError('Unable to decompress %s: %s' % (self.path, e))
+            if not self._decompressor.eof:
+                self.compressed_offset += len(data)
+                break
+            unused = self._decompressor.unused_data
+            if not unused.strip(b'\0'):
+                # gzip files may be padded with zeros
+                unused = b''
+            self.compressed_offset += len(data) - len(unused)
+            self.checkpoint = (self.compressed_offset, self.offset)
+            self._decompressor = decompressor(self.path)
+            if self.lines and not self._partial:
+                # the last line ends the member, it can resume from the next
+                line, end, _ = self.lines[-1]
+                self.lines[-1] = (line, end, self.checkpoint)
+            data = unused
+        return len(self.lines) - n
+
+    def _split(self, chunk):
+        """Queue the whole lines in a decompressed chunk."""
+        if self._skip:
+            skip = min(self._skip, len(chunk))
+            self._skip -= skip
+            self.offset += skip
+            chunk = chunk[skip:]
+        if not chunk:
+            return
+        end = self.offset - len(self._partial)
+        parts = (self._partial + chunk).split(b'\n')
+        self._partial = parts.pop()
+        for part in parts:
+            end += len(part) + 1
+            self.lines.append((part.decode('utf-8', 'ignore') + '\n', end,
+                               self.checkpoint))
+        self.offset += len(chunk)
+
+    def close(self):
+        """Close the file."""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
@@ -23,11 +23,54 @@ DEFAULTS = {
     'default_tz': 'UTC',
     'flush_interval': '30',
     'max_buffer': '1000',
+    'commit_after_upload': 'true',
     'pattern': r'.*\.log',
     'schema_file': '%(__name__)s_schema.json',
     'state_file': '%(__name__)s_state.json',
     'table_name_fmt': 'logs_{YEAR}{MONTH}{DAY}',
-    'recursive': 'true'
+    'recursive': 'true',
+    'format': 'json',
+    'format_regex': '',
+    'format_fields': '',
+    'filters': '',
+    'partition_table': '',
+    'partition_type': 'DAY',
+    'partition_field': '',
+    'partition_expiration': '',
+    'clustering_fields': '',
+    'bulk_threshold': '',
+    'bulk_dir': '%(__name__)s_bulk',
+    'bulk_max_rows': '100000',
+    'bulk_max_age': '300',
+    'compression_level': '0',
+    'compression_threshold': '1024',
+    'bisect_max_requests': '32',
+    'rate_limit_rows': '',
+    'rate_limit_bytes': '',
+    'table_rate_limit_rows': '',
+    'table_rate_limit_bytes': '',
+    'max_open_files': '256',
+    'coalesce_window': '0.05',
+    'coalesce_max_delay': '0.5',
+    'watcher': 'inotify',
+    'poll_min_interval': '1.0',
+    'poll_max_interval': '30.0',
+    'max_watches': '8192',
+    'watch_cold_after': '3600',
+    'lag_interval': '30',
+    'lag_file': '%(__name__)s_lag.json',
+    'trace_sample_rate': '0',
+    'syslog_tcp_port': '',
+    'syslog_udp_port': '',
+    'syslog_interface': '127.0.0.1',
+    'syslog_max_message': '65536',
+    'trace_file': '%(__name__)s_traces.jsonl',
+    'metrics_port': '',
+    'metrics_interface': '127.0.0.1',
+    'profile_seconds': '30',
+    'profile_mode': 'cprofile',
+    'supervise': 'false',
+    'workers': '1',
 }
 
 
@@ -59,8 +102,9 @@ class ConfigSection(abc.Mapping):
                 return value
             except (ValueError, AttributeError):
                 pass
-            except configparser.NoOptionError as e:
-                raise ValueError(*e.args)
+            except configparser.NoOptionError:
+                # a KeyError, so that get() and in work as for any mapping
+                raise KeyError(item)
         return cfg.get(name, item)
 
     def __len__(self):
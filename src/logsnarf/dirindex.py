@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_dirindex -*-
+# pylint: disable=invalid-name
+"""Cached listings of watched directories.
+
+Finding the files under a watched directory means listing every directory
+beneath it. A :py:class:`DirectoryIndex` keeps those listings, along with
+each directory's modification time. Adding, removing or renaming a file in
+a directory changes its modification time, so a refresh only lists the
+directories that have changed since, and otherwise just stats each one.
+
+Directories are compared by their modification time in nanoseconds, so a
+file added within the same clock tick as the listing, on a filesystem with
+coarse timestamps, is missed until the directory next changes.
+"""
+
+import os
+
+
+class DirectoryIndex(object):
+    """The log files under a directory."""
+
+    def __init__(self, root, pattern=None, recursive=True):
+        """
+
+        :param root: directory path
+        :type root: str
+        :param pattern: regular expression that file paths must match
+        :type pattern: re.RegexObject or None
+        :param recursive: If true, include subdirectories
+        :type recursive: bool
+        """
+        self.root = root
+        self.pattern = pattern
+        self.recursive = recursive
+        self.listed = 0
+        # directory: (mtime_ns, files, subdirectories)
+        self._dirs = {}
+
+    def __len__(self):
+        return sum(len(files) for _, files, _ in self._dirs.values())
+
+    def refresh(self):
+        """Update the index, and return the files in it.
+
+        :return: file paths
+        :rtype: list(str)
+        """
+        files = []
+        seen = set()
+        stack = [self.root]
+        while stack:
+            d = stack.pop()
+            seen.add(d)
+            listing = self.directory(d)
+            if listing is None:
+                continue
+            files.extend(listing[0])
+            if self.recursive:
+                stack.extend(listing[1])
+        for d in set(self._dirs) - seen:
+            del self._dirs[d]
+        return files
+
+    def directories(self):
+        """The directories in the index.
+
+        :rtype: list(str)
+        """
+        return list(self._dirs)
+
+    def directory(self, d):
+        """Update the index for one directory, and return its listing.
+
+        :param d: directory path
+        :type d: str
+        :return: the directory's files and subdirectories, or None if it
+          has gone
+        :rtype: tuple(list(str), list(str))
+        """
+        try:
+            mtime = os.stat(d).st_mtime_ns
+            cached = self._dirs.get(d)
+            if cached is None or cached[0] != mtime:
+                cached = self._dirs[d] = self._list(d, mtime)
+        except OSError:
+            self._dirs.pop(d, None)
+            return None
+        return cached[1], cached[2]
+
+    def _list(self, d, mtime):
+        """List a directory."""
+        self.listed += 1
+        files, subdirs = [], []
+        pattern = self.pattern
+        with os.scandir(d) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif pattern is None or pattern.match(entry.path):
+                    files.append(entry.path)
+        return mtime, files, subdirs
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_filters -*-
+# pylint: disable=invalid-name
+"""Filtering and routing lines before they're parsed.
+
+Loading and validating a line is by far the most expensive thing done with
+it, so lines that aren't wanted are best thrown away before the schema
+sees them. A :py:class:`LineFilter` checks each raw line against a list of
+rules, and each rule says what to do with the lines it matches:
+
+ * ``drop``: throw the line away.
+ * ``sample``: keep a fraction ``rate`` of the lines, chosen at random, and
+   throw away the rest.
+ * ``route``: load the line as usual, and upload it to ``table`` rather
+   than the table it would otherwise go to.
+
+Rules match in one of three ways:
+
+ * ``substring``: the pattern appears anywhere in the line.
+ * ``prefix``: the line starts with the pattern.
+ * ``regex``: the regular expression matches at the start of the line. Use
+   a leading ``.*`` to match anywhere.
+
+The rules are compiled into a single regular expression, so a line is
+scanned once however many rules there are, and if every rule is anchored
+to the start of the line only its start is looked at. If more than one rule
+matches, the rule matching earliest in the line is used, and of those
+the first listed. Lines that match no rule are kept.
+
+Rules are configured per app section, as a JSON list with ``filters``::
+
+    filters=[
+        {"match": "prefix", "pattern": "{\\"pname\\": \\"CRON\\"", "action": "drop"},
+        {"match": "substring", "pattern": "GET /healthz", "action": "sample",
+         "rate": 0.01},
+        {"match": "regex", "pattern": ".*\\"pname\\": \\"nginx\\"",
+         "action": "route", "table": "nginx", "name": "nginx"}]
+
+Lines dropped and routed are counted by rule, labelled with the rule's
+``name``, or its position in the list if it hasn't got one.
+"""
+
+import random
+import re
+
+from . import metrics
+
+ACTIONS = ['drop', 'sample', 'route']
+MATCHES = ['substring', 'prefix', 'regex']
+
+# Returned by LineFilter for lines to throw away.
+DROP = object()
+
+DROPPED_LINES = metrics.counter(
+    'logsnarf_filter_dropped_lines',
+    'Lines dropped, or sampled out, before parsing.', ['filter', 'rule'])
+ROUTED_LINES = metrics.counter(
+    'logsnarf_filter_routed_lines',
+    'Lines routed to a table before parsing.', ['filter', 'rule'])
+
+
+class Rule(object):
+    """A filter rule."""
+
+    def __init__(self, match, pattern, action, table=None, rate=None,
+                 name=None):
+        """
+
+        :param match: one of :py:data:`MATCHES`
+        :type match: str
+        :param pattern: the substring, prefix, or regular expression
+        :type pattern: str
+        :param action: one of :py:data:`ACTIONS`
+        :type action: str
+        :param table: table to route lines to, for route
+        :type table: str
+        :param rate: fraction of lines to keep, for sample
+        :type rate: float
+        :param name: name the rule's metrics are labelled with
+        :type name: str
+        :raises ValueError: if the rule isn't valid
+        """
+        if match not in MATCHES:
+            raise ValueError('match must be one of %s, not %s' % (
+                MATCHES, match))
+        if action not in ACTIONS:
+            raise ValueError('action must be one of %s, not %s' % (
+                ACTIONS, action))
+        if not pattern:
+            raise ValueError('A filter rule needs a pattern')
+        if action == 'route' and not table:
+            raise ValueError('A route rule needs a table')
+        if action == 'sample':
+            if rate is None or not 0 <= rate <= 1:
+                raise ValueError('A sample rule needs a rate from 0 to 1')
+        self.match = match
+        self.pattern = pattern
+        self.action = action
+        self.table = table
+        self.rate = rate
+        self.name = name
+
+    @classmethod
+    def fromDict(cls, d):
+        """Make a rule from its configuration.
+
+        :param d: rule configuration
+        :type d: dict
+        :rtype: Rule
+        :raises ValueError: if the rule isn't valid
+        """
+        try:
+            return cls(**d)
+        except TypeError as e:
+            raise ValueError('Invalid filter rule %r: %s' % (d, e))
+
+    @property
+    def anchored(self):
+        """True if the rule only matches at the start of a line."""
+        return self.match != 'substring'
+
+    def regex(self):
+        """The rule as a regular expression.
+
+        :rtype: str
+        """
+        if self.match == 'substring':
+            return re.escape(self.pattern)
+        if self.match == 'prefix':
+            return r'\A' + re.escape(self.pattern)
+        return r'\A(?:%s)' % self.pattern
+
+
+class LineFilter(object):
+    """Decides what to do with a line, from a list of rules."""
+
+    def __init__(self, rules, name='default', seed=None):
+        """
+
+        :param rules: rules, or their configuration
+        :type rules: list(Rule or dict)
+        :param name: name the filter's metrics are labelled with
+        :type name: str
+        :param seed: seed for sampling
+        :type seed: int
+        :raises ValueError: if a rule isn't valid
+        """
+        self.name = name
+        self.rules = [r if isinstance(r, Rule) else Rule.fromDict(r)
+                      for r in rules]
+        self.random = random.Random(seed)
+        # Outer group index of each rule. Every rule's pattern is wrapped in
+        # a group, so the last group closed in a match is the rule's.
+        self._groups = {}
+        regexes = []
+        index = 1
+        for i, rule in enumerate(self.rules):
+            regex = rule.regex()
+            try:
+                groups = re.compile(regex).groups
+            except re.error as e:
+                raise ValueError('Invalid filter pattern %r: %s' % (
+                    rule.pattern, e))
+            label = rule.name or str(i)
+            if rule.action == 'route':
+                counter = ROUTED_LINES.labels(name, label)
+            else:
+                counter = DROPPED_LINES.labels(name, label)
+            self._groups[index] = (rule.action, rule.table, rule.rate,
+                                   counter)
+            regexes.append('(%s)' % regex)
+            index += groups + 1
+        pattern = re.compile('|'.join(regexes), re.S)
+        if not self.rules:
+            self._match = lambda line: None
+        elif all(rule.anchored for rule in self.rules):
+            self._match = pattern.match
+        else:
+            self._match = pattern.search
+
+    def __call__(self, line):
+        """What to do with a line.
+
+        :param line: the raw line
+        :type line: str
+        :return: :py:data:`DROP` to drop the line, a table name to route it
+          to, or None to load it as usual
+        """
+        m = self._match(line)
+        if m is None:
+            return None
+        action, table, rate, counter = self._groups[m.lastindex]
+        if action == 'route':
+            counter.inc()
+            return table
+        if action == 'sample' and self.random.random() < rate:
+            return None
+        counter.inc()
+        return DROP
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_handles -*-
+# pylint: disable=invalid-name
+"""Open file handles for log files.
+
+Reading a log file on every modification used to mean opening it, seeking
+to our offset, checking we're at the start of a line, reading and closing
+it again. For files written to thousands of times a second, that's most of
+the system calls made. :py:class:`HandleCache` keeps the files we read
+open instead, up to a limit, closing the least recently read when it's
+reached. A cached file is read from where we left off, including the
+start of any line that hadn't been finished.
+
+An open file is tied to an inode, so a file that's been rotated is still
+the old file. :py:class:`logsnarf.snarf.LogSnarf` compares the inode to
+the path's, and finishes reading the old file before starting on the new
+one. An inode can be reused once its file has been deleted and closed, so
+the first bytes of each file are kept as a fingerprint, and a file
+reopened with the same inode but a different fingerprint is taken to be a
+new file. Fingerprints of closed files are kept until the file is
+forgotten, up to :py:attr:`HandleCache.max_fingerprints`, after which the
+oldest are dropped, and those files are only checked by inode.
+"""
+
+import collections
+import os
+
+from . import metrics
+
+FINGERPRINT_SIZE = 256
+
+OPEN_FILES = metrics.gauge('logsnarf_open_files',
+                           'Log files held open for reading.')
+FILE_OPENS = metrics.counter('logsnarf_file_opens', 'Log files opened.')
+
+
+class OpenFile(object):
+    """A log file open for reading lines."""
+
+    def __init__(self, path, inode, fingerprint=None):
+        """
+
+        :param path: file path
+        :type path: str
+        :param inode: the file's inode
+        :type inode: int
+        :param fingerprint: the file's fingerprint when it was last open
+        :type fingerprint: bytes
+        :raises IOError: if the file can't be opened
+        """
+        self.path = path
+        self.inode = inode
+        self.fp = open(path, 'rb')
+        FILE_OPENS.inc()
+        OPEN_FILES.inc()
+        if os.fstat(self.fp.fileno()).st_ino != inode:
+            self.close()
+            raise IOError('%s was replaced before it was opened' % path)
+        self.fingerprint = self.fp.read(FINGERPRINT_SIZE)
+        # a fingerprint is a prefix of the file, and either may have grown
+        n = min(len(self.fingerprint), len(fingerprint or b''))
+        self.reused = fingerprint is not None and (
+            self.fingerprint[:n] != fingerprint[:n])
+        self.offset = None
+        self.partial = b''
+
+    def seek(self, offset):
+        """Go to offset, or the start of the line it's in.
+
+        :param offset: offset of the start of a line
+        :type offset: int
+        :return: the offset of the start of the line
+        :rtype: int
+        """
+        self.partial = b''
+        if offset:
+            self.fp.seek(max(0, offset - 4096))
+            buf = self.fp.read(offset - max(0, offset - 4096))
+            if not buf.endswith(b'\n'):
+                offset = offset - len(buf) + buf.rfind(b'\n') + 1
+        self.fp.seek(offset)
+        self.offset = offset
+        return offset
+
+    def readline(self):
+        """Read the next complete line.
+
+        :return: the line, including its newline, or None if there isn't a
+          complete line
+        :rtype: bytes
+        """
+        line = self.fp.readline()
+        if self.partial:
+            line = self.partial + line
+            self.partial = b''
+        if not line.endswith(b'\n'):
+            self.partial = line
+            return None
+        self.offset += len(line)
+        return line
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+            OPEN_FILES.dec()
+
+
+class HandleCache(object):
+    """Least recently used cache of open log files."""
+
+    def __init__(self, max_open=256, max_fingerprints=16384):
+        """
+
+        :param max_open: the most files to keep open
+        :type max_open: int
+        :param max_fingerprints: the most fingerprints of closed files to keep
+        :type max_fingerprints: int
+        """
+        self.max_open = max_open
+        self.max_fingerprints = max_fingerprints
+        self._files = collections.OrderedDict()
+        self._fingerprints = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def get(self, path):
+        """The open file for path, if there is one.
+
+        :param path: file path
+        :type path: str
+        :rtype: OpenFile
+        """
+        return self._files.get(path)
+
+    def open(self, path, inode, offset):
+        """Get an open file, positioned at offset.
+
+        If the file had been opened before, and its fingerprint has since
+        changed, the new file is positioned at 0 and its ``reused`` flag is
+        set.
+
+        :param path: file path
+        :type path: str
+        :param inode: the file's current inode
+        :type inode: int
+        :param offset: offset of the start of the next line to read
+        :type offset: int
+        :rtype: OpenFile
+        :raises IOError: if the file can't be opened
+        """
+        f = self._files.get(path)
+        if f is not None and f.inode == inode:
+            self._files.move_to_end(path)
+            if f.offset != offset:
+                f.seek(offset)
+            return f
+        if f is not None:
+            self.close(path)
+        fingerprint = self._fingerprints.pop(path, (None, None))
+        f = OpenFile(path, inode,
+                     fingerprint[1] if fingerprint[0] == inode else None)
+        f.seek(0 if f.reused else offset)
+        self._files[path] = f
+        while len(self._files) > self.max_open:
+            self.close(next(iter(self._files)))
+        return f
+
+    def close(self, path):
+        """Close the file open for path, if there is one.
+
+        :param path: file path
+        :type path: str
+        """
+        f = self._files.pop(path, None)
+        if f is not None:
+            self._fingerprints[path] = (f.inode, f.fingerprint)
+            self._fingerprints.move_to_end(path)
+            while len(self._fingerprints) > self.max_fingerprints:
+                self._fingerprints.popitem(last=False)
+            f.close()
+
+    def rename(self, old, new):
+        """Move the open file for old to new.
+
+        :param old: old file path
+        :type old: str
+        :param new: new file path
+        :type new: str
+        """
+        f = self._files.pop(old, None)
+        if f is not None:
+            f.path = new
+            self.close(new)
+            self._files[new] = f
+        self._fingerprints.pop(old, None)
+
+    def forget(self, path):
+        """Close the file open for path, and forget its fingerprint.
+
+        :param path: file path
+        :type path: str
+        """
+        self.close(path)
+        self._fingerprints.pop(path, None)
+
+    def closeAll(self):
+        """Close every open file."""
+        for path in list(self._files):
+            self.close(path)
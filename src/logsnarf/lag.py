@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_lag -*-
+# pylint: disable=invalid-name
+"""Ingestion lag tracking.
+
+The state file only records how far into each file we've read. The
+:py:class:`LagTracker` compares that with each file's size, to give how
+many bytes behind we are, and estimates how many seconds behind that is.
+
+Sizes are updated as files are read, and by periodically stat()ing every
+known file, which catches growth while the producer is paused. Each time a
+file is seen to grow, the size and the file's modification time are
+recorded. The estimate of seconds behind is the age of the oldest recorded
+size that is past our offset, i.e. roughly when the oldest unread data was
+written.
+
+The tracker can write a snapshot to a JSON file, which ``logsnarf-status``
+reads without involving the running process.
+"""
+
+import collections
+import logging
+import os
+import weakref
+
+import simplejson as json
+from twisted.internet import task
+
+from . import metrics
+
+HISTORY = 64
+
+LAG_BYTES = metrics.gauge(
+    'logsnarf_lag_bytes', 'Bytes not yet read from a log file.', ['path'])
+LAG_SECONDS = metrics.gauge(
+    'logsnarf_lag_seconds', 'Estimated seconds behind on a log file.',
+    ['path'])
+TOTAL_LAG_BYTES = metrics.gauge(
+    'logsnarf_total_lag_bytes', 'Bytes not yet read from all log files.')
+MAX_LAG_SECONDS = metrics.gauge(
+    'logsnarf_max_lag_seconds',
+    'Estimated seconds behind on the furthest behind log file.')
+
+_trackers = weakref.WeakSet()
+TOTAL_LAG_BYTES.labels().setFunction(
+    lambda: sum(t.totalLagBytes() for t in list(_trackers)))
+MAX_LAG_SECONDS.labels().setFunction(
+    lambda: max([t.maxLagSeconds() for t in list(_trackers)] or [0.0]))
+
+
+class FileLag(object):
+    """Size, offset and growth history of one file."""
+
+    __slots__ = ('size', 'offset', 'history')
+
+    def __init__(self):
+        self.size = 0
+        self.offset = 0
+        self.history = collections.deque(maxlen=HISTORY)
+
+
+class LagTracker(object):
+    """Track how far behind we are on a set of files."""
+
+    def __init__(self, reactor=None):
+        """
+
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.files = {}
+        self.snapshot_path = None
+        self._poll_task = task.LoopingCall(self.poll)
+        self._poll_task.clock = reactor
+        _trackers.add(self)
+
+    def setSnapshotPath(self, path):
+        """Write a snapshot of lag to path every poll.
+
+        :param path: path of the snapshot file
+        :type path: str
+        """
+        self.snapshot_path = path
+
+    def start(self, interval=30):
+        """Start polling file sizes.
+
+        :param interval: seconds between polls
+        :type interval: float
+        """
+        if not self._poll_task.running:
+            self._poll_task.start(interval, now=False)
+
+    def stop(self):
+        """Stop polling file sizes."""
+        if self._poll_task.running:
+            self._poll_task.stop()
+
+    def update(self, path, size=None, offset=None, mtime=None):
+        """Record the size of, or our offset into, a file.
+
+        :param path: path of the file
+        :type path: str
+        :param size: current size of the file
+        :type size: int
+        :param offset: offset we have read up to
+        :type offset: int
+        :param mtime: modification time of the file at that size
+        :type mtime: float
+        """
+        f = self.files.get(path)
+        if f is None:
+            f = self.files[path] = FileLag()
+            LAG_BYTES.labels(path).setFunction(
+                lambda: self.lagBytes(path))
+            LAG_SECONDS.labels(path).setFunction(
+                lambda: self.lagSeconds(path))
+        if size is not None and size != f.size:
+            if size < f.size:
+                # truncated or replaced, the history no longer applies.
+                f.history.clear()
+            f.size = size
+            f.history.append((mtime or self.reactor.seconds(), size))
+        if offset is not None:
+            f.offset = offset
+
+    def remove(self, path):
+        """Stop tracking a file."""
+        if self.files.pop(path, None) is not None:
+            LAG_BYTES.remove(path)
+            LAG_SECONDS.remove(path)
+
+    def lagBytes(self, path):
+        """Bytes not yet read from a file."""
+        f = self.files.get(path)
+        if f is None:
+            return 0
+        return max(0, f.size - f.offset)
+
+    def lagSeconds(self, path):
+        """Estimated seconds since the oldest unread data was written."""
+        f = self.files.get(path)
+        if f is None or f.offset >= f.size:
+            return 0.0
+        for t, size in f.history:
+            if size > f.offset:
+                return max(0.0, self.reactor.seconds() - t)
+        return 0.0
+
+    def totalLagBytes(self):
+        """Bytes not yet read from all files."""
+        return sum(self.lagBytes(path) for path in self.files)
+
+    def maxLagSeconds(self):
+        """Estimated seconds behind on the furthest behind file."""
+        return max([self.lagSeconds(path) for path in self.files] or [0.0])
+
+    def poll(self):
+        """stat() every known file, and write a snapshot if configured."""
+        for path in list(self.files):
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.remove(path)
+                continue
+            self.update(path, size=st.st_size, mtime=st.st_mtime)
+        if self.snapshot_path:
+            self.writeSnapshot(self.snapshot_path)
+
+    def snapshot(self):
+        """Return current lag for every file.
+
+        :rtype: dict
+        """
+        return {
+            'time': self.reactor.seconds(),
+            'files': dict(
+                (path, {
+                    'size': f.size,
+                    'offset': f.offset,
+                    'lag_bytes': self.lagBytes(path),
+                    'lag_seconds': self.lagSeconds(path),
+                }) for path, f in self.files.items()),
+        }
+
+    def writeSnapshot(self, path):
+        """Atomically write a snapshot to path."""
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f, sort_keys=True)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            self.log.exception('Unable to write lag snapshot %s', path)
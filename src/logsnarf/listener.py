@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_listener -*-
+# pylint: disable=invalid-name
+"""Syslog network listener.
+
+Receives syslog messages over the network and hands them straight to the
+uploader, rather than having rsyslog write them to files for
+:py:class:`logsnarf.snarf.LogSnarf` to read back. Messages are accepted
+over UDP, one per datagram, and over TCP, framed either with RFC 6587
+octet counting (``LEN SP MSG``) or by newlines. Each connection works out
+its framing from each frame's first byte, as rsyslog does.
+
+Each message is passed to the consumer as one line, so a message must be
+in the form the schema loads: JSON, or the section's ``format``, such as
+``rfc5424``. With rsyslog, either forward with a JSON template::
+
+    action(type="omfwd" target="127.0.0.1" port="5140" protocol="tcp"
+           TCP_Framing="octet-counted" template="json_lines")
+
+or send RFC 5424 messages as they are, with ``format=rfc5424``::
+
+    action(type="omfwd" target="127.0.0.1" port="5140" protocol="tcp"
+           TCP_Framing="octet-counted" template="RSYSLOG_SyslogProtocol23Format")
+
+Newlines within a message are replaced by spaces.
+
+When the uploader pauses the listener, it stops reading from every TCP
+connection, so senders block or queue, and stops reading from the UDP
+socket, so datagrams queue in the kernel until its receive buffer is full
+and are dropped from then on. Messages aren't checkpointed: those buffered
+by the uploader are lost if logsnarf is killed, as they would be had
+they been sent over UDP.
+"""
+
+import logging
+
+from twisted.internet import defer
+from twisted.internet import interfaces
+from twisted.internet import protocol
+from zope.interface import implementer
+
+from . import metrics
+
+MAX_MESSAGE = 64 * 1024
+
+MESSAGES = metrics.counter(
+    'logsnarf_syslog_messages', 'Syslog messages received.',
+    ['listener', 'transport'])
+RECEIVED_BYTES = metrics.counter(
+    'logsnarf_syslog_bytes', 'Syslog message bytes received.',
+    ['listener', 'transport'])
+FRAMING_ERRORS = metrics.counter(
+    'logsnarf_syslog_framing_errors',
+    'TCP connections dropped for a bad or oversized frame.', ['listener'])
+CONNECTIONS = metrics.gauge(
+    'logsnarf_syslog_connections', 'Open syslog TCP connections.',
+    ['listener'])
+
+
+class FramingError(Exception):
+    """A TCP stream that can't be split into messages."""
+
+
+class SyslogStreamProtocol(protocol.Protocol):
+    """Splits a syslog TCP stream into messages.
+
+    Frames starting with a digit are octet counted (RFC 6587 3.4.1), others
+    are terminated by a newline (3.4.2).
+    """
+
+    def __init__(self, listener):
+        self.listener = listener
+        self._buf = b''
+
+    def connectionMade(self):
+        self.listener.connectionMade(self)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.listener.connectionLost(self)
+
+    def dataReceived(self, data):
+        self._buf += data
+        try:
+            messages = self.frames()
+        except FramingError as e:
+            self.listener.framingError(self, e)
+            self.transport.loseConnection()
+            return
+        for message in messages:
+            self.listener.messageReceived(message, 'tcp')
+
+    def frames(self):
+        """Take every complete message from the buffer.
+
+        :rtype: list(bytes)
+        """
+        buf, pos, messages = self._buf, 0, []
+        limit = self.listener.max_message
+        while pos < len(buf):
+            if buf[pos:pos + 1].isdigit():
+                space = buf.find(b' ', pos, pos + 11)
+                if space == -1:
+                    if len(buf) - pos > 10:
+                        raise FramingError('Bad octet count %r' %
+                                           buf[pos:pos + 10])
+                    break
+                length = buf[pos:space]
+                if not length.isdigit():
+                    raise FramingError('Bad octet count %r' % length)
+                length = int(length)
+                if length > limit:
+                    raise FramingError('Message of %d bytes is over the %d '
+                                       'byte limit' % (length, limit))
+                end = space + 1 + length
+                if end > len(buf):
+                    break
+                messages.append(buf[space + 1:end])
+                pos = end
+            else:
+                end = buf.find(b'\n', pos)
+                if end == -1:
+                    if len(buf) - pos > limit:
+                        raise FramingError('Unterminated message over the %d '
+                                           'byte limit' % limit)
+                    break
+                messages.append(buf[pos:end])
+                pos = end + 1
+        self._buf = buf[pos:]
+        return messages
+
+
+class SyslogDatagramProtocol(protocol.DatagramProtocol):
+    """Receives one syslog message per datagram."""
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagramReceived(self, datagram, addr):
+        self.listener.messageReceived(datagram, 'udp')
+
+
+class SyslogStreamFactory(protocol.Factory):
+    def __init__(self, listener):
+        self.listener = listener
+
+    def buildProtocol(self, addr):
+        p = SyslogStreamProtocol(self.listener)
+        p.factory = self
+        return p
+
+
+@implementer(interfaces.IPushProducer)
+class SyslogListener(object):
+    """Listens for syslog messages, and writes them to a consumer.
+
+    implements :twisted:`twisted.internet.interfaces.IPushProducer`
+    """
+
+    def __init__(self, consumer, name='default', reactor=None):
+        """
+
+        :param consumer: a consumer object
+        :type consumer:
+            implements(:twisted:`twisted.internet.interfaces.IConsumer`)
+        :param name: name the listener's metrics are labelled with
+        :type name: str
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.name = name
+        self.consumer = consumer
+        self.max_message = MAX_MESSAGE
+        self.paused = True
+        self.ports = []
+        self.connections = set()
+        self._udp_ports = []
+        self._listen = []
+        self._messages = dict(
+            (t, MESSAGES.labels(name, t)) for t in ('tcp', 'udp'))
+        self._bytes = dict(
+            (t, RECEIVED_BYTES.labels(name, t)) for t in ('tcp', 'udp'))
+        self._framing_errors = FRAMING_ERRORS.labels(name)
+        CONNECTIONS.labels(name).setFunction(lambda: len(self.connections))
+        self._callback = consumer.write
+        self.consumer.registerProducer(self, True)
+
+    def setMaxMessage(self, n):
+        """Set the largest message accepted over TCP, in bytes.
+
+        A connection sending a larger message is dropped. Larger datagrams
+        can't be received.
+
+        :param n: message size limit
+        :type n: int
+        """
+        self.max_message = n
+
+    def listenTCP(self, port, interface='127.0.0.1'):
+        """Listen for syslog over TCP, once started.
+
+        :param port: port to listen on
+        :type port: int
+        :param interface: address to listen on
+        :type interface: str
+        """
+        self._listen.append(('tcp', port, interface))
+
+    def listenUDP(self, port, interface='127.0.0.1'):
+        """Listen for syslog over UDP, once started.
+
+        :param port: port to listen on
+        :type port: int
+        :param interface: address to listen on
+        :type interface: str
+        """
+        self._listen.append(('udp', port, interface))
+
+    def start(self):
+        """Start listening."""
+        for transport, port, interface in self._listen:
+            self.log.info('Listening for syslog on %s %s:%d', transport,
+                          interface, port)
+            if transport == 'tcp':
+                p = self.reactor.listenTCP(port, SyslogStreamFactory(self),
+                                           interface=interface)
+            else:
+                p = self.reactor.listenUDP(port, SyslogDatagramProtocol(self),
+                                           interface=interface,
+                                           maxPacketSize=self.max_message)
+                self._udp_ports.append(p)
+            self.ports.append(p)
+        self.paused = False
+
+    def stop(self):
+        """Stop listening, and close connections.
+
+        :return: a deferred that fires once the ports are closed
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        for conn in list(self.connections):
+            conn.transport.loseConnection()
+        ds = [defer.maybeDeferred(p.stopListening) for p in self.ports]
+        self.ports = []
+        self._udp_ports = []
+        return defer.gatherResults(ds)
+
+    def connectionMade(self, conn):
+        self.connections.add(conn)
+        if self.paused:
+            conn.transport.pauseProducing()
+
+    def connectionLost(self, conn):
+        self.connections.discard(conn)
+
+    def framingError(self, conn, error):
+        self._framing_errors.inc()
+        self.log.error('Dropping syslog connection from %s: %s',
+                       conn.transport.getPeer(), error)
+
+    def messageReceived(self, message, transport):
+        """Pass a message on to the consumer as a line.
+
+        :param message: the message
+        :type message: bytes
+        :param transport: tcp or udp
+        :type transport: str
+        """
+        self._messages[transport].inc()
+        self._bytes[transport].inc(len(message))
+        line = message.decode('utf-8', 'ignore').rstrip('\r\n')
+        if '\n' in line:
+            line = line.replace('\n', ' ')
+        if line:
+            self._callback(line + '\n')
+
+    def pauseProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method
+
+        Stop reading from every connection and socket.
+        """
+        self.paused = True
+        for conn in self.connections:
+            conn.transport.pauseProducing()
+        for port in self._udp_ports:
+            port.stopReading()
+        self.log.debug('Paused producing')
+
+    def resumeProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method
+
+        Start reading again.
+        """
+        self.paused = False
+        for conn in self.connections:
+            conn.transport.resumeProducing()
+        for port in self._udp_ports:
+            port.startReading()
+        self.log.debug('Resumed producing')
+
+    def stopProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method"""
+        self.stop()
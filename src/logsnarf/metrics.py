@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_metrics -*-
+# pylint: disable=invalid-name
+"""Process metrics.
+
+A small metrics library with counters, gauges and histograms, and a
+:twisted:`twisted.web.resource.Resource` that serves them in the Prometheus
+text exposition format.
+
+Metrics are created through the module level :py:func:`counter`,
+:py:func:`gauge` and :py:func:`histogram` functions, which return the
+existing metric if one of that name is already registered. Metrics with
+label names are used through :py:meth:`Metric.labels`. Callers on hot paths
+should keep hold of the child returned by labels(), rather than looking it up
+for every update.
+
+Gauges can be given a function with :py:meth:`GaugeValue.setFunction`, which
+is called at collection time. This is the cheapest way to expose things like
+buffer sizes, which change too often to be worth updating as they change.
+Functions of an object should be made with :py:func:`weakFunction`, so the
+registry doesn't keep the object alive.
+
+Logsnarf exports
+
+ * ``logsnarf_read_lines_total``, ``logsnarf_read_bytes_total`` per file
+ * ``logsnarf_parse_seconds`` and ``logsnarf_parse_errors_total`` by reason
+ * ``logsnarf_buffer_rows``, ``logsnarf_producer_paused``,
+   ``logsnarf_uploads_in_flight``, ``logsnarf_upload_seconds``,
+   ``logsnarf_uploaded_rows_total`` and ``logsnarf_failed_rows_total`` per
+   uploader (app section)
+ * ``logsnarf_service_retries_total`` per dataset, and
+   ``logsnarf_compression_ratio`` per project and dataset
+
+Instrumentation on the per-line path costs under a microsecond per line,
+around five percent of :py:meth:`logsnarf.schema.Schema.loads` on the
+syslog schema, as measured by the ``metrics/`` cases of
+:py:mod:`logsnarf.bench.micro`.
+"""
+
+import bisect
+import logging
+import weakref
+
+from twisted.web import resource
+from twisted.web import server
+
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0,
+                   60.0, 120.0)
+
+
+class CounterValue(object):
+    """A value that only goes up."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        """Increment the counter by n."""
+        self.value += n
+
+    def samples(self):
+        yield '_total', (), self.value
+
+
+class GaugeValue(object):
+    """A value that can go up and down."""
+
+    __slots__ = ('value', '_fn')
+
+    def __init__(self):
+        self.value = 0
+        self._fn = None
+
+    def set(self, value):
+        """Set the gauge to value."""
+        self.value = value
+
+    def inc(self, n=1):
+        """Increment the gauge by n."""
+        self.value += n
+
+    def dec(self, n=1):
+        """Decrement the gauge by n."""
+        self.value -= n
+
+    def setFunction(self, fn):
+        """Take the value of the gauge from fn at collection time.
+
+        :param callable fn: a callable taking no arguments, returning a number
+        """
+        self._fn = fn
+
+    def samples(self):
+        if self._fn is not None:
+            yield '', (), self._fn()
+        else:
+            yield '', (), self.value
+
+
+class HistogramValue(object):
+    """Counts of observations in cumulative buckets."""
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record an observation."""
+        i = bisect.bisect_left(self.bounds, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            yield '_bucket', (('le', formatValue(float(bound))),), cumulative
+        yield '_bucket', (('le', '+Inf'),), self.count
+        yield '_sum', (), self.sum
+        yield '_count', (), self.count
+
+
+class Metric(object):
+    """A named metric, with a value for each combination of label values."""
+
+    type = None
+
+    def __init__(self, name, doc, labelnames=()):
+        """
+
+        :param name: metric name
+        :type name: str
+        :param doc: help text for the metric
+        :type doc: str
+        :param labelnames: names of the labels for this metric
+        :type labelnames: tuple(str)
+        """
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._unlabelled = self._children[()] = self._newChild()
+
+    def _newChild(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Return the value for a combination of label values.
+
+        :param values: label values, in the order of labelnames
+        """
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name,
+                                                           self.labelnames))
+            child = self._children[key] = self._newChild()
+        return child
+
+    def remove(self, *values):
+        """Forget the value for a combination of label values."""
+        self._children.pop(tuple(str(v) for v in values), None)
+
+    def collect(self):
+        """Return the metric in Prometheus text format.
+
+        :rtype: list(str)
+        """
+        lines = ['# HELP %s %s' % (self.name, escapeHelp(self.doc)),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for key, child in sorted(self._children.items()):
+            labels = list(zip(self.labelnames, key))
+            for suffix, extra, value in child.samples():
+                lines.append('%s%s%s %s' % (
+                    self.name, suffix, formatLabels(labels + list(extra)),
+                    formatValue(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _newChild(self):
+        return CounterValue()
+
+    def inc(self, n=1):
+        """Increment an unlabelled counter by n."""
+        self._unlabelled.inc(n)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _newChild(self):
+        return GaugeValue()
+
+    def set(self, value):
+        """Set an unlabelled gauge to value."""
+        self._unlabelled.set(value)
+
+    def inc(self, n=1):
+        """Increment an unlabelled gauge by n."""
+        self._unlabelled.inc(n)
+
+    def dec(self, n=1):
+        """Decrement an unlabelled gauge by n."""
+        self._unlabelled.dec(n)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, doc, labelnames)
+
+    def _newChild(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        """Record an observation in an unlabelled histogram."""
+        self._unlabelled.observe(value)
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Register a metric, or return the one already of that name.
+
+        :raises ValueError: if a different type of metric has that name
+        """
+        existing = self.metrics.get(metric.name)
+        if existing is None:
+            self.metrics[metric.name] = metric
+            return metric
+        if existing.type != metric.type or \
+                existing.labelnames != metric.labelnames:
+            raise ValueError('Metric %s already registered as a %s with '
+                             'labels %s' % (metric.name, existing.type,
+                                            existing.labelnames))
+        return existing
+
+    def exposition(self):
+        """Return all metrics in Prometheus text format.
+
+        :rtype: bytes
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].collect())
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+
+REGISTRY = Registry()
+
+
+def counter(name, doc, labelnames=(), registry=REGISTRY):
+    """Create or fetch a counter.
+
+    Counter names should not include the _total suffix, it's added on
+    exposition.
+    """
+    return registry.register(Counter(name, doc, labelnames))
+
+
+def gauge(name, doc, labelnames=(), registry=REGISTRY):
+    """Create or fetch a gauge."""
+    return registry.register(Gauge(name, doc, labelnames))
+
+
+def histogram(name, doc, labelnames=(), buckets=DEFAULT_BUCKETS,
+              registry=REGISTRY):
+    """Create or fetch a histogram."""
+    return registry.register(Histogram(name, doc, labelnames, buckets))
+
+
+def weakFunction(obj, fn):
+    """A gauge function, taking fn of obj through a weak reference.
+
+    This keeps a gauge from keeping obj alive. Once obj is gone the gauge
+    reads 0.
+
+    :param obj: the object the gauge measures
+    :param callable fn: a callable taking obj, returning a number
+    :rtype: callable
+    """
+    ref = weakref.ref(obj)
+
+    def value():
+        o = ref()
+        return 0 if o is None else fn(o)
+    return value
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def escapeHelp(doc):
+    return doc.replace('\\', r'\\').replace('\n', r'\n')
+
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, v.replace('\\', r'\\').replace('\n', r'\n')
+                     .replace('"', r'\"'))
+        for k, v in labels)
+
+
+class MetricsResource(resource.Resource):
+    """Serves a registry in Prometheus text format."""
+
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    # noinspection PyPep8Naming
+    def render_GET(self, request):
+        request.setHeader(b'content-type', CONTENT_TYPE)
+        return self.registry.exposition()
+
+
+def listen(port, interface='127.0.0.1', registry=REGISTRY, reactor=None):
+    """Serve metrics over HTTP.
+
+    :param port: TCP port to listen on
+    :type port: int
+    :param interface: address to listen on
+    :type interface: str
+    :return: the listening port
+    :rtype: :twisted:`twisted.internet.interfaces.IListeningPort`
+    """
+    if not reactor:
+        from twisted.internet import reactor
+    logging.info('Serving metrics on %s:%d', interface, port)
+    return reactor.listenTCP(port, server.Site(MetricsResource(registry)),
+                             interface=interface)
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_notifier -*-
+# pylint: disable=invalid-name
+"""Sharing an inotify file descriptor between app sections.
+
+Each :py:class:`logsnarf.snarf.LogSnarf` used to have an inotify file
+descriptor of its own. App sections watching the same directories then took
+a kernel watch each for them, and were each told of every change.
+
+A :py:class:`Notifier` owns one inotify file descriptor, and hands out a
+:py:class:`NotifierClient` to each LogSnarf. A directory watched by several
+clients has one kernel watch, with the events any of them want, and each
+event is passed to the clients watching for it. App sections share the
+notifier from :py:func:`sharedNotifier`.
+
+Each client pauses on its own, so that one section waiting on its uploads
+doesn't hold up the others. Events for a paused client are queued, up to
+:py:data:`MAX_QUEUED_EVENTS`, after which they're dropped and the client is
+told its queue overflowed when it resumes, as the kernel would, so it
+rescans. The file descriptor itself is only left unread when every client
+is paused, leaving the events queued in the kernel, as before.
+
+Twisted's :twisted:`twisted.internet.inotify.INotify` has no public way to
+get IN_Q_OVERFLOW events, which aren't for any watch, or to add events to a
+watch, so :py:class:`INotify` does both through its internals. Those are
+only used in :py:meth:`INotify.watchOverflow` and :py:meth:`INotify.setMask`,
+Twisted is pinned in pyproject.toml, and
+``logsnarf.test.test_notifier.TwistedInternalsTestCase`` fails if the
+internals change.
+"""
+
+import collections
+import functools
+import logging
+
+from twisted.internet import inotify
+from twisted.python import filepath
+
+# The watch descriptor of IN_Q_OVERFLOW events, -1 as an unsigned int.
+OVERFLOW_WD = 0xFFFFFFFF
+# Events kept for a paused client before it's treated as overflowed, the
+# kernel's default fs.inotify.max_queued_events.
+MAX_QUEUED_EVENTS = 16384
+# Events on the watched directory itself, passed to every client of it.
+SELF_EVENTS = (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF |
+               inotify.IN_UNMOUNT)
+
+_notifiers = {}
+
+
+def sharedNotifier(reactor=None):
+    """Return the notifier shared by app sections, creating it if needed.
+
+    :param reactor: twisted reactor
+    :type reactor: :twisted:`twisted.internet.reactor`
+    :rtype: Notifier
+    """
+    if not reactor:
+        from twisted.internet import reactor
+    if reactor not in _notifiers:
+        _notifiers[reactor] = Notifier(reactor)
+    return _notifiers[reactor]
+
+
+class INotify(inotify.INotify):
+    """An INotify that stays open when a watched directory is deleted.
+
+    Twisted's closes its file descriptor when any watched directory is
+    deleted, which loses the watches of every other directory with it.
+    """
+
+    def loseConnection(self, _connDone=None):
+        # called by INotify._doRead on IN_DELETE_SELF, the watch is already
+        # removed. Use close() to close it.
+        pass
+
+    def close(self):
+        """Close the inotify file descriptor."""
+        inotify.INotify.loseConnection(self)
+
+    def watchOverflow(self, callback):
+        """Call callback, as an inotify callback, on IN_Q_OVERFLOW.
+
+        Overflow events aren't for any watch, so INotify would drop them.
+
+        :param callback: the callback
+        :type callback: callable
+        """
+        self._watchpoints[OVERFLOW_WD] = inotify._Watch(
+            filepath.FilePath('/'), inotify.IN_Q_OVERFLOW,
+            callbacks=[callback])
+
+    def setMask(self, path, mask):
+        """Change the events watched for in a watched directory.
+
+        The kernel replaces a watch's mask when it's added again.
+
+        :param path: the watched directory
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        :param mask: the events to watch for
+        :type mask: int
+        """
+        mask |= inotify.IN_DELETE_SELF
+        wd = self._inotify.add(self._fd, path.asBytesMode(), mask)
+        self._watchpoints[wd].mask = mask
+
+
+class Notifier(object):
+    """One inotify file descriptor, shared by several clients."""
+
+    def __init__(self, reactor=None, inotifier=None):
+        """
+
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        :param inotifier: the inotify file descriptor to use, by default a
+          new one
+        :type inotifier: INotify
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if inotifier is None:
+            inotifier = INotify(reactor=reactor)
+        self._inotifier = inotifier
+        inotifier.watchOverflow(self._overflowed)
+        # watched directory: {client: mask}
+        self._watchers = {}
+        self.clients = []
+        self.reading = False
+        self.paused = False
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __contains__(self, d):
+        return d in self._watchers
+
+    def client(self, overflow=None, max_queued=MAX_QUEUED_EVENTS):
+        """A new client.
+
+        :param overflow: called, as an inotify callback, when events for the
+          client have been lost
+        :type overflow: callable
+        :param max_queued: events to queue while the client is paused
+        :type max_queued: int
+        :rtype: NotifierClient
+        """
+        c = NotifierClient(self, overflow, max_queued)
+        self.clients.append(c)
+        return c
+
+    def startReading(self):
+        """Start reading events."""
+        if not self.reading:
+            self.reading = True
+            self._inotifier.startReading()
+
+    def watch(self, client, path, mask):
+        """Watch a directory for a client.
+
+        :param client: the client
+        :type client: NotifierClient
+        :param path: directory to watch
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        :param mask: events the client wants
+        :type mask: int
+        :raises twisted.internet.inotify.INotifyError: if the kernel won't
+          watch it
+        """
+        d = path.asTextMode().path
+        watchers = self._watchers.get(d)
+        if watchers is None:
+            self._inotifier.watch(
+                path, mask=mask,
+                callbacks=[functools.partial(self._notified, d)])
+            self._watchers[d] = {client: mask}
+            return
+        wanted = 0
+        for m in watchers.values():
+            wanted |= m
+        if mask & ~wanted:
+            self._inotifier.setMask(path, wanted | mask)
+        watchers[client] = mask
+
+    def ignore(self, client, path):
+        """Stop watching a directory for a client.
+
+        :raises KeyError: if the client isn't watching it
+        """
+        d = path.asTextMode().path
+        watchers = self._watchers.get(d, {})
+        del watchers[client]
+        if not watchers:
+            del self._watchers[d]
+            self._inotifier.ignore(path)
+
+    def clientPaused(self):
+        """Stop reading events if every client is paused."""
+        if not self.paused and all(c.paused for c in self.clients):
+            self.paused = True
+            self._inotifier.pauseProducing()
+
+    def clientResumed(self):
+        """Read events again, for a client that has resumed."""
+        if self.paused:
+            self.paused = False
+            self._inotifier.resumeProducing()
+
+    def close(self):
+        """Stop watching everything."""
+        self._watchers.clear()
+        self._inotifier.close()
+
+    def _notified(self, d, ignored, path, mask):
+        """The callback given to :twisted:`twisted.internet.inotify.INotify`
+        for the watch on directory d.
+        """
+        watchers = self._watchers.get(d)
+        if watchers is None:
+            return
+        for client, wanted in list(watchers.items()):
+            if mask & (wanted | SELF_EVENTS):
+                client.notify(d, path, mask)
+        if mask & inotify.IN_DELETE_SELF:
+            # INotify removes the watch
+            del self._watchers[d]
+
+    def _overflowed(self, ignored, path, mask):
+        """The callback for IN_Q_OVERFLOW, which every client needs."""
+        for client in self.clients:
+            client.overflowed()
+
+
+class NotifierClient(object):
+    """What a LogSnarf sees of a :py:class:`Notifier`.
+
+    Watches are made and removed as with
+    :twisted:`twisted.internet.inotify.INotify`, and the client is paused and
+    resumed in its place.
+    """
+
+    def __init__(self, notifier, overflow=None,
+                 max_queued=MAX_QUEUED_EVENTS):
+        self.notifier = notifier
+        self.overflow = overflow
+        self.max_queued = max_queued
+        self.paused = False
+        # watched directory: callbacks
+        self._callbacks = {}
+        # (directory, path, mask) of events while paused
+        self._queue = collections.deque()
+        self._overflowed = False
+
+    def __len__(self):
+        return len(self._callbacks)
+
+    def startReading(self):
+        self.notifier.startReading()
+
+    def watch(self, path, mask=inotify.IN_WATCH_MASK, autoAdd=False,
+              callbacks=None, recursive=False):
+        """Watch a directory, calling callbacks with its events.
+
+        :param path: the directory
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        :param mask: the events to watch for
+        :type mask: int
+        :param callbacks: inotify callbacks
+        :type callbacks: list(callable)
+        """
+        if autoAdd or recursive:
+            raise ValueError('Directories are watched one at a time')
+        self.notifier.watch(self, path, mask)
+        self._callbacks[path.asTextMode().path] = callbacks or []
+
+    def ignore(self, path):
+        """Stop watching a directory.
+
+        :raises KeyError: if it isn't watched
+        """
+        self.notifier.ignore(self, path)
+        self._callbacks.pop(path.asTextMode().path, None)
+
+    def pauseProducing(self):
+        self.paused = True
+        self.notifier.clientPaused()
+
+    def resumeProducing(self):
+        self.paused = False
+        self.notifier.clientResumed()
+        queue = self._queue
+        while queue and not self.paused:
+            self._deliver(*queue.popleft())
+        if self._overflowed and not self.paused:
+            self._overflowed = False
+            self._deliverOverflow()
+
+    def notify(self, d, path, mask):
+        """Pass on, or queue, an event for the watch on directory d."""
+        if not self.paused:
+            self._deliver(d, path, mask)
+        elif self._overflowed:
+            pass
+        elif len(self._queue) >= self.max_queued:
+            # rescanning will find the changes these were for
+            self._queue.clear()
+            self._overflowed = True
+        else:
+            self._queue.append((d, path, mask))
+
+    def overflowed(self):
+        """The kernel's event queue has overflowed."""
+        if self.paused:
+            self._queue.clear()
+            self._overflowed = True
+        else:
+            self._deliverOverflow()
+
+    def _deliver(self, d, path, mask):
+        if mask & inotify.IN_DELETE_SELF:
+            callbacks = self._callbacks.pop(d, ())
+        else:
+            callbacks = self._callbacks.get(d, ())
+        for callback in callbacks:
+            callback(None, path, mask)
+
+    def _deliverOverflow(self):
+        if self.overflow is not None:
+            self.overflow(None, filepath.FilePath('/'),
+                          inotify.IN_Q_OVERFLOW)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_parsers -*-
+# pylint: disable=invalid-name
+"""Line format parsers.
+
+By default :py:meth:`logsnarf.schema.Schema.loads` expects each line to be a
+JSON document. The parsers here let lines in other formats be loaded
+without templating them into JSON first:
+
+ * ``rfc5424``: syslog messages as defined by RFC 5424.
+ * ``rfc3164``: BSD syslog messages, as described by RFC 3164, including
+   rsyslog's variant with an RFC 3339 timestamp.
+ * ``logfmt``: ``key=value`` pairs, with double quoted values.
+ * ``regex``: a regular expression with named groups.
+
+Each parser turns a line into a flat dict of field names to values, and
+raises ValueError if the line doesn't parse. Names with dots refer to fields
+of records, as they do in :py:meth:`~logsnarf.schema.Schema.setFieldValidator`.
+The syslog parsers produce the field names of the syslog schema in
+:doc:`schema_file`:
+
+================ ====================================================
+``timereported`` the message's timestamp, as a float
+``time``         when the message was parsed, as rsyslog's ``timegenerated``
+``host``         hostname
+``pname``        app-name (RFC 5424) or tag (RFC 3164)
+``pid``          procid, or the pid in the tag
+``msgid``        msgid (RFC 5424)
+``sev``          severity name, e.g. ``err``
+``syslog.fac``   facility name, e.g. ``auth``
+``syslog.pri``   priority value
+``msg``          the message
+================ ====================================================
+
+and RFC 5424 structured data parameters as ``<SD-ID>.<PARAM-NAME>``. Nil
+(``-``) values are left out. The schema renames these to other fields if
+given a mapping, and drops any that aren't in the schema. See
+:py:meth:`~logsnarf.schema.Schema.setParser`.
+
+Timestamps are converted with a compiled regular expression rather than
+dateutil, which is several times faster, and values are otherwise left as
+strings for the schema's validators to coerce.
+"""
+
+import calendar
+import datetime
+import re
+import time
+
+import pytz
+
+FORMATS = ['json', 'rfc5424', 'rfc3164', 'logfmt', 'regex']
+
+SEVERITIES = ['emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info',
+              'debug']
+FACILITIES = ['kern', 'user', 'mail', 'daemon', 'auth', 'syslog', 'lpr',
+              'news', 'uucp', 'cron', 'authpriv', 'ftp', 'ntp', 'security',
+              'console', 'solaris-cron', 'local0', 'local1', 'local2',
+              'local3', 'local4', 'local5', 'local6', 'local7']
+MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec']))
+
+# Priority value to (severity, facility, pri), built once.
+PRIORITIES = dict(
+    (str(pri), (SEVERITIES[pri & 7], FACILITIES[pri >> 3], str(pri)))
+    for pri in range(len(FACILITIES) * 8))
+
+RFC3339_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d+)?'
+    r'(?:(Z)|([+-])(\d\d):?(\d\d))?$', re.I)
+SD_PARAM = r' [^= \]]+="(?:[^"\\]|\\.)*"'
+SD_ELEMENT_RE = re.compile(r'\[([^ \]]+)((?:%s)*)\]' % SD_PARAM)
+SD_PARAM_RE = re.compile(r' ([^= \]]+)="((?:[^"\\]|\\.)*)"')
+RFC5424_RE = re.compile(
+    r'<(\d{1,3})>1 (\S+) (\S+) (\S+) (\S+) (\S+) '
+    r'(-|(?:\[[^ \]]+(?:%s)*\])+)(?: (.*))?$' % SD_PARAM, re.S)
+RFC3164_RE = re.compile(
+    r'<(\d{1,3})>'
+    r'(?:([A-Z][a-z]{2}) ([ \d]\d) (\d\d):(\d\d):(\d\d)|(\d{4}-\S+)) '
+    r'(\S+) '
+    r'(?:([^:\[\s]+)(?:\[([^\]]*)\])?: ?)?(.*)$', re.S)
+LOGFMT_RE = re.compile(r'([^\s=]+)(?:=(?:"((?:[^"\\]|\\.)*)"|(\S*)))?')
+ESCAPE_RE = re.compile(r'\\(.)')
+
+
+def _unescape(value):
+    if '\\' in value:
+        return ESCAPE_RE.sub(r'\1', value)
+    return value
+
+
+class TimestampParser(object):
+    """Converts RFC 3339 timestamps to unix timestamps."""
+
+    def __init__(self, default_tz=pytz.UTC):
+        """
+
+        :param default_tz: timezone of timestamps without an offset
+        :type default_tz: datetime.tzinfo
+        """
+        self.default_tz = default_tz
+
+    def __call__(self, value):
+        """
+        :param value: an RFC 3339 timestamp
+        :type value: str
+        :rtype: float
+        :raises ValueError: if value isn't an RFC 3339 timestamp
+        """
+        m = RFC3339_RE.match(value)
+        if not m:
+            raise ValueError('Invalid timestamp %r' % value)
+        (year, month, day, hour, minute, second, frac, zulu, sign, off_h,
+         off_m) = m.groups()
+        fields = (int(year), int(month), int(day), int(hour), int(minute),
+                  int(second))
+        frac = float(frac) if frac else 0.0
+        if zulu or sign:
+            ts = calendar.timegm(fields)
+            if sign:
+                offset = int(off_h) * 3600 + int(off_m) * 60
+                ts -= offset if sign == '+' else -offset
+            return ts + frac
+        return self.local(fields) + frac
+
+    def local(self, fields):
+        """Unix timestamp of a time in the default timezone.
+
+        :param fields: year, month, day, hour, minute and second
+        :type fields: tuple(int)
+        :rtype: float
+        """
+        if self.default_tz is pytz.UTC:
+            return calendar.timegm(fields)
+        dt = datetime.datetime(*fields)
+        if hasattr(self.default_tz, 'localize'):
+            dt = self.default_tz.localize(dt)
+        else:
+            dt = dt.replace(tzinfo=self.default_tz)
+        return calendar.timegm(dt.utctimetuple())
+
+
+def _priority(result, pri):
+    try:
+        (result['sev'], result['syslog.fac'],
+         result['syslog.pri']) = PRIORITIES[pri]
+    except KeyError:
+        raise ValueError('Invalid priority %s' % pri)
+
+
+class RFC5424Parser(object):
+    """Parses RFC 5424 syslog messages."""
+
+    def __init__(self, default_tz=pytz.UTC, clock=time.time):
+        """
+
+        :param default_tz: timezone of timestamps without an offset
+        :type default_tz: datetime.tzinfo
+        :param clock: function returning the current time
+        :type clock: callable
+        """
+        self.timestamp = TimestampParser(default_tz)
+        self.clock = clock
+
+    def __call__(self, line):
+        m = RFC5424_RE.match(line.rstrip('\r\n'))
+        if not m:
+            raise ValueError('Not an RFC 5424 message: %r' % line[:80])
+        pri, ts, host, app, procid, msgid, sd, msg = m.groups()
+        result = {'time': self.clock()}
+        _priority(result, pri)
+        if ts != '-':
+            result['timereported'] = self.timestamp(ts)
+        for name, value in (('host', host), ('pname', app), ('pid', procid),
+                            ('msgid', msgid)):
+            if value != '-':
+                result[name] = value
+        if sd and sd != '-':
+            for sd_id, params in SD_ELEMENT_RE.findall(sd):
+                for name, value in SD_PARAM_RE.findall(params):
+                    result['%s.%s' % (sd_id, name)] = _unescape(value)
+        if msg:
+            if msg.startswith('\ufeff'):
+                msg = msg[1:]
+            result['msg'] = msg
+        return result
+
+
+class RFC3164Parser(object):
+    """Parses BSD syslog messages.
+
+    These timestamps have no year. It's taken to be the current year, or the
+    previous one if that would put the message more than a day in the
+    future, as it would for messages from December read in January.
+    """
+
+    def __init__(self, default_tz=pytz.UTC, clock=time.time):
+        """
+
+        :param default_tz: timezone of the timestamps
+        :type default_tz: datetime.tzinfo
+        :param clock: function returning the current time
+        :type clock: callable
+        """
+        self.timestamp = TimestampParser(default_tz)
+        self.clock = clock
+
+    def __call__(self, line):
+        m = RFC3164_RE.match(line.rstrip('\r\n'))
+        if not m:
+            raise ValueError('Not an RFC 3164 message: %r' % line[:80])
+        (pri, month, day, hour, minute, second, iso, host, tag, pid,
+         msg) = m.groups()
+        now = self.clock()
+        result = {'time': now}
+        _priority(result, pri)
+        if iso:
+            result['timereported'] = self.timestamp(iso)
+        else:
+            if month not in MONTHS:
+                raise ValueError('Invalid month %r' % month)
+            year = time.gmtime(now).tm_year
+            fields = (MONTHS[month], int(day), int(hour),
+                      int(minute), int(second))
+            ts = self.timestamp.local((year,) + fields)
+            if ts > now + 86400:
+                ts = self.timestamp.local((year - 1,) + fields)
+            result['timereported'] = float(ts)
+        result['host'] = host
+        if tag:
+            result['pname'] = tag
+        if pid:
+            result['pid'] = pid
+        if msg:
+            result['msg'] = msg
+        return result
+
+
+class LogfmtParser(object):
+    """Parses logfmt lines.
+
+    Keys without a value are taken as true.
+    """
+
+    def __call__(self, line):
+        result = {}
+        for key, quoted, bare in LOGFMT_RE.findall(line):
+            if quoted:
+                result[key] = _unescape(quoted)
+            elif bare:
+                result[key] = bare
+            else:
+                result[key] = True
+        if not result:
+            raise ValueError('No logfmt pairs in %r' % line[:80])
+        return result
+
+
+class RegexParser(object):
+    """Parses lines with a regular expression's named groups.
+
+    Groups that don't match are left out.
+    """
+
+    def __init__(self, pattern):
+        """
+
+        :param pattern: regular expression, with named groups
+        :type pattern: str or re.RegexObject
+        :raises ValueError: if the pattern has no named groups
+        """
+        if not hasattr(pattern, 'match'):
+            pattern = re.compile(pattern)
+        if not pattern.groupindex:
+            raise ValueError('%s has no named groups' % pattern.pattern)
+        self.pattern = pattern
+
+    def __call__(self, line):
+        m = self.pattern.match(line.rstrip('\r\n'))
+        if not m:
+            raise ValueError('Line does not match %s: %r' % (
+                self.pattern.pattern, line[:80]))
+        return dict((k, v) for k, v in m.groupdict().items() if v is not None)
+
+
+def build(fmt, regex=None, default_tz=pytz.UTC):
+    """Build the parser for a format.
+
+    :param fmt: one of :py:data:`FORMATS`
+    :type fmt: str
+    :param regex: the pattern, for the regex format
+    :type regex: str
+    :param default_tz: timezone of timestamps without one
+    :type default_tz: datetime.tzinfo
+    :return: a parser, or None for json
+    :rtype: callable
+    :raises ValueError: for an unknown format
+    """
+    if fmt == 'json':
+        return None
+    if fmt == 'rfc5424':
+        return RFC5424Parser(default_tz)
+    if fmt == 'rfc3164':
+        return RFC3164Parser(default_tz)
+    if fmt == 'logfmt':
+        return LogfmtParser()
+    if fmt == 'regex':
+        if not regex:
+            raise ValueError('The regex format needs a pattern')
+        return RegexParser(regex)
+    raise ValueError('format must be one of %s, not %s' % (FORMATS, fmt))
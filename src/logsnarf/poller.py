@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_poller -*-
+# pylint: disable=invalid-name
+"""Watching directories by polling.
+
+inotify doesn't see changes made over NFS by other hosts, and can miss
+changes on overlay filesystems. A :py:class:`Poller` watches a directory
+by stat'ing the files in it instead, and reports the changes it finds as
+the inotify events :py:class:`logsnarf.snarf.LogSnarf` would have had:
+
+ * ``IN_CREATE`` for a new file
+ * ``IN_MODIFY`` for a file whose inode, size or modification time changed
+ * ``IN_MOVED_FROM`` and ``IN_MOVED_TO`` for a file renamed within its
+   directory, found by its inode, followed by ``IN_MODIFY`` if another file
+   has taken its place
+ * ``IN_MOVED_FROM`` and then ``IN_DELETE`` for a file that has gone
+
+A file renamed into another directory is seen as deleted and created.
+
+Each directory is polled on its own schedule. A directory with changes is
+polled again after ``min_interval`` seconds, and each poll that finds
+nothing doubles its interval, up to ``max_interval``, so quiet directories
+cost little. Listings come from a :py:class:`logsnarf.dirindex.DirectoryIndex`,
+so a directory is only listed again when its modification time changes,
+but every file in it is stat'ed each time it's polled.
+
+Polling is chosen per app section with ``watcher=poll``. It's also how
+:py:class:`logsnarf.watches.WatchManager` watches the directories it has no
+inotify watches for. It adds and removes directories itself, and creates the
+Poller with ``recursive=False``, so that new subdirectories are reported
+as ``IN_CREATE | IN_ISDIR`` rather than polled.
+"""
+
+import os
+
+from twisted.internet import inotify
+
+from . import metrics
+
+POLLS = metrics.counter('logsnarf_poller_polls', 'Directories polled.')
+POLLED_FILES = metrics.counter('logsnarf_poller_files',
+                               'Files stat\'ed while polling.')
+
+
+class Poller(object):
+    """Polls the directories in an index for changed files."""
+
+    def __init__(self, index, callback, min_interval=1.0, max_interval=30.0,
+                 reactor=None, recursive=True):
+        """
+
+        :param index: the directories to poll
+        :type index: logsnarf.dirindex.DirectoryIndex
+        :param callback: called with the path of a changed file, and the
+          inotify event mask for the change
+        :type callback: callable
+        :param min_interval: seconds between polls of an active directory
+        :type min_interval: float
+        :param max_interval: seconds between polls of a quiet directory
+        :type max_interval: float
+        :param recursive: if true, poll new subdirectories of a recursive
+          index, otherwise report them to the callback
+        :type recursive: bool
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.index = index
+        self.callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.recursive = recursive
+        self.paused = True
+        self.running = False
+        # directory: [interval, DelayedCall]
+        self._schedule = {}
+        # directory: the files in it when it was last polled
+        self._files = {}
+        # directory: its subdirectories when it was last polled
+        self._subdirs = {}
+        # file: (inode, size, mtime_ns)
+        self._stats = {}
+
+    def snapshot(self):
+        """Record the state of every file, without reporting anything."""
+        self.index.refresh()
+        for d in self.index.directories():
+            self.poll(d, report=False)
+
+    def start(self):
+        """Start polling.
+
+        Polls of the directories in the index are spread over
+        ``min_interval``, rather than all made at once.
+        """
+        self.paused = False
+        self.running = True
+        dirs = [d for d, (_, call) in self._schedule.items() if call is None]
+        for i, d in enumerate(dirs):
+            self._schedule[d][1] = self.reactor.callLater(
+                self.min_interval * i / len(dirs), self._poll, d)
+
+    def stop(self):
+        """Stop polling."""
+        self.paused = True
+        self.running = False
+        for entry in self._schedule.values():
+            if entry[1] is not None and entry[1].active():
+                entry[1].cancel()
+            entry[1] = None
+
+    def __len__(self):
+        return len(self._schedule)
+
+    def __contains__(self, d):
+        return d in self._schedule
+
+    def add(self, d, report=False):
+        """Start polling a directory.
+
+        :param d: directory path
+        :type d: str
+        :param report: if true, report the files already in it as created
+        :type report: bool
+        """
+        if d in self._schedule:
+            return
+        self.poll(d, report)
+        entry = self._schedule.get(d)
+        if entry is not None and self.running:
+            entry[1] = self.reactor.callLater(entry[0], self._poll, d)
+
+    def remove(self, d):
+        """Stop polling a directory.
+
+        :param d: directory path
+        :type d: str
+        """
+        self._forget(d, report=False)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def interval(self, d):
+        """Seconds until a directory is next polled.
+
+        :param d: directory path
+        :type d: str
+        :rtype: float
+        """
+        return self._schedule[d][0]
+
+    def _poll(self, d):
+        """Poll a directory on its schedule."""
+        entry = self._schedule.get(d)
+        if entry is None:
+            return
+        if not self.paused:
+            if self.poll(d):
+                entry[0] = self.min_interval
+            else:
+                entry[0] = min(entry[0] * 2, self.max_interval)
+            if d not in self._schedule:
+                # gone
+                return
+        entry[1] = self.reactor.callLater(entry[0], self._poll, d)
+
+    def poll(self, d, report=True):
+        """Stat the files in a directory, and report those that changed.
+
+        :param d: directory path
+        :type d: str
+        :param report: if false, record what's there without reporting it
+        :type report: bool
+        :return: True if anything changed
+        :rtype: bool
+        """
+        POLLS.inc()
+        listing = self.index.directory(d)
+        if d not in self._schedule:
+            self._schedule[d] = [self.min_interval, None]
+        old = self._files.get(d, ())
+        if listing is None:
+            self._forget(d, report)
+            return bool(old)
+        files, subdirs = listing
+        stats = {}
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            stats[f] = (st.st_ino, st.st_size, st.st_mtime_ns)
+        POLLED_FILES.inc(len(files))
+        self._files[d] = set(stats)
+
+        # inodes no longer at their path, that may turn up at another
+        moved_from = {}
+        for f in old:
+            prev = self._stats[f]
+            if f not in stats:
+                del self._stats[f]
+                moved_from[prev[0]] = f
+            elif stats[f][0] != prev[0]:
+                moved_from[prev[0]] = f
+        created, modified = [], []
+        for f, st in stats.items():
+            prev = self._stats.get(f)
+            if prev is None:
+                created.append(f)
+            elif prev != st:
+                modified.append(f)
+            self._stats[f] = st
+
+        new_dirs = []
+        if self.index.recursive and self.recursive:
+            new_dirs = [s for s in subdirs if s not in self._schedule]
+            for s in new_dirs:
+                self._schedule[s] = [self.min_interval, None]
+        elif self.index.recursive:
+            known = self._subdirs.get(d, ())
+            new_dirs = [s for s in subdirs if s not in known]
+            self._subdirs[d] = set(subdirs)
+        if report:
+            self._report(moved_from, created, modified, stats)
+            for s in new_dirs:
+                if self.recursive:
+                    self._poll(s)
+                else:
+                    self.callback(s, inotify.IN_CREATE | inotify.IN_ISDIR)
+        return bool(moved_from or created or modified or new_dirs)
+
+    def _report(self, moved_from, created, modified, stats):
+        """Call the callback with the changes found in a directory."""
+        callback = self.callback
+        for f in moved_from.values():
+            callback(f, inotify.IN_MOVED_FROM)
+        for f in created:
+            moved = moved_from.pop(stats[f][0], None) is not None
+            callback(f, inotify.IN_MOVED_TO if moved else inotify.IN_CREATE)
+        for f in modified:
+            callback(f, inotify.IN_MODIFY)
+        for f in moved_from.values():
+            if f not in stats:
+                callback(f, inotify.IN_DELETE)
+
+    def _forget(self, d, report):
+        """Stop polling a directory, reporting its files as deleted."""
+        entry = self._schedule.pop(d, None)
+        if entry is not None and entry[1] is not None and entry[1].active():
+            entry[1].cancel()
+        self._subdirs.pop(d, None)
+        for f in self._files.pop(d, ()):
+            self._stats.pop(f, None)
+            if report:
+                self.callback(f, inotify.IN_DELETE)
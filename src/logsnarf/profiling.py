@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_profiling -*-
+# pylint: disable=invalid-name
+"""Runtime profiling.
+
+A running logsnarf can be profiled without restarting it. Sending it
+SIGUSR1 profiles it for profile_seconds seconds, or stops a profile already
+running, and writes the result to the data directory. With the ``cprofile``
+mode (the default) the reactor thread is profiled deterministically, and a
+pstats file is written, which can be read with :py:mod:`pstats` or
+snakeviz::
+
+    kill -USR1 $(pidof snarf)
+    python -m pstats ~/.local/share/logsnarf/profile-1234-20150101-000000.pstats
+
+The ``sample`` mode instead samples the stacks of every thread, worker threads
+included, every 10ms, and writes them in the collapsed format read by
+flamegraph.pl and speedscope.
+
+SIGUSR2 switches the per-stage timers on and off. These time
+:py:meth:`logsnarf.snarf.LogSnarf.doRead`,
+:py:meth:`logsnarf.schema.Schema.loads`,
+:py:meth:`logsnarf.uploader.BigQueryUploader.addData` and
+:py:meth:`~logsnarf.uploader.BigQueryUploader.upload` into the
+``logsnarf_stage_seconds`` histogram. Stages nest, doRead includes the time
+spent in the others for the lines it reads. When switched off they cost a
+flag check per call.
+"""
+
+import collections
+import cProfile
+import functools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+from . import metrics
+
+MODES = ['cprofile', 'sample']
+SAMPLE_INTERVAL = 0.01
+
+STAGE_SECONDS = metrics.histogram(
+    'logsnarf_stage_seconds',
+    'Time spent in each stage, while stage timers are on.', ['stage'])
+
+_stage_timers = {'enabled': False}
+
+
+def stageTimersEnabled():
+    """True if the per-stage timers are switched on."""
+    return _stage_timers['enabled']
+
+
+def setStageTimers(enabled):
+    """Switch the per-stage timers on or off.
+
+    :param enabled: True to switch them on
+    :type enabled: bool
+    """
+    _stage_timers['enabled'] = bool(enabled)
+    logging.info('Stage timers %s', 'on' if enabled else 'off')
+
+
+def timed(stage):
+    """Decorator timing calls into a stage, while stage timers are on.
+
+    :param stage: stage name, used as the histogram label
+    :type stage: str
+    """
+    child = STAGE_SECONDS.labels(stage)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _stage_timers['enabled']:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class StackSampler(object):
+    """Samples the stacks of all threads from a background thread."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='logsnarf-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self.sample(me)
+
+    def sample(self, skip=None):
+        """Record the current stack of every thread but skip."""
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            self.counts[';'.join(stack)] += 1
+
+    def dump(self, path):
+        """Write samples in collapsed stack format."""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.counts.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class Profiler(object):
+    """Profiles the running process on demand."""
+
+    def __init__(self, directory, mode='cprofile', reactor=None):
+        """
+
+        :param directory: directory profiles are written to
+        :type directory: str
+        :param mode: cprofile or sample
+        :type mode: str
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if mode not in MODES:
+            raise ValueError('profile_mode must be one of %s, not %s' % (
+                MODES, mode))
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.directory = directory
+        self.mode = mode
+        self.log = logging.getLogger(self.__class__.__name__)
+        self._profile = None
+        self._stop_call = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self, seconds):
+        """Profile for seconds seconds.
+
+        :param seconds: how long to profile for
+        :type seconds: float
+        """
+        if self.running:
+            return
+        self.log.info('Profiling (%s) for %s seconds', self.mode, seconds)
+        if self.mode == 'cprofile':
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._profile = StackSampler()
+            self._profile.start()
+        self._stop_call = self.reactor.callLater(seconds, self.stop)
+
+    def stop(self):
+        """Stop profiling, and write the profile out.
+
+        :return: path of the profile written
+        :rtype: str
+        """
+        if not self.running:
+            return None
+        if self._stop_call.active():
+            self._stop_call.cancel()
+        profile, self._profile = self._profile, None
+        if self.mode == 'cprofile':
+            profile.disable()
+            ext = 'pstats'
+        else:
+            profile.stop()
+            ext = 'collapsed'
+        path = os.path.join(self.directory, 'profile-%d-%s.%s' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S'), ext))
+        try:
+            if self.mode == 'cprofile':
+                profile.dump_stats(path)
+            else:
+                profile.dump(path)
+        except (IOError, OSError):
+            self.log.exception('Unable to write profile %s', path)
+            return None
+        self.log.info('Profile written to %s', path)
+        return path
+
+    def toggle(self, seconds):
+        """Start profiling if not running, otherwise stop."""
+        if self.running:
+            self.stop()
+        else:
+            self.start(seconds)
+
+
+def installSignalHandlers(profiler, seconds):
+    """Profile on SIGUSR1, and toggle stage timers on SIGUSR2.
+
+    :param profiler: the profiler to start and stop
+    :type profiler: Profiler
+    :param seconds: how long SIGUSR1 profiles for
+    :type seconds: float
+    """
+    reactor = profiler.reactor
+
+    # noinspection PyUnusedLocal
+    def onUSR1(signum, frame):
+        reactor.callFromThread(profiler.toggle, seconds)
+
+    # noinspection PyUnusedLocal
+    def onUSR2(signum, frame):
+        reactor.callFromThread(setStageTimers, not stageTimersEnabled())
+
+    signal.signal(signal.SIGUSR1, onUSR1)
+    signal.signal(signal.SIGUSR2, onUSR2)
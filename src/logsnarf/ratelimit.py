@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_ratelimit -*-
+# pylint: disable=invalid-name
+"""Client side rate limiting for streaming inserts.
+
+BigQuery streaming insert quotas apply per table and per project. A
+:py:class:`RateLimiter` holds token buckets for rows and bytes per second,
+for the project as a whole, and for each table. Requests that would exceed
+the budget are delayed rather than failed, so we don't trip the quota and
+end up retrying everything at once. Tables are told apart by dataset and
+table id, and the buckets of tables that have been idle long enough to
+refill are dropped, so tables written to once don't stay around.
+
+Limiters are shared per project through :py:func:`projectLimiter`, so all
+App sections uploading to a project share one budget. Its limits are set
+once, with :py:meth:`RateLimiter.setLimits`, and sections that set different
+ones are rejected. Limiters aren't shared between processes, so supervised
+workers each set a share of the limits, see
+:py:func:`logsnarf.app.rate_limit_shares`.
+"""
+
+import logging
+
+from twisted.internet import defer
+from twisted.internet import task
+
+_limiters = {}
+
+#: seconds between looking for idle table buckets to drop, the refill period
+#: of a bucket of the default capacity
+SWEEP_INTERVAL = 1.0
+
+
+def projectLimiter(project, reactor=None):
+    """Return the shared rate limiter for a project, creating it if needed.
+
+    :param project: project id
+    :type project: str
+    :param reactor: twisted reactor, only used when creating the limiter
+    :type reactor: :twisted:`twisted.internet.reactor`
+    :rtype: RateLimiter
+    """
+    if project not in _limiters:
+        _limiters[project] = RateLimiter(reactor)
+    return _limiters[project]
+
+
+class TokenBucket(object):
+    """A token bucket that allows debt.
+
+    Tokens are reserved up front, taking the bucket negative if there aren't
+    enough, and the caller is told how long to wait before the tokens would
+    have been available. This keeps requests in order, without a queue.
+    """
+
+    def __init__(self, rate, capacity=None, clock=None):
+        """
+
+        :param rate: tokens added per second
+        :type rate: float
+        :param capacity: maximum tokens held, defaults to one second's worth
+        :type capacity: float
+        :param clock: provider of seconds(), usually the reactor
+        :type clock: :twisted:`twisted.internet.interfaces.IReactorTime`
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock.seconds()
+
+    def reserve(self, n):
+        """Take n tokens from the bucket.
+
+        :param n: number of tokens to take
+        :type n: float
+        :return: seconds until the tokens taken are available
+        :rtype: float
+        """
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def idle(self, now):
+        """True if the bucket has been full for at least one refill period.
+
+        A new bucket starts full, so such a bucket can be dropped and made
+        again when next needed, without changing what it allows.
+
+        :param now: the current time
+        :type now: float
+        :rtype: bool
+        """
+        refill = self.capacity / self.rate
+        full = self.updated + (self.capacity - self.tokens) / self.rate
+        return now - full >= refill
+
+
+class RateLimiter(object):
+    """Rows and bytes per second limits for a project, and its tables."""
+
+    def __init__(self, reactor=None):
+        """
+
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.project_rows = None
+        self.project_bytes = None
+        self.table_rows = None
+        self.table_bytes = None
+        self.limits = None
+        # (dataset, table) -> (rows bucket, bytes bucket)
+        self._tables = {}
+        self._swept = reactor.seconds()
+        self.queued = 0
+        self.delayed = 0
+
+    def setLimits(self, rows_per_second=None, bytes_per_second=None,
+                  table_rows_per_second=None, table_bytes_per_second=None):
+        """Set the project and table limits of a shared limiter, once.
+
+        Setting the same limits again does nothing, so each user of the
+        limiter can set them, without resetting the budget.
+
+        :param rows_per_second: project rows per second, or None
+        :type rows_per_second: float
+        :param bytes_per_second: project bytes per second, or None
+        :type bytes_per_second: float
+        :param table_rows_per_second: rows per second for each table, or None
+        :type table_rows_per_second: float
+        :param table_bytes_per_second: bytes per second for each table, or
+          None
+        :type table_bytes_per_second: float
+        :raises ValueError: if different limits have already been set
+        """
+        limits = (rows_per_second, bytes_per_second, table_rows_per_second,
+                  table_bytes_per_second)
+        if self.limits is not None:
+            if limits != self.limits:
+                raise ValueError('Rate limits %s differ from those already '
+                                 'set, %s' % (limits, self.limits))
+            return
+        self.limits = limits
+        self.setProjectLimits(rows_per_second, bytes_per_second)
+        self.setTableLimits(table_rows_per_second, table_bytes_per_second)
+
+    def setProjectLimits(self, rows_per_second=None, bytes_per_second=None):
+        """Limit inserts across all tables in the project.
+
+        :param rows_per_second: rows per second, or None for no limit
+        :type rows_per_second: float
+        :param bytes_per_second: bytes per second, or None for no limit
+        :type bytes_per_second: float
+        """
+        self.project_rows = self._bucket(rows_per_second)
+        self.project_bytes = self._bucket(bytes_per_second)
+
+    def setTableLimits(self, rows_per_second=None, bytes_per_second=None):
+        """Limit inserts into each table.
+
+        :param rows_per_second: rows per second, or None for no limit
+        :type rows_per_second: float
+        :param bytes_per_second: bytes per second, or None for no limit
+        :type bytes_per_second: float
+        """
+        self.table_rows = rows_per_second
+        self.table_bytes = bytes_per_second
+        self._tables = {}
+
+    @property
+    def limitsBytes(self):
+        """True if any bytes per second limit is set."""
+        return bool(self.project_bytes or self.table_bytes)
+
+    def acquire(self, dataset, table, rows, nbytes=0):
+        """Wait for budget to send rows to a table.
+
+        :param dataset: dataset the table is in
+        :type dataset: str
+        :param table: table id the rows are for
+        :type table: str
+        :param rows: number of rows to be sent
+        :type rows: int
+        :param nbytes: size of the request in bytes
+        :type nbytes: int
+        :return: a deferred that fires when the request may be sent
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        delay = 0.0
+        buckets = [(self.project_rows, rows), (self.project_bytes, nbytes)]
+        if self.table_rows or self.table_bytes:
+            self._sweep()
+            key = (dataset, table)
+            if key not in self._tables:
+                self._tables[key] = (self._bucket(self.table_rows),
+                                     self._bucket(self.table_bytes))
+            table_rows, table_bytes = self._tables[key]
+            buckets.extend([(table_rows, rows), (table_bytes, nbytes)])
+        for bucket, n in buckets:
+            if bucket is not None:
+                delay = max(delay, bucket.reserve(n))
+        if not delay:
+            return defer.succeed(None)
+        self.log.debug('Delaying %d rows for %s.%s by %f seconds', rows,
+                       dataset, table, delay)
+        self.queued += 1
+        self.delayed += 1
+        d = task.deferLater(self.reactor, delay, lambda: None)
+        d.addBoth(self._dequeued)
+        return d
+
+    def _sweep(self):
+        """Drop the buckets of tables that haven't been written to lately.
+
+        Runs at most once per refill period, so the cost of walking every
+        table is spread over the requests made in that time.
+        """
+        now = self.reactor.seconds()
+        if now - self._swept < SWEEP_INTERVAL:
+            return
+        self._swept = now
+        for key, buckets in list(self._tables.items()):
+            if all(b is None or b.idle(now) for b in buckets):
+                del self._tables[key]
+
+    def _dequeued(self, result):
+        self.queued -= 1
+        return result
+
+    def _bucket(self, rate):
+        if not rate:
+            return None
+        return TokenBucket(rate, clock=self.reactor)
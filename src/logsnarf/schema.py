@@ -7,13 +7,17 @@ import datetime
 import hashlib
 import logging
 import re
+import time
 
 import arrow
 import pytz
 import simplejson as json
 from dateutil import parser
+from twisted.internet import defer
 
 from . import errors
+from . import metrics
+from . import profiling
 
 REQUIRED_FIELD_KEYS = ['name', 'type']
 OTHER_FIELD_KEYS = ['mode', 'description', 'fields']
@@ -33,6 +37,15 @@ VALID_MODES = {
     'REQUIRED': 3,
 }
 
+PARSE_SECONDS = metrics.histogram(
+    'logsnarf_parse_seconds',
+    'Time taken to decode and validate a line.')
+PARSE_ERRORS = metrics.counter(
+    'logsnarf_parse_errors',
+    'Lines that failed to decode or validate.', ['reason'])
+DECODE_ERRORS = PARSE_ERRORS.labels('decode')
+VALIDATION_ERRORS = PARSE_ERRORS.labels('validation')
+
 
 # TODO: This should probably be wrapped in a consumer/producer class.
 class Schema(object):
@@ -83,6 +96,10 @@ class Schema(object):
             'RECORD': lambda x, y: y,
         }
         self._postproc = []
+        self._batch_postproc = []
+        self._parser = None
+        self._parser_fields = {}
+        self._parsed_names = {}
         self.validateSchema()
 
     def setObjectLoadHook(self, fn):
@@ -95,6 +112,48 @@ class Schema(object):
         if callable(fn):
             self._load_hook = fn
 
+    def setParser(self, parser, fields=None):
+        """Parse lines with parser, rather than as JSON.
+
+        The parser returns a flat dict of names to values, for example
+        one from :py:mod:`logsnarf.parsers`. Names are renamed by fields,
+        if given, then those with dots are nested into records, and any that
+        aren't fields of the schema are dropped. The result is validated and
+        post-processed as a decoded JSON document would be. The object load
+        hook isn't used.
+
+        :param callable parser: A callable that takes a line and returns a
+                                dict, or raises ValueError. None to go back
+                                to parsing JSON.
+        :param dict fields: Parser names to schema field names, using dotted
+                            notation for fields of records.
+        """
+        self._parser = parser
+        self._parser_fields = dict(fields or {})
+        self._parsed_names = {}
+
+    def _fromParsed(self, parsed):
+        """Turn a parser's flat dict into a document for the schema."""
+        obj = {}
+        names = self._parsed_names
+        for key, value in parsed.items():
+            path = names.get(key, False)
+            if path is False:
+                name = self._parser_fields.get(key, key)
+                if name in self.field_dict or name in self.ignore_fields:
+                    path = name.split('.')
+                else:
+                    path = None
+                if len(names) < 4096:
+                    names[key] = path
+            if path is None:
+                continue
+            entry = obj
+            for part in path[:-1]:
+                entry = entry.setdefault(part, {})
+            entry[path[-1]] = value
+        return obj
+
     def registerPostprocessor(self, fn):
         """Register a post processor.
 
@@ -108,9 +167,60 @@ class Schema(object):
         if callable(fn):
             self._postproc.append(fn)
 
+    def registerBatchPostprocessor(self, fn, asynchronous=False):
+        """Register a batch post processor.
+
+        Registers a function to be called on each batch of objects that
+        have been decoded, validated and post-processed by :py:meth:`~.loads`.
+        Batches are whatever the uploader is given in one write, usually a
+        read of a file by :py:class:`logsnarf.snarf.LogSnarf`. Objects still
+        have their ``_sha1`` field, and may have a ``table`` field, which the
+        post processor can set to route the object to another table.
+
+        Post processors registered with :py:meth:`~.registerPostprocessor`
+        are the special case of a batch of one object. They're run as each
+        line is loaded, so an error drops only that line, where an error
+        from a batch post processor drops the whole batch.
+
+        :param callable fn: A callable that takes one argument, a list of
+                            objects, and returns a list of objects. The
+                            list may be shorter or longer.
+        :param bool asynchronous: If true, fn returns a
+                                  :twisted:`twisted.internet.defer.Deferred`
+                                  that fires with the list.
+        """
+        if callable(fn):
+            self._batch_postproc.append((fn, asynchronous))
+
+    @property
+    def batchPostprocessors(self):
+        """True if any batch post processors are registered."""
+        return bool(self._batch_postproc)
+
+    def postProcessBatch(self, objs, start=0):
+        """Run the batch post processors on a list of loaded objects.
+
+        :param list objs: objects returned by :py:meth:`~.loads`
+        :param int start: index of the first post processor to run
+        :return: the post-processed objects, or if there are asynchronous
+                 post processors, a Deferred that fires with them.
+        :rtype: list or :twisted:`twisted.internet.defer.Deferred`
+        """
+        postproc = self._batch_postproc
+        for i in range(start, len(postproc)):
+            fn, asynchronous = postproc[i]
+            if asynchronous:
+                d = defer.maybeDeferred(fn, objs)
+                if i + 1 < len(postproc):
+                    d.addCallback(self.postProcessBatch, i + 1)
+                return d
+            objs = fn(objs)
+        return objs
+
     def clearPostprocessors(self):
-        """Removes all post processors."""
+        """Removes all post processors, per object and batch."""
         self._postproc = []
+        self._batch_postproc = []
 
     def setFieldValidator(self, field_name, fn):
         """Override the validator for a particular field in the schema.
@@ -141,13 +251,15 @@ class Schema(object):
             js_object = fn(js_object)
         return js_object
 
+    @profiling.timed('loads')
     def loads(self, json_string):
         """Deserialize json_string into a python object.
 
         This applies all schema checks and post-processors.
 
         :param string|bytes json_string: utf-8 encoded string containing a JSON
-                                    document.
+                                    document, or a line for the parser set
+                                    with :py:meth:`~.setParser`.
         :return: The JSON document as a python object
         :rtype: dict or list or integer or float or unicode
         :raises logsnarf.errors.ValidationError:
@@ -157,12 +269,24 @@ class Schema(object):
             if the string does not contain a valid JSON document.
 
         """
+        start = time.perf_counter()
         if isinstance(json_string, bytes):
             json_string = json_string.decode('utf-8')
-        obj = self._postProcess(
-            json.loads(json_string, encoding='utf-8',
-                       object_hook=self._load_hook))
+        try:
+            if self._parser is None:
+                obj = json.loads(json_string, encoding='utf-8',
+                                 object_hook=self._load_hook)
+            else:
+                obj = self._fromParsed(self._parser(json_string))
+            obj = self._postProcess(obj)
+        except errors.ValidationError:
+            VALIDATION_ERRORS.inc()
+            raise
+        except ValueError:
+            DECODE_ERRORS.inc()
+            raise
         obj['_sha1'] = hashlib.sha1(json_string.encode('utf-8')).hexdigest()
+        PARSE_SECONDS.observe(time.perf_counter() - start)
         return obj
 
     def validateSchema(self):
@@ -1,28 +1,167 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # pylint: disable=invalid-name
-"""BigQuery service."""
+"""BigQuery service.
 
+Each thread that talks to BigQuery needs an authorized
+:py:class:`httplib2.Http`, with its own connections, and an API client
+built from the discovery document. These are kept by a
+:py:class:`ConnectionPool`, which services with the same project and
+credentials share through :py:func:`connectionPool`, so that app sections
+uploading to one project don't each open connections, and build clients, in
+every thread.
+"""
+
+import gzip
 import logging
+import os
+import random
 import ssl
+import struct
 import sys
 import threading
 import time
 import uuid
+import weakref
 
 import httplib2
+import simplejson as json
 from googleapiclient import discovery, errors
+from googleapiclient import http as ghttp
 from twisted.internet import threads, task
 from twisted.python import failure
 
 from . import errors as lserrors
+from . import metrics
+
+PARTITION_TYPES = ['HOUR', 'DAY', 'MONTH', 'YEAR']
+
+#: HTTP statuses of whole-request failures worth retrying
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+#: 403 reasons that mean "slow down" rather than "not allowed"
+RETRY_REASONS = frozenset(['rateLimitExceeded', 'quotaExceeded'])
+
+RETRIES = metrics.counter(
+    'logsnarf_service_retries', 'insertAll requests retried.', ['dataset'])
+COMPRESSION_RATIO = metrics.gauge(
+    'logsnarf_compression_ratio',
+    'Ratio of uncompressed to sent request bytes.', ['project', 'dataset'])
+# (project, dataset): service whose compression ratio is exported
+_gauge_owners = weakref.WeakValueDictionary()
+
+
+_pools = {}
+
+
+def connectionPool(project, creds, key=None, discovery_url=None,
+                   debug=False):
+    """Return the shared connection pool for a project, creating it if needed.
+
+    :param project: project id
+    :type project: str
+    :param creds: oauth2 credentials, only used when creating the pool
+    :type creds: oauth2client.Credentials
+    :param key: identifies the credentials, services with different
+      credentials don't share a pool
+    :type key: str
+    :param discovery_url: discovery document URL template
+    :type discovery_url: str
+    :param debug: set debug on the API clients
+    :type debug: bool
+    :rtype: ConnectionPool
+    """
+    if (project, key) not in _pools:
+        _pools[project, key] = ConnectionPool(creds, discovery_url, debug)
+    return _pools[project, key]
+
+
+class ConnectionPool(object):
+    """An authorized http connection, and API client, for each thread."""
+
+    def __init__(self, creds, discovery_url=None, debug=False):
+        """
+
+        :param creds: oauth2 credentials
+        :type creds: oauth2client.Credentials
+        :param discovery_url: discovery document URL template
+        :type discovery_url: str
+        :param debug: set debug on the API clients
+        :type debug: bool
+        """
+        self.creds = creds
+        self.discovery_url = discovery_url
+        self.debug = debug
+        self.local = threading.local()
+
+    @property
+    def http(self):
+        """Creates and authorizes a httplib2.Http() instance"""
+        if not hasattr(self.local, 'http'):
+            http = httplib2.Http(timeout=120)
+            self.creds.authorize(http)
+            self.local.http = http
+        return self.local.http
+
+    @property
+    def service(self):
+        """Creates a BigQuery service."""
+        if not hasattr(self.local, 'service'):
+            kwargs = {}
+            if self.discovery_url:
+                kwargs['discoveryServiceUrl'] = self.discovery_url
+                kwargs['cache_discovery'] = False
+            self.local.service = discovery.build(
+                'bigquery', 'v2', http=self.http, **kwargs)
+            if self.debug:
+                self.local.service.debug = True
+        return self.local.service
+
+
+def tableId(table):
+    """Strip any partition decorator from a table name.
+
+    :param str table: table name, possibly with a ``$partition`` suffix.
+    :return: the bare table id
+    :rtype: str
+    """
+    return table.split('$', 1)[0]
+
+
+def gzipSize(path):
+    """Uncompressed size of a gzip file, from its trailer.
+
+    :param str path: path to a file
+    :return: uncompressed size (modulo 2**32), or None if not a gzip file.
+    :rtype: int
+    """
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\x1f\x8b':
+            return None
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def errorReasons(e):
+    """Reasons given in the body of a BigQuery error response.
+
+    :param e: the error
+    :type e: :py:class:`googleapiclient.errors.HttpError`
+    :return: the ``reason`` of each of the response's errors
+    :rtype: set(str)
+    """
+    try:
+        content = json.loads(e.content)
+        return set(err.get('reason') for err in content['error']['errors'])
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return set()
 
 
 class BigQueryService(object):
     """A fairly basic wrapper around the google BigQuery API.
     """
 
-    def __init__(self, project_id, dataset, creds, reactor=None, debug=False):
+    def __init__(self, project_id, dataset, creds, reactor=None, debug=False,
+                 discovery_url=None):
         """
 
         :param project_id: Numeric project id
@@ -33,7 +172,11 @@ class BigQueryService(object):
         :type creds: oauth2client.Credentials
         :param reactor: twisted reactor object
         :type reactor: :twisted:`twisted.internet.reactor`
-
+        :param discovery_url:
+          discovery document URL template, to talk to an endpoint other than
+          Google's, such as the benchmark stand-in in
+          :py:mod:`logsnarf.bench.fakeservice`
+        :type discovery_url: str
         """
         self.debug = debug
         if not reactor:
@@ -45,26 +188,168 @@ class BigQueryService(object):
         self.dataset = dataset
         self.tables = {}
         self.creds = creds
-        self.local = threading.local()
+        self.discovery_url = discovery_url
+        self.connections = ConnectionPool(creds, discovery_url, debug)
+        self.local = self.connections.local
+        self.time_partitioning = None
+        self.clustering_fields = None
+        self.job_poll_interval = 5
+        self.retry_delay = 1.0
+        self.max_retry_delay = 60.0
+        self.max_retries = 8
+        self.compression_level = 0
+        self.compression_threshold = 1024
+        self.stats = {
+            'requests': 0,
+            'compressed_requests': 0,
+            'raw_bytes': 0,
+            'sent_bytes': 0,
+        }
+        self._stats_lock = threading.Lock()
+        self.limiter = None
+        self.tracer = None
+        self._retries = RETRIES.labels(dataset)
+        if _gauge_owners.get((project_id, dataset)) is not None:
+            self.log.warning('Taking over the compression ratio metric of '
+                             'another service for %s:%s', project_id, dataset)
+        _gauge_owners[(project_id, dataset)] = self
+        COMPRESSION_RATIO.labels(project_id, dataset).setFunction(
+            metrics.weakFunction(self, lambda svc: svc.compressionRatio))
 
     @property
     def http(self):
-        """Creates and authorizes a httplib2.Http() instance"""
-        if not hasattr(self.local, 'http'):
-            http = httplib2.Http(timeout=120)
-            self.creds.authorize(http)
-            self.local.http = http
-        return self.local.http
+        """This thread's authorized httplib2.Http() instance"""
+        return self.connections.http
 
     @property
     def service(self):
-        """Creates a BigQuery service."""
-        if not hasattr(self.local, 'service'):
-            self.local.service = discovery.build(
-                'bigquery', 'v2', http=self.http)
-            if self.debug:
-                self.local.service.debug = True
-        return self.local.service
+        """This thread's BigQuery API client."""
+        return self.connections.service
+
+    def setConnectionPool(self, pool):
+        """Use a connection pool shared with other services.
+
+        :param pool: connection pool, usually shared for the project
+        :type pool: ConnectionPool
+        """
+        self.connections = pool
+        self.local = pool.local
+
+    def setPartitioning(self, partition_type='DAY', field=None,
+                        expiration_ms=None, clustering_fields=None):
+        """Create new tables as time-partitioned tables.
+
+        :param partition_type: one of HOUR, DAY, MONTH or YEAR
+        :type partition_type: str
+        :param field:
+          TIMESTAMP field to partition on. If not given, tables are partitioned
+          by ingestion time, and rows are routed with a partition decorator.
+        :type field: str
+        :param expiration_ms: partition expiration in milliseconds
+        :type expiration_ms: int
+        :param clustering_fields: up to four fields to cluster tables by
+        :type clustering_fields: list(str)
+        :raises logsnarf.errors.ConfigError: if the settings are invalid
+        """
+        if partition_type not in PARTITION_TYPES:
+            raise lserrors.ConfigError(
+                'partition_type must be one of %s, not %s' % (
+                    PARTITION_TYPES, partition_type))
+        if clustering_fields and len(clustering_fields) > 4:
+            raise lserrors.ConfigError(
+                'No more than four clustering fields may be given')
+        time_partitioning = {'type': partition_type}
+        if field:
+            time_partitioning['field'] = field
+        if expiration_ms:
+            time_partitioning['expirationMs'] = str(expiration_ms)
+        self.time_partitioning = time_partitioning
+        self.clustering_fields = clustering_fields or None
+
+    def setCompression(self, level, threshold=1024):
+        """Gzip compress request bodies.
+
+        :param level: gzip compression level, 1-9. 0 disables compression.
+        :type level: int
+        :param threshold: bodies smaller than this many bytes are sent raw
+        :type threshold: int
+        """
+        if not 0 <= level <= 9:
+            raise lserrors.ConfigError(
+                'compression_level must be between 0 and 9, not %s' % level)
+        self.compression_level = level
+        self.compression_threshold = threshold
+
+    def setRateLimiter(self, limiter):
+        """Rate limit :py:meth:`~.insertAll` calls.
+
+        Requests over the limiter's budget are queued until there is budget
+        for them. :py:meth:`~.insertAll_s` is not limited.
+
+        :param limiter: rate limiter, usually shared for the project
+        :type limiter: logsnarf.ratelimit.RateLimiter
+        """
+        self.limiter = limiter
+
+    def setTracer(self, tracer):
+        """Record the stages of traced :py:meth:`~.insertAll` calls.
+
+        :param tracer: tracer shared with the uploader
+        :type tracer: logsnarf.tracing.Tracer
+        """
+        self.tracer = tracer
+
+    def _traced(self, upload_id):
+        return self.tracer is not None and \
+            self.tracer.get(upload_id) is not None
+
+    def _span(self, result, upload_id, name, start, **attrs):
+        """Callback recording a span that ends now."""
+        self.tracer.span(upload_id, name, start, **attrs)
+        return result
+
+    @property
+    def compressionRatio(self):
+        """Ratio of uncompressed to sent bytes over all requests so far."""
+        if not self.stats['sent_bytes']:
+            return 1.0
+        return float(self.stats['raw_bytes']) / self.stats['sent_bytes']
+
+    def _recordSize(self, raw, sent):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            self.stats['raw_bytes'] += raw
+            self.stats['sent_bytes'] += sent
+            if sent != raw:
+                self.stats['compressed_requests'] += 1
+
+    def _compress(self, request):
+        """Gzip the body of a request, if it's large enough to be worth it.
+
+        Called *inside* a worker thread.
+
+        :param request: request to compress the body of
+        :type request: googleapiclient.http.HttpRequest
+        :return: the request
+        :rtype: googleapiclient.http.HttpRequest
+        """
+        body = request.body
+        if body is None:
+            return request
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        raw = len(body)
+        if self.compression_level and raw >= self.compression_threshold:
+            body = gzip.compress(body, self.compression_level)
+            request.headers['content-encoding'] = 'gzip'
+        request.body = body
+        request.body_size = len(body)
+        request.headers['content-length'] = str(len(body))
+        self._recordSize(raw, len(body))
+        self.log.debug('Request body %d bytes, sent %d bytes. Compression '
+                       'ratio so far %.2f', raw, len(body),
+                       self.compressionRatio)
+        return request
 
     def updateTableList(self):
         """Update our internal cache of tables."""
@@ -97,6 +382,7 @@ class BigQueryService(object):
         :raises googleapiclient.errors.HttpError: if a HTTP error occurs
         :raises ssl.SSLError: if an SSL based error occurs
         """
+        name = tableId(name)
         self.log.info('Attempting to create table %s', name)
         self.updateTableList()
         self.log.debug('Table list updated')
@@ -114,6 +400,10 @@ class BigQueryService(object):
                 'tableId': name,
             },
         }
+        if self.time_partitioning:
+            body['timePartitioning'] = self.time_partitioning
+        if self.clustering_fields:
+            body['clustering'] = {'fields': self.clustering_fields}
         try:
             tables.insert(
                 projectId=self.project,
@@ -150,42 +440,121 @@ class BigQueryService(object):
         :rtype: :twisted:`twisted.internet.defer.Deferred`
         """
         upload_id = upload_id or uuid.uuid4().hex
+        return self._insertAll(table, table_schema, data, upload_id, 0)
+
+    def _insertAll(self, table, table_schema, data, upload_id, attempt):
+        traced = self._traced(upload_id)
 
-        if table not in self.tables:
+        if tableId(table) not in self.tables:
             self.log.info('Table does not yet exist %s', table)
             self.log.debug('Triggering upload line %s', data[0])
 
             d = threads.deferToThread(self.createTable, table, table_schema)
+            if traced:
+                d.addCallback(self._span, upload_id, 'create_table',
+                              self.reactor.seconds())
             # We need an extra argument for the result
             d.addCallback(
-                lambda x, call, _table, _schema, _data, _id: call(_table, _schema, _data, _id),
-                self.insertAll, table, table_schema, data,
-                upload_id)
+                lambda x, call, _table, _schema, _data, _id, _attempt: call(_table, _schema, _data, _id, _attempt),
+                self._insertAll, table, table_schema, data,
+                upload_id, attempt)
+        elif self.limiter is not None:
+            if self.limiter.limitsBytes:
+                # the request is built in a worker thread, so the body isn't
+                # serialized in this one just to be measured
+                d = threads.deferToThread(self._insertRequest, table, data)
+                d.addCallback(self._acquire, upload_id, table, len(data))
+            else:
+                d = self._acquire((None, 0), upload_id, table, len(data))
+            d.addCallback(self._startInsertAll, upload_id, table,
+                          table_schema, data, attempt)
         else:
-            self.log.info('Starting upload %s', upload_id)
-            d = threads.deferToThread(self._doInsertAll, table, data)
-            d.addErrback(self._errback, upload_id, table, table_schema, data)
+            d = self._startInsertAll(None, upload_id, table, table_schema,
+                                     data, attempt)
+
+        return d
+
+    def _acquire(self, built, upload_id, table, rows):
+        """Wait for the rate limiter to allow a request.
 
+        :param built: the request, if already built, and its body's size
+        :type built: tuple(googleapiclient.http.HttpRequest, int)
+        :return: a deferred firing with the request
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        request, nbytes = built
+        d = self.limiter.acquire(self.dataset, tableId(table), rows, nbytes)
+        if self._traced(upload_id):
+            d.addCallback(self._span, upload_id, 'rate_limit',
+                          self.reactor.seconds())
+        d.addCallback(lambda _: request)
+        return d
+
+    def _startInsertAll(self, request, upload_id, table, table_schema, data,
+                        attempt=0):
+        self.log.info('Starting upload %s', upload_id)
+        if self._traced(upload_id):
+            d = threads.deferToThread(self._tracedInsertAll, upload_id,
+                                      self.reactor.seconds(), table, data,
+                                      request)
+        else:
+            d = threads.deferToThread(self._doInsertAll, table, data, request)
+        d.addErrback(self._errback, upload_id, table, table_schema, data,
+                     attempt)
         return d
 
-    def _doInsertAll(self, table, data):
+    def _doInsertAll(self, table, data, request=None):
         """Work method for insertAll to do be called *inside* a worker thread.
 
         :param table: table to insert data to.
         :type table: str
         :param data: the rows to be intersted. usually a list of dicts.
         :type data: list(dict)
+        :param request: the request, if already built by
+          :py:meth:`~._insertRequest`, maybe in another worker thread
+        :type request: googleapiclient.http.HttpRequest
         :return: Results of the insert.
         :rtype:
           https://cloud.google.com/bigquery/docs/reference/rest/v2/tabledata/insertAll#response-body
         """
+        if request is None:
+            return self._insertRequest(table, data)[0].execute()
+        return request.execute(http=self.http)
+
+    def _insertRequest(self, table, data):
+        """Build the compressed insertAll request for rows.
+
+        Called *inside* a worker thread.
+
+        :return: the request, and the size of its body before compression
+        :rtype: tuple(googleapiclient.http.HttpRequest, int)
+        """
         tabledata = self.service.tabledata()
         insert = tabledata.insertAll(
             projectId=self.project,
             datasetId=self.dataset,
             tableId=table,
             body={'rows': data})
-        return insert.execute()
+        nbytes = len(insert.body or '')
+        return self._compress(insert), nbytes
+
+    def _tracedInsertAll(self, upload_id, queued, table, data, request=None):
+        """:py:meth:`~._doInsertAll`, recording the time spent waiting for
+        this worker thread and making the request."""
+        started = self.reactor.seconds()
+        self.reactor.callFromThread(self.tracer.span, upload_id,
+                                    'thread_wait', queued, started)
+        try:
+            result = self._doInsertAll(table, data, request)
+        except Exception as e:
+            status = getattr(getattr(e, 'resp', None), 'status', None)
+            self.reactor.callFromThread(
+                self.tracer.span, upload_id, 'http', started,
+                self.reactor.seconds(), status=status or e.__class__.__name__)
+            raise
+        self.reactor.callFromThread(self.tracer.span, upload_id, 'http',
+                                    started, self.reactor.seconds())
+        return result
 
     def insertAll_s(self, table, table_schema, data, upload_id=None):
         """Synchronous version of :py:meth:`~.insertAll`.
@@ -209,74 +578,202 @@ class BigQueryService(object):
         """
         upload_id = upload_id or uuid.uuid4().hex
 
-        if table not in self.tables:
+        if tableId(table) not in self.tables:
             self.log.info('Table does not yet exist %s', table)
             self.log.debug('Triggering upload line %s', data[0])
             self.createTable(table, table_schema)
 
-        tabledata = self.service.tabledata()
-        insert = tabledata.insertAll(
-            projectId=self.project,
-            datasetId=self.dataset,
-            tableId=table,
-            body={'rows': data})
+        insert = self._insertRequest(table, data)[0]
 
-        retries = 5
-        for n in range(1, retries + 1):
+        for n in range(self.max_retries + 1):
             try:
-                self.log.debug('Synchronous insertAll try %d', n)
+                self.log.debug('Synchronous insertAll try %d', n + 1)
                 value = insert.execute()
                 self.log.debug('Synchronous insertAll success')
                 return value
             except (errors.HttpError, ssl.SSLError):
                 fail = failure.Failure(*sys.exc_info())
-                (retry, delay) = self._handleErrors(fail)
+                (retry, delay) = self._handleErrors(fail, n)
                 # Ugh.. This should, hopefully be rare
                 if retry:
+                    self._retries.inc()
                     self.log.error(
                         'Retrying insertAll upload_id %s after a %s delay.',
                         upload_id, delay)
                     time.sleep(delay)
                 else:
                     raise
-        self.log.error('Ran out of attempts to run insertAll in synchronous '
-                       'mode. Raising ServiceException')
-        raise lserrors.ServiceError('Was unable to complete upload id %d '
-                                    'after %d attempts', upload_id, retries)
 
-    def _handleErrors(self, fail):
+    def load(self, table, table_schema, path, upload_id=None, job_id=None):
+        """Load a newline delimited JSON file into a table with a load job.
+
+        The table is created if necessary. The file may be gzip compressed.
+        The job is polled every :py:attr:`job_poll_interval` seconds until it
+        is done.
+
+        :param table: table to load data into.
+        :type table: str
+        :param table_schema: list of fields, representing the table schema
+        :type table_schema: list
+        :param path: path to the file to load
+        :type path: str
+        :param upload_id:
+          unique identifier for this upload, only used internally for logging.
+          one is generated if not supplied
+        :type upload_id: str
+        :param job_id:
+          BigQuery job id. If a job with this id already exists, that job is
+          polled instead of starting a new one.
+        :type job_id: str
+        :return: a deferred for the completed job resource, described at
+                 https://cloud.google.com/bigquery/docs/reference/rest/v2/jobs#resource
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        :raises logsnarf.errors.ServiceError: (via the deferred) if the job
+            completes with an error.
+        """
+        upload_id = upload_id or uuid.uuid4().hex
+        job_id = job_id or 'logsnarf_%s' % upload_id
+        self.log.info('Starting load job %s for upload %s', job_id, upload_id)
+        d = threads.deferToThread(self._doLoad, table, table_schema, path,
+                                  job_id)
+        d.addCallback(self._pollJob, upload_id)
+        return d
+
+    def _doLoad(self, table, table_schema, path, job_id):
+        """Work method for load, to be called *inside* a worker thread.
+
+        :return: the job resource
+        :rtype: dict
+        """
+        load = {
+            'sourceFormat': 'NEWLINE_DELIMITED_JSON',
+            'destinationTable': {
+                'projectId': self.project,
+                'datasetId': self.dataset,
+                'tableId': table,
+            },
+            'schema': {
+                'fields': table_schema,
+            },
+            'createDisposition': 'CREATE_IF_NEEDED',
+            'writeDisposition': 'WRITE_APPEND',
+        }
+        if self.time_partitioning:
+            load['timePartitioning'] = self.time_partitioning
+        if self.clustering_fields:
+            load['clustering'] = {'fields': self.clustering_fields}
+        body = {
+            'jobReference': {
+                'projectId': self.project,
+                'jobId': job_id,
+            },
+            'configuration': {
+                'load': load,
+            },
+        }
+        media = ghttp.MediaFileUpload(
+            path, mimetype='application/octet-stream', resumable=True)
+        sent = os.path.getsize(path)
+        self._recordSize(gzipSize(path) or sent, sent)
+        jobs = self.service.jobs()
+        try:
+            return jobs.insert(projectId=self.project, body=body,
+                               media_body=media).execute()
+        except errors.HttpError as e:
+            if e.resp['status'] != '409':
+                raise
+            self.log.info('Load job %s already exists', job_id)
+            return self._getJob(job_id)
+
+    def _getJob(self, job_id):
+        """Fetch a job resource, to be called *inside* a worker thread."""
+        return self.service.jobs().get(projectId=self.project,
+                                       jobId=job_id).execute()
+
+    def _pollJob(self, job, upload_id):
+        """Poll a job until it is done.
+
+        :param job: job resource
+        :type job: dict
+        :param upload_id: internal identifier for the upload, for logging
+        :type upload_id: str
+        :return: the job resource, or a deferred for it if not yet done
+        :raises logsnarf.errors.ServiceError: if the job failed
+        """
+        job_id = job['jobReference']['jobId']
+        status = job.get('status', {})
+        if status.get('state') != 'DONE':
+            self.log.debug('Load job %s state %s', job_id, status.get('state'))
+            d = task.deferLater(self.reactor, self.job_poll_interval,
+                                threads.deferToThread, self._getJob, job_id)
+            d.addCallback(self._pollJob, upload_id)
+            return d
+        if status.get('errorResult'):
+            self.log.error('Load job %s for upload %s failed %s', job_id,
+                           upload_id, status.get('errors'))
+            raise lserrors.ServiceError(
+                'Load job %s failed: %s' % (
+                    job_id, status['errorResult'].get('message')))
+        table = job['configuration']['load']['destinationTable']['tableId']
+        self.tables[tableId(table)] = True
+        self.log.info('Load job %s for upload %s complete', job_id, upload_id)
+        return job
+
+    def _handleErrors(self, fail, attempt=0):
         """Handle whole-request errors.
 
-        :return tuple(bool, int):
+        Server errors, SSL errors and 403s for exceeding a rate limit or
+        quota are retried, waiting :py:attr:`retry_delay` seconds, doubled
+        with each attempt up to :py:attr:`max_retry_delay`, with jitter so
+        that uploads failed together aren't retried together. After
+        :py:attr:`max_retries` retries the request is given up on.
+
+        :param fail: the failure
+        :type fail: :twisted:`twisted.python.failure.Failure`
+        :param attempt: number of times the request has been retried
+        :type attempt: int
+        :return tuple(bool, float):
             Tuple containing True, delay if the request should be retried
             after delay seconds. False, if the original exception should be
             re-raised.
         """
-        if fail.type == errors.HttpError:
-            # Retry errors.
-            if fail.value.resp.status in ['403', '500', '503', '504']:
+        if fail.check(errors.HttpError):
+            status = int(fail.value.resp.status)
+            if status in RETRY_STATUSES:
                 self.log.error(fail)
-                return True, 5
+            elif status == 403 and errorReasons(fail.value) & RETRY_REASONS:
+                self.log.error('Request rejected %s', fail.value)
             else:
-                self.log.error('Unhandled status code %d',
-                               fail.value.resp.status)
+                self.log.error('Unhandled status code %d', status)
                 self.log.debug(fail.value.resp)
-        elif fail.type == ssl.SSLError:
+                return False, 0
+        elif fail.check(ssl.SSLError):
             self.log.error(fail)
-            return True, 0
         else:
             return False, 0
+        if attempt >= self.max_retries:
+            self.log.error('Giving up after %d retries', attempt)
+            return False, 0
+        delay = min(self.retry_delay * 2 ** attempt, self.max_retry_delay)
+        return True, random.uniform(delay / 2, delay)
 
-    def _errback(self, fail, upload_id, table, table_schema, data):
+    def _errback(self, fail, upload_id, table, table_schema, data, attempt=0):
         """Error handler for _upload, in the case of a whole-request failure."""
         self.log.error('Error for upload id %s %s', upload_id, fail)
         self.log.debug(fail.printTraceback())
-        (retry, delay) = self._handleErrors(fail)
+        (retry, delay) = self._handleErrors(fail, attempt)
         if retry:
+            self._retries.inc()
             self.log.error('Retrying upload %s after a %s second delay',
                            upload_id, delay)
+            if self._traced(upload_id):
+                now = self.reactor.seconds()
+                status = getattr(getattr(fail.value, 'resp', None), 'status',
+                                 None)
+                self.tracer.span(upload_id, 'retry_delay', now, now + delay,
+                                 status=status or fail.type.__name__)
             d = task.deferLater(self.reactor, delay,
-                                self.insertAll, table, table_schema, data,
-                                upload_id)
+                                self._insertAll, table, table_schema, data,
+                                upload_id, attempt + 1)
             return d
         return fail
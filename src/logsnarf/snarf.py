@@ -12,19 +12,73 @@ time.
 
 Updates are sent to the consumer as complete lines (including newlines).
 Infile progress is tracked via a persistent state object, which tracks
-the inode and file offset.
+the inode and file offset. Compressed files are read with
+:py:mod:`logsnarf.compressed`. With an ack tracker, offsets are only saved
+once the uploader is done with the lines before them, see
+:py:mod:`logsnarf.acks`.
+
+If events come in faster than they're read, the kernel's inotify queue
+overflows and events are lost. When that happens the watched directories are
+rescanned: their listings are kept by :py:mod:`logsnarf.dirindex`, so only
+directories that have changed are listed again, and every file is stat'ed
+and compared with its state. Only files that have grown, shrunk or been
+replaced are read. The stat'ing is done a batch of files at a time, so as
+not to hold up the reactor.
+
+Directories on filesystems where inotify isn't reliable can be watched by
+polling instead, with :py:mod:`logsnarf.poller`. Otherwise, which of the
+directories are given inotify watches, and which are polled, is decided by
+:py:mod:`logsnarf.watches`. The inotify file descriptor can be shared with
+other LogSnarfs, each pausing on its own, see :py:mod:`logsnarf.notifier`.
 """
 
-import codecs
+import collections
+import itertools
 import logging
 import os
 import os.path
 
 from twisted.internet import inotify
 from twisted.internet import interfaces
+from twisted.internet import threads
+from twisted.python import failure
 from twisted.python import filepath
 from zope.interface import implementer
 
+from . import compressed
+from . import dirindex
+from . import handles
+from . import lag
+from . import metrics
+from . import notifier
+from . import poller
+from . import profiling
+from . import watches
+
+WATCH_MASK = (inotify.IN_MODIFY | inotify.IN_DELETE | inotify.IN_CREATE |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO)
+# Files stat'ed per reactor iteration when rescanning.
+RESCAN_BATCH = 1000
+# Most checkPattern decisions to remember.
+MATCH_CACHE_SIZE = 65536
+WATCHERS = ['inotify', 'poll']
+
+LINES_READ = metrics.counter('logsnarf_read_lines',
+                             'Lines read from log files.', ['path'])
+BYTES_READ = metrics.counter('logsnarf_read_bytes',
+                             'Bytes read from log files.', ['path'])
+MODIFY_EVENTS = metrics.counter('logsnarf_modify_events',
+                                'IN_MODIFY events for log files.')
+COALESCED_EVENTS = metrics.counter(
+    'logsnarf_coalesced_events',
+    'IN_MODIFY events for files that already had a read pending.')
+OVERFLOWS = metrics.counter('logsnarf_inotify_overflows',
+                            'Times the inotify event queue overflowed.')
+RESCANNED_FILES = metrics.counter(
+    'logsnarf_rescanned_files', 'Files stat\'ed while rescanning.')
+RESCAN_READS = metrics.counter(
+    'logsnarf_rescan_reads', 'Changed files found while rescanning.')
+
 
 @implementer(interfaces.IPushProducer)
 class LogSnarf(object):
@@ -33,7 +87,8 @@ class LogSnarf(object):
     implements :twisted:`twisted.internet.interfaces.IPushProducer`
     """
 
-    def __init__(self, state_obj, consumer, reactor=None):
+    def __init__(self, state_obj, consumer, reactor=None,
+                 notifier_obj=None):
         """Initialize a LogSnarf object.
 
         :param state_obj: current state
@@ -41,41 +96,104 @@ class LogSnarf(object):
         :param consumer: a consumer object
         :type consumer:
             implements(:twisted:`twisted.internet.interfaces.IConsumer`)
+        :param notifier_obj: inotify file descriptor to share, by default
+          one of our own
+        :type notifier_obj: logsnarf.notifier.Notifier
         """
         if not reactor:
             from twisted.internet import reactor
         self.consumer = consumer
         self.reactor = reactor
-        self._inotifier = inotify.INotify(reactor=self.reactor)
+        if notifier_obj is None:
+            notifier_obj = notifier.Notifier(reactor=self.reactor)
+        self._inotifier = notifier_obj.client(overflow=self._snarfcb)
         self._callback = None
+        self._lag_callback = None
+        self.lag = lag.LagTracker(reactor=self.reactor)
+        self.lag_interval = 30
         self._state = state_obj
+        self.acks = None
+        # read positions not yet committed to the state, and the commits
+        # waiting on the ack tracker, as (mark, path, entry)
+        self._positions = {}
+        self._commits = collections.deque()
+        # inode: paths whose read position is in that inode, and path: inode,
+        # for finding renamed files. Built from the state when first needed.
+        self._inodes = None
+        self._inode_of = {}
         self._patterns = {}
+        # path component trie of the watched directories, built from
+        # _patterns when needed, with their patterns under the key None
+        self._pattern_trie = None
+        self._matches = {}
+        self._indexes = {}
+        self._pollers = []
+        self.poll_min_interval = 1.0
+        self.poll_max_interval = 30.0
+        self._watches = None
+        self.max_watches = 8192
+        self.watch_cold_after = 3600
+        self._rescan = None
+        self._rescan_again = False
         self._paused_in_doRead = []
+        self._compressed = {}
+        self._handles = handles.HandleCache()
+        # path: [FilePath, time of first event, DelayedCall]
+        self._dirty = {}
+        self.coalesce_window = 0
+        self.coalesce_max_delay = 0
         self.paused = True
         self.log = logging.getLogger(self.__class__.__name__)
         self.consumer.registerProducer(self, True)
         self.setCallback(self.consumer.write)
 
-    def watch(self, path, pattern=None, recursive=True):
+    def watch(self, path, pattern=None, recursive=True, watcher='inotify'):
         """Add a watch to a given directory.
 
         :param path: directory to watch for changes in
         :param pattern: regular expression that files much match
         :param recursive: If true, also watch subdirectories.
+        :param watcher: one of :py:data:`WATCHERS`, inotify, or poll to
+            poll the directory for changes
 
         :type path: string or :twisted:`twisted.python.filepath.FilePath`
         :type pattern: re.RegexObject or None
         :type recursive: bool
+        :type watcher: str
+        :raises ValueError: if watcher isn't known
         """
+        if watcher not in WATCHERS:
+            raise ValueError('watcher must be one of %s, not %s' % (
+                WATCHERS, watcher))
         if not isinstance(path, filepath.FilePath):
             path = filepath.FilePath(path)
         self._patterns[path.path] = pattern
+        self._pattern_trie = None
+        self._matches.clear()
+        index = self._indexes[path.path] = dirindex.DirectoryIndex(
+            path.path, pattern, recursive)
+        if watcher == 'poll':
+            # record what's there before the backlog is read, so that
+            # anything written after is polled for
+            p = poller.Poller(index, self._pollcb, self.poll_min_interval,
+                              self.poll_max_interval, reactor=self.reactor)
+            p.snapshot()
+            self._pollers.append(p)
+            if not self.paused:
+                p.start()
         # noinspection PyUnresolvedReferences
         self.reactor.callWhenRunning(self._do_backlog, path, pattern,
                                      recursive)
-        self._inotifier.watch(path, recursive=recursive, autoAdd=True,
-                              callbacks=[self._snarfcb],
-                              mask=inotify.IN_MODIFY | inotify.IN_DELETE)
+        if watcher == 'inotify':
+            if self._watches is None:
+                self._watches = watches.WatchManager(
+                    self._inotifier, self._snarfcb, WATCH_MASK,
+                    self.max_watches, self.watch_cold_after,
+                    self.poll_min_interval, self.poll_max_interval,
+                    reactor=self.reactor)
+                if not self.paused:
+                    self._watches.start()
+            self._watches.manage(index)
 
     def _do_backlog(self, path, pattern, recursive):
         """Process the backlog.
@@ -84,26 +202,89 @@ class LogSnarf(object):
         are processed and added to the state file.
         """
         self.log.info("Processing backlog in %s pattern: %s recursive: %s",
-                      path.path, pattern.pattern, recursive)
-        if recursive:
-            filenames = []
-            for dirpath, _, filename in os.walk(path.path):
-                filenames.extend([os.path.join(dirpath, f) for f in filename])
-        else:
-            filenames = [
-                os.path.join(path.path, f) for f in os.listdir(path.path)
-            ]
-        if pattern:
-            filenames = filter(pattern.match, filenames)
+                      path.path, pattern and pattern.pattern, recursive)
+        index = self._indexes.get(path.path)
+        if index is None:
+            index = self._indexes[path.path] = dirindex.DirectoryIndex(
+                path.path, pattern, recursive)
+        filenames = index.refresh()
 
         self.log.info("Files to process as backlog %s", filenames)
-        filenames = map(filepath.FilePath, filenames)
+        for filename in filenames:
+            self._enqueue(filepath.FilePath(filename))
+
+    def _enqueue(self, path):
+        """Read a file now, or when we're resumed."""
+        if self.paused:
+            # picked up by resumeProducing
+            if path not in self._paused_in_doRead:
+                self._paused_in_doRead.append(path)
+        else:
+            self.doRead(path)
+
+    def rescan(self):
+        """Look for files that have changed without us being told.
+
+        Every file in the watched directories is stat'ed, a batch at a time,
+        and those whose size or inode differs from their state are read.
+        Rescanning while a rescan is running starts another once it's done.
+        """
+        if self._rescan is not None:
+            self._rescan_again = True
+            return
+        self._rescan_again = False
+        filenames = []
+        for index in self._indexes.values():
+            filenames.extend(index.refresh())
+        self.log.info('Rescanning %d files', len(filenames))
+        self._rescan = iter(filenames)
+        self._rescanBatch()
+
+    def _rescanBatch(self):
+        """Stat the next batch of files being rescanned."""
+        n = 0
+        for filename in itertools.islice(self._rescan, RESCAN_BATCH):
+            n += 1
+            if self._changed(filename):
+                RESCAN_READS.inc()
+                self._enqueue(filepath.FilePath(filename))
+        RESCANNED_FILES.inc(n)
+        if n == RESCAN_BATCH:
+            self.reactor.callLater(0, self._rescanBatch)
+            return
+        self._rescan = None
+        if self._rescan_again:
+            self.rescan()
 
-        map(self.doRead, filenames)
+    def _changed(self, filename):
+        """True if a file isn't as its state says we left it.
+
+        :param filename: file path
+        :type filename: str
+        :rtype: bool
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        entry = self._position(filename)
+        if entry is None:
+            return st.st_size > 0
+        if entry[1] != st.st_ino:
+            return True
+        if len(entry) > 2:
+            # compressed, the offset is into the uncompressed data
+            return entry[2][0] < st.st_size
+        return entry[0] != st.st_size
 
     def start(self):
         """Start watching."""
         self._inotifier.startReading()
+        for p in self._pollers:
+            p.start()
+        if self._watches is not None:
+            self._watches.start()
+        self.lag.start(self.lag_interval)
         self.paused = False
 
     def setCallback(self, callback):
@@ -123,6 +304,155 @@ class LogSnarf(object):
         self.log.debug('Callback set to %s', name)
         self._callback = callback
 
+    def setCoalescing(self, window, max_delay):
+        """Coalesce modification events for a file into one read.
+
+        A file is read once no events for it have come in for window
+        seconds, or max_delay seconds after the first event, whichever is
+        sooner. A window of 0 reads the file on every event.
+
+        :param window: seconds to wait for more events
+        :type window: float
+        :param max_delay: longest to put off reading a modified file
+        :type max_delay: float
+        """
+        self.coalesce_window = window
+        self.coalesce_max_delay = max(window, max_delay)
+
+    def setAckTracker(self, acks):
+        """Save offsets only once the consumer is done with the lines.
+
+        The same tracker must be given to the consumer.
+
+        :param acks: ack tracker
+        :type acks: logsnarf.acks.AckTracker
+        """
+        self.acks = acks
+        acks.addCallback(self._acked)
+
+    def _position(self, name):
+        """The state entry for how far a file has been read."""
+        entry = self._positions.get(name)
+        return entry if entry is not None else self._state.get(name)
+
+    def _commit(self, name, entry):
+        """Record how far a file has been read.
+
+        The entry is saved to the state once every line written before it
+        has been acknowledged.
+        """
+        acks = self.acks
+        if acks is None or acks.last <= acks.watermark:
+            self._state[name] = entry
+            self._positions.pop(name, None)
+        else:
+            self._positions[name] = entry
+            self._commits.append((acks.last, name, entry))
+        if self._inodes is not None and self._inode_of.get(name) != entry[1]:
+            self._reindex(name)
+
+    def _acked(self, watermark):
+        """Save the entries whose lines have all been acknowledged."""
+        commits = self._commits
+        done = {}
+        while commits and commits[0][0] <= watermark:
+            _, name, entry = commits.popleft()
+            done[name] = entry
+        if not done:
+            return
+        self._state.update(done)
+        for name, entry in done.items():
+            if self._positions.get(name) is entry:
+                del self._positions[name]
+            self._reindex(name)
+
+    def _forget(self, name):
+        """Drop a file's state, committed or not, and its handle."""
+        self._state.pop(name, None)
+        if self._positions.pop(name, None) is not None:
+            self._commits = collections.deque(
+                c for c in self._commits if c[1] != name)
+        self._handles.forget(name)
+        self._reindex(name)
+
+    def _reindex(self, name):
+        """Update the inode index for a path's read position."""
+        if self._inodes is None:
+            return
+        inode = self._inode_of.pop(name, None)
+        if inode is not None:
+            names = self._inodes[inode]
+            names.discard(name)
+            if not names:
+                del self._inodes[inode]
+        entry = self._position(name)
+        if entry is not None:
+            self._inode_of[name] = entry[1]
+            self._inodes.setdefault(entry[1], set()).add(name)
+
+    def _withInode(self, inode):
+        """Paths whose read position is in inode.
+
+        :rtype: list(str)
+        """
+        if self._inodes is None:
+            self._inodes = {}
+            for name in set(self._state).union(self._positions):
+                self._reindex(name)
+        return sorted(self._inodes.get(inode, ()))
+
+    def setPolling(self, min_interval, max_interval):
+        """Set how often directories watched by polling are polled.
+
+        Must be called before the directories are watched.
+
+        :param min_interval: seconds between polls of an active directory
+        :type min_interval: float
+        :param max_interval: seconds between polls of a quiet directory
+        :type max_interval: float
+        """
+        self.poll_min_interval = min_interval
+        self.poll_max_interval = max_interval
+
+    def setWatchBudget(self, max_watches, cold_after):
+        """Set how many inotify watches can be used.
+
+        Must be called before the directories are watched.
+
+        :param max_watches: the most directories to watch with inotify
+        :type max_watches: int
+        :param cold_after: seconds a watched directory can go without log
+          files before it's polled instead
+        :type cold_after: float
+        """
+        self.max_watches = max_watches
+        self.watch_cold_after = cold_after
+
+    def setMaxOpenFiles(self, n):
+        """Set the most files to keep open between reads.
+
+        :param n: open file limit
+        :type n: int
+        """
+        self._handles.max_open = n
+
+    def setLagCallback(self, callback):
+        """Set a function to be told how far behind we are on a file.
+
+        The callback should have a signature of f(path, lag), accepting the
+        path of a file, and the number of bytes in it that have not been read
+        yet. It's called as reads of a file start and stop.
+        """
+        if not callable(callback):
+            raise TypeError('%r is not callable.', callback)
+        self._lag_callback = callback
+
+    def _reportLag(self, path, offset):
+        size = path.getsize()
+        self.lag.update(path.path, size, offset, path.getModificationTime())
+        if self._lag_callback is not None:
+            self._lag_callback(path.path, max(0, size - offset))
+
     def pauseProducing(self):
         """:twisted:`twisted.internet.interfaces.IPushProducer` method
 
@@ -130,6 +460,10 @@ class LogSnarf(object):
         """
         self.paused = True
         self._inotifier.pauseProducing()
+        for p in self._pollers:
+            p.pauseProducing()
+        if self._watches is not None:
+            self._watches.pauseProducing()
         self.log.debug('Paused producing')
 
     def resumeProducing(self):
@@ -148,37 +482,92 @@ class LogSnarf(object):
             self.doRead(path)
         self.log.debug('Resuming inotify')
         self._inotifier.resumeProducing()
+        for p in self._pollers:
+            p.resumeProducing()
+        if self._watches is not None:
+            self._watches.resumeProducing()
 
     def cleanState(self):
         """Remove invalid entries from the state file."""
-        for path in self._state:
+        for path in list(self._state):
             if not os.path.exists(path):
-                self._state.pop(path, None)
+                self._forget(path)
 
     def checkPattern(self, path):
         """Check a path against our pattern.
 
+        The path matches if it's in a watched directory whose pattern
+        matches it. Decisions are remembered until the next watch.
+
         :param twisted.python.filepath.FilePath path: The path to check
         :returns bool: true if the path matches.
         """
+        name = path.path
+        result = self._matches.get(name)
+        if result is None:
+            result = self._checkPattern(name)
+            if len(self._matches) >= MATCH_CACHE_SIZE:
+                self._matches.clear()
+            self._matches[name] = result
+        return result
+
+    def _checkPattern(self, name):
+        if self._pattern_trie is None:
+            self._pattern_trie = {}
+            for root, pattern in self._patterns.items():
+                node = self._pattern_trie
+                for part in root.split('/'):
+                    if part:
+                        node = node.setdefault(part, {})
+                node[None] = pattern
+        # the patterns of the directories the path is in
+        patterns = []
+        node = self._pattern_trie
+        for part in name.split('/'):
+            if not part:
+                continue
+            if None in node:
+                patterns.append(node[None])
+            node = node.get(part)
+            if node is None:
+                break
+        else:
+            if None in node:
+                patterns.append(node[None])
         # Start with most specific (longest) path
-        for pth in sorted(self._patterns, reverse=True,
-                          key=len):
-            if path.path.startswith(pth):
-                if self._patterns[pth] is None or \
-                        self._patterns[pth].search(path.path):
-                    return True
+        for pattern in reversed(patterns):
+            if pattern is None or pattern.search(name):
+                return True
         return False
 
+    @profiling.timed('doRead')
     def doRead(self, path):
         """read from a file.
 
         :param path: the file to read
         :type path: :twisted:`twisted.python.filepath.FilePath`
         """
-        path.restat()
-        offset, inode = self._state.get(path.path, [0, path.getInodeNumber()])
+        try:
+            path.restat()
+        except OSError:
+            # gone, finish reading it if it's still open
+            handle = self._handles.get(path.path)
+            if handle is not None:
+                self._readLines(path, handle)
+            return
+        if compressed.isCompressed(path.path):
+            self._readCompressed(path)
+            return
         new_inode = path.getInodeNumber()
+        handle = self._handles.get(path.path)
+        if handle is not None and handle.inode != new_inode:
+            # rotated, finish reading the old file first
+            self.log.info('%s has been replaced, finishing the old file',
+                          path.path)
+            if not self._readLines(path, handle):
+                return
+            self._handles.close(path.path)
+        offset, inode = (self._position(path.path) or [0, new_inode])[:2]
 
         if inode != new_inode:
             self.log.warning('%s is a new file, inodes differ. Starting '
@@ -191,51 +580,305 @@ class LogSnarf(object):
                              'offset 0', path.path, path.getsize(), offset)
             offset = 0
         self.log.debug('do_read: %s offset: %d', path.path, offset)
+        self._reportLag(path, offset)
         try:
-            with path.open() as raw_fp:
-                f = codecs.getreader('utf-8')(raw_fp, errors='ignore')
-                if offset != 0:
-                    f.seek(offset - 1)
-                    c = f.read(1)
-                    if c != '\n':
-                        offset = self._seekNewLine(f, offset)
-                        f.seek(offset)
-                line = True
-                while line:
-                    line = f.readline()
-                    if line.endswith('\n'):
-                        # the reader looks ahead, we need to offset this when
-                        # storing, well, offsets
-                        offset = f.tell()
-                        if f.charbuffer is not None:
-                            offset -= len(f.charbuffer)
-                        self._callback(line)
-                        if self.paused:
-                            self.log.debug('Paused by consumer')
-                            self._paused_in_doRead.append(path)
-                            self._state[path.path] = [offset, inode]
-                            return
-
-                self._state[path.path] = [offset, inode]
+            handle = self._handles.open(path.path, inode, offset)
+            if handle.reused:
+                self.log.warning('%s is a new file, its inode has been '
+                                 'reused. Starting from offset 0', path.path)
+                handle.reused = False
+            self._readLines(path, handle)
         except IOError:
             self.log.exception('error while processing %s', path)
+            self._handles.close(path.path)
+            return
+        self._reportLag(path, handle.offset)
 
-    def _seekNewLine(self, fp, offset):
-        """Seek backwards to the first newline in fp from offset."""
-        fp.seek(offset - 4096)
-        buf = fp.read(4096)
-        new_offset = offset - 4096 + buf.rfind('\n') + 1
-        self.log.debug('Rewinding %r to %d', fp, new_offset)
-        fp.seek(new_offset)
-        return new_offset
+    def _readLines(self, path, handle):
+        """Send the complete lines in an open file to the consumer.
+
+        :param path: the file's path
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        :param handle: the open file
+        :type handle: logsnarf.handles.OpenFile
+        :return: False if we were paused before the end of the file
+        :rtype: bool
+        """
+        start, lines = handle.offset, 0
+        line = handle.readline()
+        while line is not None:
+            lines += 1
+            self._callback(line.decode('utf-8', 'ignore'))
+            if self.paused:
+                break
+            line = handle.readline()
+        entry = [handle.offset, handle.inode]
+        if self._position(path.path) != entry:
+            self._commit(path.path, entry)
+        self._countRead(path, lines, handle.offset - start)
+        if self.paused and line is not None:
+            self.log.debug('Paused by consumer')
+            if path not in self._paused_in_doRead:
+                self._paused_in_doRead.append(path)
+            return False
+        return True
+
+    def _readCompressed(self, path):
+        """Read from a compressed file.
+
+        Lines are decompressed in a worker thread, a chunk at a time, and
+        sent to the consumer from the reactor thread.
+
+        :param path: the file to read
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        """
+        inode = path.getInodeNumber()
+        reader = self._compressed.get(path.path)
+        if reader is None or reader.inode != inode:
+            if reader is not None:
+                reader.close()
+            offset, checkpoint = 0, None
+            entry = self._position(path.path)
+            if entry and entry[1] == inode:
+                offset = entry[0]
+                checkpoint = entry[2] if len(entry) > 2 else None
+            elif entry:
+                self.log.warning('%s is a new file, inodes differ. Starting '
+                                 'from offset 0', path.path)
+            else:
+                original = compressed.uncompressedPath(path.path)
+                entry = self._position(original)
+                if entry is not None:
+                    if self._exists(original, entry[1]):
+                        # still being compressed, it's read once the
+                        # original is deleted
+                        return
+                    offset = entry[0]
+                    self._compressedFrom(original, path.path, [offset, inode])
+            try:
+                reader = compressed.CompressedReader(path.path, inode, offset,
+                                                     checkpoint)
+            except ValueError as e:
+                self.log.error('Unable to read %s: %s', path.path, e)
+                return
+            self._compressed[path.path] = reader
+        reader.exhausted = False
+        if not reader.busy:
+            self._sendCompressed(path, reader)
+
+    @staticmethod
+    def _exists(name, inode):
+        """True if the file at name has inode."""
+        try:
+            return os.stat(name).st_ino == inode
+        except OSError:
+            return False
+
+    def _compressedFrom(self, original, name, entry):
+        """Carry the state of a deleted file over to its compressed copy.
+
+        :param original: path of the file that was compressed
+        :type original: str
+        :param name: path of the compressed file
+        :type name: str
+        :param entry: the compressed file's state entry, starting from the
+          original's offset
+        :type entry: list
+        """
+        self.log.info('%s was compressed to %s, reading on from offset %d',
+                      original, name, entry[0])
+        self._commit(name, entry)
+        self._forget(original)
+        LINES_READ.remove(original)
+        BYTES_READ.remove(original)
+        self.lag.remove(original)
+
+    def _compressedCopy(self, path):
+        """The compressed copy of a file, if one is waiting to be read.
+
+        :param path: the file
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        :rtype: :twisted:`twisted.python.filepath.FilePath`
+        """
+        for suffix in compressed.SUFFIXES:
+            copy = filepath.FilePath(path.path + suffix)
+            if self._position(copy.path) is None and copy.exists() and \
+                    self.checkPattern(copy):
+                return copy
+        return None
+
+    def _sendCompressed(self, path, reader):
+        """Send decompressed lines, then decompress more in a thread."""
+        offset = checkpoint = None
+        lines = 0
+        while reader.lines and not self.paused:
+            line, offset, checkpoint = reader.lines.popleft()
+            lines += 1
+            self._callback(line)
+        if offset is not None:
+            start = (self._position(path.path) or [0])[0]
+            self._commit(path.path, [offset, reader.inode, list(checkpoint)])
+            self._countRead(path, lines, offset - start)
+        self._reportLag(path, reader.compressed_offset)
+        if self.paused:
+            if path not in self._paused_in_doRead:
+                self._paused_in_doRead.append(path)
+            return
+        if reader.complete:
+            self._compressed.pop(path.path, None)
+            return
+        if reader.exhausted:
+            return
+        reader.busy = True
+        d = threads.deferToThread(reader.read)
+        d.addBoth(self._compressedRead, path, reader)
+
+    def _compressedRead(self, result, path, reader):
+        """Callback for decompressing a chunk in a worker thread."""
+        reader.busy = False
+        if self._compressed.get(path.path) is not reader:
+            # deleted, or replaced by a new file, while we were reading
+            reader.close()
+        elif isinstance(result, failure.Failure):
+            self.log.error('Error while reading %s: %s', path.path,
+                           result.getErrorMessage())
+            reader.close()
+            self._compressed.pop(path.path)
+        else:
+            self._sendCompressed(path, reader)
+
+    @staticmethod
+    def _countRead(path, lines, nbytes):
+        if lines:
+            LINES_READ.labels(path.path).inc(lines)
+            BYTES_READ.labels(path.path).inc(nbytes)
 
     def _snarfcb(self, _, path, mask):
         """The callback given to :twisted:`twisted.internet.inotify.INotify`"""
+        if mask & inotify.IN_Q_OVERFLOW:
+            OVERFLOWS.inc()
+            self.log.warning('inotify queue overflowed, rescanning')
+            self.reactor.callLater(0, self.rescan)
+            return
+        if isinstance(path.path, bytes):
+            # INotify hands us bytes paths, our state and patterns are text.
+            path = path.asTextMode()
         if mask & inotify.IN_DELETE:
-            self._state.pop(path.path, None)
+            if self._position(path.path) is not None:
+                copy = self._compressedCopy(path)
+                if copy is not None:
+                    # takes over the state of the deleted file
+                    self.doRead(copy)
+            self._clean(path)
+            self._forget(path.path)
+            reader = self._compressed.pop(path.path, None)
+            if reader is not None and not reader.busy:
+                reader.close()
+            LINES_READ.remove(path.path)
+            BYTES_READ.remove(path.path)
+            self.lag.remove(path.path)
+            self._matches.pop(path.path, None)
+            return
+        if mask & inotify.IN_MOVED_FROM:
+            handle = self._handles.get(path.path)
+            if handle is not None and not self.paused:
+                # read what was written before the rename while we can
+                self._readLines(path, handle)
             return
-        if not mask & inotify.IN_MODIFY:
+        if not mask & (inotify.IN_MODIFY | inotify.IN_CREATE |
+                       inotify.IN_MOVED_TO):
             return
         if not self.checkPattern(path):
             return
+        if mask & inotify.IN_MODIFY:
+            MODIFY_EVENTS.inc()
+            if self.coalesce_window:
+                self._modified(path)
+                return
+        self._clean(path)
+        if mask & inotify.IN_MOVED_TO:
+            self._moved(path)
+        self.doRead(path)
+
+    def _pollcb(self, path, mask):
+        """The callback given to :py:class:`logsnarf.poller.Poller`"""
+        self._snarfcb(None, filepath.FilePath(path), mask)
+
+    def _modified(self, path):
+        """Schedule a read of a modified file, if there isn't one pending.
+
+        Further events for the file put the read off for another window,
+        up to max_delay after the first.
+
+        :param path: the modified file
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        """
+        pending = self._dirty.get(path.path)
+        if pending is None:
+            self._dirty[path.path] = [
+                path, self.reactor.seconds(),
+                self.reactor.callLater(self.coalesce_window, self._readDirty,
+                                       path.path)]
+            return
+        COALESCED_EVENTS.inc()
+        _, first, call = pending
+        call.reset(max(0, min(self.coalesce_window,
+                              first + self.coalesce_max_delay -
+                              self.reactor.seconds())))
+
+    def _readDirty(self, name):
+        """Read a modified file, once its events have settled."""
+        path = self._dirty.pop(name)[0]
+        if self.paused:
+            if path not in self._paused_in_doRead:
+                self._paused_in_doRead.append(path)
+            return
         self.doRead(path)
+
+    def _clean(self, path):
+        """Cancel any pending read of a file."""
+        pending = self._dirty.pop(path.path, None)
+        if pending is not None:
+            pending[2].cancel()
+
+    def _moved(self, path):
+        """Carry the state of a renamed file over to its new path.
+
+        Renamed files are found by inode, among the files we know of that
+        no longer have that inode, through an index of the inodes of our
+        read positions.
+
+        :param path: the file's new path
+        :type path: :twisted:`twisted.python.filepath.FilePath`
+        """
+        try:
+            path.restat()
+        except OSError:
+            return
+        inode = path.getInodeNumber()
+        for old in self._withInode(inode):
+            if old == path.path:
+                continue
+            try:
+                if os.stat(old).st_ino == inode:
+                    continue
+            except OSError:
+                pass
+            self.log.info('%s was renamed to %s', old, path.path)
+            entry = self._state.get(old)
+            if entry is not None:
+                self._state[path.path] = entry
+                del self._state[old]
+            entry = self._positions.pop(old, None)
+            if entry is not None:
+                self._positions[path.path] = entry
+                self._commits = collections.deque(
+                    (m, path.path if n == old else n, e)
+                    for m, n, e in self._commits)
+            self._handles.rename(old, path.path)
+            self._reindex(old)
+            self._reindex(path.path)
+            LINES_READ.remove(old)
+            BYTES_READ.remove(old)
+            self.lag.remove(old)
+            return
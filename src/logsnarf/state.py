@@ -65,6 +65,11 @@ class State(abc.MutableMapping):
     def __getitem__(self, key):
         return self._values.__getitem__(key)
 
+    def update(self, *args, **kwargs):
+        """Update several values, saving once."""
+        self._values.update(*args, **kwargs)
+        self.save()
+
     def save(self):
         """Save current state."""
         with open(self.state_path, 'w') as f:
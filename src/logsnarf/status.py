@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_status -*-
+# pylint: disable=invalid-name
+"""logsnarf-status command.
+
+Reports how far behind logsnarf is on each file it knows about. Offsets are
+read from each app's state file, and compared to the current size of each
+file. Estimates of seconds behind come from the lag snapshot the running
+process writes every lag_interval seconds. Neither file is written to, and
+the running process isn't contacted. The files of each shard of an app
+run by a supervisor, see :py:mod:`logsnarf.supervisor`, are read.
+"""
+import os
+import sys
+import time
+
+import simplejson as json
+from twisted.python import usage
+
+from . import config
+from . import errors
+from . import supervisor
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['resource_name', 'n', 'logsnarf', 'Resource name'],
+        ['config_file', 'f', None, 'Config file'],
+    ]
+    optFlags = [
+        ['json', 'j', 'Print status as JSON'],
+    ]
+
+
+def _loadJSON(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return default
+
+
+def fileStatus(state_path, snapshot_path=None, now=None):
+    """Return lag for every file in a state file.
+
+    :param state_path: path to the state file
+    :type state_path: str
+    :param snapshot_path: path to the lag snapshot file, if any
+    :type snapshot_path: str
+    :param now: current time, defaults to time.time()
+    :type now: float
+    :return: status of the app's files, and totals
+    :rtype: dict
+    """
+    now = now or time.time()
+    state = _loadJSON(state_path, {})
+    snapshot = {}
+    if snapshot_path:
+        snapshot = _loadJSON(snapshot_path, {})
+    snapshot_files = snapshot.get('files', {})
+    files = []
+    for path, value in sorted(state.items()):
+        offset, inode = value[:2]
+        entry = {'path': path, 'offset': offset}
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry['error'] = 'missing'
+            files.append(entry)
+            continue
+        entry['size'] = st.st_size
+        if st.st_ino != inode:
+            # rotated, it will be read from the start.
+            entry['lag_bytes'] = st.st_size
+        elif len(value) > 2:
+            # compressed, offsets are uncompressed. Count from the
+            # checkpoint, which is at most one member behind.
+            entry['lag_bytes'] = max(0, st.st_size - value[2][0])
+        else:
+            entry['lag_bytes'] = max(0, st.st_size - offset)
+        if not entry['lag_bytes']:
+            entry['lag_seconds'] = 0.0
+        elif path in snapshot_files:
+            entry['lag_seconds'] = snapshot_files[path]['lag_seconds']
+        else:
+            entry['lag_seconds'] = None
+        files.append(entry)
+    seconds = [f['lag_seconds'] for f in files
+               if f.get('lag_seconds') is not None]
+    return {
+        'files': files,
+        'total_lag_bytes': sum(f.get('lag_bytes', 0) for f in files),
+        'max_lag_seconds': max(seconds or [0.0]),
+        'snapshot_age': now - snapshot['time'] if 'time' in snapshot else None,
+    }
+
+
+def mergeStatus(statuses):
+    """Merge the status of the shards of an app.
+
+    :param statuses: status of each shard
+    :type statuses: list(dict)
+    :rtype: dict
+    """
+    ages = [s['snapshot_age'] for s in statuses
+            if s['snapshot_age'] is not None]
+    return {
+        'files': sorted((f for s in statuses for f in s['files']),
+                        key=lambda f: f['path']),
+        'total_lag_bytes': sum(s['total_lag_bytes'] for s in statuses),
+        'max_lag_seconds': max(s['max_lag_seconds'] for s in statuses),
+        'snapshot_age': max(ages) if ages else None,
+    }
+
+
+def appStatus(cfg, section_name):
+    """Return lag for every file known to an app section.
+
+    If the app is sharded over several workers, the status of each shard is
+    merged.
+
+    :param cfg: config object
+    :type cfg: logsnarf.config.Config
+    :param section_name: app section name
+    :type section_name: str
+    :rtype: dict
+    """
+    section = cfg[section_name]
+    count = 1
+    if cfg['logsnarf']['supervise']:
+        count = supervisor.shardCount(section)
+    return mergeStatus([fileStatus(
+        cfg.saveConfigPath(supervisor.shardPath(section['state_file'],
+                                                (i, count))),
+        cfg.saveDataPath(supervisor.shardPath(section['lag_file'],
+                                              (i, count))))
+        for i in range(count)])
+
+
+def formatStatus(status):
+    """Format the status of several apps as text.
+
+    :param status: app section name to status
+    :type status: dict
+    :rtype: str
+    """
+    lines = []
+    for name in sorted(status):
+        app = status[name]
+        if app['snapshot_age'] is None:
+            age = 'no lag snapshot'
+        else:
+            age = 'lag snapshot %ds old' % app['snapshot_age']
+        lines.append('[%s] %d bytes behind, at most %.0f seconds (%s)' % (
+            name, app['total_lag_bytes'], app['max_lag_seconds'], age))
+        for f in app['files']:
+            if 'error' in f:
+                lines.append('  %s: %s' % (f['path'], f['error']))
+                continue
+            if f['lag_seconds'] is None:
+                seconds = '?'
+            else:
+                seconds = '%.0f' % f['lag_seconds']
+            lines.append('  %s: offset %d of %d, %d bytes %s seconds behind'
+                         % (f['path'], f['offset'], f['size'],
+                            f['lag_bytes'], seconds))
+    return '\n'.join(lines)
+
+
+def main():
+    opts = Options()
+    try:
+        opts.parseOptions()
+    except usage.UsageError as e:
+        print("%s: %s" % (sys.argv[0], e))
+        print("%s: Try --help for usage details." % (sys.argv[0]))
+        sys.exit(1)
+    cfg = config.Config(resource_name=opts['resource_name'],
+                        config_file=opts['config_file'])
+    cfg.loadConfigs()
+    sections = cfg.get('logsnarf', None)
+    if sections is None:
+        raise errors.ConfigError('No logsnarf section configured.')
+    try:
+        config_apps = json.loads(sections['apps'])
+    except json.JSONDecodeError:
+        raise errors.ConfigError('No valid apps section in configuration')
+    status = dict((s, appStatus(cfg, s)) for s in config_apps
+                  if s in cfg.keys())
+    if opts['json']:
+        print(json.dumps(status, indent=2, sort_keys=True))
+    else:
+        print(formatStatus(status))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_supervisor -*-
+# pylint: disable=invalid-name
+"""Running app sections in worker processes.
+
+In one process every app section shares a reactor, and so a single core.
+With ``supervise`` set in the logsnarf section, the process started is a
+:py:class:`Supervisor`, which runs each app section in a worker process of
+its own. An app section with ``workers`` set above 1 has its directories
+dealt out between that many workers, its shards. Each worker has its own
+reactor, uploader, and state, lag and bulk files, see
+:py:func:`shardPath`.
+
+Workers that exit are restarted, after a delay that doubles, up to
+:py:data:`MAX_RESTART_DELAY`, each time a worker exits soon after it was
+started. SIGUSR1 and SIGUSR2, for profiling, are passed on to every
+worker. On shutdown workers are sent SIGTERM, so they can flush their
+uploads, and killed if they haven't exited after :py:data:`STOP_TIMEOUT`
+seconds.
+
+Workers write their metrics to the supervisor over a pipe every
+:py:data:`METRICS_INTERVAL` seconds. The supervisor serves them on
+``metrics_port``, each sample labelled with the worker it came from, along
+with its own ``logsnarf_workers_running`` and
+``logsnarf_worker_restarts_total``. A worker whose supervisor goes away
+stops.
+"""
+
+import collections
+import logging
+import os
+import signal
+import sys
+
+import simplejson as json
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import protocol
+from twisted.internet import stdio
+from twisted.internet import task
+
+from . import metrics
+
+METRICS_FD = 3
+METRICS_INTERVAL = 5.0
+MIN_RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 60.0
+STOP_TIMEOUT = 120.0
+FORWARDED_SIGNALS = ('USR1', 'USR2')
+
+# the supervisor's own metrics, kept apart from those of the app modules,
+# which are only used in workers.
+REGISTRY = metrics.Registry()
+WORKERS_RUNNING = metrics.gauge('logsnarf_workers_running',
+                                'Worker processes running.',
+                                registry=REGISTRY)
+WORKER_RESTARTS = metrics.counter('logsnarf_worker_restarts',
+                                  'Worker processes restarted after '
+                                  'exiting.', ['worker'], registry=REGISTRY)
+
+
+def shardPath(path, shard):
+    """The path a shard keeps a per-section file or directory at.
+
+    ``app1_state.json`` for the second of four shards is
+    ``app1_state.1of4.json``.
+
+    :param path: the section's path
+    :type path: str
+    :param shard: (index, count) of the shard, or None
+    :type shard: tuple(int, int)
+    :rtype: str
+    """
+    if shard is None or shard[1] < 2:
+        return path
+    base, ext = os.path.splitext(path)
+    return '%s.%dof%d%s' % (base, shard[0], shard[1], ext)
+
+
+def shardCount(section):
+    """How many workers a section's directories are sharded over.
+
+    :param section: app configuration section
+    :type section: logsnarf.config.ConfigSection
+    :rtype: int
+    """
+    dirs = section.get('directories', None)
+    n = len(json.loads(dirs)) if dirs else 1
+    return max(1, min(section['workers'], n))
+
+
+def workerName(section_name, shard):
+    """The name a worker is known by in logs and metrics."""
+    if shard is None or shard[1] < 2:
+        return section_name
+    return '%s/%d' % (section_name, shard[0])
+
+
+def workerArgs(section_name, shard, resource_name, config_file=None):
+    """Command line arguments to run a worker.
+
+    :param section_name: app section the worker runs
+    :type section_name: str
+    :param shard: (index, count) of the worker's shard
+    :type shard: tuple(int, int)
+    :rtype: list(str)
+    """
+    args = [sys.executable, '-m', 'logsnarf.app', '-n', resource_name]
+    if config_file:
+        args.extend(['-f', config_file])
+    args.extend(['--worker', section_name,
+                 '--shard', '%d/%d' % shard])
+    return args
+
+
+def mergeExpositions(expositions):
+    """Merge Prometheus text expositions, labelling the samples of each.
+
+    :param expositions: (labels, exposition) pairs, labels being a list of
+      (name, value) pairs added to every sample in the exposition
+    :type expositions: list(tuple(list, bytes))
+    :rtype: bytes
+    """
+    # name: [HELP line, TYPE line, samples]
+    families = collections.defaultdict(lambda: [None, None, []])
+    for labels, text in expositions:
+        extra = metrics.formatLabels(labels)[1:-1]
+        family = None
+        for line in text.decode('utf-8').splitlines():
+            if not line:
+                continue
+            if line.startswith('# '):
+                parts = line.split(' ', 3)
+                if len(parts) < 3:
+                    continue
+                family = families[parts[2]]
+                i = 0 if parts[1] == 'HELP' else 1
+                if family[i] is None:
+                    family[i] = line
+                continue
+            if family is None:
+                continue
+            if extra:
+                i = min(n for n in (line.find('{'), line.find(' '))
+                        if n >= 0)
+                if line[i] == '{':
+                    line = '%s{%s,%s' % (line[:i], extra, line[i + 1:])
+                else:
+                    line = '%s{%s}%s' % (line[:i], extra, line[i:])
+            family[2].append(line)
+    lines = []
+    for name in sorted(families):
+        doc, kind, samples = families[name]
+        lines.extend(l for l in (doc, kind) if l is not None)
+        lines.extend(samples)
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Reads a worker's metrics, and tells its supervisor when it ends."""
+
+    def __init__(self, worker):
+        self.worker = worker
+        self._buf = b''
+
+    def childDataReceived(self, childFD, data):
+        if childFD != METRICS_FD:
+            return
+        parts = (self._buf + data).split(b'\0')
+        self._buf = parts.pop()
+        if parts:
+            self.worker.metrics = parts[-1]
+
+    def processEnded(self, reason):
+        self.worker.ended(reason)
+
+
+class Worker(object):
+    """A worker process, and its restarts."""
+
+    def __init__(self, supervisor, name, args):
+        """
+
+        :param supervisor: the supervisor
+        :type supervisor: Supervisor
+        :param name: worker name
+        :type name: str
+        :param args: command line to run the worker
+        :type args: list(str)
+        """
+        self.supervisor = supervisor
+        self.reactor = supervisor.reactor
+        self.name = name
+        self.args = args
+        self.process = None
+        self.metrics = b''
+        self.started = None
+        self.delay = MIN_RESTART_DELAY
+        self._restart = None
+        self._waiting = []
+        self.log = logging.getLogger('%s.%s' % (self.__class__.__name__,
+                                                name))
+
+    @property
+    def running(self):
+        return self.process is not None
+
+    def start(self):
+        """Start the worker process."""
+        self._restart = None
+        self.started = self.reactor.seconds()
+        self.process = self.reactor.spawnProcess(
+            WorkerProtocol(self), self.args[0], self.args,
+            env=self.supervisor.env,
+            childFDs={0: 'w', 1: 1, 2: 2, METRICS_FD: 'r'})
+        WORKERS_RUNNING.inc()
+        self.log.info('Started worker %s, pid %s', self.name,
+                      self.process.pid)
+
+    def signal(self, signame):
+        """Send the worker process a signal, by name, e.g. 'TERM'."""
+        if self.process is None:
+            return
+        try:
+            self.process.signalProcess(signame)
+        except (error.ProcessExitedAlready, OSError):
+            pass
+
+    def stop(self):
+        """Stop the worker, and don't restart it.
+
+        :return: fires once the worker has exited
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        if self._restart is not None:
+            self._restart.cancel()
+            self._restart = None
+        if self.process is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        self.signal('TERM')
+        return d
+
+    def ended(self, reason):
+        """The worker process has exited."""
+        self.process = None
+        self.metrics = b''
+        WORKERS_RUNNING.dec()
+        waiting, self._waiting = self._waiting, []
+        if waiting or self.supervisor.stopping:
+            self.log.info('Worker %s stopped', self.name)
+            for d in waiting:
+                d.callback(None)
+            return
+        if self.reactor.seconds() - self.started >= MAX_RESTART_DELAY:
+            self.delay = MIN_RESTART_DELAY
+        self.log.error('Worker %s exited, restarting in %ss: %s', self.name,
+                       self.delay, reason.value)
+        WORKER_RESTARTS.labels(self.name).inc()
+        self._restart = self.reactor.callLater(self.delay, self.start)
+        self.delay = min(self.delay * 2, MAX_RESTART_DELAY)
+
+
+class Supervisor(object):
+    """Runs, and restarts, worker processes."""
+
+    def __init__(self, workers, env=None, reactor=None):
+        """
+
+        :param workers: (name, command line) of each worker
+        :type workers: list(tuple(str, list(str)))
+        :param env: environment for the workers, by default ours
+        :type env: dict
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.env = os.environ.copy() if env is None else env
+        self.stopping = False
+        self.workers = [Worker(self, name, args) for name, args in workers]
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        """Start every worker."""
+        self.log.info('Starting %d workers', len(self.workers))
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """Stop every worker, killing those that don't exit in time.
+
+        :return: fires once every worker has exited
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        self.stopping = True
+        d = defer.DeferredList([w.stop() for w in self.workers])
+        kill = self.reactor.callLater(STOP_TIMEOUT, self.signal, 'KILL')
+
+        def stopped(result):
+            if kill.active():
+                kill.cancel()
+            return result
+
+        return d.addBoth(stopped)
+
+    def signal(self, signame):
+        """Send every worker a signal, by name, e.g. 'USR1'."""
+        for worker in self.workers:
+            worker.signal(signame)
+
+    def installSignalHandlers(self):
+        """Pass on profiling signals to the workers."""
+
+        # noinspection PyUnusedLocal
+        def forward(signum, frame):
+            signame = signal.Signals(signum).name[3:]
+            self.reactor.callFromThread(self.signal, signame)
+
+        for signame in FORWARDED_SIGNALS:
+            signal.signal(getattr(signal, 'SIG' + signame), forward)
+
+    def exposition(self):
+        """Our metrics and the workers', in Prometheus text format.
+
+        This lets the supervisor be served as a metrics registry.
+
+        :rtype: bytes
+        """
+        return mergeExpositions(
+            [([], REGISTRY.exposition())] +
+            [([('worker', w.name)], w.metrics) for w in self.workers])
+
+
+class WorkerControl(protocol.Protocol):
+    """A worker's end of the pipes to its supervisor.
+
+    Writes our metrics to the supervisor, and stops the reactor if the
+    supervisor goes away.
+    """
+
+    def __init__(self, registry=metrics.REGISTRY, interval=METRICS_INTERVAL,
+                 reactor=None):
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.registry = registry
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.clock = reactor
+        self.interval = interval
+
+    def connectionMade(self):
+        self._reporter.start(self.interval)
+
+    def report(self):
+        """Write our metrics to the supervisor."""
+        self.transport.write(self.registry.exposition() + b'\0')
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self._reporter.running:
+            self._reporter.stop()
+        if self.reactor.running:
+            logging.warning('Lost the supervisor, stopping')
+            self.reactor.stop()
+
+
+def connectSupervisor(reactor=None):
+    """Talk to our supervisor, over stdin and the metrics pipe.
+
+    :rtype: WorkerControl
+    """
+    control = WorkerControl(reactor=reactor)
+    stdio.StandardIO(control, stdin=0, stdout=METRICS_FD, reactor=reactor)
+    return control
@@ -0,0 +1,119 @@
+import mock
+from twisted.internet import inotify
+from twisted.internet import reactor
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import acks
+from logsnarf import snarf
+from logsnarf.test.test_snarf import MockConsumer
+
+
+class AckTrackerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.acks = acks.AckTracker()
+        self.watermarks = []
+        self.acks.addCallback(self.watermarks.append)
+
+    def test_inOrder(self):
+        a, b = self.acks.mark(), self.acks.mark()
+        self.assertEqual((a, b, self.acks.last), (0, 1, 1))
+        self.acks.release(a)
+        self.assertEqual(self.acks.watermark, 0)
+        self.acks.release(b)
+        self.assertEqual(self.watermarks, [0, 1])
+        self.assertEqual(len(self.acks), 0)
+
+    def test_outOfOrder(self):
+        a, b, c = self.acks.mark(), self.acks.mark(), self.acks.mark()
+        self.acks.release(c)
+        self.acks.release(b)
+        self.assertEqual(self.watermarks, [])
+        self.assertEqual(self.acks.watermark, -1)
+        self.acks.release(a)
+        self.assertEqual(self.watermarks, [2])
+
+    def test_held(self):
+        a = self.acks.mark()
+        self.acks.hold(a, 2)
+        self.acks.release(a)
+        self.acks.release(a)
+        self.assertEqual(self.acks.watermark, -1)
+        self.acks.release(a)
+        self.assertEqual(self.acks.watermark, 0)
+
+
+class AckingConsumer(MockConsumer):
+    """Holds the mark of each write until it's acked."""
+
+    def __init__(self, tracker):
+        MockConsumer.__init__(self)
+        self.acks = tracker
+        self.marks = []
+
+    def write(self, data):
+        MockConsumer.write(self, data)
+        self.marks.append(self.acks.mark())
+
+
+class CommitTestCase(unittest.TestCase):
+    """Offsets saved only once the lines before them are acknowledged."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.acks = acks.AckTracker()
+        self.consumer = AckingConsumer(self.acks)
+        self.state = {}
+        self.snarf = snarf.LogSnarf(state_obj=self.state,
+                                    consumer=self.consumer,
+                                    reactor=mock.MagicMock(spec=reactor))
+        self.snarf._inotifier = mock.MagicMock(spec=inotify.INotify)
+        self.snarf.setAckTracker(self.acks)
+        self.snarf.start()
+        self.addCleanup(self.snarf._handles.closeAll)
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+        self.log = self.root.child('app.log')
+        self.log.setContent(b'line1\nline2\n')
+        self.addCleanup(self.snarf.lag.remove, self.log.path)
+
+    def append(self, data):
+        with open(self.log.path, 'ab') as f:
+            f.write(data)
+
+    def test_committedWhenAcked(self):
+        self.snarf.doRead(self.log)
+        self.assertEqual(self.consumer.data, ['line1\n', 'line2\n'])
+        self.assertNotIn(self.log.path, self.state)
+        self.acks.release(self.consumer.marks[0])
+        self.assertNotIn(self.log.path, self.state)
+        self.acks.release(self.consumer.marks[1])
+        self.assertEqual(self.state[self.log.path][0], 12)
+        self.assertEqual(self.snarf._positions, {})
+
+    def test_readContinues(self):
+        self.snarf.doRead(self.log)
+        self.append(b'line3\n')
+        self.snarf.doRead(self.log)
+        self.assertEqual(self.consumer.data,
+                         ['line1\n', 'line2\n', 'line3\n'])
+        for m in self.consumer.marks[:2]:
+            self.acks.release(m)
+        self.assertEqual(self.state[self.log.path][0], 12)
+        self.acks.release(self.consumer.marks[2])
+        self.assertEqual(self.state[self.log.path][0], 18)
+
+    def test_nothingPending(self):
+        self.snarf.doRead(self.log)
+        for m in self.consumer.marks:
+            self.acks.release(m)
+        self.snarf._commit(self.log.path, [20, 1])
+        self.assertEqual(self.state[self.log.path], [20, 1])
+
+    def test_deleted(self):
+        self.snarf.doRead(self.log)
+        self.snarf._snarfcb(None, self.log, inotify.IN_DELETE)
+        for m in self.consumer.marks:
+            self.acks.release(m)
+        self.assertNotIn(self.log.path, self.state)
+        self.assertEqual(len(self.snarf._commits), 0)
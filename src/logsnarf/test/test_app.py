@@ -0,0 +1,61 @@
+import os
+
+import mock
+from twisted.trial import unittest
+
+from logsnarf import app
+from logsnarf import config
+from logsnarf import supervisor
+from logsnarf.test.schema_test_utils import SCHEMA_DIR
+
+CONFIG = """
+[logsnarf]
+apps = ["app1"]
+
+[app1]
+project_id = project
+dataset = logs
+service_email = logsnarf@example.com
+keyfile = key.p12
+schema_file = %(schema)s
+"""
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = self.mktemp()
+        os.makedirs(self.root)
+        for name in 'saveConfigPath', 'saveDataPath':
+            patcher = mock.patch.object(
+                config.Config, name,
+                side_effect=lambda n='': os.path.join(self.root, n))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app, 'ServiceAccountCredentials')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app.listener, 'SyslogListener')
+        self.listener = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def config(self, extra=''):
+        path = os.path.join(self.root, 'logsnarf.ini')
+        with open(path, 'w') as f:
+            f.write(CONFIG % {
+                'schema': os.path.join(SCHEMA_DIR, 'syslog', 'schema.json')})
+            f.write(extra)
+        cfg = config.Config(config_file=path)
+        cfg.loadConfigs()
+        return cfg
+
+    def test_listenerOnly(self):
+        cfg = self.config('syslog_udp_port = 5514\n')
+        a = app.App(cfg, 'app1')
+        self.assertIsNone(a.snarfer)
+        self.assertIs(a.listener, self.listener.return_value)
+        self.listener.return_value.listenUDP.assert_called_once_with(
+            5514, '127.0.0.1')
+        self.assertEqual(supervisor.shardCount(cfg['app1']), 1)
+
+    def test_nothingToWatch(self):
+        self.assertRaises(SystemExit, app.App, self.config(), 'app1')
@@ -0,0 +1,265 @@
+import os
+
+from googleapiclient import errors as gerrors
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.internet import tcp
+from twisted.internet import threads
+from twisted.trial import unittest
+
+from logsnarf import metrics
+from logsnarf import service
+from logsnarf.bench import fakeservice
+from logsnarf.bench import generator
+from logsnarf.bench import harness
+from logsnarf.bench import micro
+from logsnarf.bench import watch
+
+
+class LogGeneratorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+        self.gen = generator.LogGenerator(self.dir, files=2, seed=1,
+                                          reactor=self.clock)
+
+    def lineCounts(self):
+        counts = []
+        for path in self.gen.paths:
+            with open(path) as f:
+                counts.append(len(f.readlines()))
+        return counts
+
+    def test_linesValidate(self):
+        sch = harness.buildSchema()
+        for _ in range(200):
+            line = self.gen.line(1420070400.5)
+            self.assertTrue(line.endswith('\n'))
+            entry = sch.loads(line)
+            self.assertEqual(entry['time'], 1420070400.5)
+            self.assertEqual(entry['table'], 'bench_20150101')
+            self.assertTrue(entry['host'].endswith('example.com'))
+            self.assertIsInstance(entry['pid'], int)
+
+    def test_seedRepeatable(self):
+        other = generator.LogGenerator(self.dir, seed=1)
+        self.assertEqual(self.gen.line(1.0), other.line(1.0))
+
+    def test_write(self):
+        self.gen.write(5)
+        self.assertEqual(self.lineCounts(), [3, 2])
+        self.assertEqual(self.gen.written, 5)
+        self.assertEqual(self.gen.bytes_written,
+                         sum(os.path.getsize(p) for p in self.gen.paths))
+
+    def test_runRate(self):
+        d = self.gen.run(100, rate=200)
+        self.clock.advance(0.25)
+        self.assertEqual(self.gen.written, 50)
+        self.assertNoResult(d)
+        self.clock.pump([generator.TICK] * 30)
+        self.assertEqual(self.successResultOf(d), 100)
+        self.assertEqual(sum(self.lineCounts()), 100)
+
+    def test_runUnlimited(self):
+        d = self.gen.run(generator.CHUNK * 2 + 1)
+        self.assertEqual(self.gen.written, generator.CHUNK)
+        self.clock.pump([0, 0])
+        self.assertEqual(self.successResultOf(d), generator.CHUNK * 2 + 1)
+
+
+class SinkTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(101))
+        self.assertEqual(fakeservice.percentile(values, 50), 50)
+        self.assertEqual(fakeservice.percentile(values, 99), 99)
+        self.assertEqual(fakeservice.percentile([], 99), None)
+
+    def test_record(self):
+        sink = fakeservice.Sink()
+        sink.record([{'json': {'time': 100.0}}, {'json': {'time': 99.5}},
+                     {'json': {}}], now=101.0)
+        self.assertEqual(sink.rows, 3)
+        summary = sink.summary()
+        self.assertEqual(summary['latency_p50'], 1.0)
+        self.assertEqual(summary['latency_max'], 1.5)
+
+
+class FakeBigQueryServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sink = fakeservice.Sink()
+
+    def rows(self, n):
+        return [{'insertId': str(i), 'json': {'time': 0}} for i in range(n)]
+
+    def test_latency(self):
+        svc = fakeservice.FakeBigQueryService(self.sink, latency=0.5,
+                                              reactor=self.clock)
+        d = svc.insertAll('t', None, self.rows(3))
+        self.clock.advance(0.4)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertEqual(self.successResultOf(d),
+                         {'kind': 'bigquery#tableDataInsertAllResponse'})
+        self.assertEqual(self.sink.rows, 3)
+        self.assertIn('t', svc.tables)
+
+    def test_errorRate(self):
+        svc = fakeservice.FakeBigQueryService(self.sink, error_rate=1.0,
+                                              reactor=self.clock)
+        svc.max_retries = 2
+        d = svc.insertAll('t', None, self.rows(3))
+        self.clock.advance(0)
+        fail = self.failureResultOf(d, gerrors.HttpError)
+        self.assertEqual(fail.value.resp.status, 503)
+        self.assertEqual(self.sink.rows, 0)
+        self.assertEqual(self.sink.failed_requests, 3)
+
+    def test_errorRetried(self):
+        svc = fakeservice.FakeBigQueryService(self.sink, error_rate=0.5,
+                                              seed=1, reactor=self.clock)
+        ds = [svc.insertAll('t', None, self.rows(1)) for _ in range(10)]
+        self.clock.advance(0)
+        for d in ds:
+            self.successResultOf(d)
+        self.assertEqual(self.sink.rows, 10)
+        self.assertTrue(self.sink.failed_requests > 0)
+
+    def test_rowErrorRate(self):
+        svc = fakeservice.FakeBigQueryService(self.sink, row_error_rate=1.0,
+                                              reactor=self.clock)
+        d = svc.insertAll('t', None, self.rows(2))
+        self.clock.advance(0)
+        result = self.successResultOf(d)
+        self.assertEqual([e['index'] for e in result['insertErrors']], [0, 1])
+        self.assertEqual(result['insertErrors'][0]['errors'][0]['reason'],
+                         'backendError')
+        self.assertEqual(self.sink.failed_rows, 2)
+
+
+class FakeBigQueryResourceTestCase(unittest.TestCase):
+    """The real service, talking to the HTTP stand-in."""
+
+    def setUp(self):
+        self.sink = fakeservice.Sink()
+        self.standin = fakeservice.FakeBigQueryResource(self.sink)
+        self.standin.listen()
+        self.addCleanup(self.standin.port.stopListening)
+        self.svc = service.BigQueryService(
+            'bench', 'bench', fakeservice.NoCredentials(),
+            discovery_url=self.standin.discoveryURL())
+
+    def insertAll(self, rows):
+        """insertAll_s in a thread, closing the connection after."""
+        try:
+            return self.svc.insertAll_s('logs', [], rows)
+        finally:
+            for conn in self.svc.http.connections.values():
+                conn.close()
+
+    @defer.inlineCallbacks
+    def waitForDisconnect(self):
+        for _ in range(100):
+            if not [r for r in reactor.getReaders()
+                    if isinstance(r, tcp.Server)]:
+                return
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_insertAll(self):
+        self.svc.setCompression(6, threshold=0)
+        rows = [{'insertId': 'a', 'json': {'time': 0}}]
+        result = yield threads.deferToThread(self.insertAll, rows)
+        yield self.waitForDisconnect()
+        self.assertEqual(result['kind'],
+                         'bigquery#tableDataInsertAllResponse')
+        self.assertEqual(self.sink.rows, 1)
+        self.assertEqual(self.svc.stats['compressed_requests'], 1)
+        self.assertEqual(list(self.standin.tables), ['logs'])
+
+
+class FormatResultsTestCase(unittest.TestCase):
+    def result(self, lines_per_second, p99):
+        return {
+            'options': {'lines': 10},
+            'results': {
+                'lines': 10, 'seconds': 1.0, 'complete': True,
+                'lines_per_second': lines_per_second,
+                'latency_p50': 0.1, 'latency_p99': p99,
+                'cpu_seconds_per_1k_lines': 1.0, 'peak_rss_bytes': 1000,
+            },
+        }
+
+    def test_compare(self):
+        text = harness.formatResults(self.result(200.0, 0.5),
+                                     self.result(100.0, 1.0))
+        lines = text.splitlines()
+        self.assertEqual(lines[0], '10 lines in 1.00s')
+        self.assertIn('+100.0% better', lines[1])
+        self.assertIn('-50.0% better', lines[3])
+        self.assertIn('+0.0% worse', lines[2])
+
+
+class MicroTestCase(unittest.TestCase):
+    def test_generatedSchemas(self):
+        sch = micro._schema(micro.wideSchema(8))
+        entry = sch.loads(micro.wideDocument(8))
+        self.assertEqual(entry['f1'], 1)
+        self.assertEqual(entry['f3'], 1420070400.3)
+        sch = micro._schema(micro.deepSchema(3))
+        entry = sch.loads(micro.deepDocument(3))
+        self.assertEqual(entry['child']['child']['child'], {'leaf': 'leaf'})
+        self.assertEqual(entry['count'], 2)
+
+    def test_casesRun(self):
+        results = micro.run(number=3, repeat=1)
+        for name in ('loads/simple', 'loads/syslog', 'loads/wide',
+                     'loads/deep', 'validateJSON/deep',
+                     'toUnixTimestamp/iso_naive', 'loadHook/dotted',
+                     'validator/pid/string', 'parse/json', 'parse/rfc5424',
+                     'loads/syslog-rfc3164', 'loads/syslog-logfmt',
+                     'loads/syslog-regex'):
+            self.assertGreater(results[name]['ns_per_call'], 0)
+
+    def test_formatLines(self):
+        sch = harness.buildSchema()
+        for fmt, (parser, lines) in micro.formatLines(3).items():
+            sch.setParser(parser)
+            for line in lines:
+                entry = sch.loads(line)
+                self.assertIsInstance(entry['timereported'], float)
+                self.assertTrue(entry['host'].endswith('example.com'))
+                self.assertIsInstance(entry.get('pid', 0), int)
+
+    def test_runFilter(self):
+        results = micro.run(number=1, repeat=1, pattern='^validator/host')
+        self.assertEqual(sorted(results),
+                         ['validator/host/fqdn', 'validator/host/short'])
+
+    def test_runMetrics(self):
+        results = micro.run(number=1, repeat=1, pattern='^metrics/')
+        self.assertEqual(sorted(results), ['metrics/counter', 'metrics/labels',
+                                           'metrics/timer'])
+        self.assertNotIn(b'bench_', metrics.REGISTRY.exposition())
+
+    def test_formatResults(self):
+        results = {'loads/simple': {'ns_per_call': 900.0}}
+        baseline = {'loads/simple': {'ns_per_call': 1000.0}}
+        self.assertEqual(micro.formatResults(results, baseline),
+                         'loads/simple          900 ns    -10.0% faster '
+                         '(was 1000)')
+
+
+class WatchTestCase(unittest.TestCase):
+    def test_run(self):
+        root = self.mktemp()
+        results = watch.run(files=30, per_dir=10, active=10, repeat=1,
+                            root=root)
+        self.assertEqual(sorted(results), ['index/refresh', 'poll/active',
+                                           'poll/idle', 'snapshot'])
+        self.assertEqual(len(os.listdir(root)), 3)
+        text = watch.formatResults(results)
+        self.assertIn('idle polling every 30s', text)
@@ -0,0 +1,208 @@
+import gzip
+import os
+
+import arrow
+import mock
+import simplejson as json
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import acks
+from logsnarf import bulk
+from logsnarf import errors
+from logsnarf import uploader
+
+
+class FakeLoadService(object):
+    """Local stand-in for BigQueryService.load."""
+
+    def __init__(self):
+        self.loaded = {}
+        self.jobs = []
+        self.fail_with = None
+
+    def load(self, table, table_schema, path, upload_id=None, job_id=None):
+        self.jobs.append(job_id)
+        if self.fail_with is not None:
+            return defer.fail(self.fail_with)
+        with gzip.open(path, 'rb') as fp:
+            rows = [json.loads(line) for line in fp]
+        self.loaded.setdefault(table, []).extend(rows)
+        return defer.succeed({'jobReference': {'jobId': job_id}})
+
+    def updateTableList(self):
+        pass
+
+
+def rows(n):
+    return [{'insertId': str(i), 'json': {'n': i}} for i in range(n)]
+
+
+class BulkLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = FakeLoadService()
+        self.spool_dir = self.mktemp()
+        self.loader = bulk.BulkLoader(self.service, [], self.spool_dir,
+                                      reactor=self.clock)
+
+    def test_writeAndRotate(self):
+        self.assertEqual(self.loader.write('logs', rows(3)), [])
+        upload_id, d = self.loader.rotate('logs')
+        self.assertEqual(self.service.jobs, ['logsnarf_%s' % upload_id])
+        self.assertEqual(self.service.loaded['logs'],
+                         [{'n': 0}, {'n': 1}, {'n': 2}])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        self.assertEqual(self.loader.pending, {})
+
+    def test_writeRotatesAtMaxRows(self):
+        self.loader.setMaxRows(5)
+        self.assertEqual(self.loader.write('logs', rows(4)), [])
+        loads = self.loader.write('logs', rows(2))
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len(self.service.loaded['logs']), 6)
+
+    def test_rotateExpired(self):
+        self.loader.setMaxAge(60)
+        self.loader.write('logs', rows(1))
+        self.assertEqual(self.loader.rotateExpired(), [])
+        self.clock.advance(60)
+        self.assertEqual(len(self.loader.rotateExpired()), 1)
+        self.assertEqual(self.service.loaded['logs'], [{'n': 0}])
+
+    def test_closeThenRecover(self):
+        self.loader.write('logs', rows(2))
+        self.loader.close()
+        self.assertEqual(self.service.jobs, [])
+        loader = bulk.BulkLoader(self.service, [], self.spool_dir,
+                                 reactor=self.clock)
+        self.assertEqual(len(loader.recover()), 1)
+        self.assertEqual(self.service.loaded['logs'], [{'n': 0}, {'n': 1}])
+
+    def test_spooledOnClose(self):
+        spooled = []
+        self.loader.write('logs', rows(2), lambda: spooled.append(1))
+        self.loader.write('logs', rows(1), lambda: spooled.append(2))
+        self.assertEqual(spooled, [])
+        self.loader.close()
+        self.assertEqual(spooled, [1, 2])
+        path, = os.listdir(self.spool_dir)
+        with gzip.open(os.path.join(self.spool_dir, path), 'rb') as fp:
+            self.assertEqual(len(fp.readlines()), 3)
+
+    def test_recoverSalvagesPartialFile(self):
+        path = os.path.join(self.spool_dir, 'logs.abc.json.gz.part')
+        data = gzip.compress(b'{"n": 0}\n{"n": 1}\n{"n": 2')
+        with open(path, 'wb') as fp:
+            fp.write(data[:-8])
+        self.loader.recover()
+        self.assertEqual(self.service.jobs, ['logsnarf_abc'])
+        self.assertEqual(self.service.loaded['logs'], [{'n': 0}, {'n': 1}])
+
+    def test_recoverSkipsOpenFiles(self):
+        self.loader.write('logs', rows(1))
+        self.assertEqual(self.loader.recover(), [])
+
+    def test_loadRejected(self):
+        self.service.fail_with = errors.ServiceError('rejected')
+        self.loader.write('logs', rows(1))
+        _, d = self.loader.rotate('logs')
+        self.failureResultOf(d, errors.ServiceError)
+        names = os.listdir(self.spool_dir)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].endswith(bulk.FAILED_SUFFIX))
+        self.assertEqual(self.loader.recover(), [])
+
+    def test_loadTransientFailure(self):
+        self.service.fail_with = IOError('connection reset')
+        self.loader.write('logs', rows(1))
+        upload_id, d = self.loader.rotate('logs')
+        self.clock.advance(self.loader.retry_delay)
+        self.assertEqual(len(self.service.jobs), 2)
+        self.clock.advance(self.loader.retry_delay)
+        self.assertEqual(len(self.service.jobs), 2)
+        self.assertEqual(self.loader.recover(), [])
+        self.service.fail_with = None
+        self.clock.advance(self.loader.retry_delay)
+        self.assertEqual(self.service.jobs, ['logsnarf_%s' % upload_id] * 3)
+        self.successResultOf(d)
+        self.assertEqual(self.service.loaded['logs'], [{'n': 0}])
+        self.assertEqual(self.loader.pending, {})
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+    def test_closeCancelsRetry(self):
+        self.service.fail_with = IOError('connection reset')
+        self.loader.write('logs', rows(1))
+        _, d = self.loader.rotate('logs')
+        self.loader.close()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.service.fail_with = None
+        self.assertEqual(len(self.loader.recover()), 1)
+        self.assertEqual(self.service.loaded['logs'], [{'n': 0}])
+
+
+class BulkUploaderTestCase(unittest.TestCase):
+    """Uploader and bulk loader, end to end against a local stand-in."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = FakeLoadService()
+        self.service.insertAll = mock.Mock()
+        self.uploader = uploader.BigQueryUploader(
+            mock.MagicMock(), self.service, 'logs_{YEAR}{MONTH}{DAY}',
+            reactor=self.clock)
+        self.uploader.now = arrow.get(1420070400)
+        self.uploader.producer = mock.Mock(paused=False)
+        self.loader = bulk.BulkLoader(self.service, [], self.mktemp(),
+                                      reactor=self.clock)
+        self.uploader.setBulkLoader(self.loader, 1000)
+
+    def addRows(self, n):
+        self.uploader.addData([{'_sha1': str(i), 'n': i} for i in range(n)])
+
+    def test_streamsWhenNotBehind(self):
+        self.uploader.setLag('/var/log/a.log', 10)
+        self.assertFalse(self.uploader.bulkMode)
+        self.addRows(3)
+        self.uploader.upload()
+        self.assertTrue(self.service.insertAll.called)
+
+    def test_bulkWhenBehind(self):
+        self.uploader.setLag('/var/log/a.log', 10)
+        self.uploader.setLag('/var/log/b.log', 5000)
+        self.assertTrue(self.uploader.bulkMode)
+        self.addRows(300)
+        self.uploader.upload()
+        self.assertFalse(self.service.insertAll.called)
+        self.assertEqual(self.uploader._linebuffer, [])
+        self.uploader.setLag('/var/log/b.log', 0)
+        self.assertFalse(self.uploader.bulkMode)
+        self.clock.advance(self.loader.max_age)
+        self.uploader.upload()
+        self.assertEqual(len(self.service.loaded['logs_201511']), 300)
+        self.assertEqual(self.uploader.uploadq, {})
+
+    def test_ackedOnceSpoolFileClosed(self):
+        tracker = acks.AckTracker()
+        self.uploader.setAckTracker(tracker)
+        schema = self.uploader.schema
+        schema.batchPostprocessors = False
+        schema.loads.side_effect = lambda ln: {'_sha1': ln, 'n': ln}
+        self.uploader.setLag('/var/log/b.log', 5000)
+        self.uploader.write('a\nb\n')
+        self.uploader.upload()
+        self.assertEqual(self.uploader._linebuffer, [])
+        self.assertEqual(tracker.watermark, -1)
+        self.clock.advance(self.loader.max_age)
+        self.uploader.setLag('/var/log/b.log', 0)
+        self.uploader.upload()
+        self.assertEqual(tracker.watermark, 0)
+
+    def test_flushClosesSpoolFiles(self):
+        self.uploader.setLag('/var/log/b.log', 5000)
+        self.addRows(3)
+        self.uploader.flush()
+        self.assertEqual(self.loader._files, {})
+        self.assertEqual(self.service.jobs, [])
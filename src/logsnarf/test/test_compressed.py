@@ -0,0 +1,212 @@
+import bz2
+import gzip
+import os
+import re
+
+import mock
+from twisted.internet import defer
+from twisted.internet import inotify
+from twisted.internet import reactor
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import compressed
+from logsnarf import snarf
+from logsnarf.test.test_snarf import MockConsumer
+
+LINES = [('line %d %s\n' % (i, 'x' * (i % 50))).encode() for i in range(2000)]
+
+
+class CompressedReaderTestCase(unittest.TestCase):
+    def write(self, suffix, members, compress=gzip.compress):
+        path = self.mktemp() + suffix
+        with open(path, 'wb') as f:
+            for member in members:
+                f.write(compress(b''.join(member)))
+        return path
+
+    def readAll(self, reader, chunk_size=1024):
+        while not reader.exhausted:
+            reader.read(chunk_size)
+        return list(reader.lines)
+
+    def test_isCompressed(self):
+        self.assertTrue(compressed.isCompressed('/var/log/syslog.2.gz'))
+        self.assertTrue(compressed.isCompressed('/var/log/syslog.2.zst'))
+        self.assertFalse(compressed.isCompressed('/var/log/syslog.1'))
+
+    def test_gzip(self):
+        path = self.write('.gz', [LINES])
+        reader = compressed.CompressedReader(path, 1)
+        lines = self.readAll(reader)
+        self.assertEqual([ln for ln, _, _ in lines],
+                         [ln.decode() for ln in LINES])
+        self.assertEqual(lines[-1][1], len(b''.join(LINES)))
+        self.assertTrue(reader.complete)
+        self.assertIsNone(reader.fp)
+        self.assertEqual(reader.compressed_offset, os.path.getsize(path))
+
+    def test_bz2(self):
+        path = self.write('.bz2', [LINES[:10], LINES[10:20]], bz2.compress)
+        reader = compressed.CompressedReader(path, 1)
+        lines = self.readAll(reader)
+        self.assertEqual([ln for ln, _, _ in lines],
+                         [ln.decode() for ln in LINES[:20]])
+        self.assertTrue(reader.complete)
+
+    def test_checkpoints(self):
+        path = self.write('.gz', [LINES[:1000], LINES[1000:]])
+        first = len(gzip.compress(b''.join(LINES[:1000])))
+        split = len(b''.join(LINES[:1000]))
+        lines = self.readAll(compressed.CompressedReader(path, 1))
+        self.assertEqual(lines[998][2], (0, 0))
+        # the last line of a member can resume from the next
+        self.assertEqual(lines[999][1], split)
+        self.assertEqual(lines[999][2], (first, split))
+        self.assertEqual(lines[1000][2], (first, split))
+
+    def test_resume(self):
+        path = self.write('.gz', [LINES[:1000], LINES[1000:]])
+        lines = self.readAll(compressed.CompressedReader(path, 1))
+        _, offset, checkpoint = lines[1500]
+        reader = compressed.CompressedReader(path, 1, offset, checkpoint)
+        self.assertEqual(reader.compressed_offset, checkpoint[0])
+        self.assertEqual(self.readAll(reader), lines[1501:])
+
+    def test_growing(self):
+        data = gzip.compress(b''.join(LINES))
+        path = self.mktemp() + '.gz'
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        reader = compressed.CompressedReader(path, 1)
+        n = len(self.readAll(reader))
+        self.assertFalse(reader.complete)
+        with open(path, 'ab') as f:
+            f.write(data[len(data) // 2:])
+        reader.exhausted = False
+        self.assertEqual(len(self.readAll(reader)), len(LINES))
+        self.assertTrue(0 < n < len(LINES))
+        self.assertTrue(reader.complete)
+
+    def test_corrupt(self):
+        path = self.mktemp() + '.gz'
+        with open(path, 'wb') as f:
+            f.write(b'not gzip data')
+        self.assertRaises(IOError, compressed.CompressedReader(path, 1).read)
+
+    def test_unsupported(self):
+        self.patch(compressed, 'zstandard', None)
+        self.assertRaises(ValueError, compressed.CompressedReader, 'a.zst', 1)
+
+
+class SnarfCompressedTestCase(unittest.TestCase):
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.patch(snarf.threads, 'deferToThread', self.deferToThread)
+        self.patch(compressed, 'CHUNK_SIZE', 1024)
+        self.pending = []
+        self.consumer = MockConsumer()
+        self.state = {}
+        self.snarf = snarf.LogSnarf(self.state, self.consumer,
+                                    reactor=mock.MagicMock(spec=reactor))
+        self.snarf._inotifier = mock.Mock()
+        self.snarf.start()
+        self.path = filepath.FilePath(self.mktemp() + '.gz')
+        self.path.setContent(gzip.compress(b''.join(LINES)))
+        self.addCleanup(self.snarf.lag.remove, self.path.path)
+
+    def deferToThread(self, f, *args):
+        d = defer.Deferred()
+        self.pending.append((d, f, args))
+        return d
+
+    def runThreads(self):
+        while self.pending:
+            d, f, args = self.pending.pop(0)
+            defer.maybeDeferred(f, *args).chainDeferred(d)
+
+    def test_doRead(self):
+        self.snarf.doRead(self.path)
+        self.assertEqual(len(self.pending), 1)
+        # a second event while reading doesn't start another read
+        self.snarf.doRead(self.path)
+        self.assertEqual(len(self.pending), 1)
+        self.runThreads()
+        self.assertEqual(self.consumer.data, [ln.decode() for ln in LINES])
+        offset, inode, checkpoint = self.state[self.path.path]
+        self.assertEqual(offset, len(b''.join(LINES)))
+        self.assertEqual(checkpoint, [self.path.getsize(), offset])
+        self.assertEqual(self.snarf._compressed, {})
+        self.assertEqual(snarf.LINES_READ.labels(self.path.path).value,
+                         len(LINES))
+        self.assertEqual(self.snarf.lag.files[self.path.path].offset,
+                         self.path.getsize())
+
+    def test_pausedAndRestarted(self):
+        self.snarf.doRead(self.path)
+        self.pending[0][1]()
+        consumer = self.consumer
+        consumer.write = lambda line: (
+            consumer.data.append(line), len(consumer.data) == 10 and
+            self.snarf.pauseProducing())
+        self.snarf.setCallback(consumer.write)
+        self.pending.pop(0)[0].callback(None)
+        self.assertEqual(len(consumer.data), 10)
+        self.assertEqual(self.snarf._paused_in_doRead, [self.path])
+        self.assertEqual(self.state[self.path.path][0],
+                         len(b''.join(LINES[:10])))
+
+        # a new process resumes from the state
+        consumer2 = MockConsumer()
+        snarf2 = snarf.LogSnarf(self.state, consumer2,
+                                reactor=mock.MagicMock(spec=reactor))
+        snarf2._inotifier = mock.Mock()
+        self.addCleanup(snarf2.lag.remove, self.path.path)
+        snarf2.start()
+        snarf2.doRead(self.path)
+        self.runThreads()
+        self.assertEqual(consumer2.data, [ln.decode() for ln in LINES[10:]])
+
+    def test_error(self):
+        self.path.setContent(b'not gzip data')
+        self.snarf.doRead(self.path)
+        self.runThreads()
+        self.assertEqual(self.consumer.data, [])
+        self.assertEqual(self.snarf._compressed, {})
+        self.flushLoggedErrors()
+
+    def test_rotatedThenCompressed(self):
+        root = filepath.FilePath(self.mktemp())
+        root.makedirs()
+        self.snarf._patterns[root.path] = re.compile(r'.*\.log')
+        log = root.child('app.log')
+        rotated = root.child('app.log.1')
+        gz = root.child('app.log.1.gz')
+        for p in log, rotated, gz:
+            self.addCleanup(self.snarf.lag.remove, p.path)
+        self.addCleanup(self.snarf._handles.closeAll)
+        log.setContent(b'a\nb\nc\n')
+        self.snarf.doRead(log)
+        # logrotate renames the file, then compresses it
+        log.moveTo(rotated)
+        self.snarf._snarfcb(None, log, inotify.IN_MOVED_FROM)
+        self.snarf._snarfcb(None, rotated, inotify.IN_MOVED_TO)
+        with open(rotated.path, 'ab') as f:
+            f.write(b'd\n')
+        gz.setContent(gzip.compress(rotated.getContent()))
+        self.snarf._snarfcb(None, gz, inotify.IN_CREATE)
+        self.snarf._snarfcb(None, gz, inotify.IN_MODIFY)
+        self.assertEqual(self.pending, [])
+        rotated.remove()
+        self.snarf._snarfcb(None, rotated, inotify.IN_DELETE)
+        self.runThreads()
+        self.assertEqual(self.consumer.data, ['a\n', 'b\n', 'c\n', 'd\n'])
+        self.assertNotIn(rotated.path, self.state)
+        self.assertEqual(self.state[gz.path][:2], [8, gz.getInodeNumber()])
+
+    def test_compressedAfterRestart(self):
+        self.state[self.path.path[:-3]] = [len(b''.join(LINES[:10])), 1]
+        self.snarf.doRead(self.path)
+        self.runThreads()
+        self.assertEqual(self.consumer.data, [ln.decode() for ln in LINES[10:]])
+        self.assertNotIn(self.path.path[:-3], self.state)
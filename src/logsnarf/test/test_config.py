@@ -56,6 +56,13 @@ class ConfigSectionTestCase(unittest.TestCase):
         self.assertTrue(isinstance(section['testfloat'], float))
         self.assertTrue(isinstance(section['testfloat2'], float))
 
+    def test_configSectionMissing(self):
+        section = config.ConfigSection('test1', self.cp)
+        self.assertRaises(KeyError, lambda: section['missing'])
+        self.assertIsNone(section.get('missing', None))
+        self.assertNotIn('missing', section)
+        self.assertIn('opt1', section)
+
 
 class ConfigTestCase(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,55 @@
+import os
+import re
+
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import dirindex
+
+
+class DirectoryIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.child('sub').makedirs()
+        self.root.child('a.log').touch()
+        self.root.child('b.txt').touch()
+        self.root.child('sub').child('c.log').touch()
+        self.index = dirindex.DirectoryIndex(self.root.path,
+                                             re.compile(r'.*\.log'))
+
+    def touchDir(self, d, ns):
+        st = os.stat(d.path)
+        os.utime(d.path, ns=(st.st_atime_ns, st.st_mtime_ns + ns))
+
+    def test_refresh(self):
+        self.assertEqual(sorted(self.index.refresh()), [
+            self.root.child('a.log').path,
+            self.root.child('sub').child('c.log').path])
+        self.assertEqual(self.index.listed, 2)
+        self.assertEqual(len(self.index), 2)
+
+    def test_notRecursive(self):
+        self.index.recursive = False
+        self.assertEqual(self.index.refresh(),
+                         [self.root.child('a.log').path])
+
+    def test_unchanged(self):
+        self.index.refresh()
+        self.index.refresh()
+        self.assertEqual(self.index.listed, 2)
+
+    def test_changed(self):
+        self.index.refresh()
+        sub = self.root.child('sub')
+        sub.child('d.log').touch()
+        self.touchDir(sub, 1)
+        self.assertIn(sub.child('d.log').path, self.index.refresh())
+        self.assertEqual(self.index.listed, 3)
+
+    def test_removedDir(self):
+        self.index.refresh()
+        self.root.child('sub').remove()
+        self.touchDir(self.root, 1)
+        self.assertEqual(self.index.refresh(),
+                         [self.root.child('a.log').path])
+        self.assertEqual(list(self.index._dirs), [self.root.path])
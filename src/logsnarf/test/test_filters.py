@@ -0,0 +1,96 @@
+import mock
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import filters
+from logsnarf import uploader
+
+
+class RuleTestCase(unittest.TestCase):
+    def test_invalid(self):
+        for d in ({'match': 'glob', 'pattern': 'a', 'action': 'drop'},
+                  {'match': 'prefix', 'pattern': 'a', 'action': 'keep'},
+                  {'match': 'prefix', 'pattern': '', 'action': 'drop'},
+                  {'match': 'prefix', 'pattern': 'a', 'action': 'route'},
+                  {'match': 'prefix', 'pattern': 'a', 'action': 'sample'},
+                  {'match': 'prefix', 'pattern': 'a', 'action': 'sample',
+                   'rate': 2},
+                  {'match': 'prefix', 'pattern': 'a', 'action': 'drop',
+                   'colour': 'red'}):
+            self.assertRaises(ValueError, filters.Rule.fromDict, d)
+
+    def test_invalidRegex(self):
+        self.assertRaises(ValueError, filters.LineFilter, [
+            {'match': 'regex', 'pattern': '(', 'action': 'drop'}])
+
+
+class LineFilterTestCase(unittest.TestCase):
+    def test_prefix(self):
+        f = filters.LineFilter([
+            {'match': 'prefix', 'pattern': '<15>', 'action': 'drop'}], 'pfx')
+        self.assertIs(f('<15>debug'), filters.DROP)
+        self.assertIsNone(f('<14>info <15>'))
+        self.assertEqual(f._match.__name__, 'match')
+        self.assertEqual(filters.DROPPED_LINES.labels('pfx', '0').value, 1)
+
+    def test_substring(self):
+        f = filters.LineFilter([
+            {'match': 'substring', 'pattern': 'a.b', 'action': 'drop'}])
+        self.assertIs(f('xx a.b'), filters.DROP)
+        self.assertIsNone(f('xx axb'))
+        self.assertEqual(f._match.__name__, 'search')
+
+    def test_regexAnchored(self):
+        f = filters.LineFilter([
+            {'match': 'regex', 'pattern': r'\d+ (a|b)', 'action': 'route',
+             'table': 'digits', 'name': 'digits'}], 'rx')
+        self.assertEqual(f('12 b'), 'digits')
+        self.assertIsNone(f('x 12 b'))
+        self.assertEqual(filters.ROUTED_LINES.labels('rx', 'digits').value,
+                         1)
+
+    def test_ruleOrder(self):
+        f = filters.LineFilter([
+            {'match': 'regex', 'pattern': '(x)(y)', 'action': 'route',
+             'table': 'xy'},
+            {'match': 'substring', 'pattern': 'debug', 'action': 'drop'},
+            {'match': 'prefix', 'pattern': 'error', 'action': 'route',
+             'table': 'errors'},
+            {'match': 'prefix', 'pattern': 'err', 'action': 'drop'},
+        ])
+        self.assertEqual(f('xy debug'), 'xy')
+        self.assertIs(f('a debug'), filters.DROP)
+        # earliest match wins, then the first listed
+        self.assertEqual(f('error debug'), 'errors')
+        self.assertIs(f('errno'), filters.DROP)
+        self.assertIsNone(f('info'))
+
+    def test_sample(self):
+        f = filters.LineFilter([
+            {'match': 'prefix', 'pattern': 'a', 'action': 'sample',
+             'rate': 0.25}], seed=1)
+        kept = [f('a') for _ in range(1000)].count(None)
+        self.assertTrue(200 < kept < 300, kept)
+
+    def test_noRules(self):
+        self.assertIsNone(filters.LineFilter([])('anything'))
+
+
+class UploaderFilterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.schema = mock.MagicMock()
+        self.schema.loads.side_effect = lambda ln: {'_sha1': None, 'l': ln}
+        self.schema.batchPostprocessors = False
+        self.uploader = uploader.BigQueryUploader(
+            self.schema, mock.MagicMock(), 'logs', reactor=task.Clock())
+        self.uploader.setLineFilter(filters.LineFilter([
+            {'match': 'prefix', 'pattern': 'drop', 'action': 'drop'},
+            {'match': 'prefix', 'pattern': 'route', 'action': 'route',
+             'table': 'routed'}]))
+
+    def test_write(self):
+        self.uploader.write('keep\ndrop me\nroute me\n')
+        self.assertEqual(self.schema.loads.call_count, 2)
+        self.assertEqual(
+            [(t, row['json']['l']) for t, row in self.uploader._linebuffer],
+            [('logs', 'keep'), ('routed', 'route me')])
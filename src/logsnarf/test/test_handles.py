@@ -0,0 +1,112 @@
+import os
+
+from twisted.trial import unittest
+
+from logsnarf import handles
+
+
+class OpenFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        with open(self.path, 'wb') as f:
+            f.write(b'line1\nline2\npart')
+        self.inode = os.stat(self.path).st_ino
+
+    def test_readline(self):
+        f = handles.OpenFile(self.path, self.inode)
+        self.addCleanup(f.close)
+        f.seek(0)
+        self.assertEqual(f.readline(), b'line1\n')
+        self.assertEqual(f.readline(), b'line2\n')
+        self.assertIsNone(f.readline())
+        self.assertEqual(f.offset, 12)
+        with open(self.path, 'ab') as fp:
+            fp.write(b'ial\n')
+        self.assertEqual(f.readline(), b'partial\n')
+        self.assertEqual(f.offset, 20)
+
+    def test_seekMidLine(self):
+        f = handles.OpenFile(self.path, self.inode)
+        self.addCleanup(f.close)
+        self.assertEqual(f.seek(8), 6)
+        self.assertEqual(f.readline(), b'line2\n')
+
+    def test_replaced(self):
+        self.assertRaises(IOError, handles.OpenFile, self.path,
+                          self.inode + 1)
+
+
+class HandleCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = handles.HandleCache(2)
+        self.addCleanup(self.cache.closeAll)
+
+    def makeFile(self, content=b'line1\n'):
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path, os.stat(path).st_ino
+
+    def test_cached(self):
+        path, inode = self.makeFile()
+        opens = handles.FILE_OPENS._unlabelled.value
+        f = self.cache.open(path, inode, 0)
+        self.assertEqual(f.readline(), b'line1\n')
+        self.assertIs(self.cache.open(path, inode, 6), f)
+        self.assertEqual(handles.FILE_OPENS._unlabelled.value, opens + 1)
+
+    def test_cachedSeeks(self):
+        path, inode = self.makeFile()
+        f = self.cache.open(path, inode, 0)
+        f.readline()
+        self.assertIs(self.cache.open(path, inode, 0), f)
+        self.assertEqual(f.readline(), b'line1\n')
+
+    def test_maxOpen(self):
+        files = [self.makeFile() for _ in range(3)]
+        opened = [self.cache.open(path, inode, 0) for path, inode in files]
+        self.assertEqual(len(self.cache), 2)
+        self.assertNotIn(files[0][0], self.cache)
+        self.assertTrue(opened[0].fp.closed)
+        # using a file makes it the most recent
+        self.cache.open(files[1][0], files[1][1], 0)
+        self.cache.open(files[0][0], files[0][1], 0)
+        self.assertEqual(sorted(self.cache._files),
+                         sorted([files[0][0], files[1][0]]))
+
+    def test_inodeReused(self):
+        path, inode = self.makeFile(b'first file\n')
+        self.cache.open(path, inode, 0)
+        self.cache.close(path)
+        with open(path, 'r+b') as f:
+            f.write(b'other')
+        f = self.cache.open(path, inode, 11)
+        self.assertTrue(f.reused)
+        self.assertEqual(f.offset, 0)
+
+    def test_maxFingerprints(self):
+        self.cache.max_fingerprints = 2
+        files = [self.makeFile() for _ in range(3)]
+        for path, inode in files:
+            self.cache.open(path, inode, 0)
+            self.cache.close(path)
+        self.assertEqual(list(self.cache._fingerprints),
+                         [files[1][0], files[2][0]])
+        self.cache.forget(files[1][0])
+        self.assertEqual(list(self.cache._fingerprints), [files[2][0]])
+
+    def test_fingerprintGrown(self):
+        path, inode = self.makeFile(b'a')
+        self.cache.open(path, inode, 0)
+        self.cache.close(path)
+        with open(path, 'ab') as f:
+            f.write(b'bc\n')
+        f = self.cache.open(path, inode, 0)
+        self.assertFalse(f.reused)
+
+    def test_rename(self):
+        path, inode = self.makeFile()
+        f = self.cache.open(path, inode, 0)
+        self.cache.rename(path, 'new')
+        self.assertIs(self.cache.get('new'), f)
+        self.assertIsNone(self.cache.get(path))
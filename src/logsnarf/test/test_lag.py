@@ -0,0 +1,82 @@
+import os
+
+import simplejson as json
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import lag
+from logsnarf import metrics
+
+
+class LagTrackerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.tracker = lag.LagTracker(reactor=self.clock)
+
+    def test_lagBytes(self):
+        self.tracker.update('/a.log', size=100, offset=40)
+        self.assertEqual(self.tracker.lagBytes('/a.log'), 60)
+        self.tracker.update('/a.log', offset=100)
+        self.assertEqual(self.tracker.lagBytes('/a.log'), 0)
+        self.assertEqual(self.tracker.lagBytes('/unknown.log'), 0)
+
+    def test_lagSeconds(self):
+        self.tracker.update('/a.log', size=100, offset=0, mtime=900)
+        self.clock.advance(10)
+        self.tracker.update('/a.log', size=200)
+        self.assertEqual(self.tracker.lagSeconds('/a.log'), 110)
+        # read past what was written at 900
+        self.tracker.update('/a.log', offset=150)
+        self.assertEqual(self.tracker.lagSeconds('/a.log'), 0)
+        self.clock.advance(5)
+        self.assertEqual(self.tracker.lagSeconds('/a.log'), 5)
+        self.tracker.update('/a.log', offset=200)
+        self.assertEqual(self.tracker.lagSeconds('/a.log'), 0)
+
+    def test_truncateClearsHistory(self):
+        self.tracker.update('/a.log', size=100, offset=100, mtime=900)
+        self.tracker.update('/a.log', size=10, offset=0)
+        self.assertEqual(list(self.tracker.files['/a.log'].history),
+                         [(1000, 10)])
+
+    def test_aggregates(self):
+        self.tracker.update('/a.log', size=100, offset=0, mtime=990)
+        self.tracker.update('/b.log', size=100, offset=50, mtime=900)
+        self.assertEqual(self.tracker.totalLagBytes(), 150)
+        self.assertEqual(self.tracker.maxLagSeconds(), 100)
+
+    def test_metrics(self):
+        self.tracker.update('/a.log', size=100, offset=0, mtime=990)
+        exposition = metrics.REGISTRY.exposition()
+        self.assertIn(b'logsnarf_lag_bytes{path="/a.log"} 100\n', exposition)
+        self.assertIn(b'logsnarf_lag_seconds{path="/a.log"} 10.0\n',
+                      exposition)
+        self.tracker.remove('/a.log')
+        self.assertNotIn(b'/a.log', metrics.REGISTRY.exposition())
+
+    def test_pollAndSnapshot(self):
+        log = self.mktemp()
+        with open(log, 'w') as f:
+            f.write('x' * 10)
+        self.tracker.update(log, size=5, offset=5)
+        self.tracker.update('/gone.log', size=5, offset=0)
+        snapshot_path = self.mktemp()
+        self.tracker.setSnapshotPath(snapshot_path)
+        self.tracker.poll()
+        self.assertEqual(self.tracker.lagBytes(log), 5)
+        self.assertNotIn('/gone.log', self.tracker.files)
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['files'][log]['lag_bytes'], 5)
+        self.assertEqual(snapshot['time'], 1000)
+        self.assertFalse(os.path.exists(snapshot_path + '.tmp'))
+
+    def test_startPolls(self):
+        self.tracker.poll = polls = []
+        self.tracker._poll_task.f = lambda: polls.append(1)
+        self.tracker.start(30)
+        self.assertEqual(polls, [])
+        self.clock.advance(30)
+        self.assertEqual(polls, [1])
+        self.tracker.stop()
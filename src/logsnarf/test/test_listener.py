@@ -0,0 +1,130 @@
+import mock
+from twisted.internet import task
+from twisted.internet import testing
+from twisted.trial import unittest
+
+from logsnarf import listener
+from logsnarf import metrics
+
+
+class Consumer(object):
+    def __init__(self):
+        self.lines = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def write(self, data):
+        self.lines.append(data)
+
+
+class SyslogStreamProtocolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.consumer = Consumer()
+        self.listener = listener.SyslogListener(self.consumer, 'test',
+                                                reactor=task.Clock())
+        self.listener.paused = False
+        self.proto = listener.SyslogStreamFactory(
+            self.listener).buildProtocol(None)
+        self.transport = testing.StringTransport()
+        self.proto.makeConnection(self.transport)
+
+    def test_octetCounted(self):
+        self.proto.dataReceived(b'10 {"a": "b"}12 {"c": "d\ne"}')
+        self.assertEqual(self.consumer.lines,
+                         ['{"a": "b"}\n', '{"c": "d e"}\n'])
+
+    def test_octetCountedPartial(self):
+        self.proto.dataReceived(b'10 {"a": ')
+        self.proto.dataReceived(b'"b"}1')
+        self.assertEqual(self.consumer.lines, ['{"a": "b"}\n'])
+        self.proto.dataReceived(b'0 {"c": "d"}')
+        self.assertEqual(len(self.consumer.lines), 2)
+
+    def test_newlineFramed(self):
+        self.proto.dataReceived(b'{"a": "b"}\r\n{"c"')
+        self.proto.dataReceived(b': "d"}\n')
+        self.assertEqual(self.consumer.lines,
+                         ['{"a": "b"}\n', '{"c": "d"}\n'])
+
+    def test_mixedFraming(self):
+        self.proto.dataReceived(b'<13>hello\n7 <13>bye')
+        self.assertEqual(self.consumer.lines, ['<13>hello\n', '<13>bye\n'])
+
+    def test_badOctetCount(self):
+        self.proto.dataReceived(b'12345678901234 x')
+        self.assertTrue(self.transport.disconnecting)
+        self.assertEqual(listener.FRAMING_ERRORS.labels('test').value, 1)
+
+    def test_oversized(self):
+        self.listener.setMaxMessage(10)
+        self.proto.dataReceived(b'11 ')
+        self.assertTrue(self.transport.disconnecting)
+        proto = listener.SyslogStreamProtocol(self.listener)
+        transport = testing.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(b'<13>no newline')
+        self.assertTrue(transport.disconnecting)
+        self.assertEqual(self.consumer.lines, [])
+
+
+class SyslogListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = testing.MemoryReactorClock()
+        self.consumer = Consumer()
+        self.listener = listener.SyslogListener(self.consumer, 'paused',
+                                                reactor=self.clock)
+
+    def connect(self):
+        proto = self.clock.tcpServers[0][1].buildProtocol(None)
+        transport = testing.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_registers(self):
+        self.assertIs(self.consumer.producer, self.listener)
+
+    def test_start(self):
+        self.listener.listenTCP(5140)
+        self.listener.listenUDP(5141, '0.0.0.0')
+        self.clock.listenUDP = mock.Mock()
+        self.listener.start()
+        self.assertFalse(self.listener.paused)
+        self.assertEqual(self.clock.tcpServers[0][0], 5140)
+        self.assertEqual(self.clock.tcpServers[0][3], '127.0.0.1')
+        args, kwargs = self.clock.listenUDP.call_args
+        self.assertEqual(args[0], 5141)
+        self.assertEqual(kwargs['interface'], '0.0.0.0')
+        self.assertEqual(self.listener._udp_ports,
+                         [self.clock.listenUDP.return_value])
+
+    def test_pauseResume(self):
+        self.listener.listenTCP(5140)
+        self.listener.start()
+        proto, transport = self.connect()
+        self.assertEqual(transport.producerState, 'producing')
+        udp = mock.Mock()
+        self.listener._udp_ports.append(udp)
+        self.listener.pauseProducing()
+        self.assertEqual(transport.producerState, 'paused')
+        udp.stopReading.assert_called_once_with()
+        # new connections start paused
+        _, transport2 = self.connect()
+        self.assertEqual(transport2.producerState, 'paused')
+        self.assertIn(b'logsnarf_syslog_connections{listener="paused"} 2',
+                      metrics.REGISTRY.exposition())
+        self.listener.resumeProducing()
+        self.assertEqual(transport.producerState, 'producing')
+        self.assertEqual(transport2.producerState, 'producing')
+        udp.startReading.assert_called_once_with()
+        proto.connectionLost(None)
+        self.assertEqual(len(self.listener.connections), 1)
+
+    def test_datagram(self):
+        proto = listener.SyslogDatagramProtocol(self.listener)
+        proto.datagramReceived(b'{"a": "b"}\n', ('127.0.0.1', 514))
+        proto.datagramReceived(b'', ('127.0.0.1', 514))
+        self.assertEqual(self.consumer.lines, ['{"a": "b"}\n'])
+        self.assertEqual(
+            listener.MESSAGES.labels('paused', 'udp').value, 2)
@@ -0,0 +1,105 @@
+import gc
+import io
+
+from twisted.trial import unittest
+from twisted.web.test import requesthelper
+
+from logsnarf import metrics
+from logsnarf import schema
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_counter(self):
+        c = metrics.counter('test_things', 'Things.', ['kind'],
+                            registry=self.registry)
+        c.labels('a').inc()
+        c.labels('a').inc(2)
+        c.labels('b"\\').inc()
+        self.assertEqual(self.registry.exposition().decode('utf-8'), (
+            '# HELP test_things Things.\n'
+            '# TYPE test_things counter\n'
+            'test_things_total{kind="a"} 3\n'
+            'test_things_total{kind="b\\"\\\\"} 1\n'))
+
+    def test_counterUnlabelled(self):
+        c = metrics.counter('test_things', 'Things.', registry=self.registry)
+        c.inc()
+        self.assertIn(b'\ntest_things_total 1\n',
+                      self.registry.exposition())
+
+    def test_gaugeFunction(self):
+        g = metrics.gauge('test_depth', 'Depth.', ['q'],
+                          registry=self.registry)
+        buf = []
+        g.labels('q1').setFunction(lambda: len(buf))
+        buf.extend([1, 2])
+        self.assertIn(b'test_depth{q="q1"} 2\n', self.registry.exposition())
+        g.remove('q1')
+        self.assertNotIn(b'q1', self.registry.exposition())
+
+    def test_weakFunction(self):
+        class Queue(object):
+            depth = 3
+        q = Queue()
+        fn = metrics.weakFunction(q, lambda o: o.depth)
+        self.assertEqual(fn(), 3)
+        del q
+        gc.collect()
+        self.assertEqual(fn(), 0)
+
+    def test_histogram(self):
+        h = metrics.histogram('test_seconds', 'Seconds.', buckets=(0.1, 1),
+                              registry=self.registry)
+        for v in 0.05, 0.1, 0.5, 5:
+            h.observe(v)
+        lines = self.registry.exposition().decode('utf-8').splitlines()
+        self.assertEqual(lines[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 5.65',
+            'test_seconds_count 4',
+        ])
+
+    def test_registerExisting(self):
+        c = metrics.counter('test_things', 'Things.', registry=self.registry)
+        self.assertIs(
+            metrics.counter('test_things', 'Things.', registry=self.registry),
+            c)
+        self.assertRaises(ValueError, metrics.gauge, 'test_things', 'Things.',
+                          registry=self.registry)
+
+    def test_labelsWrongCount(self):
+        c = metrics.counter('test_things', 'Things.', ['a', 'b'],
+                            registry=self.registry)
+        self.assertRaises(ValueError, c.labels, 'x')
+
+    def test_resource(self):
+        metrics.counter('test_things', 'Things.',
+                        registry=self.registry).inc()
+        request = requesthelper.DummyRequest([b''])
+        body = metrics.MetricsResource(self.registry).render_GET(request)
+        self.assertEqual(body, self.registry.exposition())
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b'content-type'),
+            [metrics.CONTENT_TYPE])
+
+
+class SchemaMetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sch = schema.Schema(io.StringIO(
+            '[{"name": "a", "type": "INTEGER", "mode": "REQUIRED"}]'))
+
+    def test_parseMetrics(self):
+        count = schema.PARSE_SECONDS.labels().count
+        decode = schema.DECODE_ERRORS.value
+        validation = schema.VALIDATION_ERRORS.value
+        self.sch.loads('{"a": 1}')
+        self.assertRaises(ValueError, self.sch.loads, '{"a": 1')
+        self.assertRaises(ValueError, self.sch.loads, '{"b": 1}')
+        self.assertEqual(schema.PARSE_SECONDS.labels().count, count + 1)
+        self.assertEqual(schema.DECODE_ERRORS.value, decode + 1)
+        self.assertEqual(schema.VALIDATION_ERRORS.value, validation + 1)
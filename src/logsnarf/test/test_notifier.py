@@ -0,0 +1,205 @@
+import struct
+
+import mock
+import twisted
+from twisted.internet import inotify
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import notifier
+from logsnarf import snarf
+from logsnarf.test.test_snarf import MockConsumer
+
+
+class TwistedInternalsTestCase(unittest.TestCase):
+    """The private parts of Twisted's INotify that notifier.INotify uses.
+
+    If these fail after upgrading Twisted, notifier.INotify.watchOverflow
+    and setMask need changing before the pin in pyproject.toml is moved.
+    """
+
+    def setUp(self):
+        self.inotifier = notifier.INotify(reactor=mock.MagicMock())
+        self.addCleanup(self.inotifier.close)
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+
+    def require(self, obj, name):
+        if not hasattr(obj, name):
+            self.fail('Twisted %s has no %s, which logsnarf.notifier uses' % (
+                twisted.__version__, name))
+        return getattr(obj, name)
+
+    def test_internals(self):
+        self.assertIsInstance(self.require(self.inotifier, '_watchpoints'),
+                              dict)
+        self.assertIsInstance(self.require(self.inotifier, '_fd'), int)
+        self.require(self.require(self.inotifier, '_inotify'), 'add')
+        self.require(inotify, '_Watch')
+
+    def test_setMask(self):
+        wd = self.inotifier.watch(self.root, mask=inotify.IN_MODIFY)
+        self.inotifier.setMask(self.root,
+                               inotify.IN_MODIFY | inotify.IN_CREATE)
+        self.assertEqual(self.inotifier._isWatched(self.root), wd)
+        self.assertEqual(self.inotifier._watchpoints[wd].mask,
+                         inotify.IN_MODIFY | inotify.IN_CREATE |
+                         inotify.IN_DELETE_SELF)
+
+    def test_watchOverflow(self):
+        events = []
+        self.inotifier.watchOverflow(
+            lambda _, path, mask: events.append((path, mask)))
+        self.inotifier._doRead(struct.pack(
+            '=LLLL', notifier.OVERFLOW_WD, inotify.IN_Q_OVERFLOW, 0, 0))
+        self.assertEqual(events, [(filepath.FilePath(b'/'),
+                                   inotify.IN_Q_OVERFLOW)])
+
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reactor = mock.MagicMock()
+        self.notifier = notifier.Notifier(reactor=self.reactor)
+        self.addCleanup(self.notifier.close)
+        self.inotifier = self.notifier._inotifier
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+        self.events = {'a': [], 'b': []}
+        self.overflows = {'a': 0, 'b': 0}
+        self.a = self.client('a')
+        self.b = self.client('b')
+
+    def client(self, name, max_queued=notifier.MAX_QUEUED_EVENTS):
+        def overflow(ignored, path, mask):
+            self.overflows[name] += 1
+
+        return self.notifier.client(overflow, max_queued)
+
+    def watch(self, client, name, mask=inotify.IN_MODIFY):
+        client.watch(self.root, mask=mask, callbacks=[
+            lambda _, path, m: self.events[name].append(
+                (path.basename(), m))])
+
+    def event(self, mask, name=b'x.log', wd=None):
+        if wd is None:
+            wd = self.inotifier._isWatched(self.root)
+        name = name + b'\0' * (16 - len(name)) if name else b''
+        self.inotifier._doRead(
+            struct.pack('=LLLL', wd, mask, 0, len(name)) + name)
+
+    def test_oneWatch(self):
+        self.watch(self.a, 'a')
+        self.watch(self.b, 'b')
+        self.assertEqual(len(self.inotifier._watchpaths), 1)
+        self.event(inotify.IN_MODIFY)
+        self.assertEqual(self.events['a'], [(b'x.log', inotify.IN_MODIFY)])
+        self.assertEqual(self.events['b'], [(b'x.log', inotify.IN_MODIFY)])
+
+    def test_masks(self):
+        self.watch(self.a, 'a')
+        self.watch(self.b, 'b', inotify.IN_CREATE)
+        wd = self.inotifier._isWatched(self.root)
+        self.assertEqual(self.inotifier._watchpoints[wd].mask &
+                         inotify.IN_CREATE, inotify.IN_CREATE)
+        self.event(inotify.IN_CREATE)
+        self.assertEqual(self.events['a'], [])
+        self.assertEqual(self.events['b'], [(b'x.log', inotify.IN_CREATE)])
+
+    def test_ignore(self):
+        self.watch(self.a, 'a')
+        self.watch(self.b, 'b')
+        self.a.ignore(self.root)
+        self.assertIn(self.root.path, self.notifier)
+        self.event(inotify.IN_MODIFY)
+        self.assertEqual(self.events['a'], [])
+        self.b.ignore(self.root)
+        self.assertNotIn(self.root.path, self.notifier)
+        self.assertEqual(self.inotifier._watchpaths, {})
+        self.assertRaises(KeyError, self.b.ignore, self.root)
+
+    def test_pausedQueued(self):
+        self.watch(self.a, 'a')
+        self.watch(self.b, 'b')
+        self.a.pauseProducing()
+        self.event(inotify.IN_MODIFY)
+        self.assertEqual(self.events['a'], [])
+        self.assertEqual(len(self.events['b']), 1)
+        self.assertFalse(self.notifier.paused)
+        self.a.resumeProducing()
+        self.assertEqual(self.events['a'], [(b'x.log', inotify.IN_MODIFY)])
+
+    def test_pausedOverflow(self):
+        self.a = self.client('a', max_queued=2)
+        self.watch(self.a, 'a')
+        self.a.pauseProducing()
+        for _ in range(3):
+            self.event(inotify.IN_MODIFY)
+        self.assertEqual(self.overflows['a'], 0)
+        self.a.resumeProducing()
+        self.assertEqual(self.events['a'], [])
+        self.assertEqual(self.overflows['a'], 1)
+
+    def test_kernelOverflow(self):
+        self.watch(self.a, 'a')
+        self.a.pauseProducing()
+        self.event(inotify.IN_Q_OVERFLOW, name=None,
+                   wd=notifier.OVERFLOW_WD)
+        self.assertEqual(self.overflows, {'a': 0, 'b': 1})
+        self.a.resumeProducing()
+        self.assertEqual(self.overflows, {'a': 1, 'b': 1})
+
+    def test_allPaused(self):
+        self.inotifier.pauseProducing = mock.Mock()
+        self.inotifier.resumeProducing = mock.Mock()
+        self.a.pauseProducing()
+        self.assertFalse(self.inotifier.pauseProducing.called)
+        self.b.pauseProducing()
+        self.inotifier.pauseProducing.assert_called_once_with()
+        self.b.resumeProducing()
+        self.inotifier.resumeProducing.assert_called_once_with()
+
+    def test_deletedStaysOpen(self):
+        self.watch(self.a, 'a')
+        self.watch(self.b, 'b')
+        self.event(inotify.IN_DELETE_SELF, name=None)
+        self.assertEqual(self.events['a'], [(self.root.basename().encode(),
+                                             inotify.IN_DELETE_SELF)])
+        self.assertNotIn(self.root.path, self.notifier)
+        self.assertEqual(len(self.a), 0)
+        self.assertTrue(self.inotifier.connected)
+        self.assertFalse(self.inotifier.disconnecting)
+
+
+class SharedSnarfTestCase(unittest.TestCase):
+    """LogSnarfs sharing a notifier pause on their own."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.notifier = notifier.Notifier(reactor=mock.MagicMock())
+        self.addCleanup(self.notifier.close)
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+        self.log = self.root.child('app.log')
+        self.log.setContent(b'line1\n')
+        self.consumers = [MockConsumer(), MockConsumer()]
+        self.snarfs = [snarf.LogSnarf({}, c, reactor=mock.MagicMock(),
+                                      notifier_obj=self.notifier)
+                       for c in self.consumers]
+        for s in self.snarfs:
+            s._patterns[self.root.path] = None
+            s._inotifier.watch(self.root, mask=snarf.WATCH_MASK,
+                               callbacks=[s._snarfcb])
+            s.start()
+            self.addCleanup(s._handles.closeAll)
+            self.addCleanup(s.lag.remove, self.log.path)
+
+    def test_pausedSectionDoesNotBlockOthers(self):
+        self.snarfs[0].pauseProducing()
+        wd = self.notifier._inotifier._isWatched(self.root)
+        name = b'app.log' + b'\0' * 9
+        self.notifier._inotifier._doRead(struct.pack(
+            '=LLLL', wd, inotify.IN_MODIFY, 0, len(name)) + name)
+        self.assertEqual(self.consumers[0].data, [])
+        self.assertEqual(self.consumers[1].data, ['line1\n'])
+        self.snarfs[0].resumeProducing()
+        self.assertEqual(self.consumers[0].data, ['line1\n'])
@@ -0,0 +1,125 @@
+import pytz
+from twisted.trial import unittest
+
+from logsnarf import parsers
+
+NOW = 1445000000.0  # 2015-10-16 12:53:20 UTC
+
+
+class TimestampParserTestCase(unittest.TestCase):
+    def test_offsets(self):
+        ts = parsers.TimestampParser()
+        self.assertEqual(ts('2015-01-01T00:00:00Z'), 1420070400)
+        self.assertEqual(ts('2015-01-01T00:00:00.25z'), 1420070400.25)
+        self.assertEqual(ts('2015-01-01T01:30:00+01:30'), 1420070400)
+        self.assertEqual(ts('2014-12-31T19:00:00-05:00'), 1420070400)
+        self.assertEqual(ts('2015-01-01 00:00:00'), 1420070400)
+
+    def test_defaultTZ(self):
+        ts = parsers.TimestampParser(pytz.timezone('America/New_York'))
+        self.assertEqual(ts('2014-12-31T19:00:00'), 1420070400)
+        self.assertEqual(ts('2015-01-01T00:00:00Z'), 1420070400)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parsers.TimestampParser(), 'Jan 1')
+
+
+class RFC5424ParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parse = parsers.RFC5424Parser(clock=lambda: NOW)
+
+    def test_parse(self):
+        result = self.parse(
+            '<165>1 2003-10-11T22:14:15.003Z mymachine.example.com evntslog '
+            '- ID47 [exampleSDID@32473 iut="3" eventSource="App\\"x\\""]'
+            '[examplePriority@32473 class="high"] ﻿An event\n')
+        self.assertEqual(result, {
+            'time': NOW,
+            'timereported': 1065910455.003,
+            'sev': 'notice',
+            'syslog.fac': 'local4',
+            'syslog.pri': '165',
+            'host': 'mymachine.example.com',
+            'pname': 'evntslog',
+            'msgid': 'ID47',
+            'exampleSDID@32473.iut': '3',
+            'exampleSDID@32473.eventSource': 'App"x"',
+            'examplePriority@32473.class': 'high',
+            'msg': 'An event',
+        })
+
+    def test_nil(self):
+        self.assertEqual(self.parse('<34>1 - - - - - -'), {
+            'time': NOW, 'sev': 'crit', 'syslog.fac': 'auth',
+            'syslog.pri': '34'})
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.parse, 'hello')
+        self.assertRaises(ValueError, self.parse, '<999>1 - - - - - -')
+        self.assertRaises(ValueError, self.parse, '<34>1 - - - - - [x')
+
+
+class RFC3164ParserTestCase(unittest.TestCase):
+    def setUp(self):
+        self.parse = parsers.RFC3164Parser(clock=lambda: NOW)
+
+    def test_parse(self):
+        result = self.parse('<38>Oct  9 22:14:15 gw sshd[123]: Accepted key')
+        self.assertEqual(result, {
+            'time': NOW,
+            'timereported': 1444428855.0,
+            'sev': 'info',
+            'syslog.fac': 'auth',
+            'syslog.pri': '38',
+            'host': 'gw',
+            'pname': 'sshd',
+            'pid': '123',
+            'msg': 'Accepted key',
+        })
+
+    def test_noTag(self):
+        result = self.parse('<13>Feb  5 17:32:18 10.0.0.99 Use the BFG!')
+        self.assertEqual(result['msg'], 'Use the BFG!')
+        self.assertNotIn('pname', result)
+
+    def test_lastYear(self):
+        parse = parsers.RFC3164Parser(clock=lambda: 1420070400.0)
+        result = parse('<13>Dec 31 23:59:59 gw cron: hi')
+        self.assertEqual(result['timereported'], 1420070399.0)
+
+    def test_rfc3339Timestamp(self):
+        result = self.parse('<13>2015-01-01T00:00:00.5+00:00 gw app: hi')
+        self.assertEqual(result['timereported'], 1420070400.5)
+
+
+class LogfmtParserTestCase(unittest.TestCase):
+    def test_parse(self):
+        parse = parsers.LogfmtParser()
+        self.assertEqual(
+            parse('at=info path="/a b" q="say \\"hi\\"" empty= flag\n'),
+            {'at': 'info', 'path': '/a b', 'q': 'say "hi"', 'empty': True,
+             'flag': True})
+        self.assertRaises(ValueError, parse, '  ')
+
+
+class RegexParserTestCase(unittest.TestCase):
+    def test_parse(self):
+        parse = parsers.RegexParser(r'(?P<host>\S+) (?:(?P<pid>\d+) )?'
+                                    r'(?P<msg>.*)')
+        self.assertEqual(parse('gw hello\n'), {'host': 'gw', 'msg': 'hello'})
+        self.assertEqual(parse('gw 12 hi')['pid'], '12')
+        self.assertRaises(ValueError, parse, '')
+
+    def test_noGroups(self):
+        self.assertRaises(ValueError, parsers.RegexParser, r'\S+')
+
+
+class BuildTestCase(unittest.TestCase):
+    def test_build(self):
+        self.assertIsNone(parsers.build('json'))
+        self.assertIsInstance(parsers.build('rfc5424'),
+                              parsers.RFC5424Parser)
+        self.assertIsInstance(parsers.build('regex', r'(?P<msg>.*)'),
+                              parsers.RegexParser)
+        self.assertRaises(ValueError, parsers.build, 'regex')
+        self.assertRaises(ValueError, parsers.build, 'xml')
@@ -0,0 +1,149 @@
+import os
+import re
+
+import mock
+from twisted.internet import inotify
+from twisted.internet import task
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import dirindex
+from logsnarf import poller
+from logsnarf import snarf
+from logsnarf.test import test_snarf
+
+
+class PollerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.events = []
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.child('sub').makedirs()
+        self.root.child('a.log').setContent(b'a\n')
+        self.root.child('sub').child('b.log').setContent(b'b\n')
+        self.root.child('c.txt').setContent(b'c\n')
+        index = dirindex.DirectoryIndex(self.root.path, re.compile(r'.*\.log'))
+        self.poller = poller.Poller(
+            index, lambda path, mask: self.events.append((path, mask)),
+            min_interval=1, max_interval=8, reactor=self.clock)
+        self.poller.snapshot()
+        self.poller.start()
+
+    def append(self, log, data):
+        # setContent replaces the file
+        with open(log.path, 'ab') as f:
+            f.write(data)
+
+    def touchDir(self, d):
+        # listings are cached by mtime, which may not have ticked over
+        st = os.stat(d.path)
+        os.utime(d.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    def test_quiet(self):
+        self.clock.advance(1)
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.poller.interval(self.root.path), 2)
+        for _ in range(10):
+            self.clock.advance(8)
+        self.assertEqual(self.poller.interval(self.root.path), 8)
+
+    def test_modified(self):
+        self.clock.pump([4] * 3)
+        log = self.root.child('sub').child('b.log')
+        self.append(log, b'b\n')
+        for _ in range(8):
+            if not self.events:
+                self.clock.advance(1)
+        self.assertEqual(self.events, [(log.path, inotify.IN_MODIFY)])
+        self.assertEqual(self.poller.interval(log.parent().path), 1)
+
+    def test_created(self):
+        self.root.child('d.log').setContent(b'd\n')
+        self.root.child('e.txt').setContent(b'e\n')
+        self.touchDir(self.root)
+        self.clock.advance(1)
+        self.assertEqual(self.events, [(self.root.child('d.log').path,
+                                        inotify.IN_CREATE)])
+
+    def test_renamed(self):
+        log = self.root.child('a.log')
+        log.moveTo(self.root.child('a.1.log'))
+        log.setContent(b'new\n')
+        self.touchDir(self.root)
+        self.clock.advance(1)
+        self.assertEqual(self.events, [
+            (log.path, inotify.IN_MOVED_FROM),
+            (self.root.child('a.1.log').path, inotify.IN_MOVED_TO),
+            (log.path, inotify.IN_MODIFY)])
+
+    def test_deleted(self):
+        log = self.root.child('a.log')
+        log.remove()
+        self.touchDir(self.root)
+        self.clock.advance(1)
+        self.assertEqual(self.events, [(log.path, inotify.IN_MOVED_FROM),
+                                       (log.path, inotify.IN_DELETE)])
+
+    def test_newDirectory(self):
+        new = self.root.child('new')
+        new.makedirs()
+        new.child('f.log').setContent(b'f\n')
+        self.touchDir(self.root)
+        self.clock.advance(1)
+        self.assertEqual(self.events, [(new.child('f.log').path,
+                                        inotify.IN_CREATE)])
+        self.assertEqual(self.poller.interval(new.path), 1)
+
+    def test_removedDirectory(self):
+        sub = self.root.child('sub')
+        sub.remove()
+        self.touchDir(self.root)
+        self.clock.advance(1)
+        self.assertEqual(self.events, [(sub.child('b.log').path,
+                                        inotify.IN_DELETE)])
+        self.assertNotIn(sub.path, self.poller._schedule)
+        self.clock.advance(100)
+
+    def test_paused(self):
+        self.poller.pauseProducing()
+        self.append(self.root.child('a.log'), b'a\n')
+        self.clock.advance(1)
+        self.assertEqual(self.events, [])
+        self.poller.resumeProducing()
+        self.clock.advance(1)
+        self.assertEqual(len(self.events), 1)
+
+    def test_stop(self):
+        self.poller.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class SnarfPollingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.snarf = snarf.LogSnarf(state_obj={},
+                                    consumer=test_snarf.MockConsumer(),
+                                    reactor=self.clock)
+        self.snarf._inotifier = mock.MagicMock(spec=inotify.INotify)
+        self.snarf.doRead = mock.Mock()
+        self.clock.callWhenRunning = mock.Mock()
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+        self.root.child('a.log').setContent(b'a\n')
+
+    def test_watch(self):
+        self.snarf.setPolling(1, 4)
+        self.snarf.watch(self.root.path, re.compile(r'.*\.log'),
+                         watcher='poll')
+        self.assertFalse(self.snarf._inotifier.watch.called)
+        self.snarf.start()
+        self.addCleanup(self.snarf.lag.stop)
+        with open(self.root.child('a.log').path, 'ab') as f:
+            f.write(b'a\n')
+        self.clock.advance(1)
+        self.assertEqual([c[0][0] for c in self.snarf.doRead.call_args_list],
+                         [self.root.child('a.log')])
+
+    def test_unknownWatcher(self):
+        self.assertRaises(ValueError, self.snarf.watch, self.root.path,
+                          watcher='fanotify')
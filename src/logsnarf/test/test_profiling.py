@@ -0,0 +1,90 @@
+import os
+import pstats
+import threading
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import profiling
+
+
+class StageTimersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(profiling.setStageTimers, False)
+
+    def count(self, stage):
+        return profiling.STAGE_SECONDS.labels(stage).count
+
+    def test_timed(self):
+        @profiling.timed('test')
+        def fn(x):
+            return x * 2
+
+        before = self.count('test')
+        self.assertEqual(fn(2), 4)
+        self.assertEqual(self.count('test'), before)
+        profiling.setStageTimers(True)
+        self.assertTrue(profiling.stageTimersEnabled())
+        self.assertEqual(fn(3), 6)
+        self.assertEqual(self.count('test'), before + 1)
+
+    def test_timedRaises(self):
+        @profiling.timed('test_raises')
+        def fn():
+            raise ValueError()
+
+        profiling.setStageTimers(True)
+        self.assertRaises(ValueError, fn)
+        self.assertEqual(self.count('test_raises'), 1)
+
+
+class StackSamplerTestCase(unittest.TestCase):
+    def test_sample(self):
+        sampler = profiling.StackSampler()
+        sampler.sample()
+        sampler.sample()
+        path = self.mktemp()
+        sampler.dump(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        mine = [ln for ln in lines if 'test_profiling.py:test_sample' in ln]
+        self.assertEqual(len(mine), 1)
+        stack, count = mine[0].rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        self.assertTrue(
+            stack.startswith(threading.current_thread().name + ';'))
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dir = self.mktemp()
+        os.mkdir(self.dir)
+
+    def test_badMode(self):
+        self.assertRaises(ValueError, profiling.Profiler, self.dir, 'bad',
+                          reactor=self.clock)
+
+    def test_cprofile(self):
+        profiler = profiling.Profiler(self.dir, reactor=self.clock)
+        profiler.start(10)
+        self.assertTrue(profiler.running)
+        sorted(range(10))
+        self.clock.advance(10)
+        self.assertFalse(profiler.running)
+        names = os.listdir(self.dir)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].endswith('.pstats'))
+        stats = pstats.Stats(os.path.join(self.dir, names[0]))
+        self.assertTrue([k for k in stats.stats if 'sorted' in k[2]])
+
+    def test_toggle(self):
+        profiler = profiling.Profiler(self.dir, 'sample', reactor=self.clock)
+        profiler.toggle(10)
+        self.assertTrue(profiler.running)
+        profiler.toggle(10)
+        self.assertFalse(profiler.running)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        names = os.listdir(self.dir)
+        self.assertEqual(len(names), 1)
+        self.assertTrue(names[0].endswith('.collapsed'))
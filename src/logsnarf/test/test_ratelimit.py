@@ -0,0 +1,169 @@
+import mock
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import app
+from logsnarf import errors
+from logsnarf import ratelimit
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.bucket = ratelimit.TokenBucket(100, clock=self.clock)
+
+    def test_reserveWithinCapacity(self):
+        self.assertEqual(self.bucket.reserve(60), 0)
+        self.assertEqual(self.bucket.reserve(40), 0)
+
+    def test_reserveOverCapacity(self):
+        self.assertEqual(self.bucket.reserve(100), 0)
+        self.assertAlmostEqual(self.bucket.reserve(50), 0.5)
+        self.assertAlmostEqual(self.bucket.reserve(50), 1.0)
+
+    def test_refill(self):
+        self.bucket.reserve(100)
+        self.clock.advance(0.5)
+        self.assertEqual(self.bucket.reserve(50), 0)
+        self.clock.advance(10)
+        self.bucket.reserve(0)
+        self.assertEqual(self.bucket.tokens, 100)
+
+    def test_idle(self):
+        self.bucket.reserve(50)
+        # refilled at 0.5, idle a refill period after that
+        self.assertFalse(self.bucket.idle(1.4))
+        self.assertTrue(self.bucket.idle(1.5))
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = ratelimit.RateLimiter(reactor=self.clock)
+
+    def test_noLimits(self):
+        self.successResultOf(
+            self.limiter.acquire('ds', 'logs', 10000, 10 ** 9))
+        self.assertFalse(self.limiter.limitsBytes)
+
+    def test_projectRowsQueued(self):
+        self.limiter.setProjectLimits(rows_per_second=100)
+        self.successResultOf(self.limiter.acquire('ds', 'a', 100))
+        d = self.limiter.acquire('ds', 'b', 100)
+        self.assertNoResult(d)
+        self.assertEqual(self.limiter.queued, 1)
+        self.clock.advance(1)
+        self.successResultOf(d)
+        self.assertEqual(self.limiter.queued, 0)
+
+    def test_tableBytesPerTable(self):
+        self.limiter.setTableLimits(bytes_per_second=1000)
+        self.assertTrue(self.limiter.limitsBytes)
+        self.successResultOf(self.limiter.acquire('ds', 'a', 1, 1000))
+        self.successResultOf(self.limiter.acquire('ds', 'b', 1, 1000))
+        d = self.limiter.acquire('ds', 'a', 1, 500)
+        self.assertNoResult(d)
+        self.clock.advance(0.5)
+        self.successResultOf(d)
+
+    def test_tablesPerDataset(self):
+        self.limiter.setTableLimits(rows_per_second=10)
+        self.successResultOf(self.limiter.acquire('ds1', 'logs', 10))
+        self.successResultOf(self.limiter.acquire('ds2', 'logs', 10))
+        self.assertNoResult(self.limiter.acquire('ds1', 'logs', 10))
+
+    def test_idleTablesDropped(self):
+        self.limiter.setTableLimits(rows_per_second=10)
+        self.limiter.acquire('ds', 'a', 5)
+        self.limiter.acquire('ds', 'b', 20)
+        self.clock.advance(1.5)
+        self.limiter.acquire('ds', 'c', 1)
+        # a refilled at 0.5, b is still in debt
+        self.assertEqual(sorted(self.limiter._tables),
+                         [('ds', 'b'), ('ds', 'c')])
+        self.clock.advance(0.5)
+        self.limiter.acquire('ds', 'c', 1)
+        self.assertEqual(sorted(self.limiter._tables),
+                         [('ds', 'b'), ('ds', 'c')])
+
+    def test_noTableLimitsNoBuckets(self):
+        self.limiter.setProjectLimits(rows_per_second=10)
+        self.limiter.acquire('ds', 'a', 5)
+        self.assertEqual(self.limiter._tables, {})
+
+    def test_requestsKeepOrder(self):
+        self.limiter.setProjectLimits(rows_per_second=10)
+        self.limiter.acquire('ds', 'a', 10)
+        results = []
+        for i in range(3):
+            self.limiter.acquire('ds', 'a', 10).addCallback(
+                lambda _, n: results.append(n), i)
+        self.clock.advance(1)
+        self.assertEqual(results, [0])
+        self.clock.advance(2)
+        self.assertEqual(results, [0, 1, 2])
+
+    def test_projectLimiterShared(self):
+        self.assertIs(ratelimit.projectLimiter('p1', self.clock),
+                      ratelimit.projectLimiter('p1'))
+        self.assertIsNot(ratelimit.projectLimiter('p1', self.clock),
+                         ratelimit.projectLimiter('p2', self.clock))
+
+    def test_setLimitsOnce(self):
+        self.limiter.setLimits(rows_per_second=100, table_rows_per_second=10)
+        self.limiter.acquire('ds', 'a', 10)
+        self.limiter.setLimits(rows_per_second=100, table_rows_per_second=10)
+        self.assertNoResult(self.limiter.acquire('ds', 'a', 10))
+        self.assertRaises(ValueError, self.limiter.setLimits,
+                          rows_per_second=200)
+        self.assertEqual(self.limiter.project_rows.rate, 100)
+
+
+class InstallTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limiters = {}
+        patcher = mock.patch.object(ratelimit, '_limiters', self.limiters)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def section(**limits):
+        section = dict.fromkeys(['rate_limit_rows', 'rate_limit_bytes',
+                                 'table_rate_limit_rows',
+                                 'table_rate_limit_bytes'], '')
+        section.update(limits)
+        return section
+
+    def test_sharedByEverySection(self):
+        limited, unlimited = mock.Mock(project='p'), mock.Mock(project='p')
+        app.install_rate_limiter(self.section(), unlimited)
+        app.install_rate_limiter(self.section(rate_limit_rows=100), limited)
+        limiter = self.limiters['p']
+        unlimited.setRateLimiter.assert_called_once_with(limiter)
+        limited.setRateLimiter.assert_called_once_with(limiter)
+        self.assertEqual(limiter.project_rows.rate, 100)
+
+    def test_conflictingLimits(self):
+        app.install_rate_limiter(self.section(rate_limit_rows=100),
+                                 mock.Mock(project='p'))
+        self.assertRaises(errors.ConfigError, app.install_rate_limiter,
+                          self.section(rate_limit_rows=50),
+                          mock.Mock(project='p'))
+        app.install_rate_limiter(self.section(rate_limit_rows=50),
+                                 mock.Mock(project='q'))
+
+    def test_workerShares(self):
+        cfg = {
+            'logsnarf': {'apps': '["app1", "app2", "app3"]'},
+            'app1': {'project_id': 'p', 'workers': 2,
+                     'directories': '["/a", "/b"]'},
+            'app2': {'project_id': 'p', 'workers': 1},
+            'app3': {'project_id': 'q', 'workers': 1},
+        }
+        self.assertEqual(app.rate_limit_shares(cfg, 'app1'), (3, 2))
+        self.assertEqual(app.rate_limit_shares(cfg, 'app3'), (1, 1))
+        svc = mock.Mock(project='p')
+        app.install_rate_limiter(
+            self.section(rate_limit_rows=300, table_rate_limit_rows=100),
+            svc, (3, 2))
+        self.assertEqual(self.limiters['p'].limits, (100.0, None, 50.0, None))
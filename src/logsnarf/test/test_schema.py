@@ -1,6 +1,7 @@
 import io
 import logging
 
+from twisted.internet import defer
 from twisted.trial import unittest
 
 from . import schema_test_utils
@@ -74,3 +75,55 @@ class SchemaTestCase(unittest.TestCase):
                           self.sch.setFieldValidator,
                           'unfield',
                           lambda x, y: y)
+
+    def test_setParser(self):
+        self.sch.setParser(lambda line: dict(
+            pair.split('=') for pair in line.split()),
+            fields={'a': 'fielda'})
+        result = self.sch.loads('a=hello fieldb=5 unknown=x')
+        self.assertEqual(result['fielda'], 'hello')
+        self.assertEqual(result['fieldb'], 5)
+        self.assertNotIn('unknown', result)
+        self.assertNotIn('a', result)
+        self.assertEqual(len(result['_sha1']), 40)
+
+    def test_setParserNested(self):
+        sch = schema.Schema(io.StringIO("""[
+            {"name": "msg", "type": "STRING"},
+            {"name": "syslog", "type": "RECORD", "fields": [
+                {"name": "fac", "type": "STRING"},
+                {"name": "pri", "type": "INTEGER"}]}]"""))
+        sch.setParser(lambda line: {'msg': line, 'syslog.pri': '13',
+                                    'syslog.fac': 'user'})
+        result = sch.loads('hello')
+        self.assertEqual(result['syslog'], {'fac': 'user', 'pri': 13})
+
+    def test_setParserError(self):
+        def parser(line):
+            raise ValueError('bad line')
+
+        self.sch.setParser(parser)
+        self.assertRaises(ValueError, self.sch.loads, 'x')
+        self.sch.setParser(None)
+        self.assertEqual(self.sch.loads(BASIC_INPUT)['fieldb'], 5)
+
+    def test_postProcessBatch(self):
+        self.assertFalse(self.sch.batchPostprocessors)
+        self.sch.registerBatchPostprocessor(lambda objs: objs + [{'n': 2}])
+        self.sch.registerBatchPostprocessor(
+            lambda objs: [dict(o, seen=True) for o in objs])
+        self.assertTrue(self.sch.batchPostprocessors)
+        self.assertEqual(self.sch.postProcessBatch([{'n': 1}]),
+                         [{'n': 1, 'seen': True}, {'n': 2, 'seen': True}])
+
+    def test_postProcessBatchAsynchronous(self):
+        d = defer.Deferred()
+        self.sch.registerBatchPostprocessor(lambda objs: objs[1:])
+        self.sch.registerBatchPostprocessor(lambda objs: d, asynchronous=True)
+        self.sch.registerBatchPostprocessor(lambda objs: objs * 2)
+        result = self.sch.postProcessBatch([{'n': 1}, {'n': 2}])
+        self.assertNoResult(result)
+        d.callback([{'n': 3}])
+        self.assertEqual(self.successResultOf(result), [{'n': 3}] * 2)
+        self.sch.clearPostprocessors()
+        self.assertFalse(self.sch.batchPostprocessors)
@@ -0,0 +1,326 @@
+import gc
+import gzip
+import ssl
+import weakref
+
+import httplib2
+import mock
+import simplejson as json
+from googleapiclient import errors as gerrors
+from mock import sentinel
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from logsnarf import errors
+from logsnarf import metrics
+from logsnarf import ratelimit
+from logsnarf import service
+
+
+SCHEMA = [{'name': 'time', 'type': 'TIMESTAMP'}]
+
+
+class BigQueryServiceTestCase(unittest.TestCase):
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.reactor = mock.MagicMock(spec=reactor)
+        self.svc = service.BigQueryService('project', 'dataset',
+                                           mock.MagicMock(),
+                                           reactor=self.reactor)
+        self.api = mock.MagicMock()
+        self.svc.local.service = self.api
+        self.svc.updateTableList = mock.Mock()
+
+    def insertedBody(self):
+        return self.api.tables.return_value.insert.call_args[1]['body']
+
+    def test_tableId(self):
+        self.assertEqual(service.tableId('logs$20150101'), 'logs')
+        self.assertEqual(service.tableId('logs'), 'logs')
+
+    def test_createTable(self):
+        self.svc.createTable('logs', SCHEMA)
+        body = self.insertedBody()
+        self.assertEqual(body['tableReference']['tableId'], 'logs')
+        self.assertNotIn('timePartitioning', body)
+        self.assertNotIn('clustering', body)
+        self.assertIn('logs', self.svc.tables)
+
+    def test_createTablePartitioned(self):
+        self.svc.setPartitioning('DAY', 'time', 86400000, ['host'])
+        self.svc.createTable('logs$20150101', SCHEMA)
+        body = self.insertedBody()
+        self.assertEqual(body['tableReference']['tableId'], 'logs')
+        self.assertEqual(body['timePartitioning'],
+                         {'type': 'DAY', 'field': 'time',
+                          'expirationMs': '86400000'})
+        self.assertEqual(body['clustering'], {'fields': ['host']})
+
+    def test_createTableExists(self):
+        self.svc.tables['logs'] = True
+        self.svc.createTable('logs$20150101', SCHEMA)
+        self.assertFalse(self.api.tables.return_value.insert.called)
+
+    def test_setPartitioningInvalidType(self):
+        self.assertRaises(errors.ConfigError, self.svc.setPartitioning,
+                          'WEEK')
+
+    def test_setPartitioningTooManyClusteringFields(self):
+        self.assertRaises(errors.ConfigError, self.svc.setPartitioning,
+                          'DAY', None, None, ['a', 'b', 'c', 'd', 'e'])
+
+    def loadJob(self, state='DONE', error=None):
+        job = {
+            'jobReference': {'jobId': 'job1'},
+            'configuration': {'load': {'destinationTable': {
+                'tableId': 'logs$20150101'}}},
+            'status': {'state': state},
+        }
+        if error:
+            job['status']['errorResult'] = {'message': error}
+        return job
+
+    def spoolFile(self):
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b'{"time": 1420070400}\n' * 100))
+        return path
+
+    @mock.patch('googleapiclient.http.MediaFileUpload')
+    def test_doLoad(self, media):
+        self.svc.setPartitioning('DAY', 'time')
+        self.svc._doLoad('logs', SCHEMA, self.spoolFile(), 'job1')
+        kwargs = self.api.jobs.return_value.insert.call_args[1]
+        self.assertEqual(kwargs['media_body'], media.return_value)
+        body = kwargs['body']
+        self.assertEqual(body['jobReference']['jobId'], 'job1')
+        load = body['configuration']['load']
+        self.assertEqual(load['sourceFormat'], 'NEWLINE_DELIMITED_JSON')
+        self.assertEqual(load['destinationTable']['tableId'], 'logs')
+        self.assertEqual(load['timePartitioning'],
+                         {'type': 'DAY', 'field': 'time'})
+        self.assertEqual(self.svc.stats['raw_bytes'], 2100)
+        self.assertTrue(self.svc.compressionRatio > 10)
+
+    @mock.patch('googleapiclient.http.MediaFileUpload')
+    def test_doLoadExistingJob(self, media):
+        jobs = self.api.jobs.return_value
+        jobs.insert.return_value.execute.side_effect = gerrors.HttpError(
+            httplib2.Response({'status': '409'}), b'')
+        jobs.get.return_value.execute.return_value = sentinel.job
+        self.assertEqual(
+            self.svc._doLoad('logs', SCHEMA, self.spoolFile(), 'job1'),
+            sentinel.job)
+        jobs.get.assert_called_once_with(projectId='project', jobId='job1')
+
+    def test_pollJobDone(self):
+        job = self.loadJob()
+        self.assertEqual(self.svc._pollJob(job, 'upload1'), job)
+        self.assertIn('logs', self.svc.tables)
+
+    def test_pollJobFailed(self):
+        self.assertRaises(errors.ServiceError, self.svc._pollJob,
+                          self.loadJob(error='bad row'), 'upload1')
+
+    @mock.patch('twisted.internet.threads.deferToThread')
+    def test_pollJobPending(self, deferToThread):
+        clock = task.Clock()
+        self.svc.reactor = clock
+        deferToThread.side_effect = lambda f, *a: defer.succeed(f(*a))
+        self.api.jobs.return_value.get.return_value.execute.return_value = \
+            self.loadJob()
+        d = self.svc._pollJob(self.loadJob(state='RUNNING'), 'upload1')
+        self.assertNoResult(d)
+        clock.advance(self.svc.job_poll_interval)
+        self.assertEqual(self.successResultOf(d)['status']['state'], 'DONE')
+
+    def request(self, body):
+        return mock.Mock(body=body, headers={}, body_size=len(body))
+
+    def test_compressDisabled(self):
+        req = self.svc._compress(self.request('{"rows": []}' * 200))
+        self.assertNotIn('content-encoding', req.headers)
+        self.assertEqual(req.headers['content-length'], str(12 * 200))
+        self.assertEqual(self.svc.compressionRatio, 1.0)
+
+    def test_compress(self):
+        self.svc.setCompression(6, threshold=100)
+        body = '{"rows": []}' * 200
+        req = self.svc._compress(self.request(body))
+        self.assertEqual(req.headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(req.body), body.encode('utf-8'))
+        self.assertEqual(req.body_size, len(req.body))
+        self.assertEqual(req.headers['content-length'], str(len(req.body)))
+        self.assertEqual(self.svc.stats['compressed_requests'], 1)
+        self.assertTrue(self.svc.compressionRatio > 10)
+
+    def test_compressBelowThreshold(self):
+        self.svc.setCompression(6, threshold=100)
+        req = self.svc._compress(self.request('{"rows": []}'))
+        self.assertNotIn('content-encoding', req.headers)
+        self.assertEqual(req.body, b'{"rows": []}')
+        self.assertEqual(self.svc.stats['compressed_requests'], 0)
+
+    def httpFailure(self, status, reason=None):
+        content = b''
+        if reason:
+            content = json.dumps(
+                {'error': {'errors': [{'reason': reason}]}}).encode()
+        return failure.Failure(gerrors.HttpError(
+            httplib2.Response({'status': str(status)}), content))
+
+    def test_handleErrorsRetryable(self):
+        self.patch(service.random, 'uniform', lambda a, b: (a, b))
+        for status in 500, 502, 503, 504:
+            self.assertEqual(
+                self.svc._handleErrors(self.httpFailure(status)),
+                (True, (0.5, 1.0)))
+
+    def test_handleErrorsRateLimited(self):
+        self.patch(service.random, 'uniform', lambda a, b: b)
+        for reason in 'rateLimitExceeded', 'quotaExceeded':
+            self.assertEqual(
+                self.svc._handleErrors(self.httpFailure(403, reason)),
+                (True, 1.0))
+
+    def test_handleErrorsForbidden(self):
+        self.assertEqual(
+            self.svc._handleErrors(self.httpFailure(403, 'accessDenied')),
+            (False, 0))
+        self.assertEqual(self.svc._handleErrors(self.httpFailure(403)),
+                         (False, 0))
+
+    def test_handleErrorsNotRetryable(self):
+        for status in 400, 404:
+            self.assertEqual(
+                self.svc._handleErrors(self.httpFailure(status)), (False, 0))
+
+    def test_handleErrorsSSL(self):
+        self.patch(service.random, 'uniform', lambda a, b: b)
+        fail = failure.Failure(ssl.SSLError('reset'))
+        self.assertEqual(self.svc._handleErrors(fail), (True, 1.0))
+
+    def test_handleErrorsOther(self):
+        fail = failure.Failure(ValueError())
+        self.assertEqual(self.svc._handleErrors(fail), (False, 0))
+
+    def test_handleErrorsBackoff(self):
+        self.patch(service.random, 'uniform', lambda a, b: b)
+        fail = self.httpFailure(503)
+        self.assertEqual(
+            [self.svc._handleErrors(fail, n)[1] for n in range(8)],
+            [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 60.0, 60.0])
+        self.assertEqual(self.svc._handleErrors(fail, 8), (False, 0))
+
+    @mock.patch('twisted.internet.threads.deferToThread')
+    def test_insertAllGivesUp(self, deferToThread):
+        clock = task.Clock()
+        self.svc.reactor = clock
+        self.svc.max_retries = 2
+        self.svc.tables['logs'] = True
+        deferToThread.side_effect = lambda *a: defer.fail(
+            self.httpFailure(503))
+        d = self.svc.insertAll('logs', SCHEMA, [{}])
+        clock.advance(1)
+        self.assertNoResult(d)
+        clock.advance(2)
+        self.failureResultOf(d, gerrors.HttpError)
+        self.assertEqual(deferToThread.call_count, 3)
+        self.flushLoggedErrors()
+
+    def test_compressionRatioGauge(self):
+        other = service.BigQueryService('other', 'dataset', mock.MagicMock(),
+                                        reactor=self.reactor)
+        self.addCleanup(service.COMPRESSION_RATIO.remove, 'other', 'dataset')
+        other.stats['raw_bytes'] = 4
+        other.stats['sent_bytes'] = 1
+        exposition = metrics.REGISTRY.exposition()
+        self.assertIn(b'logsnarf_compression_ratio{project="project",'
+                      b'dataset="dataset"} 1.0\n', exposition)
+        self.assertIn(b'logsnarf_compression_ratio{project="other",'
+                      b'dataset="dataset"} 4.0\n', exposition)
+        ref = weakref.ref(other)
+        del other
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_setCompressionInvalid(self):
+        self.assertRaises(errors.ConfigError, self.svc.setCompression, 10)
+
+    def test_gzipSize(self):
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(b'x' * 5000))
+        self.assertEqual(service.gzipSize(path), 5000)
+        with open(path, 'wb') as f:
+            f.write(b'x' * 5000)
+        self.assertEqual(service.gzipSize(path), None)
+
+    @mock.patch('twisted.internet.threads.deferToThread')
+    def test_insertAllRateLimited(self, deferToThread):
+        clock = task.Clock()
+        limiter = ratelimit.RateLimiter(reactor=clock)
+        limiter.setTableLimits(rows_per_second=1)
+        self.svc.setRateLimiter(limiter)
+        self.svc.tables['logs'] = True
+        deferToThread.side_effect = lambda *a: defer.succeed({})
+        rows = [{'insertId': 'a', 'json': {}}]
+        self.svc.insertAll('logs', SCHEMA, rows)
+        self.assertEqual(deferToThread.call_count, 1)
+        d = self.svc.insertAll('logs$20150101', SCHEMA, rows)
+        self.assertNoResult(d)
+        self.assertEqual(deferToThread.call_count, 1)
+        clock.advance(1)
+        self.assertEqual(self.successResultOf(d), {})
+        deferToThread.assert_called_with(self.svc._doInsertAll,
+                                         'logs$20150101', rows, None)
+
+    @mock.patch('twisted.internet.threads.deferToThread')
+    def test_insertAllBytesLimited(self, deferToThread):
+        clock = task.Clock()
+        limiter = ratelimit.RateLimiter(reactor=clock)
+        limiter.setTableLimits(bytes_per_second=100)
+        self.svc.setRateLimiter(limiter)
+        self.svc.tables['logs'] = True
+        request = mock.Mock(body='x' * 60, headers={})
+        self.api.tabledata.return_value.insertAll.return_value = request
+        deferToThread.side_effect = lambda f, *a: defer.maybeDeferred(f, *a)
+        rows = [{'insertId': 'a', 'json': {}}]
+        self.svc.insertAll('logs', SCHEMA, rows)
+        request.execute.assert_called_once_with(http=self.svc.http)
+        # each request body is 60 bytes, so the second waits for 20 more
+        d = self.svc.insertAll('logs', SCHEMA, rows)
+        self.assertNoResult(d)
+        clock.advance(0.1)
+        self.assertNoResult(d)
+        clock.advance(0.1)
+        self.assertIs(self.successResultOf(d), request.execute.return_value)
+        self.assertEqual(self.api.tabledata.return_value.insertAll.call_count,
+                         2)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(service._pools.clear)
+
+    def test_sharedByProject(self):
+        creds = mock.MagicMock()
+        pool = service.connectionPool('project', creds, 'key')
+        self.assertIs(service.connectionPool('project', None, 'key'), pool)
+        self.assertIsNot(service.connectionPool('project', creds, 'other'),
+                         pool)
+        self.assertIsNot(service.connectionPool('other', creds, 'key'), pool)
+
+    def test_servicesShareClients(self):
+        pool = service.connectionPool('project', mock.MagicMock())
+        pool.local.service = sentinel.api
+        services = [service.BigQueryService('project', dataset,
+                                            mock.MagicMock(),
+                                            reactor=mock.Mock())
+                    for dataset in ('a', 'b')]
+        for svc in services:
+            svc.setConnectionPool(pool)
+            self.assertIs(svc.service, sentinel.api)
@@ -1,13 +1,16 @@
 import re
+import struct
 
 import mock
 from twisted.internet import inotify
 from twisted.internet import interfaces
 from twisted.internet import reactor
+from twisted.internet import task
 from twisted.python import filepath
 from twisted.trial import unittest
 from zope.interface import implementer
 
+from logsnarf import notifier
 from logsnarf import snarf
 
 
@@ -50,17 +53,16 @@ class LogsnarfTestCase(unittest.TestCase):
         self.assertTrue(self.snarf.paused)
 
     def test_WatchNoPatterns(self):
-        watchPath = filepath.FilePath('/foo/bar')
+        watchPath = filepath.FilePath(self.mktemp())
+        watchPath.child('empty').makedirs()
+        watchPath.child('a.log').touch()
         self.assertDictEqual(self.snarf._patterns, {})
         self.snarf.watch(watchPath, pattern=None, recursive=True)
         self.assertEqual(self.snarf._patterns[watchPath.path], None)
-        self.inotifier.watch.assert_called_once_with(watchPath,
-                                                     recursive=True,
-                                                     autoAdd=True,
-                                                     callbacks=[
-                                                         self.snarf._snarfcb],
-                                                     mask=inotify.IN_MODIFY | inotify.IN_DELETE
-                                                     )
+        # only directories with files in them are watched
+        self.inotifier.watch.assert_called_once_with(
+            watchPath, mask=snarf.WATCH_MASK,
+            callbacks=[self.snarf._watches._notified])
         self.reactor.callWhenRunning.assert_called_once_with(
             self.snarf._do_backlog,
             watchPath,
@@ -123,3 +125,327 @@ class LogsnarfTestCase(unittest.TestCase):
             self.snarf.checkPattern(filepath.FilePath('/var/log/messages')))
         self.assertTrue(
             self.snarf.checkPattern(filepath.FilePath('/var2/log/messages')))
+
+    def test_checkPatternNested(self):
+        self.snarf._patterns = {
+            '/var/log': re.compile(r'\.log$'),
+            '/var/log/app': re.compile(r'\.json$'),
+            '/': re.compile(r'/audit/'),
+        }
+        check = lambda p: self.snarf.checkPattern(filepath.FilePath(p))
+        self.assertTrue(check('/var/log/app/a.json'))
+        # the less specific directory's pattern matches
+        self.assertTrue(check('/var/log/app/a.log'))
+        self.assertFalse(check('/var/log/app/a.txt'))
+        self.assertTrue(check('/var/log/audit/x'))
+        # /var/log is not a prefix of /var/logs
+        self.assertFalse(check('/var/logs/a.json'))
+
+    def test_checkPatternCached(self):
+        self.snarf._patterns = {'/var/log': re.compile(r'\.log$')}
+        path = filepath.FilePath('/var/log/app/a.json')
+        self.assertFalse(self.snarf.checkPattern(path))
+        self.assertIs(self.snarf._matches[path.path], False)
+        self.snarf.watch('/var/log/app', None)
+        self.assertNotIn(path.path, self.snarf._matches)
+        self.assertTrue(self.snarf.checkPattern(path))
+
+    def test_setLagCallbackNotCallable(self):
+        self.assertRaises(TypeError, self.snarf.setLagCallback, 1)
+
+    def test_doReadReportsLag(self):
+        lags = []
+        self.snarf.setLagCallback(lambda p, lag: lags.append((p, lag)))
+        self.snarf.start()
+        log = filepath.FilePath(self.mktemp())
+        log.setContent(b'line1\nline2\n')
+        self.snarf.doRead(log)
+        self.assertEqual(lags, [(log.path, 12), (log.path, 0)])
+        self.assertEqual(self.consumer.data, ['line1\n', 'line2\n'])
+
+    def test_doReadCountsLines(self):
+        self.snarf.start()
+        log = filepath.FilePath(self.mktemp())
+        log.setContent(b'line1\nline2\npartial')
+        self.snarf.doRead(log)
+        self.assertEqual(snarf.LINES_READ.labels(log.path).value, 2)
+        self.assertEqual(snarf.BYTES_READ.labels(log.path).value, 12)
+        self.snarf._snarfcb(None, log, inotify.IN_DELETE)
+        self.assertNotIn((log.path,), snarf.LINES_READ._children)
+
+    def test_doBacklog(self):
+        self.snarf.start()
+        self.snarf.doRead = mock.Mock()
+        root = filepath.FilePath(self.mktemp())
+        root.child('sub').makedirs()
+        root.child('a.log').touch()
+        root.child('b.txt').touch()
+        root.child('sub').child('c.log').touch()
+        self.snarf._do_backlog(root, re.compile(r'.*\.log'), True)
+        self.assertEqual(
+            sorted(c[0][0].path for c in self.snarf.doRead.call_args_list),
+            [root.child('a.log').path, root.child('sub').child('c.log').path])
+
+    def test_doBacklogWhilePaused(self):
+        self.snarf.doRead = mock.Mock()
+        root = filepath.FilePath(self.mktemp())
+        root.makedirs()
+        root.child('a.log').touch()
+        self.snarf._do_backlog(root, None, False)
+        self.assertFalse(self.snarf.doRead.called)
+        self.assertEqual(self.snarf._paused_in_doRead, [root.child('a.log')])
+
+    def test_doReadTracksLag(self):
+        self.snarf.start()
+        log = filepath.FilePath(self.mktemp())
+        log.setContent(b'line1\nline2\n')
+        self.snarf.doRead(log)
+        self.assertEqual(self.snarf.lag.files[log.path].size, 12)
+        self.assertEqual(self.snarf.lag.files[log.path].offset, 12)
+        self.snarf._snarfcb(None, log, inotify.IN_DELETE)
+        self.assertNotIn(log.path, self.snarf.lag.files)
+
+    def test_snarfcbBytesPath(self):
+        self.snarf.doRead = mock.Mock()
+        self.snarf._patterns['/var/log'] = re.compile(r'.*\.log')
+        self.snarf._snarfcb(None, filepath.FilePath(b'/var/log/a.log'),
+                            inotify.IN_MODIFY)
+        self.snarf.doRead.assert_called_once_with(
+            filepath.FilePath('/var/log/a.log'))
+        self.assertIsInstance(self.snarf.doRead.call_args[0][0].path, str)
+
+
+class RotationTestCase(unittest.TestCase):
+    """Reading files as they're rotated."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.consumer = MockConsumer()
+        self.state = {}
+        self.snarf = snarf.LogSnarf(state_obj=self.state,
+                                    consumer=self.consumer,
+                                    reactor=mock.MagicMock(spec=reactor))
+        self.snarf._inotifier = mock.MagicMock(spec=inotify.INotify)
+        self.snarf.start()
+        self.addCleanup(self.snarf._handles.closeAll)
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.makedirs()
+        self.snarf._patterns[self.root.path] = re.compile(r'\.log(\.1)?$')
+        self.log = self.root.child('app.log')
+        self.log.setContent(b'line1\n')
+        self.addCleanup(self.snarf.lag.remove, self.log.path)
+
+    def append(self, path, data):
+        with open(path.path, 'ab') as f:
+            f.write(data)
+
+    def test_fileKeptOpen(self):
+        self.snarf.doRead(self.log)
+        handle = self.snarf._handles.get(self.log.path)
+        self.append(self.log, b'line2\npart')
+        self.snarf.doRead(self.log)
+        self.append(self.log, b'ial\n')
+        self.snarf.doRead(self.log)
+        self.assertIs(self.snarf._handles.get(self.log.path), handle)
+        self.assertEqual(self.consumer.data,
+                         ['line1\n', 'line2\n', 'partial\n'])
+        self.assertEqual(self.state[self.log.path][0], 20)
+
+    def test_rotatedDrained(self):
+        self.snarf.doRead(self.log)
+        self.append(self.log, b'line2\n')
+        self.log.moveTo(self.root.child('app.old'))
+        self.log.setContent(b'new1\n')
+        self.snarf._snarfcb(None, self.log, inotify.IN_CREATE)
+        self.assertEqual(self.consumer.data, ['line1\n', 'line2\n', 'new1\n'])
+        self.assertEqual(self.state[self.log.path],
+                         [5, self.log.getInodeNumber()])
+
+    def test_movedFromDrained(self):
+        self.snarf.doRead(self.log)
+        self.append(self.log, b'line2\n')
+        self.log.moveTo(self.root.child('app.old'))
+        self.snarf._snarfcb(None, self.log, inotify.IN_MOVED_FROM)
+        self.assertEqual(self.consumer.data, ['line1\n', 'line2\n'])
+
+    def test_renameTracked(self):
+        self.snarf.doRead(self.log)
+        self.append(self.log, b'line2\n')
+        rotated = self.root.child('app.log.1')
+        self.addCleanup(self.snarf.lag.remove, rotated.path)
+        self.log.moveTo(rotated)
+        self.snarf._snarfcb(None, self.log, inotify.IN_MOVED_FROM)
+        self.append(rotated, b'line3\n')
+        self.snarf._snarfcb(None, rotated, inotify.IN_MOVED_TO)
+        self.assertEqual(self.consumer.data,
+                         ['line1\n', 'line2\n', 'line3\n'])
+        self.assertNotIn(self.log.path, self.state)
+        self.assertEqual(self.state[rotated.path][0], 18)
+        self.assertIsNotNone(self.snarf._handles.get(rotated.path))
+
+    def test_inodeIndex(self):
+        self.state['/gone/a.log'] = [10, 1]
+        self.snarf.doRead(self.log)
+        inode = self.log.getInodeNumber()
+        self.assertEqual(self.snarf._withInode(inode), [self.log.path])
+        self.assertEqual(self.snarf._withInode(1), ['/gone/a.log'])
+        rotated = self.root.child('app.log.1')
+        self.addCleanup(self.snarf.lag.remove, rotated.path)
+        self.log.moveTo(rotated)
+        self.snarf._snarfcb(None, rotated, inotify.IN_MOVED_TO)
+        self.assertEqual(self.snarf._withInode(inode), [rotated.path])
+        self.snarf._forget(rotated.path)
+        self.assertEqual(self.snarf._withInode(inode), [])
+        self.assertNotIn(rotated.path, self.snarf._inode_of)
+        self.assertIsNone(self.snarf._handles.get(rotated.path))
+
+
+class CoalescingTestCase(unittest.TestCase):
+    """Reading files once for a burst of events."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.snarf = snarf.LogSnarf(state_obj={}, consumer=MockConsumer(),
+                                    reactor=self.clock)
+        self.snarf._inotifier = mock.MagicMock(spec=inotify.INotify)
+        self.snarf.paused = False
+        self.snarf.doRead = mock.Mock()
+        self.snarf.setCoalescing(0.1, 1.0)
+        self.snarf._patterns['/var/log'] = None
+        self.paths = [filepath.FilePath('/var/log/a.log'),
+                      filepath.FilePath('/var/log/b.log')]
+
+    def event(self, path, mask=inotify.IN_MODIFY):
+        self.snarf._snarfcb(None, path, mask)
+
+    def reads(self):
+        return [c[0][0].path for c in self.snarf.doRead.call_args_list]
+
+    def test_burst(self):
+        coalesced = snarf.COALESCED_EVENTS._unlabelled.value
+        for _ in range(10000):
+            for path in self.paths:
+                self.event(path)
+        self.assertEqual(self.reads(), [])
+        self.assertEqual(sorted(self.snarf._dirty),
+                         ['/var/log/a.log', '/var/log/b.log'])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 2)
+        self.clock.advance(0.1)
+        self.assertEqual(sorted(self.reads()),
+                         ['/var/log/a.log', '/var/log/b.log'])
+        self.assertEqual(self.snarf._dirty, {})
+        self.assertEqual(snarf.COALESCED_EVENTS._unlabelled.value,
+                         coalesced + 19998)
+
+    def test_debounce(self):
+        self.event(self.paths[0])
+        self.clock.advance(0.05)
+        self.event(self.paths[0])
+        self.clock.advance(0.05)
+        self.assertEqual(self.reads(), [])
+        self.clock.advance(0.05)
+        self.assertEqual(self.reads(), ['/var/log/a.log'])
+
+    def test_maxDelay(self):
+        for _ in range(20):
+            self.event(self.paths[0])
+            self.clock.advance(0.06)
+        # read once at 1.0 seconds, and again 0.1 after the last event
+        self.assertEqual(self.reads(), ['/var/log/a.log'])
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.reads()), 2)
+
+    def test_paused(self):
+        self.event(self.paths[0])
+        self.snarf.paused = True
+        self.clock.advance(0.1)
+        self.assertEqual(self.reads(), [])
+        self.assertEqual(self.snarf._paused_in_doRead, [self.paths[0]])
+
+    def test_deleteCancels(self):
+        self.event(self.paths[0])
+        self.event(self.paths[0], inotify.IN_DELETE)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(1)
+        self.assertEqual(self.reads(), [])
+
+    def test_createReadsNow(self):
+        self.event(self.paths[0])
+        self.event(self.paths[0], inotify.IN_CREATE)
+        self.assertEqual(self.reads(), ['/var/log/a.log'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class RescanTestCase(unittest.TestCase):
+    """Finding changed files after the event queue overflows."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = {}
+        self.snarf = snarf.LogSnarf(state_obj=self.state,
+                                    consumer=MockConsumer(),
+                                    reactor=self.clock)
+        self.snarf.paused = False
+        self.snarf.doRead = mock.Mock()
+        self.root = filepath.FilePath(self.mktemp())
+        self.root.child('sub').makedirs()
+        self.logs = [self.root.child('a.log'),
+                     self.root.child('sub').child('b.log')]
+        for log in self.logs:
+            log.setContent(b'line\n')
+            self.state[log.path] = [5, log.getInodeNumber()]
+        self.root.child('empty.log').touch()
+        self.snarf._indexes[self.root.path] = snarf.dirindex.DirectoryIndex(
+            self.root.path, re.compile(r'.*\.log'))
+
+    def reads(self):
+        return sorted(c[0][0].path for c in self.snarf.doRead.call_args_list)
+
+    def test_overflow(self):
+        overflows = snarf.OVERFLOWS._unlabelled.value
+        self.snarf.rescan = mock.Mock()
+        # as read from the inotify fd
+        self.snarf._inotifier.notifier._inotifier._doRead(struct.pack(
+            '=LLLL', notifier.OVERFLOW_WD, inotify.IN_Q_OVERFLOW, 0, 0))
+        self.assertEqual(snarf.OVERFLOWS._unlabelled.value, overflows + 1)
+        self.clock.advance(0)
+        self.snarf.rescan.assert_called_once_with()
+
+    def test_unchanged(self):
+        self.snarf.rescan()
+        self.assertEqual(self.reads(), [])
+
+    def test_changed(self):
+        self.logs[1].setContent(b'line\nline\n')
+        self.root.child('new.log').setContent(b'new\n')
+        self.root.child('new.txt').setContent(b'new\n')
+        self.snarf.rescan()
+        self.assertEqual(self.reads(), [
+            self.root.child('new.log').path, self.logs[1].path])
+
+    def test_replaced(self):
+        self.logs[0].remove()
+        self.logs[0].setContent(b'other\n')
+        self.state[self.logs[0].path][1] += 1
+        self.snarf.rescan()
+        self.assertEqual(self.reads(), [self.logs[0].path])
+
+    def test_paused(self):
+        self.logs[0].setContent(b'line\nline\n')
+        self.snarf.paused = True
+        self.snarf.rescan()
+        self.assertEqual(self.reads(), [])
+        self.assertEqual(self.snarf._paused_in_doRead, [self.logs[0]])
+
+    def test_batches(self):
+        self.patch(snarf, 'RESCAN_BATCH', 2)
+        for log in self.logs:
+            log.setContent(b'line\nline\n')
+        self.snarf.rescan()
+        self.assertEqual(len(self.reads()), 1)
+        self.snarf.rescan()
+        self.assertTrue(self.snarf._rescan_again)
+        # the rest of the first, and all of the second
+        self.clock.advance(0)
+        self.assertEqual(len(self.reads()), 4)
+        self.assertIsNone(self.snarf._rescan)
@@ -29,6 +29,15 @@ class StateTestCase(unittest.TestCase):
         mock_dump.assert_called_once_with(self.state, m.return_value,
                                           sort_keys=True)
 
+    @mock.patch('json.dump')
+    def test_stateSaveOnceOnUpdate(self, mock_dump):
+        m = mock.mock_open()
+        with mock.patch('logsnarf.state.open', m, create=True):
+            self.state.update({'a': 1, 'b': 2})
+        mock_dump.assert_called_once_with(self.state, m.return_value,
+                                          sort_keys=True)
+        self.assertEqual(self.state['b'], 2)
+
     def test_invalidStatefile(self):
         m = mock.mock_open(read_data='{ "foo": "bar", "bar": "zab", }')
         with mock.patch('logsnarf.state.open', m, create=True):
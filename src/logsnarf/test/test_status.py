@@ -0,0 +1,79 @@
+import os
+
+import simplejson as json
+from twisted.trial import unittest
+
+from logsnarf import status
+
+
+class StatusTestCase(unittest.TestCase):
+    def setUp(self):
+        self.log = self.mktemp()
+        with open(self.log, 'w') as f:
+            f.write('x' * 100)
+        self.inode = os.stat(self.log).st_ino
+        self.state_path = self.mktemp()
+        self.snapshot_path = self.mktemp()
+
+    def writeJSON(self, path, obj):
+        with open(path, 'w') as f:
+            json.dump(obj, f)
+
+    def test_fileStatus(self):
+        self.writeJSON(self.state_path, {
+            self.log: [40, self.inode],
+            '/missing.log': [10, 1],
+        })
+        self.writeJSON(self.snapshot_path, {
+            'time': 1000,
+            'files': {self.log: {'lag_seconds': 12.0}},
+        })
+        result = status.fileStatus(self.state_path, self.snapshot_path,
+                                   now=1030)
+        self.assertEqual(result['files'], [
+            {'path': '/missing.log', 'offset': 10, 'error': 'missing'},
+            {'path': self.log, 'offset': 40, 'size': 100, 'lag_bytes': 60,
+             'lag_seconds': 12.0},
+        ])
+        self.assertEqual(result['total_lag_bytes'], 60)
+        self.assertEqual(result['max_lag_seconds'], 12.0)
+        self.assertEqual(result['snapshot_age'], 30)
+
+    def test_fileStatusNoSnapshot(self):
+        self.writeJSON(self.state_path, {self.log: [100, self.inode]})
+        result = status.fileStatus(self.state_path, self.snapshot_path)
+        self.assertEqual(result['files'][0]['lag_seconds'], 0.0)
+        self.assertEqual(result['snapshot_age'], None)
+
+    def test_fileStatusRotated(self):
+        self.writeJSON(self.state_path, {self.log: [100, self.inode + 1]})
+        result = status.fileStatus(self.state_path)
+        self.assertEqual(result['files'][0]['lag_bytes'], 100)
+        self.assertEqual(result['files'][0]['lag_seconds'], None)
+
+    def test_fileStatusCompressed(self):
+        self.writeJSON(self.state_path, {self.log: [500, self.inode, [30, 400]]})
+        result = status.fileStatus(self.state_path)
+        self.assertEqual(result['files'][0]['offset'], 500)
+        self.assertEqual(result['files'][0]['lag_bytes'], 70)
+
+    def test_mergeStatus(self):
+        merged = status.mergeStatus([
+            {'files': [{'path': '/b.log'}], 'total_lag_bytes': 10,
+             'max_lag_seconds': 3.0, 'snapshot_age': None},
+            {'files': [{'path': '/a.log'}], 'total_lag_bytes': 5,
+             'max_lag_seconds': 7.0, 'snapshot_age': 20},
+        ])
+        self.assertEqual(merged, {
+            'files': [{'path': '/a.log'}, {'path': '/b.log'}],
+            'total_lag_bytes': 15, 'max_lag_seconds': 7.0,
+            'snapshot_age': 20})
+
+    def test_formatStatus(self):
+        self.writeJSON(self.state_path, {self.log: [40, self.inode]})
+        text = status.formatStatus(
+            {'app1': status.fileStatus(self.state_path)})
+        self.assertEqual(text.splitlines(), [
+            '[app1] 60 bytes behind, at most 0 seconds (no lag snapshot)',
+            '  %s: offset 40 of 100, 60 bytes ? seconds behind' % self.log,
+        ])
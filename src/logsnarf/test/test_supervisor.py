@@ -0,0 +1,234 @@
+import os
+import sys
+
+import mock
+import simplejson as json
+from twisted.internet import defer
+from twisted.internet import error
+from twisted.internet import reactor
+from twisted.internet import task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from logsnarf import app
+from logsnarf import metrics
+from logsnarf import state
+from logsnarf import supervisor
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_shardPath(self):
+        self.assertEqual(supervisor.shardPath('/s/app_state.json', (1, 4)),
+                         '/s/app_state.1of4.json')
+        self.assertEqual(supervisor.shardPath('/s/app_bulk', (0, 2)),
+                         '/s/app_bulk.0of2')
+        self.assertEqual(supervisor.shardPath('/s/app_state.json', (0, 1)),
+                         '/s/app_state.json')
+        self.assertEqual(supervisor.shardPath('/s/app_state.json', None),
+                         '/s/app_state.json')
+
+    def test_shardCount(self):
+        section = {'directories': '["/a", "/b", "/c"]', 'workers': 4}
+        self.assertEqual(supervisor.shardCount(section), 3)
+        section['workers'] = 2
+        self.assertEqual(supervisor.shardCount(section), 2)
+        self.assertEqual(supervisor.shardCount({'workers': 4}), 1)
+
+    def test_workerArgs(self):
+        args = supervisor.workerArgs('app1', (1, 2), 'logsnarf', '/etc/l.ini')
+        self.assertEqual(args[0], sys.executable)
+        self.assertEqual(args[1:], [
+            '-m', 'logsnarf.app', '-n', 'logsnarf', '-f', '/etc/l.ini',
+            '--worker', 'app1', '--shard', '1/2'])
+        self.assertEqual(supervisor.workerName('app1', (1, 2)), 'app1/1')
+        self.assertEqual(supervisor.workerName('app1', (0, 1)), 'app1')
+
+    def test_optionsShard(self):
+        opts = app.Options()
+        opts.parseOptions(['--worker', 'app1', '--shard', '1/2'])
+        self.assertEqual(opts['shard'], (1, 2))
+        self.assertRaises(app.usage.UsageError, app.Options().parseOptions,
+                          ['--shard', '2/2'])
+
+    def test_seedState(self):
+        root = self.mktemp()
+        os.makedirs(root)
+        state_path = os.path.join(root, 'app_state.json')
+        old = os.path.join(root, 'app_state.0of2.json')
+        new = os.path.join(root, 'app_state.1of2.json')
+        for path, entries, mtime in (
+                (old, {'/a/x.log': [1, 1], '/b/y.log': [1, 2]}, 1000),
+                (new, {'/a/x.log': [5, 1], '/c/z.log': [1, 3]}, 2000)):
+            with open(path, 'w') as f:
+                json.dump(entries, f)
+            os.utime(path, (mtime, mtime))
+        st = state.State(state_path)
+        app.seed_state(st, state_path, ['/a', '/b'])
+        self.assertEqual(dict(st), {'/a/x.log': [5, 1], '/b/y.log': [1, 2]})
+
+
+class MergeTestCase(unittest.TestCase):
+    def test_mergeExpositions(self):
+        registry = metrics.Registry()
+        metrics.counter('lines', 'Lines read.', ['path'],
+                        registry=registry).labels('/a.log').inc(3)
+        metrics.gauge('buffered', 'Rows buffered.',
+                      registry=registry).set(2)
+        text = registry.exposition()
+        merged = supervisor.mergeExpositions([
+            ([], b'# HELP up Up.\n# TYPE up gauge\nup 1\n'),
+            ([('worker', 'a')], text),
+            ([('worker', 'b')], text),
+        ]).decode('utf-8').splitlines()
+        self.assertEqual(merged, [
+            '# HELP buffered Rows buffered.',
+            '# TYPE buffered gauge',
+            'buffered{worker="a"} 2',
+            'buffered{worker="b"} 2',
+            '# HELP lines Lines read.',
+            '# TYPE lines counter',
+            'lines_total{worker="a",path="/a.log"} 3',
+            'lines_total{worker="b",path="/a.log"} 3',
+            '# HELP up Up.',
+            '# TYPE up gauge',
+            'up 1',
+        ])
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.processes = []
+        self.clock.spawnProcess = self.spawnProcess
+        self.supervisor = supervisor.Supervisor(
+            [('app1', ['python', 'app1']), ('app2', ['python', 'app2'])],
+            env={}, reactor=self.clock)
+        self.supervisor.start()
+        self.worker = self.supervisor.workers[0]
+
+    def spawnProcess(self, proto, executable, args, env=None, childFDs=None):
+        process = mock.Mock(pid=len(self.processes))
+        process.proto = proto
+        self.processes.append(process)
+        return process
+
+    def end(self, worker):
+        worker.process.proto.processEnded(failure.Failure(
+            error.ProcessTerminated(1)))
+
+    def tearDown(self):
+        for worker in self.supervisor.workers:
+            if worker.running:
+                self.end(worker)
+
+    def test_started(self):
+        self.assertEqual(len(self.processes), 2)
+        self.assertTrue(all(w.running for w in self.supervisor.workers))
+
+    def test_restart(self):
+        restarts = supervisor.WORKER_RESTARTS.labels('app1').value
+        self.end(self.worker)
+        self.assertFalse(self.worker.running)
+        self.clock.advance(1)
+        self.assertTrue(self.worker.running)
+        self.assertEqual(supervisor.WORKER_RESTARTS.labels('app1').value,
+                         restarts + 1)
+        self.end(self.worker)
+        self.clock.advance(1)
+        self.assertFalse(self.worker.running)
+        self.clock.advance(1)
+        self.assertTrue(self.worker.running)
+
+    def test_restartDelayReset(self):
+        self.worker.delay = 16
+        self.clock.advance(supervisor.MAX_RESTART_DELAY)
+        self.end(self.worker)
+        self.clock.advance(1)
+        self.assertTrue(self.worker.running)
+
+    def test_stop(self):
+        d = self.supervisor.stop()
+        for worker in self.supervisor.workers:
+            worker.process.signalProcess.assert_called_once_with('TERM')
+        self.end(self.supervisor.workers[0])
+        self.assertNoResult(d)
+        self.end(self.supervisor.workers[1])
+        self.successResultOf(d)
+        self.clock.advance(1)
+        self.assertEqual(len(self.processes), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stopKills(self):
+        self.supervisor.stop()
+        self.clock.advance(supervisor.STOP_TIMEOUT)
+        self.worker.process.signalProcess.assert_called_with('KILL')
+
+    def test_stopRestarting(self):
+        self.end(self.worker)
+        self.supervisor.stop()
+        self.end(self.supervisor.workers[1])
+        self.clock.advance(1)
+        self.assertFalse(self.worker.running)
+
+    def test_metrics(self):
+        proto = self.worker.process.proto
+        proto.childDataReceived(1, b'ignored\0')
+        proto.childDataReceived(supervisor.METRICS_FD,
+                                b'# TYPE x gauge\nx 1\n\0# TYPE x ')
+        proto.childDataReceived(supervisor.METRICS_FD, b'gauge\nx 2\n')
+        self.assertEqual(self.worker.metrics, b'# TYPE x gauge\nx 1\n')
+        proto.childDataReceived(supervisor.METRICS_FD, b'\0')
+        self.assertIn(b'x{worker="app1"} 2', self.supervisor.exposition())
+        self.assertIn(b'logsnarf_workers_running 2',
+                      self.supervisor.exposition())
+
+
+class WorkerControlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.running = True
+        self.clock.stop = mock.Mock()
+        self.registry = metrics.Registry()
+        metrics.gauge('x', 'X.', registry=self.registry).set(1)
+        self.control = supervisor.WorkerControl(self.registry, 5,
+                                                reactor=self.clock)
+        self.control.transport = mock.Mock()
+        self.control.connectionMade()
+
+    def test_report(self):
+        self.clock.advance(5)
+        self.assertEqual(self.control.transport.write.call_count, 2)
+        self.control.transport.write.assert_called_with(
+            self.registry.exposition() + b'\0')
+        self.control.connectionLost()
+
+    def test_supervisorLost(self):
+        self.control.connectionLost()
+        self.clock.stop.assert_called_once_with()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+class WorkerProcessTestCase(unittest.TestCase):
+    """Workers run as processes."""
+
+    def test_metricsPipe(self):
+        script = ('import os; os.write(%d, b"# TYPE x gauge\\nx 1\\n\\0")'
+                  % supervisor.METRICS_FD)
+        sup = supervisor.Supervisor(
+            [('w', [sys.executable, '-c', script])], reactor=reactor)
+        worker = sup.workers[0]
+        seen = []
+        ended = worker.ended
+
+        def stopped(reason):
+            seen.append(worker.metrics)
+            ended(reason)
+            d.callback(None)
+
+        worker.ended = stopped
+        d = defer.Deferred()
+        sup.start()
+        d.addCallback(lambda _: sup.stop())
+        d.addCallback(lambda _: self.assertEqual(
+            seen, [b'# TYPE x gauge\nx 1\n']))
+        return d
@@ -0,0 +1,193 @@
+import httplib2
+import mock
+import simplejson as json
+from googleapiclient import errors as gerrors
+from twisted.internet import defer
+from twisted.internet import task
+from twisted.trial import unittest
+
+from logsnarf import service
+from logsnarf import tracing
+from logsnarf import uploader
+
+
+class BufferClockTestCase(unittest.TestCase):
+    def test_taken(self):
+        clock = tracing.BufferClock()
+        clock.added(3, 1.0)
+        clock.added(2, 2.0)
+        clock.added(4, 3.0)
+        self.assertEqual(clock.taken(2), (1.0, 1.0))
+        self.assertEqual(clock.taken(4), (1.0, 3.0))
+        self.assertEqual(clock.taken(10), (3.0, 3.0))
+        self.assertEqual(clock.taken(1), None)
+
+    def test_takenBoundary(self):
+        clock = tracing.BufferClock()
+        clock.added(2, 1.0)
+        clock.added(2, 2.0)
+        self.assertEqual(clock.taken(2), (1.0, 1.0))
+        self.assertEqual(clock.taken(2), (2.0, 2.0))
+
+    def test_clear(self):
+        clock = tracing.BufferClock()
+        clock.added(2, 1.0)
+        clock.clear()
+        clock.added(1, 5.0)
+        self.assertEqual(clock.taken(1), (5.0, 5.0))
+
+
+class TracerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.path = self.mktemp()
+        self.tracer = tracing.Tracer(self.path, 1.0, reactor=self.clock)
+        self.addCleanup(self.tracer.close)
+
+    def traces(self):
+        with open(self.path) as f:
+            return [json.loads(ln) for ln in f]
+
+    def test_notSampled(self):
+        tracer = tracing.Tracer(self.path, 0.0, reactor=self.clock)
+        self.assertIsNone(tracer.begin('u1', 'app', 'logs', 1))
+        tracer.span('u1', 'http', 0.0)
+        tracer.finish('u1')
+        self.assertEqual(tracer.written, 0)
+
+    def test_sampleRate(self):
+        tracer = tracing.Tracer(self.path, 0.25, seed=1, reactor=self.clock)
+        sampled = [tracer.begin(str(i), 'app', 'logs', 1)
+                   for i in range(1000)]
+        n = len([t for t in sampled if t])
+        self.assertTrue(200 < n < 300, n)
+
+    def test_trace(self):
+        self.clock.advance(10)
+        self.tracer.begin('u1', 'app', 'logs', 5, buffered=(7.0, 9.0))
+        self.clock.advance(1)
+        self.tracer.span('u1', 'http', 10.5)
+        self.tracer.finish('u1')
+        [trace] = self.traces()
+        self.assertEqual(trace['trace'], 'u1')
+        self.assertEqual(trace['duration'], 1.0)
+        self.assertEqual(trace['status'], 'ok')
+        self.assertEqual(trace['spans'], [
+            {'name': 'buffered', 'upload_id': 'u1', 'start': 7.0,
+             'end': 10.0, 'newest': 9.0},
+            {'name': 'http', 'upload_id': 'u1', 'start': 10.5, 'end': 11.0},
+        ])
+
+    def test_children(self):
+        self.tracer.begin('u1', 'app', 'logs', 2)
+        self.tracer.child('u1', 'u1-1')
+        self.tracer.child('u1', 'u1-2')
+        self.tracer.finish('u1')
+        self.tracer.span('u1-1', 'http', 0.0)
+        self.tracer.finish('u1-1', failed=True)
+        self.assertEqual(self.tracer.written, 0)
+        self.tracer.finish('u1-2')
+        [trace] = self.traces()
+        self.assertEqual(trace['status'], 'failed')
+        self.assertEqual(trace['spans'][0]['upload_id'], 'u1-1')
+
+
+class UploaderTracingTestCase(unittest.TestCase):
+    """Traces recorded by the uploader."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.clock = task.Clock()
+        self.service = mock.MagicMock()
+        self.service.insertAll.side_effect = self.insertAll
+        self.responses = []
+        self.uploader = uploader.BigQueryUploader(
+            mock.MagicMock(), self.service, 'logs', reactor=self.clock)
+        self.uploader.producer = mock.Mock(paused=False)
+        self.uploader._deadLetter = mock.Mock()
+        self.uploader.setName('app')
+        self.uploader.setBatchSize(4)
+        self.tracer = tracing.Tracer(self.mktemp(), 1.0, reactor=self.clock)
+        self.tracer.write = mock.Mock()
+        self.uploader.setTracer(self.tracer)
+
+    def insertAll(self, table, schema, data, upload_id):
+        if self.responses:
+            return self.responses.pop(0)
+        return defer.succeed({})
+
+    def rows(self, n):
+        return [{'_sha1': str(i), 'table': 'logs'} for i in range(n)]
+
+    def trace(self):
+        self.assertEqual(self.tracer.write.call_count, 1)
+        return self.tracer.write.call_args[0][0].toJSON(self.clock.seconds())
+
+    def test_buffered(self):
+        self.uploader.addData(self.rows(1))
+        self.clock.advance(2)
+        self.uploader.addData(self.rows(1))
+        self.clock.advance(3)
+        self.uploader.upload()
+        trace = self.trace()
+        self.assertEqual(trace['uploader'], 'app')
+        self.assertEqual(trace['rows'], 2)
+        self.assertEqual(trace['spans'][0]['name'], 'buffered')
+        self.assertEqual(trace['spans'][0]['start'], 0)
+        self.assertEqual(trace['spans'][0]['newest'], 2)
+        self.assertEqual(trace['spans'][0]['end'], 5)
+
+    def test_partialFailure(self):
+        self.responses.append(defer.succeed({'insertErrors': [
+            {'index': 1, 'errors': [{'reason': 'backendError'}]}]}))
+        self.uploader.addData(self.rows(2))
+        self.uploader.upload()
+        trace = self.trace()
+        resubmit = [s for s in trace['spans'] if s['name'] == 'resubmit']
+        self.assertEqual(len(resubmit), 1)
+        self.assertEqual(resubmit[0]['reason'], 'partial_failure')
+        self.assertEqual(resubmit[0]['rows'], 1)
+
+    def test_bisect(self):
+        self.responses.append(defer.fail(gerrors.HttpError(
+            httplib2.Response({'status': 400}), b'')))
+        self.uploader.addData(self.rows(2))
+        self.uploader.upload()
+        trace = self.trace()
+        self.assertEqual(
+            [(s['name'], s.get('reason')) for s in trace['spans']],
+            [('buffered', None), ('resubmit', 'bisect'),
+             ('resubmit', 'bisect')])
+        self.assertEqual(trace['status'], 'ok')
+        self.assertEqual(self.tracer._traces, {})
+
+
+class ServiceTracingTestCase(unittest.TestCase):
+    """Traces recorded by the service."""
+
+    def setUp(self):
+        self.reactor = mock.Mock()
+        self.reactor.callFromThread.side_effect = lambda f, *a, **kw: f(
+            *a, **kw)
+        self.reactor.seconds.side_effect = iter(range(100)).__next__
+        self.svc = service.BigQueryService('project', 'dataset', None,
+                                           reactor=self.reactor)
+        self.tracer = tracing.Tracer(self.mktemp(), 1.0,
+                                     reactor=self.reactor)
+        self.svc.setTracer(self.tracer)
+        self.trace = self.tracer.begin('u1', 'app', 'logs', 1)
+        self.svc._doInsertAll = mock.Mock(return_value={})
+
+    def test_tracedInsertAll(self):
+        self.assertEqual(
+            self.svc._tracedInsertAll('u1', -1, 'logs', [{}]), {})
+        self.assertEqual(
+            [(s['name'], s['start'], s['end']) for s in self.trace.spans],
+            [('thread_wait', -1, 1), ('http', 1, 2)])
+
+    def test_tracedInsertAllError(self):
+        self.svc._doInsertAll.side_effect = gerrors.HttpError(
+            httplib2.Response({'status': 503}), b'')
+        self.assertRaises(gerrors.HttpError, self.svc._tracedInsertAll,
+                          'u1', 0, 'logs', [{}])
+        self.assertEqual(self.trace.spans[-1]['status'], 503)
@@ -0,0 +1,337 @@
+import gc
+import time
+import weakref
+
+import arrow
+import httplib2
+import mock
+from googleapiclient import errors as gerrors
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.python import failure
+from twisted.trial import unittest
+
+from logsnarf import acks
+from logsnarf import filters
+from logsnarf import metrics
+from logsnarf import uploader
+
+
+class BigQueryUploaderTestCase(unittest.TestCase):
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.schema = mock.MagicMock()
+        self.service = mock.MagicMock()
+        self.reactor = mock.MagicMock(spec=reactor)
+        self.uploader = uploader.BigQueryUploader(
+            self.schema, self.service, 'logs_{YEAR}{MONTH}{DAY}',
+            reactor=self.reactor)
+        self.uploader.now = arrow.get(1420070400)  # 2015-01-01 00:00 UTC
+
+    def test_tableForTableField(self):
+        entry = {'table': 'other', 'time': 1420070400}
+        self.assertEqual(self.uploader.tableFor(entry), 'other')
+        self.assertNotIn('table', entry)
+
+    def test_tableForNameFormat(self):
+        entry = {'time': 1420156800}  # 2015-01-02 00:00 UTC
+        self.assertEqual(self.uploader.tableFor(entry), 'logs_201512')
+
+    def test_tableForNoTime(self):
+        self.assertEqual(self.uploader.tableFor({}), 'logs_201511')
+
+    def test_tableForPartitionField(self):
+        self.uploader.setPartitionedTable('logs', field='time')
+        entry = {'time': 1420156800}
+        self.assertEqual(self.uploader.tableFor(entry), 'logs')
+
+    def test_tableForPartitionDecorator(self):
+        self.uploader.setPartitionedTable('logs')
+        entry = {'time': 1420156800}
+        self.assertEqual(self.uploader.tableFor(entry), 'logs$20150102')
+
+    def test_tableForPartitionDecoratorHour(self):
+        self.uploader.setPartitionedTable('logs', partition_type='HOUR')
+        entry = {'time': 1420156800 + 3600 * 5}
+        self.assertEqual(self.uploader.tableFor(entry), 'logs$2015010205')
+
+    def test_setPartitionedTableInvalidType(self):
+        self.assertRaises(ValueError, self.uploader.setPartitionedTable,
+                          'logs', None, 'WEEK')
+
+    def test_addDataPartitioned(self):
+        self.uploader.setPartitionedTable('logs', field='time')
+        self.uploader.addData([
+            {'_sha1': 'a', 'time': 1420156800},
+            {'_sha1': 'b', 'time': 1420070400},
+        ])
+        self.assertEqual([t for t, _ in self.uploader._linebuffer],
+                         ['logs', 'logs'])
+        self.assertEqual(self.uploader._linebuffer[0][1],
+                         {'insertId': 'a', 'json': {'time': 1420156800}})
+
+    def test_metricsLabelledByName(self):
+        self.uploader.setName('app1')
+        self.uploader._linebuffer.extend([('logs', {})] * 3)
+        self.assertIn(b'logsnarf_buffer_rows{uploader="app1"} 3',
+                      metrics.REGISTRY.exposition())
+        self.assertNotIn(b'logsnarf_buffer_rows{uploader="default"}',
+                         metrics.REGISTRY.exposition())
+        self.uploader.uploadq['u1'] = time.time()
+        self.uploader.producer = mock.Mock()
+        self.uploader._uploadCB({}, 'u1', 'logs', [{}, {}])
+        self.assertEqual(uploader.UPLOADED_ROWS.labels('app1').value, 2)
+        self.assertEqual(uploader.UPLOAD_SECONDS.labels('app1').count, 1)
+
+    def test_metricsRemovedOnFlush(self):
+        self.uploader.setName('app1')
+        ref = weakref.ref(self.uploader)
+        self.uploader.flush()
+        self.assertNotIn(b'logsnarf_buffer_rows{uploader="app1"}',
+                         metrics.REGISTRY.exposition())
+        self.uploader.setName('app2')
+        del self.uploader
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertIn(b'logsnarf_buffer_rows{uploader="app2"} 0',
+                      metrics.REGISTRY.exposition())
+        uploader.BUFFER_ROWS.remove('app2')
+
+    def test_registerSecondProducer(self):
+        self.uploader.start = mock.Mock()
+        first, second = mock.Mock(paused=False), mock.Mock()
+        self.uploader.registerProducer(first, True)
+        self.uploader.registerProducer(second, True)
+        self.assertEqual(self.uploader.start.call_count, 1)
+        self.assertIsInstance(self.uploader.producer, uploader.ProducerGroup)
+        self.uploader.pauseConsuming()
+        first.pauseProducing.assert_called_once_with()
+        second.pauseProducing.assert_called_once_with()
+        self.assertTrue(self.uploader.producer.paused)
+        self.uploader.resumeConsuming()
+        second.resumeProducing.assert_called_once_with()
+        self.assertFalse(self.uploader.producer.paused)
+
+
+class BatchPostprocessorTestCase(unittest.TestCase):
+    """Batch post processors run on each write."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.schema = mock.MagicMock()
+        self.schema.loads.side_effect = lambda ln: {'_sha1': ln, 'l': ln}
+        self.schema.batchPostprocessors = True
+        self.pending = []
+        self.schema.postProcessBatch.side_effect = self.postProcessBatch
+        self.uploader = uploader.BigQueryUploader(
+            self.schema, mock.MagicMock(), 'logs',
+            reactor=mock.MagicMock(spec=reactor))
+        self.uploader.producer = mock.Mock(paused=False)
+        self.uploader._deadLetter = mock.Mock()
+        self.uploader.setMaxBuffer(4)
+
+    def postProcessBatch(self, rows):
+        d = defer.Deferred()
+        self.pending.append((d, rows))
+        return d
+
+    def buffered(self):
+        return [row['json']['l'] for _, row in self.uploader._linebuffer]
+
+    def test_synchronous(self):
+        self.schema.postProcessBatch.side_effect = lambda rows: rows[:1]
+        self.uploader.write('a\nb\n')
+        self.uploader.write('c\n')
+        self.assertEqual(self.buffered(), ['a', 'c'])
+
+    def test_inOrder(self):
+        self.uploader.write('a\nb\n')
+        self.uploader.write('c\n')
+        self.assertEqual(len(self.pending), 1)
+        self.assertEqual(self.uploader._batch_rows, 3)
+        d, rows = self.pending.pop(0)
+        d.callback(rows)
+        self.assertEqual(self.buffered(), ['a', 'b'])
+        d, rows = self.pending.pop(0)
+        d.callback(rows)
+        self.assertEqual(self.buffered(), ['a', 'b', 'c'])
+        self.assertEqual(self.uploader._batch_rows, 0)
+
+    def test_backpressure(self):
+        self.uploader.write('a\nb\nc\n')
+        self.assertFalse(self.uploader.producerPaused)
+        self.uploader.write('d\n')
+        self.assertTrue(self.uploader.producerPaused)
+        d, rows = self.pending.pop(0)
+        d.callback([])
+        self.assertFalse(self.uploader.producerPaused)
+
+    def test_failed(self):
+        self.uploader.write('a\n')
+        self.uploader.write('b\n')
+        d, rows = self.pending.pop(0)
+        d.errback(RuntimeError('boom'))
+        self.uploader._deadLetter.assert_called_once_with(
+            'batch', [{'_sha1': 'a', 'l': 'a'}])
+        self.assertEqual(len(self.pending), 1)
+        self.assertEqual(self.uploader._batch_rows, 1)
+
+    def test_flushWaits(self):
+        self.uploader.upload = mock.Mock(
+            side_effect=lambda flush: self.uploader._linebuffer.clear())
+        self.uploader.write('a\n')
+        result = self.uploader.flush()
+        self.assertNoResult(result)
+        self.assertFalse(self.uploader.disconnected)
+        d, rows = self.pending.pop(0)
+        d.callback(rows)
+        self.successResultOf(result)
+        self.uploader.upload.assert_called_once_with(flush=True)
+        self.assertTrue(self.uploader.disconnected)
+
+
+class AckTestCase(unittest.TestCase):
+    """Rows acknowledged once they're done with."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.schema = mock.MagicMock()
+        self.schema.loads.side_effect = lambda ln: {'_sha1': ln, 'l': ln}
+        self.schema.batchPostprocessors = False
+        self.uploader = uploader.BigQueryUploader(
+            self.schema, mock.MagicMock(), 'logs',
+            reactor=mock.MagicMock(spec=reactor))
+        self.uploader.producer = mock.Mock(paused=False)
+        self.uploader._deadLetter = mock.Mock()
+        self.acks = acks.AckTracker()
+        self.uploader.setAckTracker(self.acks)
+
+    def rows(self):
+        return [row for _, row in self.uploader._linebuffer]
+
+    def test_heldUntilUploaded(self):
+        self.uploader.write('a\nb\n')
+        self.uploader.write('c\n')
+        self.assertEqual(self.acks.watermark, -1)
+        rows = self.rows()
+        self.uploader._uploadCB({}, 'u1', 'logs', rows[:2])
+        self.assertEqual(self.acks.watermark, 0)
+        self.uploader._uploadCB({}, 'u2', 'logs', rows[2:])
+        self.assertEqual(self.acks.watermark, 1)
+        self.assertEqual(self.uploader._row_marks, {})
+
+    def test_partialWrite(self):
+        self.uploader.write('a\nb')
+        self.assertEqual(self.acks.watermark, -1)
+        self.uploader._uploadCB({}, 'u1', 'logs', self.rows())
+        self.assertEqual(self.acks.watermark, 0)
+
+    def test_filtered(self):
+        self.uploader.setLineFilter(lambda ln: filters.DROP)
+        self.uploader.write('a\n')
+        self.assertEqual(self.acks.watermark, 0)
+
+    def test_deadLettered(self):
+        self.uploader.write('a\n')
+        self.uploader.uploadq['u1'] = time.time()
+        self.uploader._errback(failure.Failure(RuntimeError('boom')), 'u1', 'logs', self.rows())
+        self.assertEqual(self.acks.watermark, 0)
+
+    def test_invalidAndStopped(self):
+        self.uploader.write('a\nb\nc\n')
+        rows = self.rows()
+        service = self.uploader.service
+        service.insertAll.return_value = defer.succeed({})
+        self.uploader.uploadq['u1'] = time.time()
+        self.uploader._uploadCB({'insertErrors': [
+            {'index': 0, 'errors': [{'reason': 'stopped'}]},
+            {'index': 1, 'errors': [{'reason': 'invalid'}]},
+            {'index': 2, 'errors': [{'reason': 'stopped'}]},
+        ]}, 'u1', 'logs', rows)
+        self.uploader._deadLetter.assert_called_once_with('u1', [rows[1]])
+        service.insertAll.assert_called_once_with(
+            'logs', self.schema.schema, [rows[0], rows[2]], 'u1')
+        self.assertEqual(self.acks.watermark, 0)
+        self.assertEqual(self.uploader.uploadq, {})
+
+    def test_invalidOnly(self):
+        self.uploader.write('a\n')
+        self.uploader.uploadq['u1'] = time.time()
+        self.uploader._uploadCB({'insertErrors': [
+            {'index': 0, 'errors': [{'reason': 'invalid'}]},
+        ]}, 'u1', 'logs', self.rows())
+        self.assertFalse(self.uploader.service.insertAll.called)
+        self.assertEqual(self.acks.watermark, 0)
+        self.assertEqual(self.uploader.uploadq, {})
+
+
+class BisectTestCase(unittest.TestCase):
+    """Isolation of rows that cause a whole batch to be rejected."""
+
+    # noinspection PyTypeChecker
+    def setUp(self):
+        self.service = mock.MagicMock()
+        self.service.insertAll.side_effect = self.insertAll
+        self.uploader = uploader.BigQueryUploader(
+            mock.MagicMock(), self.service, 'logs_{YEAR}{MONTH}{DAY}',
+            reactor=mock.MagicMock(spec=reactor))
+        self.uploader.producer = mock.Mock(paused=False)
+        self.uploader._deadLetter = mock.Mock()
+        self.inserted = []
+        self.requests = 0
+
+    def insertAll(self, table, schema, data, upload_id):
+        self.requests += 1
+        if any(row['json'].get('poison') for row in data):
+            return defer.fail(gerrors.HttpError(
+                httplib2.Response({'status': 400}), b''))
+        self.inserted.extend(data)
+        return defer.succeed({})
+
+    def rows(self, n, poison=()):
+        return [{'insertId': str(i), 'json': {'n': i, 'poison': i in poison}}
+                for i in range(n)]
+
+    def upload(self, data):
+        self.uploader.uploadq['upload1'] = 0
+        d = self.service.insertAll('logs', None, data, 'upload1')
+        d.addCallback(self.uploader._uploadCB, 'upload1', 'logs', data)
+        d.addErrback(self.uploader._errback, 'upload1', 'logs', data)
+        return d
+
+    def deadLettered(self):
+        return [row for call in self.uploader._deadLetter.call_args_list
+                for row in call[0][1]]
+
+    def test_singlePoisonRow(self):
+        data = self.rows(16, poison=(5,))
+        self.successResultOf(self.upload(data))
+        self.assertEqual(self.deadLettered(), [data[5]])
+        self.assertEqual(sorted(r['json']['n'] for r in self.inserted),
+                         [n for n in range(16) if n != 5])
+        # 1 + 2 requests per level for 4 levels
+        self.assertEqual(self.requests, 9)
+        self.assertEqual(self.uploader.uploadq, {})
+
+    def test_twoPoisonRows(self):
+        data = self.rows(8, poison=(0, 7))
+        self.successResultOf(self.upload(data))
+        self.assertEqual(self.deadLettered(), [data[0], data[7]])
+        self.assertEqual(len(self.inserted), 6)
+
+    def test_bisectLimit(self):
+        self.uploader.setBisectLimit(4)
+        data = self.rows(16, poison=(5,))
+        self.successResultOf(self.upload(data))
+        self.assertEqual(self.requests, 5)
+        self.assertEqual(self.deadLettered(), data[4:8])
+        self.assertEqual(len(self.inserted), 12)
+        self.assertEqual(self.uploader.uploadq, {})
+
+    def test_otherErrorsNotBisected(self):
+        self.service.insertAll.side_effect = lambda *a: defer.fail(
+            gerrors.HttpError(httplib2.Response({'status': 404}), b''))
+        data = self.rows(4)
+        self.successResultOf(self.upload(data))
+        self.assertEqual(self.service.insertAll.call_count, 1)
+        self.assertEqual(self.deadLettered(), data)
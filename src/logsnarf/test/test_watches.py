@@ -0,0 +1,125 @@
+import os
+import re
+
+import mock
+from twisted.internet import inotify
+from twisted.internet import task
+from twisted.python import filepath
+from twisted.trial import unittest
+
+from logsnarf import dirindex
+from logsnarf import watches
+
+
+class WatchManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.inotifier = mock.MagicMock(spec=inotify.INotify)
+        self.events = []
+        self.root = filepath.FilePath(self.mktemp())
+        for d in ('hot', 'cold', 'cold/colder'):
+            self.root.preauthChild(d).makedirs()
+        self.root.child('a.log').touch()
+        self.root.child('hot').child('b.log').touch()
+        self.root.child('cold').child('c.txt').touch()
+        self.index = dirindex.DirectoryIndex(self.root.path,
+                                             re.compile(r'.*\.log'))
+        self.manager = self.makeManager()
+
+    def makeManager(self, max_watches=10):
+        return watches.WatchManager(
+            self.inotifier,
+            lambda _, path, mask: self.events.append((path.path, mask)),
+            inotify.IN_MODIFY, max_watches=max_watches, cold_after=100,
+            min_interval=1, max_interval=1, reactor=self.clock)
+
+    def watched(self):
+        return sorted(c[0][0].path
+                      for c in self.inotifier.watch.call_args_list)
+
+    def polled(self):
+        return sorted(self.manager._pollers[self.root.path]._schedule)
+
+    def touchDir(self, d):
+        st = os.stat(d.path)
+        os.utime(d.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+
+    def test_manage(self):
+        watching = watches.WATCHES._unlabelled.value
+        self.manager.manage(self.index)
+        self.assertEqual(self.watched(), [self.root.path,
+                                          self.root.child('hot').path])
+        self.assertEqual(self.polled(), [
+            self.root.child('cold').path,
+            self.root.child('cold').child('colder').path])
+        self.assertEqual(watches.WATCHES._unlabelled.value, watching + 2)
+        self.assertEqual(
+            watches.POLLED_DIRECTORIES.labels(self.root.path)._fn(), 2)
+        self.addCleanup(watches.WATCHES.dec, 2)
+
+    def test_budget(self):
+        self.manager = self.makeManager(max_watches=1)
+        self.manager.manage(self.index)
+        self.assertEqual(len(self.watched()), 1)
+        self.assertEqual(len(self.polled()), 3)
+        self.addCleanup(watches.WATCHES.dec, 1)
+
+    def test_watchFails(self):
+        self.inotifier.watch.side_effect = inotify.INotifyError('ENOSPC')
+        self.manager.manage(self.index)
+        self.assertEqual(self.manager.max_watches, 0)
+        self.assertEqual(len(self.polled()), 4)
+
+    def test_promote(self):
+        self.manager.manage(self.index)
+        self.manager.start()
+        cold = self.root.child('cold')
+        cold.child('d.log').touch()
+        self.touchDir(cold)
+        self.clock.advance(1)
+        self.assertIn(cold.path, self.watched())
+        self.assertNotIn(cold.path, self.polled())
+        self.assertEqual(self.events, [(cold.child('d.log').path,
+                                        inotify.IN_CREATE)])
+        self.addCleanup(watches.WATCHES.dec, 3)
+        self.manager.stop()
+
+    def test_newDirectory(self):
+        self.manager.manage(self.index)
+        new = self.root.child('hot').child('new')
+        new.makedirs()
+        new.child('e.log').touch()
+        self.manager._notified(None, new,
+                               inotify.IN_CREATE | inotify.IN_ISDIR)
+        self.assertEqual(self.events, [(new.child('e.log').path,
+                                        inotify.IN_CREATE)])
+        self.assertIn(new.path, self.manager)
+        self.addCleanup(watches.WATCHES.dec, 3)
+
+    def test_forwarded(self):
+        log = self.root.child('a.log')
+        self.manager._notified(None, log.asBytesMode(), inotify.IN_MODIFY)
+        self.assertEqual(self.events, [(log.path, inotify.IN_MODIFY)])
+
+    def test_cold(self):
+        self.manager.manage(self.index)
+        self.manager.start()
+        hot = self.root.child('hot')
+        hot.child('b.log').remove()
+        self.touchDir(hot)
+        self.clock.pump([25] * 3)
+        self.assertIn(hot.path, self.manager)
+        self.clock.advance(25)
+        self.assertNotIn(hot.path, self.manager)
+        self.inotifier.ignore.assert_called_once_with(hot)
+        self.assertIn(hot.path, self.polled())
+        self.addCleanup(watches.WATCHES.dec, 1)
+        self.manager.stop()
+
+    def test_deleted(self):
+        self.manager.manage(self.index)
+        hot = self.root.child('hot')
+        self.manager._notified(None, hot, inotify.IN_DELETE_SELF)
+        self.assertNotIn(hot.path, self.manager)
+        self.assertEqual(self.events, [])
+        self.addCleanup(watches.WATCHES.dec, 1)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_tracing -*-
+# pylint: disable=invalid-name
+"""Per-batch latency tracing.
+
+The upload latency histogram says when batches are slow, not why. A
+:py:class:`Tracer` follows a sample of batches through every stage between
+their rows being buffered and BigQuery accepting them, and writes each as one
+JSON line to a trace file. The spans recorded are:
+
+ * ``buffered``: from the oldest row in the batch being added to the
+   uploader's buffer, until the batch was taken from it. ``newest`` gives
+   when the newest row was added.
+ * ``create_table``: creating the table, the first time it's written to.
+ * ``rate_limit``: waiting for the rate limiter.
+ * ``thread_wait``: waiting for a worker thread to run the request.
+ * ``http``: making the insertAll request, with the HTTP ``status`` (or
+   exception name) if it failed.
+ * ``retry_delay``: the service waiting to retry a failed request, with the
+   ``status`` it failed with.
+ * ``resubmit``: the uploader sending rows again, with the ``reason``
+   (``partial_failure`` or ``bisect``) and number of ``rows``.
+
+Each span has ``start`` and ``end`` times, and the ``upload_id`` it belongs
+to, which differs from the trace's for the halves of a bisected batch. The
+trace is written once every request made for the batch is complete, with
+a ``status`` of ok, or failed if any rows were written to the failed
+loglines file. A trace looks like::
+
+    {"trace": "5f0c...", "uploader": "app1", "table": "logs_20150101",
+     "rows": 250, "start": 1420070400.1, "end": 1420070401.3,
+     "duration": 1.2, "status": "ok", "spans": [
+      {"name": "buffered", "start": 1420070399.2, "end": 1420070400.1,
+       "newest": 1420070400.0, "upload_id": "5f0c..."},
+      {"name": "thread_wait", ...}, {"name": "http", ...}]}
+
+Only sampled batches are traced, batches that aren't cost a dict lookup at
+each stage.
+"""
+
+import collections
+import logging
+import random
+
+import simplejson as json
+
+
+class Trace(object):
+    """Spans recorded for one batch."""
+
+    __slots__ = ('trace_id', 'uploader', 'table', 'rows', 'start', 'spans',
+                 'pending', 'status')
+
+    def __init__(self, trace_id, uploader, table, rows, start):
+        self.trace_id = trace_id
+        self.uploader = uploader
+        self.table = table
+        self.rows = rows
+        self.start = start
+        self.spans = []
+        self.pending = set([trace_id])
+        self.status = 'ok'
+
+    def span(self, name, upload_id, start, end, **attrs):
+        """Record a span.
+
+        :param name: stage name
+        :type name: str
+        :param upload_id: upload the span belongs to
+        :type upload_id: str
+        :param start: time the stage started
+        :type start: float
+        :param end: time the stage ended
+        :type end: float
+        """
+        attrs.update(name=name, upload_id=upload_id, start=start, end=end)
+        self.spans.append(attrs)
+
+    def toJSON(self, end):
+        return {
+            'trace': self.trace_id,
+            'uploader': self.uploader,
+            'table': self.table,
+            'rows': self.rows,
+            'start': self.start,
+            'end': end,
+            'duration': end - self.start,
+            'status': self.status,
+            'spans': sorted(self.spans, key=lambda s: s['start']),
+        }
+
+
+class BufferClock(object):
+    """When rows entered a FIFO buffer.
+
+    Records the time of each addition to the buffer, rather than of each
+    row, and works out when the oldest and newest of the rows taken from the
+    front of the buffer were added.
+    """
+
+    def __init__(self):
+        self._added = collections.deque()
+        self._total = 0
+        self._taken = 0
+
+    def added(self, n, now):
+        """Record n rows being added to the end of the buffer."""
+        if n:
+            self._total += n
+            self._added.append((self._total, now))
+
+    def taken(self, n):
+        """Record n rows being taken from the front of the buffer.
+
+        :return: when the oldest and newest rows were added, or None if not
+          known
+        :rtype: tuple(float, float)
+        """
+        if not n or not self._added:
+            return None
+        first = self._taken
+        self._taken = last = min(self._taken + n, self._total)
+        oldest = newest = None
+        while self._added:
+            total, when = self._added[0]
+            if oldest is None and total > first:
+                oldest = when
+            if total >= last:
+                newest = when
+                break
+            self._added.popleft()
+        if self._taken == self._total:
+            self.clear()
+        return oldest, newest
+
+    def clear(self):
+        """Forget everything, when the buffer is emptied."""
+        self._added.clear()
+        self._total = self._taken = 0
+
+
+class Tracer(object):
+    """Samples batches, and writes their traces to a file."""
+
+    def __init__(self, path, sample_rate=0.01, seed=None, reactor=None):
+        """
+
+        :param path: path of the file to append traces to
+        :type path: str
+        :param sample_rate: fraction of batches to trace
+        :type sample_rate: float
+        :param seed: seed for sampling, for repeatable tests
+        :param reactor: twisted reactor
+        :type reactor: :twisted:`twisted.internet.reactor`
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.path = path
+        self.sample_rate = sample_rate
+        self.written = 0
+        self._random = random.Random(seed)
+        self._traces = {}
+        self._file = None
+
+    def seconds(self):
+        return self.reactor.seconds()
+
+    def begin(self, upload_id, uploader, table, rows, buffered=None):
+        """Start tracing a batch, if it's sampled.
+
+        :param upload_id: upload id of the batch
+        :type upload_id: str
+        :param uploader: name of the uploader
+        :type uploader: str
+        :param table: table the batch is for
+        :type table: str
+        :param rows: number of rows in the batch
+        :type rows: int
+        :param buffered:
+          when the oldest and newest rows were buffered, from
+          :py:meth:`BufferClock.taken`
+        :type buffered: tuple(float, float)
+        :return: the trace, or None if not sampled
+        :rtype: Trace
+        """
+        if self._random.random() >= self.sample_rate:
+            return None
+        now = self.seconds()
+        trace = Trace(upload_id, uploader, table, rows, now)
+        if buffered:
+            trace.span('buffered', upload_id, buffered[0], now,
+                       newest=buffered[1])
+        self._traces[upload_id] = trace
+        return trace
+
+    def get(self, upload_id):
+        """The trace for an upload, if it's traced.
+
+        :rtype: Trace
+        """
+        return self._traces.get(upload_id)
+
+    def span(self, upload_id, name, start, end=None, **attrs):
+        """Record a span, if the upload is traced. end defaults to now."""
+        trace = self._traces.get(upload_id)
+        if trace is not None:
+            if end is None:
+                end = self.seconds()
+            trace.span(name, upload_id, start, end, **attrs)
+
+    def child(self, upload_id, child_id):
+        """Trace child_id, a request made for upload_id, as part of the same
+        trace."""
+        trace = self._traces.get(upload_id)
+        if trace is not None:
+            trace.pending.add(child_id)
+            self._traces[child_id] = trace
+
+    def finish(self, upload_id, failed=False):
+        """Record an upload being complete.
+
+        The trace is written once all its uploads are complete.
+
+        :param upload_id: the upload
+        :type upload_id: str
+        :param failed: True if rows were written to the failed loglines file
+        :type failed: bool
+        """
+        trace = self._traces.pop(upload_id, None)
+        if trace is None:
+            return
+        if failed:
+            trace.status = 'failed'
+        trace.pending.discard(upload_id)
+        if not trace.pending:
+            self.write(trace)
+
+    def write(self, trace):
+        """Append a trace to the trace file."""
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(trace.toJSON(self.seconds())))
+            self._file.write('\n')
+            self._file.flush()
+            self.written += 1
+        except (IOError, OSError):
+            self.log.exception('Unable to write trace to %s', self.path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -6,21 +6,114 @@
 A class that implements :twisted:`twisted.internet.interfaces.IConsumer` for
 uploading logs to BigQuery.
 """
+import collections
 import datetime
+import functools
 import logging
 import time
 import uuid
+import weakref
 
 import arrow
 import pytz
 import simplejson as json
 from googleapiclient import errors as gerrors
 from twisted.internet import abstract
+from twisted.internet import defer
 from twisted.internet import interfaces
 from twisted.internet import task
+from twisted.python import failure
 from zope.interface import implementer
 
 from . import errors as lserrors
+from . import filters
+from . import metrics
+from . import profiling
+from . import tracing
+
+# arrow format strings for partition decorators, keyed by partition type.
+PARTITION_DECORATORS = {
+    'HOUR': 'YYYYMMDDHH',
+    'DAY': 'YYYYMMDD',
+    'MONTH': 'YYYYMM',
+    'YEAR': 'YYYY',
+}
+
+BUFFER_ROWS = metrics.gauge(
+    'logsnarf_buffer_rows', 'Rows buffered awaiting upload.', ['uploader'])
+PRODUCER_PAUSED = metrics.gauge(
+    'logsnarf_producer_paused', '1 if the uploader has paused its producer.',
+    ['uploader'])
+UPLOADS_IN_FLIGHT = metrics.gauge(
+    'logsnarf_uploads_in_flight', 'Uploads started and not yet complete.',
+    ['uploader'])
+UPLOAD_SECONDS = metrics.histogram(
+    'logsnarf_upload_seconds', 'Time taken to complete an upload.',
+    ['uploader'])
+UPLOADED_ROWS = metrics.counter(
+    'logsnarf_uploaded_rows', 'Rows accepted by BigQuery.', ['uploader'])
+FAILED_ROWS = metrics.counter(
+    'logsnarf_failed_rows', 'Rows written to the failed loglines file.',
+    ['uploader'])
+# insertAll row error reasons the row is sent again for, others are fatal.
+RETRY_REASONS = frozenset(['backendError', 'timeout', 'stopped'])
+# name: uploader whose gauges are labelled with that name
+_gauge_owners = weakref.WeakValueDictionary()
+
+
+@implementer(interfaces.IPushProducer)
+class ProducerGroup(object):
+    """Several producers, paused and resumed together.
+
+    Lets an uploader take lines from more than one producer, such as a
+    :py:class:`logsnarf.snarf.LogSnarf` and a
+    :py:class:`logsnarf.listener.SyslogListener`.
+    """
+
+    def __init__(self, producers=()):
+        """
+
+        :param producers: producers to start the group with
+        :type producers: list
+        """
+        self.producers = list(producers)
+        self.paused = False
+
+    def add(self, producer):
+        """Add a producer to the group, pausing it if the group is paused.
+
+        :param producer: a streaming producer
+        :type producer: :twisted:`twisted.internet.interfaces.IPushProducer`
+        """
+        self.producers.append(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+    def pauseProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method
+
+        Pause every producer in the group.
+        """
+        self.paused = True
+        for producer in self.producers:
+            producer.pauseProducing()
+
+    def resumeProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method
+
+        Resume every producer in the group.
+        """
+        self.paused = False
+        for producer in self.producers:
+            producer.resumeProducing()
+
+    def stopProducing(self):
+        """:twisted:`twisted.internet.interfaces.IPushProducer` method
+
+        Stop every producer in the group.
+        """
+        for producer in self.producers:
+            producer.stopProducing()
 
 
 # noinspection PyProtectedMember
@@ -51,7 +144,10 @@ class BigQueryUploader(abstract._ConsumerMixin):
         self.service = svc
 
         self.table_name_schema = table_name_schema
+        self._partition_table = None
+        self._partition_decorator = None
         self._batchsize = 250  # Max 500
+        self._max_bisect_requests = 32
         self._max_buffer = 1000
 
         # Not accurate, just cached so we don't call it for every line
@@ -70,10 +166,64 @@ class BigQueryUploader(abstract._ConsumerMixin):
         self.paused = False
         self.uploadq = {}
         self.max_upload_n = 30
+        self.bulk = None
+        self._bulk_threshold = None
+        self._lag = {}
+        self.tracer = None
+        self._buffer_clock = None
+        self.line_filter = None
+        # batches of loaded rows awaiting batch post-processing
+        self._batches = collections.deque()
+        self._batch_rows = 0
+        self._batch_running = False
+        self._batch_waiters = []
+        self.acks = None
+        # mark of the write in progress, and of each row being uploaded
+        self._mark = None
+        self._row_marks = {}
+        self.name = None
+        self.setName('default', gauges=False)
 
     def __update_now(self):
         self.now = arrow.now(tz=pytz.UTC)
 
+    def setName(self, name, gauges=True):
+        """Set the name this uploader's metrics are labelled with.
+
+        The buffer, paused and in flight gauges are only labelled with a
+        name once it's set, and the labels are removed once the uploader is
+        flushed.
+
+        :param name: uploader name, the app section name, which is unique
+        :type name: str
+        :param gauges: if the gauges should be labelled with the name
+        :type gauges: bool
+        """
+        self._removeGauges()
+        self.name = name
+        if gauges:
+            if _gauge_owners.get(name) is not None:
+                self.log.warning('Taking over the metrics of another '
+                                 'uploader named %s', name)
+            _gauge_owners[name] = self
+            BUFFER_ROWS.labels(name).setFunction(metrics.weakFunction(
+                self, lambda upl: len(upl._linebuffer)))
+            PRODUCER_PAUSED.labels(name).setFunction(metrics.weakFunction(
+                self, lambda upl: int(bool(upl.producerPaused))))
+            UPLOADS_IN_FLIGHT.labels(name).setFunction(metrics.weakFunction(
+                self, lambda upl: len(upl.uploadq)))
+        self._upload_seconds = UPLOAD_SECONDS.labels(name)
+        self._uploaded_rows = UPLOADED_ROWS.labels(name)
+        self._failed_rows = FAILED_ROWS.labels(name)
+
+    def _removeGauges(self):
+        """Remove the gauges labelled with our name, if they're ours."""
+        if self.name is None or _gauge_owners.get(self.name) is not self:
+            return
+        del _gauge_owners[self.name]
+        for metric in BUFFER_ROWS, PRODUCER_PAUSED, UPLOADS_IN_FLIGHT:
+            metric.remove(self.name)
+
     def setDefaultTZ(self, tz):
         """Set the default timezone
 
@@ -85,6 +235,123 @@ class BigQueryUploader(abstract._ConsumerMixin):
         else:
             self.default_tz = pytz.timezone(tz)
 
+    def setPartitionedTable(self, table, field=None, partition_type='DAY'):
+        """Send all rows to a single time-partitioned table.
+
+        This replaces the per-day tables created from the table name format.
+        If field is given, BigQuery routes rows to partitions from that field
+        and rows are sent to the bare table. Otherwise the table is partitioned
+        by ingestion time, and rows are sent with a partition decorator
+        (e.g. logs$20150101) taken from their time field.
+
+        Entries containing a 'table' field are still sent to that table.
+
+        :param table: name of the partitioned table
+        :type table: str
+        :param field: TIMESTAMP field the table is partitioned on, if any
+        :type field: str
+        :param partition_type: one of HOUR, DAY, MONTH or YEAR
+        :type partition_type: str
+        """
+        if partition_type not in PARTITION_DECORATORS:
+            raise ValueError('Unknown partition type %s' % partition_type)
+        self._partition_table = table
+        if field:
+            self._partition_decorator = None
+        else:
+            self._partition_decorator = PARTITION_DECORATORS[partition_type]
+
+    def tableFor(self, entry):
+        """Work out which table an entry should be inserted into.
+
+        :param entry: validated log entry
+        :type entry: dict
+        :return: table name, possibly including a partition decorator
+        :rtype: str
+        """
+        if 'table' in entry:
+            return entry.pop('table')
+        if self._partition_table and not self._partition_decorator:
+            return self._partition_table
+        t = entry.get('time')
+        if t:
+            t = arrow.get(t, tzinfo=self.default_tz)
+        else:
+            t = self.now
+        if self._partition_table:
+            # partitions are always in UTC
+            return '%s$%s' % (self._partition_table,
+                              t.to('UTC').format(self._partition_decorator))
+        return self.table_name_schema.format(
+            YEAR=t.year, MONTH=t.month, DAY=t.day)
+
+    def setBulkLoader(self, loader, threshold):
+        """Switch to bulk loading when the producer falls far behind.
+
+        While any file is more than threshold bytes behind, rows are spooled
+        to loader instead of being streamed with insertAll. The producer
+        reports how far behind it is through :py:meth:`~.setLag`.
+
+        :param loader: bulk loader
+        :type loader: logsnarf.bulk.BulkLoader
+        :param threshold: lag in bytes above which bulk loading is used
+        :type threshold: int
+        """
+        self.bulk = loader
+        self._bulk_threshold = threshold
+
+    def setLag(self, path, lag):
+        """Record how far behind the producer is on a file.
+
+        :param path: path of the file being read
+        :type path: str
+        :param lag: number of bytes not yet read
+        :type lag: int
+        """
+        if lag:
+            self._lag[path] = lag
+        else:
+            self._lag.pop(path, None)
+
+    @property
+    def bulkMode(self):
+        """True if rows should currently be bulk loaded."""
+        if self.bulk is None or not self._lag:
+            return False
+        return max(self._lag.values()) > self._bulk_threshold
+
+    def setTracer(self, tracer):
+        """Trace a sample of batches through the upload.
+
+        The tracer should also be given to the service, with
+        :py:meth:`logsnarf.service.BigQueryService.setTracer`.
+
+        :param tracer: tracer
+        :type tracer: logsnarf.tracing.Tracer
+        """
+        self.tracer = tracer
+        self._buffer_clock = tracing.BufferClock()
+
+    def setLineFilter(self, line_filter):
+        """Drop, sample or route lines before the schema loads them.
+
+        :param line_filter: line filter
+        :type line_filter: logsnarf.filters.LineFilter
+        """
+        self.line_filter = line_filter
+
+    def setAckTracker(self, acks):
+        """Tell acks when the rows from each write are done with.
+
+        Rows are done with once BigQuery accepts them, the bulk load spool
+        file they're in is closed and synced, or they're written to the
+        failed loglines file.
+
+        :param acks: ack tracker, shared with the producer
+        :type acks: logsnarf.acks.AckTracker
+        """
+        self.acks = acks
+
     def setBatchSize(self, n):
         """Set the number of log entries to batch in an upload.
 
@@ -98,6 +365,19 @@ class BigQueryUploader(abstract._ConsumerMixin):
             raise ValueError('Batch size can not exceed 500')
         self._batchsize = n
 
+    def setBisectLimit(self, n):
+        """Set the number of extra requests used to isolate bad rows.
+
+        When a whole batch is rejected as invalid, it's split in halves
+        recursively to find the offending rows. This bounds the number of
+        extra requests that will be made for a single batch, after which the
+        remaining rows are written to the failed loglines file.
+
+        :param n: maximum extra requests per batch
+        :type n: int
+        """
+        self._max_bisect_requests = n
+
     def setMaxBuffer(self, n):
         """Set the max buffer size for uploads.
 
@@ -136,6 +416,8 @@ class BigQueryUploader(abstract._ConsumerMixin):
         self._now_task.start(3600)
 
         self._upload_task.start(self._delay)
+        if self.bulk is not None:
+            self._trackLoads(self.bulk.recover())
         # noinspection PyUnresolvedReferences
         self.reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
         self.resumeConsuming()
@@ -143,7 +425,9 @@ class BigQueryUploader(abstract._ConsumerMixin):
     def registerProducer(self, producer, streaming):
         """:twisted:`twisted.internet.interfaces.IConsumer` method
 
-        Registers a producer with the uploader.
+        Registers a producer with the uploader. Further producers are
+        grouped with the first, in a :py:class:`ProducerGroup`. Each producer
+        must write whole lines.
 
         :param producer: a producer
         :type producer: :twisted:`twisted.internet.interfaces.IProducer`
@@ -153,6 +437,13 @@ class BigQueryUploader(abstract._ConsumerMixin):
         """
         if not streaming:
             raise NotImplementedError('Only streaming producers are supported.')
+        if self.producer is not None:
+            if not isinstance(self.producer, ProducerGroup):
+                group = ProducerGroup([self.producer])
+                group.paused = self.producer.paused
+                self.producer = group
+            self.producer.add(producer)
+            return
         super(BigQueryUploader, self).registerProducer(producer, streaming)
         self.start()
 
@@ -180,37 +471,136 @@ class BigQueryUploader(abstract._ConsumerMixin):
         :param data: text containing line separated JSON
         :type data: str
         """
+        if self.acks is not None:
+            self._mark = self.acks.mark()
+            try:
+                self._write(data)
+            finally:
+                self.acks.release(self._mark)
+                self._mark = None
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        """Load the lines in data, and buffer or post-process them."""
         lines = self._buf + data
         lines = lines.split('\n')
         self._buf = lines.pop()
         json_objs = []
+        line_filter = self.line_filter
         for ln in lines:
+            table = None
+            if line_filter is not None:
+                table = line_filter(ln)
+                if table is filters.DROP:
+                    continue
             try:
-                json_objs.append(self.schema.loads(ln))
+                obj = self.schema.loads(ln)
             except (ValueError, lserrors.ValidationError):
                 self.log.exception('Unable to decode line %s', ln)
-        self.addData(json_objs)
+                continue
+            if table is not None:
+                obj['table'] = table
+            json_objs.append(obj)
+        if self.schema.batchPostprocessors:
+            if json_objs:
+                self._postProcessBatch(json_objs)
+        else:
+            self.addData(json_objs)
+
+    def _postProcessBatch(self, rows):
+        """Queue a batch of loaded rows for the batch post processors.
+
+        Batches are post-processed one at a time, so that rows are added
+        in the order they were written, and rows waiting on asynchronous
+        post processors count towards the buffer size.
+
+        :param rows: rows returned by the schema
+        :type rows: list(dict)
+        """
+        self._batches.append((rows, self._mark))
+        if self._mark is not None:
+            self.acks.hold(self._mark)
+        self._batch_rows += len(rows)
+        if not self._batch_running:
+            self._nextBatch()
+        if len(self._linebuffer) + self._batch_rows >= self._max_buffer \
+                and not self.producerPaused:
+            self.pauseConsuming()
 
-    def addData(self, data):
-        """This expects valid dicts to upload."""
+    def _nextBatch(self):
+        """Post-process queued batches, until one has to be waited for."""
+        while self._batches:
+            rows, mark = self._batches.popleft()
+            try:
+                result = self.schema.postProcessBatch(rows)
+            except Exception:
+                self._batchFailed(failure.Failure(), rows, mark)
+                continue
+            if isinstance(result, defer.Deferred):
+                self._batch_running = True
+                result.addCallbacks(self._batchCB, self._batchFailed,
+                                    callbackArgs=(rows, mark),
+                                    errbackArgs=(rows, mark))
+                return
+            self._batch_rows -= len(rows)
+            self.addData(result, mark)
+            if mark is not None:
+                self.acks.release(mark)
+        waiters, self._batch_waiters = self._batch_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def _batchCB(self, result, rows, mark=None):
+        """Callback for asynchronous batch post-processing."""
+        self._batch_running = False
+        self._batch_rows -= len(rows)
+        self.addData(result, mark)
+        if mark is not None:
+            self.acks.release(mark)
+        if self.producerPaused and len(self.uploadq) < self.max_upload_n \
+                and len(self._linebuffer) + self._batch_rows < \
+                self._max_buffer:
+            self.resumeConsuming()
+        self._nextBatch()
+
+    def _batchFailed(self, fail, rows, mark=None):
+        """Save a batch the post processors failed on."""
+        self._batch_rows -= len(rows)
+        self.log.error('Batch post-processing of %d rows failed: %s',
+                       len(rows), fail.getTraceback())
+        self._deadLetter('batch', rows)
+        if mark is not None:
+            self.acks.release(mark)
+        if self._batch_running:
+            self._batch_running = False
+            self._nextBatch()
+
+    @profiling.timed('addData')
+    def addData(self, data, mark=None):
+        """This expects valid dicts to upload.
+
+        :param mark: the ack tracker mark the rows were loaded under, if not
+          the current write's
+        :type mark: int
+        """
         if isinstance(data, dict):
             data = [data]
+        if mark is None:
+            mark = self._mark
         for entry in data:
             insert_id = entry.pop('_sha1')
             if insert_id is None:
                 insert_id = uuid.uuid4().hex
-            if 'table' in entry:
-                table = entry.pop('table')
-            else:
-                t = entry.get('time')
-                if t:
-                    t = arrow.get(t, tzinfo=self.default_tz)
-                else:
-                    t = self.now
-                table = self.table_name_schema.format(
-                    YEAR=t.year, MONTH=t.month, DAY=t.day)
-            self._linebuffer.append(
-                (table, {'insertId': insert_id, 'json': entry}))
+            table = self.tableFor(entry)
+            row = {'insertId': insert_id, 'json': entry}
+            self._linebuffer.append((table, row))
+            if mark is not None:
+                self._row_marks[id(row)] = mark
+        if mark is not None:
+            self.acks.hold(mark, len(data))
+        if self._buffer_clock is not None:
+            self._buffer_clock.added(len(data), self.reactor.seconds())
         current_bufsize = len(self._linebuffer)
         if current_bufsize >= self._batchsize:
             self.upload()
@@ -218,15 +608,29 @@ class BigQueryUploader(abstract._ConsumerMixin):
             self.pauseConsuming()
 
     def flush(self):
-        """Flush our buffer."""
+        """Flush our buffer.
+
+        :return: if rows are still being post-processed, a Deferred that
+          fires once they have been, and the buffer flushed
+        :rtype: :twisted:`twisted.internet.defer.Deferred` or None
+        """
         self.pauseConsuming()
         self.disconnecting = True
+        if self._batches or self._batch_running:
+            d = defer.Deferred()
+            d.addCallback(lambda _: self.flush())
+            self._batch_waiters.append(d)
+            return d
         self.log.debug('Flushing buffer to bigquery')
         while self._linebuffer:
             self.log.debug('Calling upload(flush=True)')
             self.upload(flush=True)
+        if self.bulk is not None:
+            self.bulk.close()
+        self._removeGauges()
         self.disconnected = True
 
+    @profiling.timed('upload')
     def upload(self, flush=False):
         """Potentially insert some table data.
 
@@ -238,8 +642,18 @@ class BigQueryUploader(abstract._ConsumerMixin):
             self.log.debug('upload called while paused')
             return
 
+        if self.bulk is not None:
+            if self.bulkMode:
+                self._bulkUpload(flush)
+                return
+            if not flush:
+                self._trackLoads(self.bulk.rotateExpired())
+
         loglines = self._linebuffer[:self._batchsize]
         self._linebuffer = self._linebuffer[self._batchsize:]
+        buffered = None
+        if self._buffer_clock is not None:
+            buffered = self._buffer_clock.taken(len(loglines))
         if not flush and len(self._linebuffer) < self._max_buffer and \
                 self.producer.paused:
             self.resumeConsuming()
@@ -256,6 +670,9 @@ class BigQueryUploader(abstract._ConsumerMixin):
                 self._uploadCB(result, upload_id, table, by_table[table],
                                synchronous=True)
             else:
+                if self.tracer is not None:
+                    self.tracer.begin(upload_id, self.name, table,
+                                      len(by_table[table]), buffered)
                 result = self.service.insertAll(
                     table, self.schema.schema, by_table[table], upload_id)
                 result.addCallback(
@@ -265,21 +682,130 @@ class BigQueryUploader(abstract._ConsumerMixin):
                 if len(self.uploadq) > self.max_upload_n and not self.paused:
                     self.pauseConsuming()
 
-    def _errback(self, failure, upload_id, _table, data):
-        logging.error(failure)
-        if failure.check(gerrors.HttpError):
-            if failure.value.status == 503:
-                self.log.info('Retrying upload id %s', upload_id)
-                table = data[0]
-                d = self.service.insertAll(
-                    table, self.schema.schema, data, upload_id)
-                d.addCallback(self._uploadCB, upload_id, table, data)
-                d.addErrback(self._errback, upload_id, table, data)
-                return d
+    def _bulkUpload(self, flush=False):
+        """Spool our whole buffer to the bulk loader.
+
+        :param flush: if this is part of flushing our buffer
+        :type flush: bool
+        """
+        loglines = self._linebuffer
+        self._linebuffer = []
+        if self._buffer_clock is not None:
+            self._buffer_clock.clear()
+        by_table = {}
+        for table, l in loglines:
+            by_table.setdefault(table, []).append(l)
+        for table in by_table:
+            rows = by_table[table]
+            # acked once their spool file is closed and synced
+            loads = self.bulk.write(table, rows,
+                                    functools.partial(self._ack, rows))
+            if not flush:
+                self._trackLoads(loads)
+        if not flush and self.producer and self.producer.paused and \
+                len(self.uploadq) < self.max_upload_n:
+            self.resumeConsuming()
+
+    def _trackLoads(self, loads):
+        """Count bulk load jobs as uploads in flight.
+
+        :param loads: upload_id, deferred pairs from the bulk loader
+        :type loads: list(tuple)
+        """
+        for upload_id, d in loads:
+            self.uploadq[upload_id] = time.time()
+            d.addBoth(self._loadDone, upload_id)
+        if len(self.uploadq) > self.max_upload_n and not self.paused:
+            self.pauseConsuming()
+
+    def _loadDone(self, result, upload_id):
+        time_taken = time.time() - self.uploadq.pop(upload_id, time.time())
+        if isinstance(result, failure.Failure):
+            self.log.error('Load %s failed after %f seconds: %s', upload_id,
+                           time_taken, result.getErrorMessage())
+        else:
+            self.log.info('Load %s complete, and took %f seconds', upload_id,
+                          time_taken)
+        if len(self.uploadq) < self.max_upload_n:
+            self.resumeConsuming()
+
+    def _errback(self, fail, upload_id, table, data, bisect=None):
+        """Errback for whole-request upload failures.
+
+        Retryable errors have already been retried by the service, until it
+        gave up, so those rows are dead-lettered like any others. If the
+        request was rejected as invalid (400), the batch is split in halves
+        and each half sent again, recursively, so that only the offending rows
+        end up in the failed loglines file. The extra requests made for one
+        batch are bounded by :py:meth:`~.setBisectLimit`.
+
+        :param fail: the failure
+        :type fail: :twisted:`twisted.python.failure.Failure`
+        :param upload_id: internal unique identifier for the upload
+        :type upload_id: str
+        :param table: BigQuery table name
+        :type table: str
+        :param data: the rows passed to the insertAll call
+        :type data: list(dict)
+        :param bisect: bisection state shared by the halves of a batch
+        :type bisect: dict
+        """
+        logging.error(fail)
+        if fail.check(gerrors.HttpError):
+            status = int(fail.value.resp.status)
+            if status == 400 and len(data) > 1:
+                if bisect is None:
+                    bisect = {'requests': 0}
+                if bisect['requests'] + 2 <= self._max_bisect_requests:
+                    return self._bisect(upload_id, table, data, bisect)
+                self.log.error('Bisect limit reached for upload id %s',
+                               upload_id)
 
         logging.error('Removing failed upload from queue %s', upload_id)
-        if upload_id in self.uploadq:
-            del self.uploadq[upload_id]
+        self.uploadq.pop(upload_id, None)
+        self._deadLetter(upload_id, data)
+        self._ack(data)
+        if self.tracer is not None:
+            self.tracer.finish(upload_id, failed=True)
+        if len(self.uploadq) < self.max_upload_n:
+            self.resumeConsuming()
+
+    def _bisect(self, upload_id, table, data, bisect):
+        """Send each half of a rejected batch as its own upload.
+
+        :return: a deferred that fires when both halves are done
+        :rtype: :twisted:`twisted.internet.defer.Deferred`
+        """
+        self.uploadq.pop(upload_id, None)
+        half = len(data) // 2
+        self.log.info('Upload id %s of %d rows rejected, retrying as two '
+                      'halves', upload_id, len(data))
+        ds = []
+        for part in data[:half], data[half:]:
+            bisect['requests'] += 1
+            part_id = '%s-%d' % (upload_id, bisect['requests'])
+            self.uploadq[part_id] = time.time()
+            if self.tracer is not None:
+                self.tracer.child(upload_id, part_id)
+                self._traceResubmit(part_id, 'bisect', len(part))
+            d = self.service.insertAll(
+                table, self.schema.schema, part, part_id)
+            d.addCallback(self._uploadCB, part_id, table, part)
+            d.addErrback(self._errback, part_id, table, part, bisect)
+            ds.append(d)
+        if self.tracer is not None:
+            self.tracer.finish(upload_id)
+        return defer.gatherResults(ds)
+
+    def _traceResubmit(self, upload_id, reason, rows):
+        if self.tracer is not None:
+            now = self.reactor.seconds()
+            self.tracer.span(upload_id, 'resubmit', now, now, reason=reason,
+                             rows=rows)
+
+    def _deadLetter(self, upload_id, data):
+        """Save rows that couldn't be uploaded to the failed loglines file."""
+        self._failed_rows.inc(len(data))
         try:
             from logsnarf import config
 
@@ -293,6 +819,19 @@ class BigQueryUploader(abstract._ConsumerMixin):
         except (ValueError, IOError):
             self.log.error('Failed saving failed loglines to file')
 
+    def _ack(self, rows):
+        """Release the ack tracker marks of rows that are done with."""
+        if self.acks is None:
+            return
+        counts = collections.Counter()
+        pop = self._row_marks.pop
+        for row in rows:
+            mark = pop(id(row), None)
+            if mark is not None:
+                counts[mark] += 1
+        for mark in sorted(counts):
+            self.acks.release(mark, counts[mark])
+
     def _uploadCB(self, result, upload_id, table, data, synchronous=False):
         """Callback handler for the upload to BigQuery.
         Here we need to handle any partial failures, by re-queueing the
@@ -320,42 +859,66 @@ class BigQueryUploader(abstract._ConsumerMixin):
         self.log.info('Upload callback for upload id %s called', upload_id)
 
         if result.get('insertErrors', None):
+            self._uploaded_rows.inc(len(data) - len(
+                set(e['index'] for e in result['insertErrors'])))
             retry_lines = []
+            failed_lines = []
             for insert_error in result['insertErrors']:
                 index = insert_error['index']
-                for e in insert_error['errors']:
-                    if e['reason'] in ['backendError', 'timeout']:
-                        if index > len(data):
-                            self.log.error('Given an index %d out of our data '
-                                           'range %d, the error was %r', index,
-                                           len(data), e)
-                        else:
-                            self.log.error(
-                                "%s : %s", e, data[index]['json'])
-                            retry_lines.append(data[index])
-                    if e['reason'] == 'invalid':
-                        self.log.error(
-                            'Fatal insert error: %s for line %s removing from '
-                            'batch for retry', e, data[index])
+                if index >= len(data):
+                    self.log.error('Given an index %d out of our data range '
+                                   '%d, the errors were %r', index, len(data),
+                                   insert_error['errors'])
+                    continue
+                reasons = set(e['reason'] for e in insert_error['errors'])
+                if reasons <= RETRY_REASONS:
+                    # stopped rows were valid, but not inserted because of
+                    # invalid rows in the same request
+                    self.log.error('%s : %s', insert_error['errors'],
+                                   data[index]['json'])
+                    retry_lines.append(data[index])
+                else:
+                    self.log.error(
+                        'Fatal insert error: %s for line %s, writing it to '
+                        'the failed loglines file', insert_error['errors'],
+                        data[index])
+                    failed_lines.append(data[index])
             self.log.info('Retrying %s lines from upload %s', len(retry_lines),
                           upload_id)
+            if failed_lines:
+                self._deadLetter(upload_id, failed_lines)
+            retrying = set(id(row) for row in retry_lines)
+            self._ack([row for row in data if id(row) not in retrying])
+            if not retry_lines:
+                return self._uploadCB({}, upload_id, table, [],
+                                      synchronous=synchronous)
             if synchronous:
                 self.log.warning('Adding %d lines from upload %s back into '
                                  'the queue. They will get a new upload_id',
                                  len(retry_lines), upload_id)
                 self._linebuffer.extend([(table, line) for line in retry_lines])
+                if self._buffer_clock is not None:
+                    self._buffer_clock.added(len(retry_lines),
+                                             self.reactor.seconds())
                 return
             else:
+                self._traceResubmit(upload_id, 'partial_failure',
+                                    len(retry_lines))
                 d = self.service.insertAll(
                     table, self.schema.schema, retry_lines, upload_id)
                 d.addCallback(self._uploadCB, upload_id, table, retry_lines)
                 d.addErrback(self._errback, upload_id, table, retry_lines)
                 return d
 
+        self._uploaded_rows.inc(len(data))
+        self._ack(data)
         if upload_id in self.uploadq:
             time_taken = time.time() - self.uploadq.pop(upload_id, 0)
+            self._upload_seconds.observe(time_taken)
         else:
             time_taken = -1.0
+        if self.tracer is not None:
+            self.tracer.finish(upload_id)
         if len(self.uploadq) < self.max_upload_n:
             self.resumeConsuming()
         self.log.info('Upload %s complete, and took %f seconds', upload_id,
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# -*- test-case-name: logsnarf.test.test_watches -*-
+# pylint: disable=invalid-name
+"""Placing inotify watches.
+
+Watching a tree recursively with inotify takes a watch for every directory
+in it, and on trees of tens of thousands of directories that runs into the
+``fs.inotify.max_user_watches`` limit, and adding them all takes minutes.
+Most of those directories rarely, if ever, have log files in them.
+
+A :py:class:`WatchManager` watches only the directories that have files
+matching the pattern in them, up to a budget of ``max_watches`` across
+every watched tree. The other directories are polled, with a
+:py:class:`logsnarf.poller.Poller`, which backs off to polling quiet
+directories every ``poll_max_interval`` seconds. When a poll finds log
+files in a directory it's given a watch, if the budget allows, and a
+watched directory that has had no log files in it for ``cold_after``
+seconds goes back to being polled. New directories start out polled.
+
+If the kernel refuses a watch before the budget is reached, the budget is
+lowered to the number of watches held.
+"""
+
+import logging
+import os
+import time
+
+from twisted.internet import inotify
+from twisted.internet import task
+from twisted.python import filepath
+
+from . import metrics
+from . import poller
+
+WATCHES = metrics.gauge('logsnarf_inotify_watches',
+                        'Directories watched with inotify.')
+POLLED_DIRECTORIES = metrics.gauge(
+    'logsnarf_polled_directories',
+    'Directories polled for want of an inotify watch.', ['root'])
+WATCH_SETUP_SECONDS = metrics.histogram(
+    'logsnarf_watch_setup_seconds',
+    'Seconds spent placing watches on a tree of directories.')
+
+
+class WatchManager(object):
+    """Decides which directories get inotify watches, and polls the rest."""
+
+    def __init__(self, inotifier, callback, mask, max_watches=8192,
+                 cold_after=3600, min_interval=1.0, max_interval=30.0,
+                 reactor=None):
+        """
+
+        :param inotifier: where to add watches
+        :type inotifier: :twisted:`twisted.internet.inotify.INotify`
+        :param callback: inotify callback, for events for files
+        :type callback: callable
+        :param mask: the inotify events to watch for
+        :type mask: int
+        :param max_watches: the most directories to watch
+        :type max_watches: int
+        :param cold_after: seconds a watched directory can go without log
+          files before it's polled instead
+        :type cold_after: float
+        :param min_interval: seconds between polls of an active directory
+        :type min_interval: float
+        :param max_interval: seconds between polls of a quiet directory
+        :type max_interval: float
+        """
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.inotifier = inotifier
+        self.callback = callback
+        self.mask = mask
+        self.max_watches = max_watches
+        self.cold_after = cold_after
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.paused = True
+        # watched directory: [index, last time it had log files]
+        self._watched = {}
+        # index root: Poller
+        self._pollers = {}
+        self._sweeper = task.LoopingCall(self.sweep)
+        self._sweeper.clock = self.reactor
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __contains__(self, d):
+        return d in self._watched
+
+    def manage(self, index):
+        """Watch the directories in an index.
+
+        :param index: the directories to watch
+        :type index: logsnarf.dirindex.DirectoryIndex
+        """
+        start = time.perf_counter()
+        p = self._pollers.get(index.root)
+        if p is None:
+            p = self._pollers[index.root] = poller.Poller(
+                index, lambda path, mask: self._polled(index, path, mask),
+                self.min_interval, self.max_interval, reactor=self.reactor,
+                recursive=False)
+            POLLED_DIRECTORIES.labels(index.root).setFunction(
+                lambda p=p: len(p))
+            if not self.paused:
+                p.start()
+        index.refresh()
+        watched = polled = 0
+        for d in index.directories():
+            listing = index.directory(d)
+            if listing is None:
+                continue
+            if listing[0] and self._watch(d, index):
+                watched += 1
+            else:
+                p.add(d)
+                polled += 1
+        elapsed = time.perf_counter() - start
+        WATCH_SETUP_SECONDS.observe(elapsed)
+        self.log.info('Watching %d directories and polling %d in %s, '
+                      'in %.2fs', watched, polled, index.root, elapsed)
+
+    def start(self):
+        """Start polling, and checking watched directories for log files."""
+        self.paused = False
+        for p in self._pollers.values():
+            p.start()
+        if not self._sweeper.running:
+            self._sweeper.start(max(self.cold_after / 4.0, 1), now=False)
+
+    def stop(self):
+        """Stop polling."""
+        self.paused = True
+        for p in self._pollers.values():
+            p.stop()
+        if self._sweeper.running:
+            self._sweeper.stop()
+
+    def pauseProducing(self):
+        for p in self._pollers.values():
+            p.pauseProducing()
+
+    def resumeProducing(self):
+        for p in self._pollers.values():
+            p.resumeProducing()
+
+    def sweep(self):
+        """Poll the watched directories that have gone cold."""
+        now = self.reactor.seconds()
+        for d, entry in list(self._watched.items()):
+            index, last = entry
+            listing = index.directory(d)
+            if listing is None:
+                # gone without our hearing of it
+                self._unwatch(d)
+            elif listing[0]:
+                entry[1] = now
+            elif now - last >= self.cold_after:
+                self.log.debug('%s has had no log files for %ds, polling it',
+                               d, now - last)
+                self._unwatch(d)
+                self._pollers[index.root].add(d)
+
+    def _watch(self, d, index):
+        """Watch a directory, if the budget allows.
+
+        :return: True if it's watched
+        :rtype: bool
+        """
+        if d in self._watched:
+            return True
+        if len(self._watched) >= self.max_watches:
+            return False
+        try:
+            self.inotifier.watch(filepath.FilePath(d), mask=self.mask,
+                                 callbacks=[self._notified])
+        except (inotify.INotifyError, OSError) as e:
+            self.log.warning('Unable to watch %s, polling it instead, and '
+                             'limiting watches to the %d held: %s',
+                             d, len(self._watched), e)
+            self.max_watches = len(self._watched)
+            return False
+        self._watched[d] = [index, self.reactor.seconds()]
+        WATCHES.inc()
+        return True
+
+    def _unwatch(self, d):
+        """Remove the watch on a directory."""
+        if self._watched.pop(d, None) is None:
+            return
+        WATCHES.dec()
+        try:
+            self.inotifier.ignore(filepath.FilePath(d))
+        except KeyError:
+            pass
+
+    def _newDirectory(self, d, index):
+        """Poll a new directory, reporting the files already in it."""
+        if index.recursive:
+            self._pollers[index.root].add(d, report=True)
+
+    def _notified(self, ignored, path, mask):
+        """The callback given to :twisted:`twisted.internet.inotify.INotify`
+        """
+        if isinstance(path.path, bytes):
+            path = path.asTextMode()
+        if mask & inotify.IN_DELETE_SELF:
+            # INotify removes the watch
+            if self._watched.pop(path.path, None) is not None:
+                WATCHES.dec()
+            return
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                entry = self._watched.get(os.path.dirname(path.path))
+                if entry is not None:
+                    self._newDirectory(path.path, entry[0])
+            return
+        self.callback(ignored, path, mask)
+
+    def _polled(self, index, path, mask):
+        """The callback given to :py:class:`logsnarf.poller.Poller`"""
+        if mask & inotify.IN_ISDIR:
+            self._newDirectory(path, index)
+            return
+        if mask & (inotify.IN_CREATE | inotify.IN_MODIFY |
+                   inotify.IN_MOVED_TO):
+            d = os.path.dirname(path)
+            p = self._pollers[index.root]
+            if d in p and self._watch(d, index):
+                p.remove(d)
+        self.callback(None, filepath.FilePath(path), mask)